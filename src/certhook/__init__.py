@@ -2,11 +2,26 @@
 A Python package for managing Let's Encrypt SSL certificates for various applications.
 """
 
-from .base import BaseCertManager
-from .unifi import UnifiCertManager
-from .pihole import PiHoleCertManager
-from .emby import EmbyCertManager
-from .freepbx import FreePBXCertManager
+import importlib
 
 __version__ = "0.1.0"
 __all__ = ["BaseCertManager", "UnifiCertManager", "PiHoleCertManager", "EmbyCertManager", "FreePBXCertManager"]
+
+# Modules of the exported classes, imported on first access
+_MODULES = {
+    "BaseCertManager": "base",
+    "UnifiCertManager": "unifi",
+    "PiHoleCertManager": "pihole",
+    "EmbyCertManager": "emby",
+    "FreePBXCertManager": "freepbx",
+}
+
+
+def __getattr__(name: str):
+    if name in _MODULES:
+        return getattr(importlib.import_module(f".{_MODULES[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,146 @@
+"""
+Module for caching the files deployments convert certificates into.
+
+Converted files (PKCS#12 bundles, combined PEM files) are stored under a
+digest of everything they're made from: the contents of their input files,
+their format and the conversion's parameters (e.g. the PKCS#12 password).
+Every deployment needing the same file, whatever its app or host, is given
+a copy of a single conversion until the certificate is renewed.
+
+Entries are converted once even when several processes need them at the
+same time, and the least recently used entries are removed once the cache
+holds more than ``max_entries`` files or ``max_bytes`` bytes. Entries hold
+private keys, so the cache is only readable by its owner.
+"""
+
+import errno
+import functools
+import hashlib
+import json
+import os
+from typing import List, Optional, Tuple
+
+from .locks import FileLock
+from .ops import Artifact, write_atomic
+from .transport import file_digest
+
+DEFAULT_CACHE_DIR = '/var/cache/certhook/artifacts'
+# Limits of the cache before the least recently used entries are removed
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class ArtifactCache:
+    """
+    Converted files, kept in a directory under the digest of what they're made from.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_DIR, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Args:
+            path: Directory holding the entries
+            max_entries: Number of entries kept
+            max_bytes: Total size of the entries kept
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Number of files served from the cache, and converted, by this instance
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, artifact: Artifact) -> str:
+        """
+        Digest identifying a file by what it's made from.
+
+        Raises:
+            FileNotFoundError: If one of the artifact's inputs is missing
+        """
+        digests = []
+        for path in artifact.inputs:
+            digest = file_digest(path)
+            if digest is None:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            digests.append(digest)
+        description = json.dumps({'format': artifact.format, 'inputs': digests, 'params': artifact.params},
+                                 sort_keys=True)
+        return hashlib.sha256(description.encode('UTF-8')).hexdigest()
+
+    def entry(self, key: str) -> str:
+        """Path of an entry"""
+        return os.path.join(self.path, key)
+
+    def fetch(self, artifact: Artifact) -> bytes:
+        """
+        Contents of a file, converted only if it isn't cached yet.
+
+        Args:
+            artifact: Description of the file
+
+        Returns:
+            The file's contents
+        """
+        key = self.key(artifact)
+        data = self._read(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        # Another process may be converting the same file, wait for it rather than repeat it
+        with FileLock(f'artifact:{key}'):
+            data = self._read(key)
+            if data is not None:
+                self.hits += 1
+                return data
+            data = artifact.render()
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            write_atomic(self.entry(key), data)
+        self.misses += 1
+        self.evict()
+        return data
+
+    def _read(self, key: str) -> Optional[bytes]:
+        """Contents of an entry, marking it as used, None if it isn't cached"""
+        try:
+            with open(self.entry(key), 'rb') as f:
+                data = f.read()
+            os.utime(self.entry(key))
+        except FileNotFoundError:
+            return None
+        return data
+
+    def entries(self) -> List[Tuple[int, int, str]]:
+        """(last used, size, path) of every entry, least recently used first"""
+        found = []
+        try:
+            with os.scandir(self.path) as scan:
+                for item in scan:
+                    # Skipping files still being written
+                    if item.name.startswith('.') or not item.is_file(follow_symlinks=False):
+                        continue
+                    try:
+                        st = item.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    found.append((st.st_mtime_ns, st.st_size, item.path))
+        except FileNotFoundError:
+            return []
+        return sorted(found)
+
+    def evict(self) -> None:
+        """Remove the least recently used entries while the cache is over its limits"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            _, size, path = entries.pop(0)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+@functools.lru_cache(maxsize=None)
+def shared(path: str) -> ArtifactCache:
+    """Cache of a directory, shared by every manager in this process"""
+    return ArtifactCache(path)
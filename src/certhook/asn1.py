@@ -0,0 +1,182 @@
+"""
+Minimal DER encoding/decoding and PEM handling for the certificate formats certhook builds.
+"""
+
+import base64
+import re
+from typing import List, Tuple
+
+# Universal tags
+INTEGER = 0x02
+BIT_STRING = 0x03
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_IDENTIFIER = 0x06
+UTF8_STRING = 0x0C
+PRINTABLE_STRING = 0x13
+IA5_STRING = 0x16
+UTC_TIME = 0x17
+GENERALIZED_TIME = 0x18
+BMP_STRING = 0x1E
+SEQUENCE = 0x30
+SET = 0x31
+
+_PEM_RE = re.compile(rb'-----BEGIN ([A-Z0-9 ]+)-----\r?\n(.*?)-----END \1-----', re.DOTALL)
+
+
+def encode_length(length: int) -> bytes:
+    """DER length octets for a content length"""
+    if length < 0x80:
+        return bytes([length])
+    octets = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(octets)]) + octets
+
+
+def tlv(tag: int, content: bytes) -> bytes:
+    """Encode a single tag-length-value element"""
+    return bytes([tag]) + encode_length(len(content)) + content
+
+
+def sequence(*items: bytes) -> bytes:
+    """Encode a SEQUENCE of already encoded elements"""
+    return tlv(SEQUENCE, b''.join(items))
+
+
+def set_of(*items: bytes) -> bytes:
+    """Encode a SET OF already encoded elements, in DER order"""
+    return tlv(SET, b''.join(sorted(items)))
+
+
+def integer(value: int) -> bytes:
+    """Encode an INTEGER"""
+    magnitude = value if value >= 0 else -value - 1
+    return tlv(INTEGER, value.to_bytes(magnitude.bit_length() // 8 + 1, 'big', signed=True))
+
+
+def octet_string(value: bytes) -> bytes:
+    """Encode an OCTET STRING"""
+    return tlv(OCTET_STRING, value)
+
+
+def null() -> bytes:
+    """Encode a NULL"""
+    return tlv(NULL, b'')
+
+
+def bmp_string(value: str) -> bytes:
+    """Encode a BMPString"""
+    return tlv(BMP_STRING, value.encode('utf-16-be'))
+
+
+def oid(dotted: str) -> bytes:
+    """Encode an OBJECT IDENTIFIER from its dotted form"""
+    arcs = [int(arc) for arc in dotted.split('.')]
+    body = bytearray([arcs[0] * 40 + arcs[1]])
+    for arc in arcs[2:]:
+        chunk = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7F))
+            arc >>= 7
+        body.extend(reversed(chunk))
+    return tlv(OBJECT_IDENTIFIER, bytes(body))
+
+
+def explicit(number: int, content: bytes) -> bytes:
+    """Wrap an encoded element in a constructed context-specific tag"""
+    return tlv(0xA0 | number, content)
+
+
+def algorithm(dotted: str, parameters: bytes = None) -> bytes:
+    """Encode an AlgorithmIdentifier"""
+    return sequence(oid(dotted), null() if parameters is None else parameters)
+
+
+def decode(data: bytes, offset: int = 0) -> Tuple[int, bytes, int]:
+    """
+    Decode one element.
+
+    Args:
+        data: DER encoded data
+        offset: Position of the element's tag
+
+    Returns:
+        Tuple of (tag, content, offset of the following element)
+
+    Raises:
+        ValueError: If the data is truncated or uses an unsupported encoding
+    """
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+    except IndexError:
+        raise ValueError('Truncated DER element') from None
+    offset += 2
+    if tag & 0x1F == 0x1F:
+        raise ValueError('High tag numbers are not supported')
+    if length & 0x80:
+        count = length & 0x7F
+        if count == 0:
+            raise ValueError('Indefinite lengths are not supported')
+        length = int.from_bytes(data[offset:offset + count], 'big')
+        offset += count
+    end = offset + length
+    if end > len(data):
+        raise ValueError('Truncated DER element')
+    return tag, data[offset:end], end
+
+
+def decode_all(data: bytes) -> List[Tuple[int, bytes]]:
+    """
+    Decode every element in a run of concatenated elements, such as
+    the content of a SEQUENCE.
+
+    Returns:
+        List of (tag, content) tuples
+    """
+    items = []
+    offset = 0
+    while offset < len(data):
+        tag, content, offset = decode(data, offset)
+        items.append((tag, content))
+    return items
+
+
+def decode_oid(content: bytes) -> str:
+    """Dotted form of an OBJECT IDENTIFIER's content"""
+    arcs = []
+    value = 0
+    for byte in content:
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(value)
+            value = 0
+    first = min(arcs[0] // 40, 2)
+    return '.'.join(str(arc) for arc in [first, arcs[0] - first * 40] + arcs[1:])
+
+
+def decode_integer(content: bytes) -> int:
+    """Value of an INTEGER's content"""
+    return int.from_bytes(content, 'big', signed=True)
+
+
+def pem_blocks(data: bytes) -> List[Tuple[str, bytes]]:
+    """
+    Extract every PEM block from a file's contents.
+
+    Args:
+        data: Contents of a PEM file
+
+    Returns:
+        List of (label, DER bytes) tuples in file order
+    """
+    return [(label.decode('ascii'), base64.b64decode(b''.join(body.split())))
+            for label, body in _PEM_RE.findall(data)]
+
+
+def pem_encode(label: str, der: bytes) -> bytes:
+    """Encode DER bytes as a PEM block"""
+    body = base64.b64encode(der)
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return (f'-----BEGIN {label}-----\n'.encode('ascii') + b'\n'.join(lines) +
+            f'\n-----END {label}-----\n'.encode('ascii'))
@@ -2,59 +2,341 @@
 Base module for certificate managers.
 """
 
+import copy
+import itertools
+import logging
+import os
 import subprocess
-from typing import List
+import time
+from typing import Dict, List, Optional, Tuple, Union
+from .artifacts import ArtifactCache
+from .deadlines import RETRYABLE, Deadline, retry_delay
+from .metrics import Recorder, measure, step_name
+from .ops import Operation, UnsupportedOperation
+from .output import DEFAULT_LIMIT, CommandLog
+from .pipeline import Pipeline
+from .probes import Probe
+from .services import Restart, RestartCoordinator
+from .steps import Step, execute
+from .transport import LOCAL, Transport
+
+logger = logging.getLogger(__name__)
 
 class BaseCertManager:
     """
     Base class for certificate managers that provides common functionality
     for managing SSL certificates.
     """
+    # Directory holding the Let's Encrypt certificate lineages
+    live_root = '/etc/letsencrypt/live'
+    # Maximum number of independent steps to run at once
+    max_parallel = 4
+    # Paths to run external programs from, keyed by program name, overriding
+    # the paths commands are written with (e.g. {'keytool': '/opt/java/bin/keytool'})
+    programs: Dict[str, str] = {}
+    # Probes telling when each restarted service is serving again, keyed by service
+    probes: Dict[str, Probe] = {}
+    # Seconds a restarted service has to pass its probe
+    readiness_deadline = 60.0
+    # (host, port) of every TLS endpoint serving the certificate once deployed
+    endpoints: List[Tuple[str, int]] = []
+    # Bytes of each command's output and errors kept for error reports
+    output_limit = DEFAULT_LIMIT
+    # Seconds any one command may run before it's terminated, None for no limit
+    step_timeout: Optional[float] = None
+    # Times a failed or timed out idempotent step is retried
+    retries = 2
+    # Base of the jittered exponential backoff between retries, in seconds
+    retry_delay = 1.0
 
-    def __init__(self, cert_name: str, verbose: bool = False):
+    def __init__(self, cert_name: str, verbose: bool = False, native: bool = True,
+                 wait_ready: bool = False):
         """
         Set up the base variables.
 
         Args:
             cert_name: Name of the certificate
-            verbose: Whether to print verbose output
+            verbose: Whether to log verbose output
+            native: Whether to run operations in-process rather than via
+                    their equivalent external commands (e.g. openssl)
+            wait_ready: Whether to wait for restarted services to pass their
+                        probes, failing the deployment if they don't
         """
         self.verbose = verbose
+        self.native = native
+        self.wait_ready = wait_ready
         self.cert_name = cert_name
-        # Variable to hold all the commands
-        self.cmds: List[list] = []
+        self.cert_dir = f'{self.live_root}/{cert_name}'
+        # Shared coordinator that defers restarts until a whole batch is
+        # deployed, None to restart at the end of this manager's own run
+        self.restart_coordinator: Optional[RestartCoordinator] = None
+        # Recorder measuring every step run, None to not measure
+        self.metrics: Optional[Recorder] = None
+        # Host the certificate is deployed to
+        self.transport: Transport = LOCAL
+        # Deadline of the whole run, shared with the other managers in it
+        self.deadline: Optional[Deadline] = None
+        # Cache of converted files shared with other deployments, None to always convert
+        self.artifact_cache: Optional[ArtifactCache] = None
+        # Variable to hold all the commands, pipelines and operations,
+        # optionally wrapped in Steps to declare what they depend on, and
+        # the services to restart once they've all run
+        self.cmds: List[Union[list, Pipeline, Operation, Step, Restart]] = []
         self.cert_cmds()
 
     def __call__(self) -> None:
         """
-        Execute all the commands.
+        Execute all the commands, overlapping steps that don't depend on each other,
+        then restart the services.
         """
-        if self.verbose:
-            print(f'Processing certificate {self.cert_name}')
-        for cmd in self.cmds:
-            self.run(cmd)
+        self.log_verbose('Processing certificate %s', self.cert_name)
+        self.upload()
+        execute([cmd for cmd in self.cmds if not isinstance(cmd, Restart)], self.run, self.max_parallel)
+        self.restart(*[cmd for cmd in self.cmds if isinstance(cmd, Restart)])
+
+    def restart(self, *restarts: Restart) -> None:
+        """
+        Restart services, or leave them to the shared restart coordinator.
+
+        Without a shared coordinator the restarts are still coalesced and
+        ordered, and the first failure is raised once all have been tried.
+
+        Args:
+            restarts: Services to restart
+        """
+        coordinator = self.restart_coordinator or RestartCoordinator(host=self.transport.host)
+        for restart in restarts:
+            coordinator.request(self.gated(restart), self.run, self)
+        if self.restart_coordinator is None:
+            outcomes = coordinator.flush()
+            self.report_outages(coordinator)
+            for _, error in coordinator.failures(outcomes):
+                raise error
 
-    def run(self, cmd: list) -> subprocess.CompletedProcess:
+    def gated(self, restart: Restart) -> Restart:
+        """
+        Restart waiting on the service's probe, when waiting for services is enabled.
+        """
+        probe = self.probes.get(restart.service)
+        if not self.wait_ready or probe is None or restart.probe is not None:
+            return restart
+        if not self.transport.local:
+            # Probe the deployed host rather than this one
+            probe = copy.copy(probe)
+            probe.host = self.transport.resolve(probe.host)
+        return Restart(restart.service, restart.via, probe, self.readiness_deadline)
+
+    def upload(self) -> None:
+        """
+        Copy the certificate files to the host when deploying to another one.
+        """
+        if self.transport.local:
+            return
+        for path in self.inputs:
+            self.log_verbose('uploading %s to %s', path, self.transport.host)
+            self.transport.put(path)
+
+    def report_outages(self, coordinator: RestartCoordinator) -> None:
+        """
+        Log how long each restarted service was out when verbose is enabled.
+        """
+        for service, seconds in sorted(coordinator.outages.items()):
+            self.log_verbose('%s ready after %.2fs', service, seconds)
+
+    def run(self, cmd: Union[list, Pipeline, Operation, Step]) -> Optional[subprocess.CompletedProcess]:
         """
         Executes the provided command using subprocess.
-        stdout/stderr only show when verbose is enabled.
+        stdout/stderr are logged a line at a time as they're written, see
+        ``command_log``.
+
+        Commands are terminated once they've run for the step's timeout or
+        ``step_timeout``, or the run's deadline passes, whichever is first.
+        Steps marked idempotent are retried up to ``retries`` times if they
+        fail or time out.
+
+        Operations run in-process, unless native execution is disabled or
+        the operation can't handle its input, in which case their equivalent
+        commands are run instead. Operations without an equivalent always
+        run in-process.
+
+        When deploying to another host, commands run there and operations
+        run as their equivalent commands there; operations without an
+        equivalent are performed here and the file they write is sent over.
+
+        With an artifact cache, files converted from the certificate are
+        taken from the cache, or converted here and added to it, then
+        written to the host, so each distinct file is converted once
+        however many deployments need it.
+
+        Pipelines run their commands with each one's output streamed to
+        the next one, without intermediate files.
 
         Args:
-            cmd: Command to execute
+            cmd: Command, pipeline, operation or step to execute
 
         Returns:
-            CompletedProcess instance with execution results
+            CompletedProcess instance with execution results, None for
+            operations run in-process
+
+        Raises:
+            subprocess.TimeoutExpired: If a command ran for too long
+            DeadlineExceeded: If the run's deadline passed before the step started
+        """
+        cmd, timeout, retries = self.policy(cmd)
+        for attempt in itertools.count():
+            try:
+                return self.run_once(cmd, self.bound(timeout))
+            except RETRYABLE as e:
+                delay = retry_delay(e, attempt, retries, self.retry_delay, self.deadline)
+                if delay is None:
+                    raise
+                self.log_retry(cmd, e, delay)
+                time.sleep(delay)
+
+    def policy(self, cmd: Union[list, Pipeline, Operation, Step]) -> tuple:
+        """
+        What to run for a command list entry, its timeout and how many times to retry it.
+        """
+        if not isinstance(cmd, Step):
+            return cmd, self.step_timeout, 0
+        timeout = self.step_timeout if cmd.timeout is None else cmd.timeout
+        return cmd.action, timeout, self.retries if cmd.idempotent else 0
+
+    def bound(self, timeout: Optional[float]) -> Optional[float]:
+        """
+        Timeout for a step starting now, shortened to what's left of the run's deadline.
+        """
+        return timeout if self.deadline is None else self.deadline.bound(timeout)
+
+    def log_context(self) -> dict:
+        """Record attributes naming the deployment, as its commands' output is logged with"""
+        return {'cert': self.cert_name, 'manager': type(self).__name__, 'host': self.transport.host}
+
+    def log_verbose(self, message: str, *args) -> None:
+        """
+        Log a message about the deployment when verbose is enabled, with its
+        context, so it goes where its commands' output goes (including the
+        clients of ``certhook serve``).
         """
-        results = subprocess.run(cmd, capture_output=True, check=True)
         if self.verbose:
-            print('command: %s' % (' '.join(results.args)))
-            print('stdout: %s' % (results.stdout.decode('UTF-8')))
-            if results.stderr:
-                print('stderr: %s' % (results.stderr.decode('UTF-8')))
-        return results
+            logger.info(message, *args, extra=self.log_context())
+
+    def log_retry(self, cmd, error: BaseException, delay: float) -> None:
+        """Log that a step is to be retried"""
+        logger.warning('%s failed, retrying in %.1fs: %s', step_name(cmd), delay, error,
+                       extra=self.log_context())
+
+    def run_once(self, cmd: Union[list, Pipeline, Operation],
+                 timeout: Optional[float] = None) -> Optional[subprocess.CompletedProcess]:
+        """
+        Execute a command, pipeline or operation once, like ``run``.
+
+        Args:
+            cmd: Command, pipeline or operation to execute
+            timeout: Seconds each command may run, None for no limit;
+                     operations run in-process can't be interrupted
+
+        Returns:
+            CompletedProcess instance with execution results, None for
+            operations run in-process
+        """
+        if isinstance(cmd, Operation):
+            if self.write_artifact(cmd):
+                return None
+            if not self.transport.local and cmd.native_only:
+                self.log_verbose('sending: %r', cmd)
+                with measure(self.metrics, self, cmd):
+                    self.transport.write(*cmd.payload())
+                return None
+            if self.transport.local and (self.native or cmd.native_only):
+                self.log_verbose('operation: %r', cmd)
+                try:
+                    with measure(self.metrics, self, cmd):
+                        cmd()
+                    return None
+                except UnsupportedOperation as e:
+                    if cmd.native_only:
+                        raise
+                    self.log_verbose('falling back to external commands: %s', e)
+            results = None
+            for fallback in cmd.commands():
+                results = self.run_once(fallback, timeout)
+            return results
+        if isinstance(cmd, Pipeline):
+            cmd = Pipeline(*[self.locate(stage) for stage in cmd.commands], seekable=cmd.seekable)
+            with measure(self.metrics, self, cmd):
+                return self.transport.run_pipeline(cmd, log=self.command_log(cmd), timeout=timeout)
+        cmd = self.locate(cmd)
+        with measure(self.metrics, self, cmd):
+            return self.transport.run(cmd, log=self.command_log(cmd), timeout=timeout)
+
+    def write_artifact(self, cmd: Operation) -> bool:
+        """
+        Write the file an operation converts from the artifact cache, when
+        there is one and the operation's file can be cached.
+
+        Returns:
+            Whether the file was written, False if the operation should be run instead
+        """
+        artifact = cmd.artifact() if self.native and self.artifact_cache is not None else None
+        if artifact is None:
+            return False
+        self.log_verbose('operation: %r', cmd)
+        try:
+            with measure(self.metrics, self, cmd):
+                data = self.artifact_cache.fetch(artifact)
+                self.transport.write(artifact.path, data, artifact.mode, artifact.owner)
+        except UnsupportedOperation as e:
+            if cmd.native_only:
+                raise
+            self.log_verbose('falling back to external commands: %s', e)
+            return False
+        return True
+
+    def locate(self, cmd: list) -> list:
+        """
+        Command with its program replaced by the path configured in ``programs``, if any.
+        """
+        program = self.programs.get(os.path.basename(cmd[0]))
+        return cmd if program is None else [program] + cmd[1:]
+
+    def command_log(self, cmd: Union[list, Pipeline]) -> CommandLog:
+        """
+        Log for a command's output, once the command is logged as starting.
+
+        Lines are logged to the ``certhook.output`` logger as they're
+        written, at INFO level when verbose is enabled and DEBUG otherwise,
+        and the last ``output_limit`` bytes of each stream are kept.
+        """
+        log = CommandLog(cmd.args if isinstance(cmd, Pipeline) else cmd,
+                         logging.INFO if self.verbose else logging.DEBUG, self.output_limit,
+                         step=step_name(cmd), **self.log_context())
+        log.start()
+        return log
+
+    @property
+    def inputs(self) -> List[str]:
+        """
+        Paths of the certificate files the deployment is built from.
+        """
+        return [f'{self.cert_dir}/fullchain.pem', f'{self.cert_dir}/privkey.pem']
+
+    @property
+    def served_cert(self) -> str:
+        """
+        Path of the certificate the app's endpoints should serve once deployed.
+        """
+        return f'{self.cert_dir}/cert.pem'
+
+    @property
+    def artifacts(self) -> List[str]:
+        """
+        Paths of the files the deployment produces, typically overridden by child classes.
+        """
+        return []
 
     def cert_cmds(self) -> None:
         """
         Method typically overridden by child classes.
         """
-        pass
\ No newline at end of file
+        pass
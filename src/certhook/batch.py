@@ -0,0 +1,318 @@
+"""
+Module for running many certificate deployments within a single process.
+"""
+
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .base import BaseCertManager
+from .deadlines import timed_out
+from .locks import deployment_locks
+from .output import last_line
+from .services import RestartCoordinator
+from .state import StateStore
+from .transport import Transport
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MANIFEST = '/etc/certhook/manifest'
+
+# Parsed manifests, with the state of the file they were read from, by path
+_manifests: Dict[str, Tuple[tuple, List[Tuple[str, str]]]] = {}
+
+
+def parse_job(spec: str) -> Tuple[str, str]:
+    """
+    Split an ``app[@host]:cert`` job specification into its parts.
+
+    Args:
+        spec: Job specification, e.g. ``unifi:example.com`` or
+              ``emby@media.lan:example.com`` to deploy to another host
+
+    Returns:
+        Tuple of (app, cert_name), the app including any host
+
+    Raises:
+        ValueError: If the specification is malformed
+    """
+    app, sep, cert_name = spec.strip().partition(':')
+    if not sep or not app or not cert_name or not all(split_app(app)):
+        raise ValueError(f"Invalid job '{spec}', expected app[@host]:cert")
+    return app, cert_name
+
+
+def split_app(app: str) -> Tuple[str, str]:
+    """
+    Split a job's app into the app and the host it's deployed to.
+
+    Args:
+        app: App of a job, e.g. ``emby`` or ``emby@media.lan``
+
+    Returns:
+        Tuple of (app, host), the host being ``localhost`` if not given
+    """
+    name, sep, host = app.partition('@')
+    return name, host if sep else 'localhost'
+
+
+def load_manifest(path: str) -> List[Tuple[str, str]]:
+    """
+    Read the jobs listed in a manifest file.
+
+    The manifest holds one ``app[@host]:cert`` job per line. Blank lines and
+    lines starting with ``#`` are ignored. Parsed manifests are kept until
+    the file changes, for long running processes reading it over and over.
+
+    Args:
+        path: Path to the manifest file
+
+    Returns:
+        List of (app, cert_name) tuples in file order
+    """
+    with open(path, 'r') as manifest:
+        st = os.fstat(manifest.fileno())
+        stamp = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = _manifests.get(path)
+        if cached is not None and cached[0] == stamp:
+            return list(cached[1])
+        jobs = []
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            jobs.append(parse_job(line))
+    _manifests[path] = (stamp, jobs)
+    return list(jobs)
+
+
+class JobResult:
+    """
+    Outcome of a single deployment within a batch.
+    """
+
+    def __init__(self, app: str, cert_name: str, success: bool,
+                 duration: float, error: Optional[BaseException] = None,
+                 skipped: bool = False):
+        """
+        Args:
+            app: Application the certificate was deployed to
+            cert_name: Name of the certificate
+            success: Whether the deployment completed
+            duration: Wall time spent on the job in seconds
+            error: Exception raised by the manager, if any
+            skipped: Whether the deployment was skipped as unchanged
+        """
+        self.app = app
+        self.cert_name = cert_name
+        self.success = success
+        self.duration = duration
+        self.error = error
+        self.skipped = skipped
+
+    @property
+    def timed_out(self) -> bool:
+        """Whether the deployment failed by taking too long, rather than by a step failing"""
+        return not self.success and timed_out(self.error)
+
+    def __str__(self) -> str:
+        if not self.success:
+            status = 'TIMEOUT' if self.timed_out else 'FAILED'
+        else:
+            status = 'SKIPPED' if self.skipped else 'OK'
+        line = f'{status} {self.app}:{self.cert_name} ({self.duration:.2f}s)'
+        if self.error is not None:
+            line += f': {self.error}'
+            if isinstance(self.error, subprocess.CalledProcessError) and last_line(self.error.stderr):
+                # The kept tail of the command's errors usually ends with the reason
+                line += f' ({last_line(self.error.stderr)})'
+        return line
+
+
+class BatchReport:
+    """
+    Collected results of a batch run.
+    """
+
+    def __init__(self, results: List[JobResult], wall_time: float,
+                 outages: Optional[Dict[str, float]] = None):
+        """
+        Args:
+            results: Per-job results, in submission order
+            wall_time: Total wall time of the batch in seconds
+            outages: Seconds each probed service took to be ready after its restart
+        """
+        self.results = results
+        self.wall_time = wall_time
+        self.outages = outages or {}
+
+    @property
+    def failed(self) -> List[JobResult]:
+        """Results of the jobs that did not complete"""
+        return [result for result in self.results if not result.success]
+
+    @property
+    def timed_out(self) -> List[JobResult]:
+        """Results of the jobs that failed by taking too long"""
+        return [result for result in self.results if result.timed_out]
+
+    @property
+    def deployed(self) -> List[JobResult]:
+        """Results of the jobs that ran to completion"""
+        return [result for result in self.results if result.success and not result.skipped]
+
+    @property
+    def skipped(self) -> List[JobResult]:
+        """Results of the jobs skipped as unchanged"""
+        return [result for result in self.results if result.skipped]
+
+    def summary(self) -> str:
+        """
+        Human readable report with one line per job and a totals line.
+        """
+        lines = [str(result) for result in self.results]
+        lines.extend(f'{service} ready after {seconds:.2f}s'
+                     for service, seconds in sorted(self.outages.items()))
+        timed_out = f' ({len(self.timed_out)} timed out)' if self.timed_out else ''
+        lines.append(f'{len(self.results)} jobs: {len(self.deployed)} deployed, '
+                     f'{len(self.skipped)} skipped, {len(self.failed)} failed{timed_out} '
+                     f'in {self.wall_time:.2f}s')
+        return '\n'.join(lines)
+
+
+class BatchRunner:
+    """
+    Runs certificate managers across a bounded pool of worker threads.
+
+    Managers spend nearly all of their time waiting on child processes,
+    so threads give the same overlap as a process pool without the cost
+    of starting extra interpreters. Jobs for the same app are additionally
+    limited so they don't trample each other's shared files and services.
+
+    Service restarts are held back until every job has finished, so a
+    service shared by many certificates is restarted (or reloaded) once
+    per host. Each host's restarts run alongside the other hosts'.
+    """
+
+    def __init__(self, max_workers: int = 4, per_app_limit: int = 1, verbose: bool = False,
+                 state: Optional[StateStore] = None, force: bool = False):
+        """
+        Args:
+            max_workers: Maximum number of jobs running at once
+            per_app_limit: Maximum number of jobs running at once for a single app
+            verbose: Whether to log verbose output
+            state: State store used to skip unchanged deployments
+            force: Deploy even when the state store says nothing changed
+        """
+        self.max_workers = max_workers
+        self.per_app_limit = per_app_limit
+        self.verbose = verbose
+        self.state = state
+        self.force = force
+        self._app_locks: Dict[str, threading.Semaphore] = {}
+        self._app_locks_guard = threading.Lock()
+
+    def _app_lock(self, app: str) -> threading.Semaphore:
+        """Get the semaphore limiting concurrency for an app"""
+        with self._app_locks_guard:
+            if app not in self._app_locks:
+                self._app_locks[app] = threading.Semaphore(self.per_app_limit)
+            return self._app_locks[app]
+
+    def _run_job(self, app: str, manager: BaseCertManager) -> JobResult:
+        """
+        Run a single manager, capturing any failure in the result.
+        """
+        with self._app_lock(app):
+            start = time.monotonic()
+            try:
+                if self.state is None:
+                    with deployment_locks(app, manager):
+                        manager()
+                    deployed = True
+                else:
+                    deployed = self.state.deploy(app, manager, self.force)
+            except Exception as e:
+                result = JobResult(app, manager.cert_name, False, time.monotonic() - start, e)
+            else:
+                result = JobResult(app, manager.cert_name, True, time.monotonic() - start,
+                                   skipped=not deployed)
+        if self.verbose:
+            logger.info('%s', result, extra=manager.log_context())
+        return result
+
+    def run(self, jobs: List[Tuple[str, BaseCertManager]]) -> BatchReport:
+        """
+        Run all jobs, continuing past failures.
+
+        Args:
+            jobs: List of (app, manager) tuples
+
+        Returns:
+            BatchReport with a result for every job
+        """
+        start = time.monotonic()
+        coordinators = self._coordinators(jobs)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = [pool.submit(self._run_job, app, manager) for app, manager in jobs]
+                results = [future.result() for future in futures]
+                flushed = list(pool.map(RestartCoordinator.flush, coordinators.values()))
+        finally:
+            self._reset(coordinators)
+        for restarts, outcomes in zip(coordinators.values(), flushed):
+            self._fail_restarts(restarts, outcomes, jobs, results)
+        return BatchReport(results, time.monotonic() - start, self._outages(coordinators))
+
+    @staticmethod
+    def _coordinators(jobs: List[Tuple[str, BaseCertManager]]) -> Dict[Transport, RestartCoordinator]:
+        """
+        Give every job the restart coordinator of the host it deploys to.
+        """
+        coordinators: Dict[Transport, RestartCoordinator] = {}
+        for _, manager in jobs:
+            if manager.transport not in coordinators:
+                coordinators[manager.transport] = RestartCoordinator(host=manager.transport.host)
+            manager.restart_coordinator = coordinators[manager.transport]
+        return coordinators
+
+    @staticmethod
+    def _reset(coordinators: Dict[Transport, RestartCoordinator]) -> None:
+        """
+        Let the next batch try the hosts that couldn't be reached in this one.
+        """
+        for transport in coordinators:
+            transport.reset()
+
+    @staticmethod
+    def _outages(coordinators: Dict[Transport, RestartCoordinator]) -> Dict[str, float]:
+        """
+        Outages of every host's services, named ``service@host`` for other hosts.
+        """
+        outages = {}
+        for transport, restarts in coordinators.items():
+            for service, seconds in restarts.outages.items():
+                outages[service if transport.local else f'{service}@{transport.host}'] = seconds
+        return outages
+
+    def _fail_restarts(self, restarts: RestartCoordinator, outcomes: dict,
+                       jobs: List[Tuple[str, BaseCertManager]], results: List[JobResult]) -> None:
+        """
+        Fail the jobs that depended on a restart that failed.
+        """
+        for manager, error in restarts.failures(outcomes):
+            index = next(i for i, (_, job) in enumerate(jobs) if job is manager)
+            result = results[index]
+            if not result.success:
+                continue
+            result.success = False
+            result.error = error
+            # The new certificate isn't live, so deploy it again next time
+            if self.state is not None:
+                self.state.forget(result.app, result.cert_name)
+            if self.verbose:
+                logger.info('%s', result, extra=manager.log_context())
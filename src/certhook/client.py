@@ -0,0 +1,112 @@
+"""
+Module for the ``certhook`` command, as a thin client of ``certhook serve``.
+
+Deploying commands are sent to a running daemon over its Unix socket, so
+they don't pay for starting an interpreter full of certhook's modules and
+for reading its state from scratch. Only the standard library modules this
+module needs are imported before a command is sent. If no daemon is
+listening the command runs in this process, as it always has.
+
+Requests and replies are JSON objects, one per line. A request holds the
+command line, working directory and certbot's environment:
+
+    {"argv": ["hook", "--manifest", "..."], "cwd": "/", "env": {"RENEWED_LINEAGE": "..."}}
+
+Replies carry the command's output as it's written, then its exit status:
+
+    {"stdout": "OK unifi:example.com (1.20s)\\n"}
+    {"exit": 0}
+"""
+
+import json
+import os
+import socket
+import sys
+from typing import Optional
+
+DEFAULT_SOCKET = '/run/certhook/certhook.sock'
+# Environment variable overriding the socket, set empty to always run in-process
+SOCKET_ENV = 'CERTHOOK_SOCKET'
+# Commands always run in-process, since a daemon can't run them for a client
+LOCAL_COMMANDS = ('serve', 'watch', 'status')
+# Environment variables sent along with a command, as certbot sets them for deploy hooks
+FORWARDED_ENV = ('RENEWED_LINEAGE', 'RENEWED_DOMAINS')
+
+
+def socket_path() -> str:
+    """Socket the daemon listens on, empty if commands shouldn't be sent to one"""
+    return os.environ.get(SOCKET_ENV, DEFAULT_SOCKET)
+
+
+def connect(path: str) -> Optional[socket.socket]:
+    """
+    Connect to the daemon.
+
+    Args:
+        path: Path to the daemon's socket
+
+    Returns:
+        The connected socket, None if no daemon is listening or it can't be used
+    """
+    if not path:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def request(argv: list, path: Optional[str] = None) -> Optional[int]:
+    """
+    Run a command in the daemon, writing its output to this process's.
+
+    Args:
+        argv: Command line arguments, without the program name
+        path: Path to the daemon's socket, ``socket_path()`` if None
+
+    Returns:
+        The command's exit status, None if no daemon is listening
+    """
+    sock = connect(socket_path() if path is None else path)
+    if sock is None:
+        return None
+    with sock, sock.makefile('rb') as replies:
+        message = {
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'env': {name: os.environ[name] for name in FORWARDED_ENV if name in os.environ},
+        }
+        try:
+            sock.sendall(json.dumps(message).encode('UTF-8') + b'\n')
+        except OSError:
+            return None
+        for line in replies:
+            reply = json.loads(line)
+            if 'exit' in reply:
+                return reply['exit']
+            for name, stream in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+                if name in reply:
+                    stream.write(reply[name])
+                    stream.flush()
+    # The daemon went away part way through, its deployments may or may not be done
+    print('certhook: lost connection to certhook serve', file=sys.stderr)
+    return 1
+
+
+def main(argv: list = None):
+    """Entry point of the certhook command, sending it to the daemon if one is running."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] not in LOCAL_COMMANDS:
+        status = request(argv)
+        if status is not None:
+            return status
+    from .main import main as run
+    return run(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
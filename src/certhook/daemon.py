@@ -0,0 +1,397 @@
+"""
+Module for ``certhook serve``, running deployments sent by the certhook command.
+
+The daemon keeps what a fresh process would load again for every command:
+imported manager classes, owner lookups, SSH master connections, parsed
+manifests and state files. Commands are parsed here with the same parsers
+as in-process runs, so a client only sends its command line (see
+``certhook.client`` for the protocol).
+
+Requests arriving within ``window`` seconds of each other are deployed as
+one batch, so a service shared by their certificates is restarted once.
+Requests whose options differ run as separate batches, one after another.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from . import main as cli
+from . import output
+from . import verify
+from .batch import BatchReport, BatchRunner, JobResult
+from .client import DEFAULT_SOCKET
+from .state import StateStore
+
+logger = logging.getLogger(__name__)
+
+# Options naming files, resolved against the client's working directory
+PATH_OPTIONS = ('manifest', 'state_file', 'artifact_cache', 'metrics_file', 'metrics_json', 'trace_file')
+# Options that only concern a single request, so don't keep it out of a batch
+REQUEST_OPTIONS = ('jobs', 'manifest', 'app', 'cert_name', 'host', 'verify', 'verify_timeout',
+                   'log_format', 'queue')
+
+
+class Connection:
+    """
+    A client's connection, written to by the threads running its request.
+    """
+
+    def __init__(self, sock: socket.socket):
+        """
+        Args:
+            sock: Accepted socket
+        """
+        self.sock = sock
+        self._lock = threading.Lock()
+        # Whether the client can still be written to
+        self.open = True
+
+    def send(self, **message) -> None:
+        """Send a reply, dropping it if the client has gone away"""
+        data = json.dumps(message).encode('UTF-8') + b'\n'
+        with self._lock:
+            if not self.open:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.open = False
+
+    def write(self, stream: str, text: str) -> None:
+        """Send output for the client's ``stdout`` or ``stderr``"""
+        if text:
+            self.send(**{stream: text})
+
+    def close(self) -> None:
+        with self._lock:
+            self.open = False
+            self.sock.close()
+
+
+class RequestParser(argparse.ArgumentParser):
+    """
+    Parser writing usage, help and errors to a client, instead of the daemon's streams.
+    """
+
+    # Client of the request being parsed
+    connection: Optional[Connection] = None
+
+    def _print_message(self, message: str, file=None) -> None:
+        if message and self.connection is not None:
+            self.connection.write('stderr' if file is sys.stderr else 'stdout', message)
+
+
+class ClientHandler(logging.Handler):
+    """
+    Forwards the records logged about a request's certificates to its client.
+    """
+
+    def __init__(self, request: 'Request'):
+        super().__init__()
+        self.request = request
+        self.certs = {cert_name for _, cert_name in request.specs}
+        self.setFormatter(output.FORMATTERS[request.args.log_format]())
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return getattr(record, 'cert', None) in self.certs
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.request.connection.write('stderr', self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+
+class Request:
+    """
+    A command received from a client, waiting to be deployed with its batch.
+    """
+
+    def __init__(self, command: Optional[str], args: argparse.Namespace,
+                 specs: List[Tuple[str, str]], connection: Connection):
+        """
+        Args:
+            command: Sub-command, None for a single deployment
+            args: Parsed command line
+            specs: (app, cert) jobs to deploy
+            connection: Client the results are sent to
+        """
+        self.command = command
+        self.args = args
+        self.specs = specs
+        self.connection = connection
+        # Exit status, once the request's batch has run
+        self.status = 1
+        self.done = threading.Event()
+
+    def key(self) -> tuple:
+        """Options a batch's requests must share, as they apply to every job"""
+        options = vars(self.args)
+        return (self.command,) + tuple(sorted((name, value) for name, value in options.items()
+                                              if name not in REQUEST_OPTIONS))
+
+    def finish(self, status: int) -> None:
+        self.status = status
+        self.done.set()
+
+
+def peer_uid(sock: socket.socket) -> Optional[int]:
+    """User id of the process at the other end of a Unix socket, None if unknown"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+class Server:
+    """
+    Accepts commands on a Unix socket and deploys them in batches.
+
+    Each connection is handled on a thread of its own, while a single
+    thread deploys the queued requests, so a batch's restarts are never
+    interleaved with another's.
+    """
+
+    # Longest a request waits for others to join its batch, in seconds
+    max_delay = 5.0
+
+    def __init__(self, path: str = DEFAULT_SOCKET, window: float = 0.2):
+        """
+        Args:
+            path: Path of the socket to listen on
+            window: Seconds to wait for another request before deploying a batch
+        """
+        self.path = path
+        self.window = window
+        self.sock: Optional[socket.socket] = None
+        self._queue: 'queue.Queue[Optional[Request]]' = queue.Queue()
+        self._stores: Dict[str, StateStore] = {}
+        self._batches: Optional[threading.Thread] = None
+
+    def bind(self) -> None:
+        """
+        Listen on the socket, readable and writable by this user only.
+
+        Raises:
+            OSError: If another daemon is listening on it, or it can't be created
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                # Left behind by a daemon that didn't exit cleanly
+                os.unlink(self.path)
+            else:
+                raise OSError(f'certhook serve is already running on {self.path}')
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        mask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(mask)
+        sock.listen(64)
+        self.sock = sock
+
+    def serve(self) -> None:
+        """Handle connections until closed"""
+        if self.sock is None:
+            self.bind()
+        self._batches = threading.Thread(target=self._run_batches, name='certhook-batches', daemon=True)
+        self._batches.start()
+        logger.info('Listening on %s', self.path)
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                if self.sock.fileno() == -1 or not os.path.exists(self.path):
+                    return
+                raise
+            threading.Thread(target=self.handle, args=(sock,), daemon=True).start()
+
+    def close(self) -> None:
+        """Stop accepting connections, letting the batch being deployed finish"""
+        if self.sock is None:
+            return
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        try:
+            # Wakes up accept() in serve()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self._queue.put(None)
+        if self._batches is not None:
+            self._batches.join()
+
+    def handle(self, sock: socket.socket) -> None:
+        """Run one client's command, replying with its output and exit status"""
+        connection = Connection(sock)
+        try:
+            uid = peer_uid(sock)
+            if uid not in (None, 0, os.getuid()):
+                connection.write('stderr', 'certhook serve: permission denied\n')
+                status = 1
+            else:
+                with sock.makefile('rb') as requests:
+                    message = json.loads(requests.readline() or b'{}')
+                status = self.submit(message, connection)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+        except Exception as e:
+            logger.exception('Request failed')
+            connection.write('stderr', f'certhook serve: {e}\n')
+            status = 1
+        connection.send(exit=status)
+        connection.close()
+
+    def submit(self, message: dict, connection: Connection) -> int:
+        """
+        Parse a client's command and queue its jobs.
+
+        Returns:
+            The command's exit status, once its jobs are deployed unless it asked to be queued
+
+        Raises:
+            SystemExit: If the command line is invalid, or asks for help
+        """
+        argv = list(message.get('argv', []))
+        command = argv.pop(0) if argv and argv[0] in cli.DEPLOY_COMMANDS else None
+        make_parser, find_specs = cli.DEPLOY_COMMANDS[command]
+        parser = make_parser(RequestParser)
+        parser.connection = connection
+        args = parser.parse_args(argv)
+        for name in PATH_OPTIONS:
+            if getattr(args, name, None):
+                setattr(args, name, os.path.join(message.get('cwd', '/'), getattr(args, name)))
+        specs = find_specs(parser, args, message.get('env', {}))
+        if not specs:
+            return 0
+        request = Request(command, args, specs, connection)
+        self._queue.put(request)
+        if args.queue:
+            return 0
+        request.done.wait()
+        return request.status
+
+    def _run_batches(self) -> None:
+        """Deploy queued requests, gathering those arriving close together into a batch"""
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            requests = [request]
+            end = time.monotonic() + self.max_delay
+            stop = False
+            while not stop:
+                wait = min(self.window, end - time.monotonic())
+                if wait <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=wait)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                else:
+                    requests.append(request)
+            self.run_batch(requests)
+            if stop:
+                return
+
+    def run_batch(self, requests: List[Request]) -> None:
+        """Deploy requests, those with the same options as a single batch"""
+        groups: Dict[tuple, List[Request]] = {}
+        for request in requests:
+            groups.setdefault(request.key(), []).append(request)
+        for group in groups.values():
+            try:
+                self.run_group(group)
+            except Exception as e:
+                logger.exception('Batch failed')
+                for request in group:
+                    request.connection.write('stderr', f'certhook serve: {e}\n')
+                    request.finish(1)
+
+    def state_store(self, path: str) -> StateStore:
+        """State store of a file, kept between batches"""
+        if path not in self._stores:
+            self._stores[path] = StateStore(path)
+        return self._stores[path]
+
+    def run_group(self, requests: List[Request]) -> None:
+        """Deploy the jobs of requests sharing their options, each job once"""
+        args = requests[0].args
+        jobs: Dict[Tuple[str, str], tuple] = {}
+        failed: Dict[Tuple[str, str], JobResult] = {}
+        for request in requests:
+            for spec in request.specs:
+                if spec in jobs or spec in failed:
+                    continue
+                app, cert_name = spec
+                try:
+                    jobs[spec] = (app, cli.build_manager(args, app, cert_name))
+                except Exception as e:
+                    failed[spec] = JobResult(app, cert_name, False, 0.0, e)
+
+        managers = [manager for _, manager in jobs.values()]
+        recorder = cli.metrics_recorder(args, managers)
+        cli.apply_deadline(args, managers)
+        runner = BatchRunner(max_workers=getattr(args, 'workers', 4),
+                             per_app_limit=getattr(args, 'per_app_limit', 1),
+                             verbose=args.verbose, state=self.state_store(args.state_file),
+                             force=args.force)
+        handlers = [ClientHandler(request) for request in requests]
+        root = logging.getLogger('certhook')
+        for handler in handlers:
+            root.addHandler(handler)
+        try:
+            report = runner.run(list(jobs.values()))
+        finally:
+            for handler in handlers:
+                root.removeHandler(handler)
+            cli.write_metrics(args, recorder)
+        logger.info('Deployed %d jobs for %d requests\n%s', len(jobs), len(requests), report.summary())
+
+        results = dict(zip(jobs, report.results))
+        results.update(failed)
+        for request in requests:
+            request.finish(self.reply(request, report, results, jobs))
+
+    @staticmethod
+    def reply(request: Request, report: BatchReport, results: Dict[Tuple[str, str], JobResult],
+              jobs: Dict[Tuple[str, str], tuple]) -> int:
+        """Send a request's part of a batch's results to its client, returning its exit status"""
+        mine = [results[spec] for spec in request.specs]
+        connection = request.connection
+        if request.command is None:
+            # Like a single deployment in-process, quiet unless it fails
+            for result in mine:
+                if not result.success:
+                    connection.write('stderr', f'{result}\n')
+        else:
+            connection.write('stdout', BatchReport(mine, report.wall_time, report.outages).summary() + '\n')
+        failed = any(not result.success for result in mine)
+
+        deployed = [jobs[spec] for spec, result in zip(request.specs, mine)
+                    if result.success and not result.skipped]
+        if not request.args.verify or not deployed:
+            return 1 if failed else 0
+        checked = verify.verify(deployed, timeout=request.args.verify_timeout)
+        connection.write('stdout', checked.summary() + '\n')
+        return 1 if failed or checked.failed else 0
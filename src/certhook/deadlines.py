@@ -0,0 +1,90 @@
+"""
+Module for bounding how long deployments take.
+
+A ``Deadline`` caps a whole run: every command of every manager sharing it
+is given at most the time left, and steps that would start once it has
+passed fail straight away with ``DeadlineExceeded``. Failed steps marked
+idempotent are retried a bounded number of times, after a jittered
+exponential backoff that never reaches past the deadline.
+"""
+
+import random
+import subprocess
+import time
+from typing import Optional
+
+# Errors a retry might get past: a command failing or running too long
+RETRYABLE = (subprocess.CalledProcessError, subprocess.TimeoutExpired)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    The run's deadline passed before a step could start.
+    """
+
+
+class Deadline:
+    """
+    Point in time a run must be finished by, shared by all of its managers.
+    """
+
+    def __init__(self, seconds: float):
+        """
+        Args:
+            seconds: Seconds from now until the deadline
+        """
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """Seconds left until the deadline, negative once it has passed"""
+        return self.expires - time.monotonic()
+
+    def bound(self, timeout: Optional[float]) -> float:
+        """
+        Timeout for a step starting now.
+
+        Args:
+            timeout: The step's own timeout, None for no limit
+
+        Returns:
+            The step's timeout, shortened to the time left if that's less
+
+        Raises:
+            DeadlineExceeded: If the deadline has passed
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f'Run deadline of {self.seconds:g}s exceeded')
+        return remaining if timeout is None else min(timeout, remaining)
+
+
+def timed_out(error: Optional[BaseException]) -> bool:
+    """Whether an error means something took too long, rather than failed"""
+    return isinstance(error, (subprocess.TimeoutExpired, TimeoutError))
+
+
+def retry_delay(error: BaseException, attempt: int, retries: int, delay: float,
+                deadline: Optional[Deadline] = None) -> Optional[float]:
+    """
+    Seconds to wait before retrying a failed idempotent step.
+
+    The wait is drawn uniformly from zero up to ``delay * 2 ** attempt``
+    ("full jitter"), so steps that failed together don't retry in lockstep.
+
+    Args:
+        error: Error the attempt failed with
+        attempt: Number of the attempt that failed, from 0
+        retries: Number of retries allowed after the first attempt
+        delay: Base delay in seconds
+        deadline: Deadline of the run, if any
+
+    Returns:
+        Seconds to wait, None if the step shouldn't be retried
+    """
+    if not isinstance(error, RETRYABLE) or attempt >= retries:
+        return None
+    wait = random.uniform(0, delay * 2 ** attempt)
+    if deadline is not None and deadline.remaining() <= wait:
+        return None
+    return wait
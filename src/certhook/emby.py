@@ -2,7 +2,12 @@
 Module for converting a Let's Encrypt certificates for use with Emby Server.
 """
 
+from typing import List
 from .base import BaseCertManager
+from .ops import Chmod, Chown, ExportPKCS12
+from .probes import TLSProbe
+from .services import Restart
+from .steps import Step
 
 
 class EmbyCertManager(BaseCertManager):
@@ -10,22 +15,31 @@ class EmbyCertManager(BaseCertManager):
     Creates and executes the commands required to convert an SSL certificate
     for use with Emby.
     """
+    # Emby serves HTTPS again once it has restarted
+    probes = {'emby-server': TLSProbe('localhost', 8920)}
+    endpoints = [('localhost', 8920)]
+
+    @property
+    def artifacts(self) -> List[str]:
+        """Paths of the files produced for Emby"""
+        return [f'{self.cert_dir}/fullchain.p12']
+
     def cert_cmds(self) -> None:
         """
         Creates the commands required to convert the cert for use with Emby.
         """
         # Convert certificate to .p12
-        self.cmds.append([
-            '/usr/bin/openssl', 'pkcs12', '-export',
-            '-inkey', f'/etc/letsencrypt/live/{self.cert_name}/privkey.pem',
-            '-in', f'/etc/letsencrypt/live/{self.cert_name}/fullchain.pem',
-            '-out', f'/etc/letsencrypt/live/{self.cert_name}/fullchain.p12',
-            '-password', 'pass:'
-        ])
+        convert = ExportPKCS12(
+            key_file=f'{self.cert_dir}/privkey.pem',
+            chain_file=f'{self.cert_dir}/fullchain.pem',
+            out_file=f'{self.cert_dir}/fullchain.p12',
+            password=''
+        )
+        self.cmds.append(convert)
 
-        # Set permissions.
-        self.cmds.append(['/usr/bin/chown', 'root:ssl-certs', f'/etc/letsencrypt/live/{self.cert_name}/fullchain.p12'])
-        self.cmds.append(['/usr/bin/chmod', '0770', f'/etc/letsencrypt/live/{self.cert_name}/fullchain.p12'])
+        # Set permissions, both at once
+        self.cmds.append(Step(Chown(f'{self.cert_dir}/fullchain.p12', 'root:ssl-certs'), after=[convert]))
+        self.cmds.append(Step(Chmod(f'{self.cert_dir}/fullchain.p12', 0o770), after=[convert]))
 
         # Restart Emby service
-        self.cmds.append(['/usr/sbin/service', 'emby-server', 'restart'])
+        self.cmds.append(Restart('emby-server'))
@@ -2,7 +2,12 @@
 Module for setting up a Let's Encrypt certificates for use with FreePBX/Asterisk
 """
 
+from typing import List, Optional
 from .base import BaseCertManager
+from .ops import AuditTree, Chmod, Chown, Copy
+from .probes import TLSProbe
+from .services import Restart
+from .steps import Step
 
 
 class FreePBXCertManager(BaseCertManager):
@@ -10,30 +15,64 @@ class FreePBXCertManager(BaseCertManager):
     Copies and executes the commands required to set an SSL certificate
     for use with Asterisk on FreePBX.
     """
+    # Directory Asterisk loads its keys from
+    keys_dir = '/etc/asterisk/keys'
+    # Owner and permissions of everything in the keys directory
+    keys_owner = 'asterisk:asterisk'
+    keys_mode = 0o700
+    # Seconds between audits of the whole keys directory, None to only ever
+    # touch the files written, infinite to audit once
+    audit_interval: Optional[float] = None
+    # File recording when the keys directory was last audited
+    audit_marker = '/var/lib/certhook/freepbx-keys.audit'
+    # Apache serves the FreePBX admin panel over HTTPS again once reloaded
+    probes = {'apache2': TLSProbe('localhost', 443)}
+    endpoints = [('localhost', 443)]
+
+    @property
+    def inputs(self) -> List[str]:
+        """Paths of the certificate files copied into Asterisk"""
+        return [f'{self.cert_dir}/cert.pem', f'{self.cert_dir}/privkey.pem']
+
+    @property
+    def artifacts(self) -> List[str]:
+        """Paths of the files produced for Asterisk"""
+        return [f'{self.keys_dir}/{self.cert_name}.crt', f'{self.keys_dir}/{self.cert_name}.key']
 
     def cert_cmds(self) -> None:
         """
         Creates all the commands needed to import the certificate into Asterisk.
         """
-        # Copy certificates to Asterisk keys directory
-        self.cmds.extend([
-            ['cp', f'/etc/letsencrypt/live/{self.cert_name}/cert.pem',
-             f'/etc/asterisk/keys/{self.cert_name}.crt'],
-            ['cp', f'/etc/letsencrypt/live/{self.cert_name}/privkey.pem',
-             f'/etc/asterisk/keys/{self.cert_name}.key']
-        ])
+        # Copy certificates to Asterisk keys directory, independently of each other
+        copy_cert = Step(Copy(f'{self.cert_dir}/cert.pem',
+                              f'{self.keys_dir}/{self.cert_name}.crt'), after=[])
+        copy_key = Step(Copy(f'{self.cert_dir}/privkey.pem',
+                             f'{self.keys_dir}/{self.cert_name}.key'), after=[])
+        self.cmds.extend([copy_cert, copy_key])
 
-        # Set proper ownership and permissions
-        self.cmds.extend([
-            ['chmod', '-R', '0700', '/etc/asterisk/keys/'],
-            ['chown', '-R', 'asterisk:asterisk', '/etc/asterisk/keys/']
-        ])
+        # Set ownership and permissions of just the copied files
+        perms = []
+        for copy in (copy_cert, copy_key):
+            perms.append(Step(Chmod(copy.action.dst, self.keys_mode), after=[copy]))
+            perms.append(Step(Chown(copy.action.dst, self.keys_owner), after=[copy]))
+        self.cmds.extend(perms)
+        ready = perms
 
-        # Configure Asterisk/FreePBX to use the new certificate
+        # Fix up anything else in the keys directory every so often
+        if self.audit_interval is not None:
+            audit = Step(AuditTree(self.keys_dir, self.keys_mode, self.keys_owner,
+                                   self.audit_marker, self.audit_interval), after=perms)
+            self.cmds.append(audit)
+            ready = [audit]
+
+        # Configure Asterisk/FreePBX to use the new certificate, one command at a
+        # time; each only (re)applies the certificate, so is safe to retry
         self.cmds.extend([
-            ['/usr/sbin/fwconsole', 'certificate', '--import'],
-            ['/usr/sbin/fwconsole', 'certificate', '--default=0'],
-            ['/usr/sbin/fwconsole', 'sysadmin', 'installHttpsCert', 'default'],
-            ['/usr/sbin/fwconsole', 'sysadmin', 'updatecert'],
-            ['/usr/sbin/service', 'apache2', 'restart']
+            Step(['/usr/sbin/fwconsole', 'certificate', '--import'], after=ready, idempotent=True),
+            Step(['/usr/sbin/fwconsole', 'certificate', '--default=0'], idempotent=True),
+            Step(['/usr/sbin/fwconsole', 'sysadmin', 'installHttpsCert', 'default'], idempotent=True),
+            Step(['/usr/sbin/fwconsole', 'sysadmin', 'updatecert'], idempotent=True),
         ])
+        # Restart (or reload) Apache
+        self.cmds.append(Restart('apache2'))
+
@@ -0,0 +1,178 @@
+"""
+Module for reporting on every certificate lineage under the live directory.
+
+Parsed certificates are cached in an index keyed by each file's inode,
+modification time and size, so a repeat scan only parses the files that
+have changed since, and lineages are scanned in parallel.
+"""
+
+import datetime
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from . import x509
+from .ops import write_atomic
+
+DEFAULT_INDEX = '/var/lib/certhook/index.json'
+
+
+class Lineage:
+    """
+    Status of one certificate lineage.
+    """
+
+    def __init__(self, name: str, path: str, cert: Optional[dict] = None,
+                 error: Optional[BaseException] = None):
+        """
+        Args:
+            name: Name of the lineage, e.g. ``example.com``
+            path: Path of the lineage's cert.pem
+            cert: Fields of the certificate from ``x509.Certificate.as_dict``
+            error: Error reading the certificate, if any
+        """
+        self.name = name
+        self.path = path
+        self.cert = cert
+        self.error = error
+
+    @property
+    def not_after(self) -> Optional[datetime.datetime]:
+        """When the certificate expires"""
+        return None if self.cert is None else datetime.datetime.fromisoformat(self.cert['not_after'])
+
+    def days_left(self, now: Optional[datetime.datetime] = None) -> Optional[float]:
+        """Days until the certificate expires, negative once expired"""
+        if self.cert is None:
+            return None
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        return (self.not_after - now).total_seconds() / 86400
+
+    def as_dict(self, now: Optional[datetime.datetime] = None) -> dict:
+        """Status as a JSON serialisable dict"""
+        status = {'name': self.name, 'path': self.path, 'days_left': self.days_left(now)}
+        if self.cert is not None:
+            status.update(self.cert)
+        if self.error is not None:
+            status['error'] = str(self.error)
+        return status
+
+
+class Index:
+    """
+    Cache of parsed certificates, kept as a JSON file.
+
+    Entries are keyed by the resolved path of each file and are only used
+    while its inode, modification time and size are unchanged.
+    """
+
+    def __init__(self, path: Optional[str] = DEFAULT_INDEX):
+        """
+        Args:
+            path: Path to the JSON index file, None to only cache in memory
+        """
+        self.path = path
+        self.parsed = 0
+        self._lock = threading.Lock()
+        self._changed = False
+        self._entries: Dict[str, dict] = self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        """Read the index file, treating a missing or corrupt file as empty"""
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def certificate(self, path: str) -> dict:
+        """
+        Fields of the first certificate in a PEM file, parsing it only if it changed.
+
+        Args:
+            path: Path to the PEM file, e.g. a lineage's cert.pem
+
+        Returns:
+            Fields from ``x509.Certificate.as_dict``
+
+        Raises:
+            OSError: If the file can't be read
+            ValueError: If the file holds no valid certificate
+        """
+        real_path = os.path.realpath(path)
+        st = os.stat(real_path)
+        key = [st.st_ino, st.st_mtime_ns, st.st_size]
+        with self._lock:
+            entry = self._entries.get(real_path)
+        if entry is not None and entry.get('key') == key:
+            return entry['cert']
+        cert = x509.load(real_path)[0].as_dict()
+        with self._lock:
+            self._entries[real_path] = {'key': key, 'cert': cert}
+            self._changed = True
+            self.parsed += 1
+        return cert
+
+    def prune(self, keep: List[str]) -> None:
+        """Drop the entries of every file not in a list of paths"""
+        keep = {os.path.realpath(path) for path in keep}
+        with self._lock:
+            for path in [path for path in self._entries if path not in keep]:
+                del self._entries[path]
+                self._changed = True
+
+    def save(self) -> None:
+        """Write the index file atomically, if anything changed"""
+        if self.path is None or not self._changed:
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            write_atomic(self.path, json.dumps(self._entries, sort_keys=True).encode(), 0o644)
+            self._changed = False
+
+
+def lineages(live_root: str) -> List[str]:
+    """Names of the lineages under a live directory"""
+    try:
+        entries = list(os.scandir(live_root))
+    except FileNotFoundError:
+        return []
+    return sorted(entry.name for entry in entries if entry.is_dir())
+
+
+def scan(live_root: str, index: Optional[Index] = None, max_workers: int = 8) -> List[Lineage]:
+    """
+    Read the certificate of every lineage.
+
+    Args:
+        live_root: Directory holding the lineages, e.g. /etc/letsencrypt/live
+        index: Cache of parsed certificates, an in-memory one if None
+        max_workers: Maximum number of lineages read at once
+
+    Returns:
+        Status of every lineage, by name
+    """
+    index = index or Index(None)
+
+    def read(name: str) -> Lineage:
+        path = os.path.join(live_root, name, 'cert.pem')
+        try:
+            return Lineage(name, path, index.certificate(path))
+        except (OSError, ValueError) as e:
+            return Lineage(name, path, error=e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(read, lineages(live_root)))
+    index.prune([result.path for result in results if result.cert is not None])
+    return results
+
+
+def by_expiry(results: List[Lineage]) -> List[Lineage]:
+    """Lineages soonest to expire first, unreadable ones before all"""
+    return sorted(results, key=lambda result: (result.cert is not None,
+                                               result.cert['not_after'] if result.cert else '', result.name))
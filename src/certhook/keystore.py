@@ -0,0 +1,383 @@
+"""
+Module for reading and writing Java keystores without running keytool.
+
+Supports the proprietary JKS format and PKCS#12 keystores, enough to
+replace or insert a private key entry while leaving every other entry
+in the keystore untouched.
+"""
+
+import hashlib
+import hmac
+import os
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+from . import asn1, pkcs12
+
+JKS_MAGIC = 0xFEEDFEED
+JCEKS_MAGIC = 0xCECECECE
+
+# Algorithm identifier used by Sun's JKS key protector
+OID_JKS_KEY_PROTECTOR = '1.3.6.1.4.1.42.2.17.1.1'
+# Marks certificates Java treats as trusted in PKCS#12 keystores
+OID_JAVA_TRUSTED_KEY_USAGE = '2.16.840.1.113894.746875.1.1'
+
+_PRIVATE_KEY_ENTRY = 1
+_TRUSTED_CERT_ENTRY = 2
+
+
+class KeystoreError(ValueError):
+    """
+    Raised when a keystore can't be read or updated in-process.
+    """
+
+
+def _java_password(password: str) -> bytes:
+    """Password bytes as Java's key protectors see them (UTF-16BE, no terminator)"""
+    return password.encode('utf-16-be')
+
+
+def jks_protect_key(key_der: bytes, password: str) -> bytes:
+    """
+    Protect a PKCS#8 key with Sun's JKS key protector.
+
+    The key is XORed with a SHA-1 based keystream seeded by a random salt,
+    followed by a SHA-1 integrity check over the password and plain key.
+
+    Args:
+        key_der: PKCS#8 PrivateKeyInfo DER
+        password: Key password
+
+    Returns:
+        EncryptedPrivateKeyInfo DER
+    """
+    passwd = _java_password(password)
+    salt = os.urandom(20)
+    stream = b''
+    digest = salt
+    while len(stream) < len(key_der):
+        digest = hashlib.sha1(passwd + digest).digest()
+        stream += digest
+    encrypted = bytes(a ^ b for a, b in zip(key_der, stream))
+    check = hashlib.sha1(passwd + key_der).digest()
+    return asn1.sequence(asn1.algorithm(OID_JKS_KEY_PROTECTOR),
+                         asn1.octet_string(salt + encrypted + check))
+
+
+def jks_recover_key(protected: bytes, password: str) -> bytes:
+    """
+    Recover the PKCS#8 key from a JKS protected key.
+
+    Args:
+        protected: EncryptedPrivateKeyInfo DER
+        password: Key password
+
+    Returns:
+        PKCS#8 PrivateKeyInfo DER
+
+    Raises:
+        KeystoreError: If the password is wrong or the protector isn't supported
+    """
+    (_, algorithm), (_, data) = asn1.decode_all(asn1.decode(protected)[1])
+    algorithm_oid = asn1.decode_oid(asn1.decode_all(algorithm)[0][1])
+    if algorithm_oid != OID_JKS_KEY_PROTECTOR:
+        raise KeystoreError(f'Unsupported JKS key protection {algorithm_oid}')
+    passwd = _java_password(password)
+    salt, encrypted, check = data[:20], data[20:-20], data[-20:]
+    stream = b''
+    digest = salt
+    while len(stream) < len(encrypted):
+        digest = hashlib.sha1(passwd + digest).digest()
+        stream += digest
+    key_der = bytes(a ^ b for a, b in zip(encrypted, stream))
+    if hashlib.sha1(passwd + key_der).digest() != check:
+        raise KeystoreError('Cannot recover key, wrong password?')
+    return key_der
+
+
+class _Reader:
+    """Big-endian reader over the JKS stream"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offset = 0
+
+    def read(self, length: int) -> bytes:
+        if self.offset + length > len(self.data):
+            raise KeystoreError('Truncated keystore')
+        chunk = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return chunk
+
+    def u16(self) -> int:
+        return struct.unpack('>H', self.read(2))[0]
+
+    def u32(self) -> int:
+        return struct.unpack('>I', self.read(4))[0]
+
+    def u64(self) -> int:
+        return struct.unpack('>Q', self.read(8))[0]
+
+    def utf(self) -> str:
+        return self.read(self.u16()).decode('utf-8')
+
+    def blob(self) -> bytes:
+        return self.read(self.u32())
+
+
+def _utf(value: str) -> bytes:
+    """Java writeUTF encoding (modified UTF-8 is identical for aliases in practice)"""
+    encoded = value.encode('utf-8')
+    return struct.pack('>H', len(encoded)) + encoded
+
+
+def _blob(value: bytes) -> bytes:
+    return struct.pack('>I', len(value)) + value
+
+
+class KeyStore:
+    """
+    Base class for keystores.
+    """
+    type_name = ''
+
+    def aliases(self) -> List[str]:
+        """Aliases of every entry, overridden by child classes"""
+        raise NotImplementedError
+
+    def get_key(self, alias: str, password: str) -> Tuple[bytes, List[bytes]]:
+        """
+        Get a private key entry, overridden by child classes.
+
+        Returns:
+            Tuple of (PKCS#8 key DER, certificate chain DERs)
+        """
+        raise NotImplementedError
+
+    def set_key_entry(self, alias: str, key_der: bytes, chain: List[bytes], password: str) -> None:
+        """
+        Replace or insert a private key entry, overridden by child classes.
+
+        Args:
+            alias: Entry alias
+            key_der: PKCS#8 PrivateKeyInfo DER
+            chain: Certificate DERs, leaf first
+            password: Key password
+        """
+        raise NotImplementedError
+
+    def dumps(self, storepass: str) -> bytes:
+        """Encode the keystore, overridden by child classes"""
+        raise NotImplementedError
+
+
+class JKSKeyStore(KeyStore):
+    """
+    Sun's proprietary JKS keystore format.
+    """
+    type_name = 'JKS'
+
+    def __init__(self):
+        # alias -> (tag, original alias, timestamp, protected key or None, [(cert type, DER)])
+        self.entries: Dict[str, tuple] = {}
+
+    @staticmethod
+    def _integrity(storepass: str, data: bytes) -> bytes:
+        """Keystore integrity digest"""
+        return hashlib.sha1(_java_password(storepass) + b'Mighty Aphrodite' + data).digest()
+
+    @classmethod
+    def loads(cls, data: bytes, storepass: str) -> 'JKSKeyStore':
+        """
+        Parse a JKS keystore.
+
+        Args:
+            data: Keystore contents
+            storepass: Store password, checked against the integrity digest
+
+        Returns:
+            JKSKeyStore instance
+        """
+        if len(data) < 20 or not hmac.compare_digest(cls._integrity(storepass, data[:-20]), data[-20:]):
+            raise KeystoreError('Keystore was tampered with, or password was incorrect')
+        reader = _Reader(data[:-20])
+        if reader.u32() != JKS_MAGIC:
+            raise KeystoreError('Not a JKS keystore')
+        version = reader.u32()
+        if version not in (1, 2):
+            raise KeystoreError(f'Unsupported JKS version {version}')
+        store = cls()
+        for _ in range(reader.u32()):
+            tag = reader.u32()
+            alias = reader.utf()
+            timestamp = reader.u64()
+            protected = None
+            if tag == _PRIVATE_KEY_ENTRY:
+                protected = reader.blob()
+                certs = []
+                for _ in range(reader.u32()):
+                    cert_type = reader.utf() if version == 2 else 'X.509'
+                    certs.append((cert_type, reader.blob()))
+            elif tag == _TRUSTED_CERT_ENTRY:
+                cert_type = reader.utf() if version == 2 else 'X.509'
+                certs = [(cert_type, reader.blob())]
+            else:
+                raise KeystoreError(f'Unsupported JKS entry type {tag}')
+            store.entries[alias.lower()] = (tag, alias, timestamp, protected, certs)
+        return store
+
+    def aliases(self) -> List[str]:
+        return [entry[1] for entry in self.entries.values()]
+
+    def get_key(self, alias: str, password: str) -> Tuple[bytes, List[bytes]]:
+        entry = self.entries.get(alias.lower())
+        if entry is None or entry[0] != _PRIVATE_KEY_ENTRY:
+            raise KeyError(alias)
+        return jks_recover_key(entry[3], password), [der for _, der in entry[4]]
+
+    def set_key_entry(self, alias: str, key_der: bytes, chain: List[bytes], password: str) -> None:
+        self.entries[alias.lower()] = (_PRIVATE_KEY_ENTRY, alias.lower(), int(time.time() * 1000),
+                                       jks_protect_key(key_der, password),
+                                       [('X.509', der) for der in chain])
+
+    def dumps(self, storepass: str) -> bytes:
+        out = [struct.pack('>III', JKS_MAGIC, 2, len(self.entries))]
+        for tag, alias, timestamp, protected, certs in self.entries.values():
+            out.append(struct.pack('>I', tag) + _utf(alias) + struct.pack('>Q', timestamp))
+            if tag == _PRIVATE_KEY_ENTRY:
+                out.append(_blob(protected) + struct.pack('>I', len(certs)))
+            for cert_type, der in certs:
+                out.append(_utf(cert_type) + _blob(der))
+        data = b''.join(out)
+        return data + self._integrity(storepass, data)
+
+
+class PKCS12KeyStore(KeyStore):
+    """
+    PKCS#12 keystore, as created by keytool on Java 9 and later.
+    """
+    type_name = 'PKCS12'
+
+    def __init__(self, iterations: int = pkcs12.DEFAULT_ITERATIONS):
+        """
+        Args:
+            iterations: Iteration count for new keys and the MAC
+        """
+        self.iterations = iterations
+        self.cert_bags: List[bytes] = []
+        self.key_bags: List[bytes] = []
+
+    @classmethod
+    def loads(cls, data: bytes, storepass: str) -> 'PKCS12KeyStore':
+        """
+        Parse a PKCS#12 keystore.
+
+        Args:
+            data: Keystore contents
+            storepass: Store password
+
+        Returns:
+            PKCS12KeyStore instance
+        """
+        try:
+            bags = pkcs12.parse_pfx(data, storepass)
+        except pkcs12.PKCS12Error as e:
+            raise KeystoreError(str(e)) from None
+        store = cls()
+        for bag in bags:
+            if bag.bag_id == pkcs12.OID_CERT_BAG:
+                store.cert_bags.append(bag.der)
+            else:
+                store.key_bags.append(bag.der)
+        return store
+
+    def _key_bag(self, alias: str) -> Optional[pkcs12.SafeBag]:
+        """Find the key bag for an alias"""
+        for der in self.key_bags:
+            bag = pkcs12.SafeBag(der)
+            if (bag.friendly_name or '').lower() == alias.lower():
+                return bag
+        return None
+
+    def aliases(self) -> List[str]:
+        aliases = []
+        for der in self.key_bags + self.cert_bags:
+            bag = pkcs12.SafeBag(der)
+            if bag.friendly_name is not None and bag.friendly_name not in aliases:
+                aliases.append(bag.friendly_name)
+        return aliases
+
+    def get_key(self, alias: str, password: str) -> Tuple[bytes, List[bytes]]:
+        bag = self._key_bag(alias)
+        if bag is None or bag.bag_id != pkcs12.OID_SHROUDED_KEY_BAG:
+            raise KeyError(alias)
+        try:
+            key_der = pkcs12.decrypt_private_key(bag.value, password)
+        except pkcs12.PKCS12Error as e:
+            raise KeystoreError(str(e)) from None
+        chain = [pkcs12.SafeBag(der).certificate for der in self.cert_bags
+                 if pkcs12.SafeBag(der).local_key_id == bag.local_key_id]
+        return key_der, chain
+
+    def set_key_entry(self, alias: str, key_der: bytes, chain: List[bytes], password: str) -> None:
+        old = self._key_bag(alias)
+        if old is not None:
+            self.key_bags.remove(old.der)
+            # Drop the old leaf certificate along with its key
+            self.cert_bags = [der for der in self.cert_bags
+                              if pkcs12.SafeBag(der).local_key_id != old.local_key_id]
+        # Avoid piling up copies of the issuing certificates on every renewal
+        self.cert_bags = [der for der in self.cert_bags if not self._is_chain_copy(der, chain)]
+
+        local_key_id = hashlib.sha1(chain[0]).digest()
+        self.key_bags.append(pkcs12.key_bag(key_der, password, alias.lower(), local_key_id, self.iterations))
+        self.cert_bags.append(pkcs12.cert_bag(chain[0], alias.lower(), local_key_id))
+        self.cert_bags.extend(pkcs12.cert_bag(der) for der in chain[1:])
+
+    @staticmethod
+    def _is_chain_copy(der: bytes, chain: List[bytes]) -> bool:
+        """Whether a bag is an anonymous copy of one of the chain's certificates"""
+        bag = pkcs12.SafeBag(der)
+        return (bag.local_key_id is None and bag.friendly_name is None and
+                OID_JAVA_TRUSTED_KEY_USAGE not in bag.attributes and bag.certificate in chain)
+
+    def dumps(self, storepass: str) -> bytes:
+        return pkcs12.assemble_pfx(self.cert_bags, self.key_bags, storepass, self.iterations)
+
+
+def loads(data: bytes, storepass: str) -> KeyStore:
+    """
+    Parse a keystore, detecting its type.
+
+    Args:
+        data: Keystore contents
+        storepass: Store password
+
+    Returns:
+        JKSKeyStore or PKCS12KeyStore instance
+
+    Raises:
+        KeystoreError: If the keystore can't be read
+    """
+    magic = struct.unpack('>I', data[:4])[0] if len(data) >= 4 else None
+    if magic == JKS_MAGIC:
+        return JKSKeyStore.loads(data, storepass)
+    if magic == JCEKS_MAGIC:
+        raise KeystoreError('JCEKS keystores are not supported')
+    return PKCS12KeyStore.loads(data, storepass)
+
+
+def load(path: str, storepass: str) -> KeyStore:
+    """
+    Read a keystore file, detecting its type.
+
+    Args:
+        path: Path to the keystore
+        storepass: Store password
+
+    Returns:
+        JKSKeyStore or PKCS12KeyStore instance
+    """
+    with open(path, 'rb') as f:
+        return loads(f.read(), storepass)
@@ -0,0 +1,287 @@
+"""
+Module for coordinating certhook processes running at the same time, e.g.
+cron and certbot's deploy hook, or back to back renewals.
+
+Locks are advisory ``flock`` locks on files in a lock directory, released
+by the kernel if their holder dies. ``FileLock`` serialises access to one
+resource, such as a deployment or a keystore. ``Coalescer`` additionally
+merges requests for the same work: a process asking for it while another
+process's run is still pending waits for that run and shares its outcome,
+instead of doing the work again.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import time
+from typing import Iterable, List, Optional
+from urllib.parse import quote
+
+DEFAULT_LOCK_DIR = '/run/lock/certhook'
+# Number of finished runs a Coalescer keeps the outcome of, for requests still waiting for the lock
+RUN_HISTORY = 32
+
+
+def lock_path(name: str, directory: Optional[str] = None) -> str:
+    """
+    Path of the lock file for a resource name, creating the lock directory.
+
+    Args:
+        name: Name of the resource, e.g. ``restart:apache2@localhost``
+        directory: Lock directory, ``DEFAULT_LOCK_DIR`` if None
+    """
+    directory = directory or DEFAULT_LOCK_DIR
+    os.makedirs(directory, mode=0o755, exist_ok=True)
+    filename = quote(name, safe='@:._-')
+    if len(filename) > 200:
+        # Keep long names, e.g. of deep paths, within the filename length limit
+        filename = filename[:100] + '-' + hashlib.sha256(name.encode()).hexdigest()
+    return os.path.join(directory, filename + '.lock')
+
+
+class FileLock:
+    """
+    Exclusive lock on a named resource, shared by every process and thread.
+
+    Each lock opens its own file description, so two FileLocks on the same
+    name exclude each other within one process too.
+    """
+
+    def __init__(self, name: str, directory: Optional[str] = None):
+        """
+        Args:
+            name: Name of the resource
+            directory: Lock directory, ``DEFAULT_LOCK_DIR`` if None
+        """
+        self.name = name
+        self.directory = directory
+        # Whether acquiring the lock had to wait for another holder
+        self.contended = False
+        # Seconds spent waiting for the lock
+        self.waited = 0.0
+        self._fd: Optional[int] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Take the lock.
+
+        Args:
+            blocking: Wait for the lock if it's held, rather than giving up
+
+        Returns:
+            True if the lock was taken, False if it's held and blocking is False
+        """
+        fd = os.open(lock_path(self.name, self.directory), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.contended = False
+            except BlockingIOError:
+                if not blocking:
+                    os.close(fd)
+                    return False
+                self.contended = True
+                start = time.monotonic()
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self.waited = time.monotonic() - start
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        """Release the lock, if held"""
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @property
+    def locked(self) -> bool:
+        """Whether this lock is held"""
+        return self._fd is not None
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+    def __repr__(self) -> str:
+        return f'FileLock({self.name!r})'
+
+
+class LockSet:
+    """
+    Several FileLocks taken together, always in name order so that
+    processes taking overlapping sets can't deadlock.
+    """
+
+    def __init__(self, names: Iterable[str], directory: Optional[str] = None):
+        """
+        Args:
+            names: Names of the resources
+            directory: Lock directory, ``DEFAULT_LOCK_DIR`` if None
+        """
+        self.locks: List[FileLock] = [FileLock(name, directory) for name in sorted(set(names))]
+
+    @property
+    def contended(self) -> bool:
+        """Whether any of the locks had to wait for another holder"""
+        return any(lock.contended for lock in self.locks)
+
+    def acquire(self) -> None:
+        """Take every lock, waiting for each in turn"""
+        try:
+            for lock in self.locks:
+                lock.acquire()
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self) -> None:
+        """Release every lock held"""
+        for lock in reversed(self.locks):
+            lock.release()
+
+    def __enter__(self) -> 'LockSet':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+def deployment_locks(app: str, manager, directory: Optional[str] = None) -> LockSet:
+    """
+    Locks held while a manager deploys: one for its (app, certificate) pair,
+    and one for every file it produces on its host, such as a keystore
+    shared by several certificates.
+
+    Args:
+        app: Application the manager deploys to
+        manager: Certificate manager for the deployment
+        directory: Lock directory, ``DEFAULT_LOCK_DIR`` if None
+    """
+    host = manager.transport.host
+    return LockSet([f'deploy:{app}:{manager.cert_name}']
+                   + [f'file:{path}@{host}' for path in manager.artifacts], directory)
+
+
+class CoalescedError(RuntimeError):
+    """
+    The run of another process that covered this process's request failed.
+    """
+
+
+class Coalescer:
+    """
+    Work done once for every request made while it's pending, across processes.
+
+    Each request takes a ticket, then waits for the work's lock. Once it
+    holds the lock, a request another process's run has already covered
+    (the run started after the ticket was taken) is done, sharing that run's
+    outcome. Otherwise this process does the work, covering every ticket
+    taken so far, including those of processes still waiting for the lock.
+
+    Outcomes are kept per run, by the range of tickets the run covered, so
+    a request reports the run that covered it even if later runs finished
+    before it got the lock. A request whose run is no longer on record does
+    the work again.
+
+    Usage::
+
+        coalescer = Coalescer('restart:apache2@localhost')
+        if coalescer.join():
+            try:
+                restart()
+            except Exception as e:
+                coalescer.done(e)
+                raise
+            coalescer.done()
+    """
+
+    def __init__(self, name: str, directory: Optional[str] = None):
+        """
+        Args:
+            name: Name of the work, e.g. ``restart:apache2@localhost``
+            directory: Lock directory, ``DEFAULT_LOCK_DIR`` if None
+        """
+        self.name = name
+        self.directory = directory
+        self._lock = FileLock(name, directory)
+        self._ticket = 0
+        self._covers = 0
+
+    def _update(self, change) -> dict:
+        """
+        Apply a change to the work's shared counters, under their own lock.
+
+        The counters are ``requested`` (tickets taken), ``done`` (last ticket
+        covered by a finished run) and ``runs``, the ``[first, last, error]``
+        tickets covered by each of the latest runs and its error, if any.
+        """
+        path = lock_path(self.name + ':queue', self.directory)
+        with open(path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                counters = json.loads(f.read() or '{}')
+            except ValueError:
+                counters = {}
+            counters.setdefault('requested', 0)
+            counters.setdefault('done', 0)
+            counters.setdefault('runs', [])
+            change(counters)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(counters))
+            return dict(counters)
+
+    def join(self) -> bool:
+        """
+        Request the work, waiting for any run in progress to finish.
+
+        Returns:
+            True if this process must now do the work (and then call
+            ``done``), False if another process's run covered the request
+
+        Raises:
+            CoalescedError: If the run that covered the request failed
+        """
+        def take(counters):
+            counters['requested'] += 1
+        self._ticket = self._update(take)['requested']
+        self._lock.acquire()
+        counters = self._update(lambda counters: None)
+        if counters['done'] >= self._ticket:
+            covering = [run for run in counters['runs'] if run[0] <= self._ticket <= run[1]]
+            if covering:
+                self._lock.release()
+                error = covering[0][2]
+                if error is not None:
+                    raise CoalescedError(f'{self.name} failed in another process: {error}')
+                return False
+        self._covers = counters['requested']
+        return True
+
+    def done(self, error: Optional[BaseException] = None) -> None:
+        """
+        Record the outcome of this process's run for every request it covered,
+        and let the next waiting process continue.
+
+        Args:
+            error: Error the run failed with, None if it succeeded
+        """
+        def finish(counters):
+            if self._covers > counters['done']:
+                outcome = None if error is None else str(error) or type(error).__name__
+                counters['runs'] = (counters['runs'] + [[counters['done'] + 1, self._covers, outcome]])[-RUN_HISTORY:]
+                counters['done'] = self._covers
+        try:
+            self._update(finish)
+        finally:
+            self._lock.release()
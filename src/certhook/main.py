@@ -3,37 +3,501 @@ Main CLI entry point for certhook.
 """
 
 import argparse
+import json
+import logging
+import os
 import sys
-from . import unifi
-from . import pihole
-from . import emby
-from . import freepbx
-
-APP_MANAGERS = {
-    'unifi': unifi.UnifiCertManager,
-    'pihole': pihole.PiHoleCertManager,
-    'emby': emby.EmbyCertManager,
-    'freepbx': freepbx.FreePBXCertManager
-}
+from typing import Optional
+from . import artifacts
+from . import output
+from . import registry
+from . import state
+from . import transport
+from .base import BaseCertManager
+from .batch import DEFAULT_MANIFEST, BatchRunner, load_manifest, parse_job, split_app
+from .deadlines import Deadline
 
-def main():
-    """Main entry point for the certhook CLI."""
-    parser = argparse.ArgumentParser(description='Certificate management tool')
-    parser.add_argument('app', choices=list(APP_MANAGERS.keys()),
-                      help='Application to manage certificates for')
-    parser.add_argument('cert_name',
-                      help='Name of the certificate (e.g., example.com)')
+# Modules only some sub-commands use (watch, status, serve, --verify and metrics
+# output) are imported by those, keeping them out of every deployment's startup
+
+# Manager classes by app name, imported only when their app is used
+APP_MANAGERS = registry.managers
+
+logger = logging.getLogger(__name__)
+
+
+def add_manager_args(parser: argparse.ArgumentParser) -> None:
+    """Add the options used to build managers."""
     parser.add_argument('--verbose', action='store_true',
                       help='Enable verbose output')
+    parser.add_argument('--no-native', dest='native', action='store_false',
+                      help='Use external tools (e.g., openssl) instead of the '
+                           'built-in implementations')
+    parser.add_argument('--wait-ready', action='store_true',
+                      help='Wait for restarted services to serve again, failing '
+                           'the deployment if they take too long')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                      help='Seconds the whole run may take; steps still running are '
+                           'terminated and the rest fail as timed out')
+    parser.add_argument('--step-timeout', type=float, metavar='SECONDS',
+                      help='Seconds any one command may run before it is terminated')
+    parser.add_argument('--retries', type=int,
+                      help='Times to retry failed steps that are safe to repeat '
+                           f'(default: {BaseCertManager.retries})')
+    parser.add_argument('--log-format', choices=sorted(output.FORMATTERS), default='text',
+                      help='Format of the log written to standard error, one timestamped '
+                           'line or JSON object per record (default: text)')
+
+
+def manager_options(args: argparse.Namespace) -> dict:
+    """Keyword arguments for building managers, leaving defaults unset."""
+    options = {'verbose': args.verbose}
+    if not args.native:
+        options['native'] = False
+    if args.wait_ready:
+        options['wait_ready'] = True
+    return options
+
+
+def apply_deadline(args: argparse.Namespace, managers: list) -> None:
+    """Give the managers of a run a shared deadline, starting now, if one was requested."""
+    if args.timeout is not None:
+        deadline = Deadline(args.timeout)
+        for manager in managers:
+            manager.deadline = deadline
+
+
+def configure_logging(args: argparse.Namespace) -> None:
+    """Send log records, including verbose command output, to standard error."""
+    output.configure(args.log_format)
+
+
+def add_daemon_args(parser: argparse.ArgumentParser) -> None:
+    """Add the options for commands a ``certhook serve`` daemon can run."""
+    parser.add_argument('--queue', action='store_true',
+                      help='If a certhook serve daemon is running, return once it has queued '
+                           'the jobs instead of waiting for their results, which go to its log')
+
+
+def add_state_args(parser: argparse.ArgumentParser) -> None:
+    """Add the change detection options shared by all deploying commands."""
+    parser.add_argument('--force', action='store_true',
+                      help='Deploy even if the certificate has not changed')
+    parser.add_argument('--state-file', default=state.DEFAULT_STATE_FILE,
+                      help=f'File recording past deployments (default: {state.DEFAULT_STATE_FILE})')
+    parser.add_argument('--artifact-cache', metavar='DIR',
+                      help='Directory caching converted files, which hold private keys, so '
+                           'deployments needing the same file share one conversion (e.g., '
+                           f'{artifacts.DEFAULT_CACHE_DIR}; default: no cache)')
+
+
+def add_metrics_args(parser: argparse.ArgumentParser) -> None:
+    """Add the options for writing out deployment measurements."""
+    parser.add_argument('--metrics-file',
+                      help='Prometheus textfile (.prom) to write step timings to, '
+                           "for node_exporter's textfile collector")
+    parser.add_argument('--metrics-json',
+                      help='File to append step timings to, one JSON object per line')
+    parser.add_argument('--trace-file',
+                      help='Chrome trace file to write step timings to')
+
+
+def metrics_recorder(args: argparse.Namespace, managers: list) -> Optional['metrics.Recorder']:
+    """Attach a recorder to the managers if any metrics output was requested."""
+    if not (args.metrics_file or args.metrics_json or args.trace_file):
+        return None
+    from . import metrics
+    recorder = metrics.Recorder()
+    for manager in managers:
+        manager.metrics = recorder
+    return recorder
+
+
+def write_metrics(args: argparse.Namespace, recorder: Optional['metrics.Recorder']) -> None:
+    """Write out the measurements taken by a recorder from metrics_recorder."""
+    if recorder is not None:
+        recorder.write(args.metrics_file, args.metrics_json, args.trace_file)
+
+
+def add_verify_args(parser: argparse.ArgumentParser) -> None:
+    """Add the options for checking the deployed certificates are served."""
+    parser.add_argument('--verify', action='store_true',
+                      help='Check the services serve the new certificates once deployed')
+    parser.add_argument('--verify-timeout', type=float, default=5.0,
+                      help='Seconds each endpoint has to serve the new certificate, retrying '
+                           'while it refuses connections or serves the old one (default: 5)')
+
+
+def deployed_jobs(jobs: list, report) -> list:
+    """The (app, manager) jobs a batch report says were deployed."""
+    return [job for job, result in zip(jobs, report.results) if result.success and not result.skipped]
+
+
+def verify_jobs(args: argparse.Namespace, jobs: list) -> int:
+    """Check deployed jobs if asked to, returning the exit status."""
+    if not args.verify or not jobs:
+        return 0
+    from . import verify
+    report = verify.verify(jobs, timeout=args.verify_timeout)
+    print(report.summary(), flush=True)
+    return 1 if report.failed else 0
+
+
+def add_batch_args(parser: argparse.ArgumentParser) -> None:
+    """Add the options controlling how many jobs run at once."""
+    parser.add_argument('--workers', type=int, default=4,
+                      help='Maximum number of jobs to run at once (default: 4)')
+    parser.add_argument('--per-app-limit', type=int, default=1,
+                      help='Maximum number of jobs to run at once per app (default: 1)')
+
+
+def batch_runner(args: argparse.Namespace) -> BatchRunner:
+    """Batch runner configured from the command line options."""
+    return BatchRunner(max_workers=args.workers, per_app_limit=args.per_app_limit,
+                       verbose=args.verbose, state=state.StateStore(args.state_file),
+                       force=args.force)
+
+
+def check_apps(parser: argparse.ArgumentParser, specs: list) -> None:
+    """Exit with an error if any (app, cert) job names an unknown app."""
+    for app, _ in specs:
+        if split_app(app)[0] not in APP_MANAGERS:
+            parser.error(f"unknown app '{app}' (choose from {', '.join(APP_MANAGERS)})")
+
+
+def build_manager(args: argparse.Namespace, app: str, cert_name: str) -> BaseCertManager:
+    """Manager for an (app, cert) job, deploying to the job's host."""
+    name, host = split_app(app)
+    manager = APP_MANAGERS[name](cert_name=cert_name, **manager_options(args))
+    if args.step_timeout is not None:
+        manager.step_timeout = args.step_timeout
+    if args.retries is not None:
+        manager.retries = args.retries
+    if args.artifact_cache:
+        manager.artifact_cache = artifacts.shared(args.artifact_cache)
+    if host != 'localhost':
+        manager.transport = transport.connect(host)
+    return manager
+
+
+def batch_parser(parser_class: type = argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """Parser for the ``certhook batch`` sub-command."""
+    parser = parser_class(prog='certhook batch', description='Deploy many certificates in one run')
+    parser.add_argument('jobs', nargs='*', metavar='app:cert',
+                      help='Job to run (e.g., unifi:example.com)')
+    parser.add_argument('--manifest',
+                      help='File listing one app:cert job per line')
+    add_batch_args(parser)
+    add_manager_args(parser)
+    add_state_args(parser)
+    add_metrics_args(parser)
+    add_verify_args(parser)
+    add_daemon_args(parser)
+    return parser
+
+
+def batch_specs(parser: argparse.ArgumentParser, args: argparse.Namespace) -> list:
+    """The (app, cert) jobs of a ``certhook batch`` command line."""
+    try:
+        specs = load_manifest(args.manifest) if args.manifest else []
+        specs.extend(parse_job(job) for job in args.jobs)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if not specs:
+        parser.error('no jobs given')
+    check_apps(parser, specs)
+    return specs
+
+
+def batch_main(argv: list) -> int:
+    """Entry point for the ``certhook batch`` sub-command."""
+    parser = batch_parser()
+    args = parser.parse_args(argv)
+    configure_logging(args)
+    specs = batch_specs(parser, args)
+
+    # Build every manager up front so argument problems surface before any work starts
+    jobs = [(app, build_manager(args, app, cert_name)) for app, cert_name in specs]
+
+    recorder = metrics_recorder(args, [manager for _, manager in jobs])
+    apply_deadline(args, [manager for _, manager in jobs])
+    try:
+        report = batch_runner(args).run(jobs)
+    finally:
+        write_metrics(args, recorder)
+        transport.close_all()
+    print(report.summary())
+    verified = verify_jobs(args, deployed_jobs(jobs, report))
+    return 1 if report.failed or verified else 0
+
+
+def hook_parser(parser_class: type = argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """Parser for the ``certhook hook`` sub-command."""
+    parser = parser_class(prog='certhook hook',
+                          description="Deploy the certificate certbot just renewed "
+                                      "(use as certbot's --deploy-hook)")
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST,
+                      help=f'File listing one app:cert job per line (default: {DEFAULT_MANIFEST})')
+    add_batch_args(parser)
+    add_manager_args(parser)
+    add_state_args(parser)
+    add_metrics_args(parser)
+    add_verify_args(parser)
+    add_daemon_args(parser)
+    return parser
+
+
+def hook_specs(parser: argparse.ArgumentParser, args: argparse.Namespace, env: dict) -> list:
+    """The manifest's (app, cert) jobs for the lineage certbot renewed, named in ``env``."""
+    lineage = env.get('RENEWED_LINEAGE')
+    if not lineage:
+        parser.error('RENEWED_LINEAGE is not set, run from certbot --deploy-hook')
+    cert_name = os.path.basename(lineage.rstrip('/'))
+    try:
+        specs = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    check_apps(parser, specs)
+    return [(app, job_cert) for app, job_cert in specs if job_cert == cert_name]
+
+
+def hook_main(argv: list) -> int:
+    """Entry point for the ``certhook hook`` sub-command, run as certbot's deploy hook."""
+    parser = hook_parser()
+    args = parser.parse_args(argv)
+    configure_logging(args)
+    specs = hook_specs(parser, args, os.environ)
+
+    jobs = [(app, build_manager(args, app, cert_name)) for app, cert_name in specs]
+    if args.verbose:
+        cert_name = os.path.basename(os.environ['RENEWED_LINEAGE'].rstrip('/'))
+        domains = os.environ.get('RENEWED_DOMAINS', '')
+        logger.info('Renewed %s (%s): %d jobs', cert_name, domains, len(jobs), extra={'cert': cert_name})
+    if not jobs:
+        return 0
+    recorder = metrics_recorder(args, [manager for _, manager in jobs])
+    apply_deadline(args, [manager for _, manager in jobs])
+    try:
+        report = batch_runner(args).run(jobs)
+    finally:
+        write_metrics(args, recorder)
+        transport.close_all()
+    print(report.summary())
+    verified = verify_jobs(args, deployed_jobs(jobs, report))
+    return 1 if report.failed or verified else 0
+
+
+def watch_main(argv: list) -> int:
+    """Entry point for the ``certhook watch`` sub-command."""
+    parser = argparse.ArgumentParser(prog='certhook watch',
+                                     description='Deploy certificates as soon as they are renewed')
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST,
+                      help='File listing one app:cert job per line, re-read on every change '
+                           f'(default: {DEFAULT_MANIFEST})')
+    parser.add_argument('--debounce', type=float, default=2.0,
+                      help='Seconds without changes that end a renewal (default: 2)')
+    add_batch_args(parser)
+    add_manager_args(parser)
+    add_state_args(parser)
+    add_metrics_args(parser)
+    add_verify_args(parser)
+
+    args = parser.parse_args(argv)
+    if args.force:
+        # Every deployment restarts services, which would be deployed again for ever
+        parser.error('--force is not supported in watch mode')
+    configure_logging(args)
+
+    from .watch import Watcher
+    try:
+        check_apps(parser, load_manifest(args.manifest))
+        watcher = Watcher(BaseCertManager.live_root, args.debounce)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    runner = batch_runner(args)
+    try:
+        for lineages in watcher.changes():
+            try:
+                specs = load_manifest(args.manifest)
+            except (OSError, ValueError) as e:
+                logger.error('Could not read manifest: %s', e)
+                continue
+            specs = [(app, cert_name) for app, cert_name in specs
+                     if cert_name in lineages and split_app(app)[0] in APP_MANAGERS]
+            jobs = [(app, build_manager(args, app, cert_name)) for app, cert_name in specs]
+            if args.verbose:
+                for lineage in sorted(lineages):
+                    logger.info('Changed: %d jobs', sum(cert_name == lineage for _, cert_name in specs),
+                                extra={'cert': lineage})
+            if jobs:
+                recorder = metrics_recorder(args, [manager for _, manager in jobs])
+                apply_deadline(args, [manager for _, manager in jobs])
+                try:
+                    report = runner.run(jobs)
+                finally:
+                    write_metrics(args, recorder)
+                print(report.summary(), flush=True)
+                verify_jobs(args, deployed_jobs(jobs, report))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        transport.close_all()
+    return 0
+
+
+def status_main(argv: list) -> int:
+    """Entry point for the ``certhook status`` sub-command."""
+    from . import inventory
+    parser = argparse.ArgumentParser(prog='certhook status',
+                                     description='Report on every certificate lineage')
+    parser.add_argument('--live-root', default=BaseCertManager.live_root,
+                      help=f'Directory holding the lineages (default: {BaseCertManager.live_root})')
+    parser.add_argument('--index', default=inventory.DEFAULT_INDEX,
+                      help=f'File caching parsed certificates (default: {inventory.DEFAULT_INDEX})')
+    parser.add_argument('--no-index', dest='index', action='store_const', const=None,
+                      help='Parse every certificate without reading or updating the index')
+    parser.add_argument('--sort', choices=['expiry', 'name'], default='expiry',
+                      help='Order of the lineages (default: expiry)')
+    parser.add_argument('--within', type=float, metavar='DAYS',
+                      help='Only report certificates expiring within this many days')
+    parser.add_argument('--json', action='store_true',
+                      help='Print a JSON array instead of a table')
+    parser.add_argument('--workers', type=int, default=8,
+                      help='Maximum number of lineages read at once (default: 8)')
+
+    args = parser.parse_args(argv)
+
+    index = inventory.Index(args.index)
+    results = inventory.scan(args.live_root, index, args.workers)
+    try:
+        index.save()
+    except OSError as e:
+        print(f'Could not update index: {e}', file=sys.stderr)
+    if args.sort == 'expiry':
+        results = inventory.by_expiry(results)
+    if args.within is not None:
+        results = [result for result in results
+                   if result.cert is None or result.days_left() <= args.within]
+
+    if args.json:
+        print(json.dumps([result.as_dict() for result in results], indent=2))
+    else:
+        for result in results:
+            if result.cert is None:
+                print(f'{result.name}  ERROR: {result.error}')
+                continue
+            print(f"{result.name}  expires {result.cert['not_after'][:10]} "
+                  f"({result.days_left():.0f} days)  {result.cert['key_type']}  "
+                  f"{', '.join(result.cert['sans'])}")
+    return 1 if any(result.error is not None for result in results) else 0
+
+
+def serve_main(argv: list) -> int:
+    """Entry point for the ``certhook serve`` sub-command."""
+    from . import client
+    from .daemon import Server
+    parser = argparse.ArgumentParser(prog='certhook serve',
+                                     description='Run the deployments other certhook commands '
+                                                 'send, keeping loaded apps, connections and '
+                                                 'files read between them')
+    parser.add_argument('--socket', default=client.socket_path(),
+                      help=f'Unix socket to listen on (default: {client.DEFAULT_SOCKET}, '
+                           f'or ${client.SOCKET_ENV})')
+    parser.add_argument('--batch-window', type=float, default=0.2, metavar='SECONDS',
+                      help='Seconds to wait for more requests before deploying the ones '
+                           'received, so they share service restarts (default: 0.2)')
+    parser.add_argument('--log-format', choices=sorted(output.FORMATTERS), default='text',
+                      help='Format of the log written to standard error (default: text)')
+
+    args = parser.parse_args(argv)
+    output.configure(args.log_format)
+
+    server = Server(args.socket, args.batch_window)
+    try:
+        server.bind()
+    except OSError as e:
+        parser.error(str(e))
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        transport.close_all()
+    return 0
+
+
+def deploy_parser(parser_class: type = argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """Parser for deploying a single certificate, ``certhook <app> <cert>``."""
+    parser = parser_class(description='Certificate management tool',
+                          epilog='Sub-commands: "certhook batch" deploys many '
+                                 'certificates at once, "certhook hook" deploys '
+                                 'from certbot\'s --deploy-hook, "certhook '
+                                 'watch" deploys certificates as they are renewed, '
+                                 '"certhook status" reports on every certificate and '
+                                 '"certhook serve" runs the other commands\' deployments '
+                                 'in a long running process.')
+    # The registry itself is given as the choices, so only --help and errors list every app
+    parser.add_argument('app', choices=APP_MANAGERS, metavar='app',
+                      help='Application to manage certificates for (%(choices)s)')
+    parser.add_argument('cert_name',
+                      help='Name of the certificate (e.g., example.com)')
+    add_manager_args(parser)
+    add_state_args(parser)
+    add_metrics_args(parser)
+    add_verify_args(parser)
+    add_daemon_args(parser)
+    parser.add_argument('--host',
+                      help='Deploy to another host over SSH (e.g., root@pihole.lan)')
+    return parser
+
+
+def deploy_specs(parser: argparse.ArgumentParser, args: argparse.Namespace) -> list:
+    """The single (app, cert) job of a ``certhook <app> <cert>`` command line."""
+    return [(f'{args.app}@{args.host}' if args.host else args.app, args.cert_name)]
+
+
+COMMANDS = {
+    'batch': batch_main,
+    'hook': hook_main,
+    'watch': watch_main,
+    'status': status_main,
+    'serve': serve_main,
+}
+
+# Parser and job list of the commands a ``certhook serve`` daemon can run, None for a
+# single deployment, with the job lists given the client's environment
+DEPLOY_COMMANDS = {
+    'batch': (batch_parser, lambda parser, args, env: batch_specs(parser, args)),
+    'hook': (hook_parser, hook_specs),
+    None: (deploy_parser, lambda parser, args, env: deploy_specs(parser, args)),
+}
+
+
+def main(argv: list = None):
+    """Main entry point for the certhook CLI, running everything in this process."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
 
-    args = parser.parse_args()
+    parser = deploy_parser()
+    args = parser.parse_args(argv)
+    configure_logging(args)
+    (app, cert_name), = deploy_specs(parser, args)
 
-    # Get the manager class for the selected app
-    manager_class = APP_MANAGERS[args.app]
-    
-    # Create and run the manager
-    manager = manager_class(cert_name=args.cert_name, verbose=args.verbose)
-    manager()
+    # Create and run the manager, skipping it if nothing changed
+    manager = build_manager(args, app, cert_name)
+    recorder = metrics_recorder(args, [manager])
+    apply_deadline(args, [manager])
+    try:
+        deployed = state.StateStore(args.state_file).deploy(app, manager, force=args.force)
+    finally:
+        write_metrics(args, recorder)
+        transport.close_all()
+    return verify_jobs(args, [(app, manager)] if deployed else [])
 
 if __name__ == '__main__':
     sys.exit(main())
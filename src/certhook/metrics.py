@@ -0,0 +1,264 @@
+"""
+Module for measuring deployments.
+
+A ``Recorder`` attached to managers records every command and in-process
+operation they run: wall time, CPU time, peak memory, exit code and bytes
+written. Recorded steps can be written as a Prometheus textfile for
+node_exporter, as JSON lines, or as a Chrome trace for chrome://tracing
+or Perfetto.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .deadlines import timed_out
+from .ops import UnsupportedOperation, write_atomic
+from .pipeline import Pipeline
+
+# Per-thread usage shows only the in-process operation being measured
+RUSAGE_OPERATION = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+# Size of the blocks counted by ru_oublock
+BLOCK_SIZE = 512
+# Exit status reported for steps that timed out, as timeout(1) exits with
+TIMEOUT_EXIT_CODE = 124
+
+
+class StepMetrics:
+    """
+    Measurements of a single command or operation.
+    """
+
+    def __init__(self, manager: str, cert_name: str, step: str, start: float):
+        """
+        Args:
+            manager: Name of the manager class that ran the step
+            cert_name: Name of the certificate being deployed
+            step: Short name of the step, e.g. ``keytool -importkeystore``
+            start: Start time as a Unix timestamp
+        """
+        self.manager = manager
+        self.cert_name = cert_name
+        self.step = step
+        self.start = start
+        self.wall = 0.0
+        self.user = 0.0
+        self.sys = 0.0
+        # Lifetime peak resident memory of certhook or of its child processes,
+        # 0 unless the step raised it
+        self.max_rss = 0
+        self.exit_code = 0
+        # Bytes written on this host, 0 for steps run on another host
+        self.bytes_written = 0
+        self.thread = threading.get_ident()
+
+    def as_dict(self) -> dict:
+        """Measurements as a JSON serialisable dict"""
+        return {name: value for name, value in vars(self).items() if name != 'thread'}
+
+
+def step_name(cmd) -> str:
+    """
+    Short name for a command or operation, e.g. ``fwconsole certificate``.
+    """
+    if isinstance(cmd, list):
+        return ' '.join([os.path.basename(cmd[0])] + cmd[1:2])
+    if isinstance(cmd, Pipeline):
+        return ' | '.join(step_name(stage) for stage in cmd.commands)
+    return type(cmd).__name__
+
+
+def exit_code(error: BaseException) -> int:
+    """Exit status to report for a step that raised"""
+    if isinstance(error, UnsupportedOperation):
+        # Not a failure, the equivalent commands run and are measured instead
+        return 0
+    if isinstance(error, subprocess.CalledProcessError):
+        return error.returncode
+    if timed_out(error):
+        return TIMEOUT_EXIT_CODE
+    if isinstance(error, FileNotFoundError):
+        return 127
+    return 1
+
+
+def escape(value: str) -> str:
+    """Escape a Prometheus label value"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Recorder:
+    """
+    Collects step measurements from any number of managers and threads.
+    """
+
+    def __init__(self):
+        self.steps: List[StepMetrics] = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, manager, cmd):
+        """
+        Measure a command or operation run inside the block.
+
+        Commands are measured by the change in resource usage of child
+        processes, so overlapping commands may be attributed each other's
+        CPU time. Operations are measured by the usage of the calling thread.
+        Peak memory is only known for the lifetime of the process (or of all
+        child processes), so it is only reported for steps that raised it.
+
+        Args:
+            manager: Manager running the step
+            cmd: Command (list), pipeline or operation
+        """
+        child = isinstance(cmd, (list, Pipeline))
+        who = resource.RUSAGE_CHILDREN if child else RUSAGE_OPERATION
+        metrics = StepMetrics(type(manager).__name__, manager.cert_name, step_name(cmd), time.time())
+        before = resource.getrusage(who)
+        start = time.perf_counter()
+        try:
+            yield metrics
+        except BaseException as e:
+            metrics.exit_code = exit_code(e)
+            raise
+        finally:
+            metrics.wall = time.perf_counter() - start
+            after = resource.getrusage(who)
+            metrics.user = after.ru_utime - before.ru_utime
+            metrics.sys = after.ru_stime - before.ru_stime
+            # ru_maxrss is in KiB on Linux, and never goes down
+            if after.ru_maxrss > before.ru_maxrss:
+                metrics.max_rss = after.ru_maxrss * 1024
+            # Files written on another host don't show in local usage and paths
+            if manager.transport.local and child:
+                metrics.bytes_written = (after.ru_oublock - before.ru_oublock) * BLOCK_SIZE
+            elif manager.transport.local:
+                metrics.bytes_written = sum(os.path.getsize(path) for path in getattr(cmd, 'outputs', [])
+                                            if os.path.isfile(path))
+            with self._lock:
+                self.steps.append(metrics)
+
+    def deployments(self) -> Dict[Tuple[str, str], dict]:
+        """
+        Totals per deployment.
+
+        Returns:
+            Mapping of (manager, cert_name) to its wall time from first step
+            start to last step end, CPU time and number of steps
+        """
+        totals: Dict[Tuple[str, str], dict] = {}
+        for step in self.steps:
+            total = totals.setdefault((step.manager, step.cert_name),
+                                      {'start': step.start, 'end': step.start, 'cpu': 0.0, 'steps': 0})
+            total['start'] = min(total['start'], step.start)
+            total['end'] = max(total['end'], step.start + step.wall)
+            total['cpu'] += step.user + step.sys
+            total['steps'] += 1
+        return totals
+
+    def prometheus(self) -> str:
+        """
+        Measurements in the Prometheus text exposition format.
+
+        Steps with the same name within a deployment are added together.
+        """
+        series: Dict[Tuple[str, str, str], dict] = {}
+        for step in self.steps:
+            values = series.setdefault((step.manager, step.cert_name, step.step), {
+                'seconds': 0.0, 'cpu_user_seconds': 0.0, 'cpu_system_seconds': 0.0,
+                'max_rss_bytes': 0, 'exit_code': 0, 'written_bytes': 0})
+            values['seconds'] += step.wall
+            values['cpu_user_seconds'] += step.user
+            values['cpu_system_seconds'] += step.sys
+            values['max_rss_bytes'] = max(values['max_rss_bytes'], step.max_rss)
+            values['exit_code'] = values['exit_code'] or step.exit_code
+            values['written_bytes'] += step.bytes_written
+
+        lines = []
+
+        def metric(name: str, help_text: str, samples) -> None:
+            lines.append(f'# HELP certhook_{name} {help_text}')
+            lines.append(f'# TYPE certhook_{name} gauge')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{escape(val)}"' for key, val in labels)
+                lines.append(f'certhook_{name}{{{label_text}}} {value}' if labels else f'certhook_{name} {value}')
+
+        step_help = {
+            'seconds': 'Wall time of the step',
+            'cpu_user_seconds': 'User CPU time of the step',
+            'cpu_system_seconds': 'System CPU time of the step',
+            'max_rss_bytes': 'Lifetime peak resident memory of certhook or its child processes, '
+                             'if the step raised it, else 0',
+            'exit_code': 'Exit status of the step, 0 on success',
+            'written_bytes': 'Bytes written by the step on the local host',
+        }
+        for name, help_text in step_help.items():
+            metric(f'step_{name}', help_text,
+                   [((('manager', manager), ('cert', cert), ('step', step)), values[name])
+                    for (manager, cert, step), values in sorted(series.items())])
+
+        deployments = sorted(self.deployments().items())
+        metric('deployment_seconds', 'Wall time of the deployment',
+               [((('manager', manager), ('cert', cert)), total['end'] - total['start'])
+                for (manager, cert), total in deployments])
+        metric('deployment_cpu_seconds', 'CPU time of the deployment',
+               [((('manager', manager), ('cert', cert)), total['cpu'])
+                for (manager, cert), total in deployments])
+        metric('run_seconds', 'Wall time of the run', [((), time.time() - self.started)])
+        metric('run_steps', 'Number of steps in the run', [((), len(self.steps))])
+        metric('run_failed_steps', 'Number of failed steps in the run',
+               [((), sum(1 for step in self.steps if step.exit_code))])
+        metric('run_timestamp_seconds', 'Start time of the run', [((), self.started)])
+        return '\n'.join(lines) + '\n'
+
+    def trace(self) -> dict:
+        """
+        Measurements in the Chrome trace event format.
+        """
+        pid = os.getpid()
+        events = [{
+            'name': step.step,
+            'cat': f'{step.manager} {step.cert_name}',
+            'ph': 'X',
+            'ts': (step.start - self.started) * 1e6,
+            'dur': step.wall * 1e6,
+            'pid': pid,
+            'tid': step.thread,
+            'args': step.as_dict(),
+        } for step in self.steps]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, prometheus: Optional[str] = None, json_lines: Optional[str] = None,
+              trace: Optional[str] = None) -> None:
+        """
+        Write the measurements to any of the supported formats.
+
+        Args:
+            prometheus: Path of the ``.prom`` file to replace, for node_exporter's textfile collector
+            json_lines: Path of the file to append one JSON object per step to
+            trace: Path of the Chrome trace file to replace
+        """
+        with self._lock:
+            if prometheus:
+                write_atomic(prometheus, self.prometheus().encode(), 0o644)
+            if json_lines:
+                with open(json_lines, 'a') as f:
+                    for step in self.steps:
+                        f.write(json.dumps(step.as_dict(), sort_keys=True) + '\n')
+            if trace:
+                write_atomic(trace, json.dumps(self.trace()).encode(), 0o644)
+
+
+def measure(recorder: Optional[Recorder], manager, cmd):
+    """
+    Context manager measuring a step with a recorder, or doing nothing without one.
+    """
+    if recorder is None:
+        return contextlib.nullcontext()
+    return recorder.measure(manager, cmd)
@@ -0,0 +1,599 @@
+"""
+In-process operations that can be queued in a certificate manager's command list.
+
+Each operation runs natively in Python, and can describe the equivalent
+external commands for when a manager is asked not to run natively.
+"""
+
+import contextlib
+import errno
+import functools
+import grp
+import os
+import pwd
+import shutil
+import stat
+import tempfile
+import time
+from typing import Callable, List, Optional, Tuple
+
+from .pipeline import Pipeline
+
+
+class UnsupportedOperation(Exception):
+    """
+    Raised by an operation that can't be performed in-process for this
+    particular input, so its equivalent commands should be run instead.
+    """
+
+
+@contextlib.contextmanager
+def atomic_open(path: str, mode: int = 0o600, uid: int = -1, gid: int = -1):
+    """
+    Open a temporary file that's renamed over a path once fully written.
+
+    The owner and permissions are set before the rename, so the file never
+    appears at its path with the wrong ones. On error the temporary file is
+    removed and the path is left untouched.
+
+    Args:
+        path: Destination path
+        mode: Permissions of the new file
+        uid: Owner of the new file, -1 to leave as the current user
+        gid: Group of the new file, -1 to leave as the current group
+
+    Yields:
+        Binary file object to write the contents to
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        if uid != -1 or gid != -1:
+            os.chown(tmp_path, uid, gid)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_atomic(path: str, data: bytes, mode: int = 0o600, uid: int = -1, gid: int = -1) -> None:
+    """
+    Write a file by renaming a fully written temporary file over it.
+
+    Args:
+        path: Destination path
+        data: File contents
+        mode: Permissions of the new file
+        uid: Owner of the new file, -1 to leave as the current user
+        gid: Group of the new file, -1 to leave as the current group
+    """
+    with atomic_open(path, mode, uid, gid) as f:
+        f.write(data)
+
+
+# Errors meaning a kernel copy isn't possible between these two files
+_NO_KERNEL_COPY = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+def copy_fd(src: int, dst: int) -> None:
+    """
+    Append the whole of one file to another at its current position,
+    inside the kernel where possible.
+
+    Tries ``os.copy_file_range``, then ``os.sendfile``, then falls back
+    to reading and writing in chunks.
+
+    Args:
+        src: File descriptor to copy from, read from the start
+        dst: File descriptor to append to
+    """
+    size = os.fstat(src).st_size
+    offset = 0
+    for kernel_copy in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, kernel_copy):
+            continue
+        try:
+            while offset < size:
+                if kernel_copy == 'copy_file_range':
+                    copied = os.copy_file_range(src, dst, size - offset, offset)
+                else:
+                    copied = os.sendfile(dst, src, offset, size - offset)
+                if not copied:
+                    break
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in _NO_KERNEL_COPY:
+                raise
+    while True:
+        chunk = os.pread(src, 65536, offset)
+        if not chunk:
+            return
+        offset += len(chunk)
+        while chunk:
+            chunk = chunk[os.write(dst, chunk):]
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_owner(owner: str) -> Tuple[int, int]:
+    """
+    Look up the ids for a ``user[:group]`` owner, as given to ``chown``.
+
+    Lookups are cached, as the same few accounts are used over and over.
+
+    Args:
+        owner: User and/or group names or numeric ids, e.g. ``root:ssl-certs`` or ``:ssl-certs``
+
+    Returns:
+        Tuple of (uid, gid), -1 for a part that isn't changed
+
+    Raises:
+        UnsupportedOperation: If a user or group doesn't exist locally
+    """
+    user, _, group = owner.partition(':')
+    try:
+        uid = -1 if not user else int(user) if user.isdigit() else pwd.getpwnam(user).pw_uid
+        gid = -1 if not group else int(group) if group.isdigit() else grp.getgrnam(group).gr_gid
+    except KeyError as e:
+        raise UnsupportedOperation(f"Can't resolve owner '{owner}'") from e
+    return uid, gid
+
+
+def walk(path: str, recursive: bool):
+    """
+    Paths to visit for a possibly recursive ``chown``/``chmod``, without
+    following symbolic links below the top level.
+    """
+    yield path
+    if recursive and os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                yield os.path.join(root, name)
+
+
+class Artifact:
+    """
+    A file derived only from the contents of input files, so a conversion
+    made for one deployment can be reused by any other needing the same file.
+    """
+
+    def __init__(self, format: str, inputs: List[str], params: dict, path: str,
+                 render: Callable[[], bytes], mode: int = 0o600, owner: Optional[str] = None):
+        """
+        Args:
+            format: Name of the kind of file, e.g. ``pkcs12``
+            inputs: Paths of the files it's made from
+            params: Other settings the contents depend on, JSON serializable
+            path: Path the file is written to
+            render: Function making the file's contents
+            mode: Permissions of the file
+            owner: Owner of the file as ``user[:group]``, None for the current user
+        """
+        self.format = format
+        self.inputs = list(inputs)
+        self.params = params
+        self.path = path
+        self.render = render
+        self.mode = mode
+        self.owner = owner
+
+
+class Operation:
+    """
+    Base class for in-process operations.
+    """
+    # Whether the operation has no external equivalent and always runs in-process
+    native_only = False
+
+    def __call__(self) -> None:
+        """
+        Perform the operation in-process, overridden by child classes.
+        """
+        raise NotImplementedError
+
+    def commands(self) -> List[list]:
+        """
+        External commands equivalent to the operation, overridden by child classes.
+        """
+        raise NotImplementedError
+
+    @property
+    def outputs(self) -> List[str]:
+        """
+        Paths of the files the operation writes, overridden by child classes.
+        """
+        return []
+
+    def payload(self) -> Tuple[str, bytes, Optional[int], Optional[str]]:
+        """
+        File a native-only operation writes, for sending to another host,
+        overridden by child classes.
+
+        Returns:
+            Tuple of (path, contents, mode or None to keep, owner or None)
+        """
+        raise NotImplementedError
+
+    def artifact(self) -> Optional[Artifact]:
+        """
+        File the operation writes, if it's derived only from its input files
+        and so can be shared through an artifact cache, overridden by child classes.
+        """
+        return None
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __repr__(self) -> str:
+        args = ', '.join(f'{name}={value!r}' for name, value in vars(self).items())
+        return f'{type(self).__name__}({args})'
+
+
+class Copy(Operation):
+    """
+    Copies a file's contents and permissions, like ``cp``.
+    """
+
+    def __init__(self, src: str, dst: str):
+        """
+        Args:
+            src: Path of the file to copy
+            dst: Destination path
+        """
+        self.src = src
+        self.dst = dst
+
+    @property
+    def outputs(self) -> List[str]:
+        return [self.dst]
+
+    def __call__(self) -> None:
+        shutil.copy(self.src, self.dst)
+
+    def commands(self) -> List[list]:
+        return [['cp', self.src, self.dst]]
+
+
+class Chown(Operation):
+    """
+    Changes the owner of a file or tree, like ``chown``.
+    """
+
+    def __init__(self, path: str, owner: str, recursive: bool = False):
+        """
+        Args:
+            path: Path to change
+            owner: New owner as ``user[:group]``
+            recursive: Also change everything below a directory
+        """
+        self.path = path
+        self.owner = owner
+        self.recursive = recursive
+
+    def __call__(self) -> None:
+        uid, gid = resolve_owner(self.owner)
+        for i, path in enumerate(walk(self.path, self.recursive)):
+            os.chown(path, uid, gid, follow_symlinks=i == 0)
+
+    def commands(self) -> List[list]:
+        return [['chown'] + (['-R'] if self.recursive else []) + [self.owner, self.path]]
+
+
+class Chmod(Operation):
+    """
+    Changes the permissions of a file or tree, like ``chmod``.
+    """
+
+    def __init__(self, path: str, mode: int, recursive: bool = False):
+        """
+        Args:
+            path: Path to change
+            mode: New permissions, e.g. ``0o640``
+            recursive: Also change everything below a directory
+        """
+        self.path = path
+        self.mode = mode
+        self.recursive = recursive
+
+    def __call__(self) -> None:
+        for i, path in enumerate(walk(self.path, self.recursive)):
+            # Like chmod, leave symbolic links found in the tree alone
+            if i == 0 or not os.path.islink(path):
+                os.chmod(path, self.mode)
+
+    def commands(self) -> List[list]:
+        return [['chmod'] + (['-R'] if self.recursive else []) + [f'{self.mode:04o}', self.path]]
+
+
+class AuditTree(Operation):
+    """
+    Brings a whole tree to one owner and mode, changing only the entries
+    that differ, at most once per interval.
+    """
+
+    def __init__(self, path: str, mode: int, owner: str, marker: str,
+                 interval: float = float('inf')):
+        """
+        Args:
+            path: Directory to audit
+            mode: Permissions every entry should have
+            owner: Owner every entry should have, as ``user:group``
+            marker: File whose modification time records the last audit
+            interval: Seconds between audits, infinite to audit only once
+        """
+        self.path = path
+        self.mode = mode
+        self.owner = owner
+        self.marker = marker
+        self.interval = interval
+
+    def due(self) -> bool:
+        """Whether the last audit was longer ago than the interval"""
+        try:
+            return time.time() - os.stat(self.marker).st_mtime >= self.interval
+        except FileNotFoundError:
+            return True
+
+    def __call__(self) -> None:
+        if not self.due():
+            return
+        uid, gid = resolve_owner(self.owner)
+        for path in walk(self.path, True):
+            st = os.lstat(path)
+            if (uid != -1 and st.st_uid != uid) or (gid != -1 and st.st_gid != gid):
+                os.chown(path, uid, gid, follow_symlinks=False)
+            if not os.path.islink(path) and stat.S_IMODE(st.st_mode) != self.mode:
+                os.chmod(path, self.mode)
+        os.makedirs(os.path.dirname(self.marker) or '.', exist_ok=True)
+        with open(self.marker, 'a'):
+            os.utime(self.marker)
+
+    def commands(self) -> List[list]:
+        if not self.due():
+            return []
+        return (Chmod(self.path, self.mode, recursive=True).commands()
+                + Chown(self.path, self.owner, recursive=True).commands()
+                + [['touch', self.marker]])
+
+
+class Write(Operation):
+    """
+    Writes data to a file in place, truncating it.
+    """
+    native_only = True
+
+    def __init__(self, path: str, data: bytes, mode: Optional[int] = None, owner: Optional[str] = None):
+        """
+        Args:
+            path: Path of the file to write
+            data: File contents
+            mode: Permissions to set, None to keep the existing ones
+            owner: Owner to set as ``user[:group]``, None to keep the existing one
+        """
+        self.path = path
+        self.data = data
+        self.mode = mode
+        self.owner = owner
+
+    @property
+    def outputs(self) -> List[str]:
+        return [self.path]
+
+    def __call__(self) -> None:
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        if self.mode is not None:
+            os.chmod(self.path, self.mode)
+        if self.owner is not None:
+            os.chown(self.path, *resolve_owner(self.owner))
+
+    def payload(self) -> Tuple[str, bytes, Optional[int], Optional[str]]:
+        return self.path, self.data, self.mode, self.owner
+
+    def __repr__(self) -> str:
+        # Contents are often private keys, keep them out of verbose output
+        return f'{type(self).__name__}(path={self.path!r}, data=<{len(self.data)} bytes>)'
+
+
+class AtomicReplace(Write):
+    """
+    Replaces a file with new data, so readers only ever see the old or the
+    complete new file. Owner and permissions are set before the swap.
+    """
+
+    def __init__(self, path: str, data: bytes, mode: int = 0o600, owner: Optional[str] = None):
+        """
+        Args:
+            path: Path of the file to replace
+            data: File contents
+            mode: Permissions of the new file
+            owner: Owner of the new file as ``user[:group]``, None for the current user
+        """
+        super().__init__(path, data, mode, owner)
+
+    def __call__(self) -> None:
+        uid, gid = resolve_owner(self.owner) if self.owner else (-1, -1)
+        write_atomic(self.path, self.data, self.mode, uid, gid)
+
+
+class Concat(Operation):
+    """
+    Atomically replaces a file with the concatenation of other files, e.g.
+    a certificate chain and its key for services wanting a single bundle.
+    """
+    native_only = True
+
+    def __init__(self, sources: List[str], path: str, mode: int = 0o600,
+                 owner: Optional[str] = None, separator: bytes = b''):
+        """
+        Args:
+            sources: Paths of the files to join, in order
+            path: Path of the file to replace
+            mode: Permissions of the new file
+            owner: Owner of the new file as ``user[:group]``, None for the current user
+            separator: Bytes written between consecutive files
+        """
+        self.sources = list(sources)
+        self.path = path
+        self.mode = mode
+        self.owner = owner
+        self.separator = separator
+
+    @property
+    def outputs(self) -> List[str]:
+        return [self.path]
+
+    def __call__(self) -> None:
+        uid, gid = resolve_owner(self.owner) if self.owner else (-1, -1)
+        with atomic_open(self.path, self.mode, uid, gid) as f:
+            for i, source in enumerate(self.sources):
+                if i and self.separator:
+                    f.write(self.separator)
+                f.flush()
+                with open(source, 'rb') as src:
+                    copy_fd(src.fileno(), f.fileno())
+
+    def render(self) -> bytes:
+        """Contents of the joined file"""
+        parts = []
+        for source in self.sources:
+            with open(source, 'rb') as src:
+                parts.append(src.read())
+        return self.separator.join(parts)
+
+    def payload(self) -> Tuple[str, bytes, Optional[int], Optional[str]]:
+        return self.path, self.render(), self.mode, self.owner
+
+    def artifact(self) -> Artifact:
+        return Artifact('concat', self.sources, {'separator': self.separator.hex()},
+                        self.path, self.render, self.mode, self.owner)
+
+
+class ExportPKCS12(Operation):
+    """
+    Wraps a PEM private key and certificate chain into a PKCS#12 file.
+    """
+
+    def __init__(self, key_file: str, chain_file: str, out_file: Optional[str], password: str,
+                 name: str = None, iterations: Optional[int] = None):
+        """
+        Args:
+            key_file: Path to the PEM private key
+            chain_file: Path to the PEM certificate chain, leaf first
+            out_file: Path of the PKCS#12 file to write, None for the
+                      commands' standard output (e.g. to pipe it on)
+            password: Password for the PKCS#12 file
+            name: Friendly name (alias) for the key and certificate
+            iterations: Key derivation iteration count, None for the default of ``certhook.pkcs12``
+        """
+        self.key_file = key_file
+        self.chain_file = chain_file
+        self.out_file = out_file
+        self.password = password
+        self.name = name
+        self.iterations = iterations
+
+    @property
+    def outputs(self) -> List[str]:
+        return [] if self.out_file is None else [self.out_file]
+
+    def __call__(self) -> None:
+        if self.out_file is None:
+            raise UnsupportedOperation('PKCS#12 export to standard output only runs as a command')
+        write_atomic(self.out_file, self.render())
+
+    def render(self) -> bytes:
+        """Contents of the PKCS#12 file"""
+        # Imported when first converting, as building its cipher tables slows down startup
+        from . import pkcs12
+        options = {} if self.iterations is None else {'iterations': self.iterations}
+        return pkcs12.export_pkcs12(self.key_file, self.chain_file, self.password,
+                                    friendly_name=self.name, **options)
+
+    def artifact(self) -> Optional[Artifact]:
+        if self.out_file is None:
+            return None
+        return Artifact('pkcs12', [self.key_file, self.chain_file],
+                        {'password': self.password, 'name': self.name, 'iterations': self.iterations},
+                        self.out_file, self.render)
+
+    def commands(self) -> List[list]:
+        cmd = ['/usr/bin/openssl', 'pkcs12', '-export',
+               '-inkey', self.key_file,
+               '-in', self.chain_file]
+        if self.out_file is not None:
+            cmd.extend(['-out', self.out_file])
+        if self.name is not None:
+            cmd.extend(['-name', self.name])
+        if self.iterations is not None:
+            cmd.extend(['-iter', str(self.iterations)])
+        cmd.extend(['-password', f'pass:{self.password}'])
+        return [cmd]
+
+
+class ImportKeystore(Operation):
+    """
+    Replaces or inserts a private key entry in a Java keystore, like
+    ``keytool -importkeystore`` does from a PKCS#12 file.
+
+    The equivalent commands stream the PKCS#12 file from ``openssl`` to
+    ``keytool`` in memory, rather than through a file.
+    """
+
+    def __init__(self, key_file: str, chain_file: str, keystore: str, alias: str,
+                 storepass: str, keypass: str, p12_password: str):
+        """
+        Args:
+            key_file: Path to the PEM private key
+            chain_file: Path to the PEM certificate chain, leaf first
+            keystore: Path to the keystore to update
+            alias: Alias of the entry to replace
+            storepass: Keystore password
+            keypass: Password protecting the entry's key
+            p12_password: Password for the PKCS#12 file passed from openssl to keytool
+        """
+        self.key_file = key_file
+        self.chain_file = chain_file
+        self.keystore = keystore
+        self.alias = alias
+        self.storepass = storepass
+        self.keypass = keypass
+        self.p12_password = p12_password
+
+    @property
+    def outputs(self) -> List[str]:
+        return [self.keystore]
+
+    def __call__(self) -> None:
+        from . import keystore, pkcs12
+        key_der, chain = pkcs12.read_key_and_chain(self.key_file, self.chain_file)
+        try:
+            with open(self.keystore, 'rb') as f:
+                store = keystore.loads(f.read(), self.storepass)
+            st = os.stat(self.keystore)
+            mode, uid, gid = st.st_mode & 0o7777, st.st_uid, st.st_gid
+        except FileNotFoundError:
+            # JKS is readable by every Java version the controller may run
+            store = keystore.JKSKeyStore()
+            mode, uid, gid = 0o640, -1, -1
+        except keystore.KeystoreError as e:
+            raise UnsupportedOperation(str(e)) from e
+        store.set_key_entry(self.alias, key_der, chain, self.keypass)
+        write_atomic(self.keystore, store.dumps(self.storepass), mode, uid, gid)
+
+    def commands(self) -> List[Pipeline]:
+        export = ExportPKCS12(self.key_file, self.chain_file, None,
+                              self.p12_password, name=self.alias)
+        # keytool reads the keystore by path and refuses a pipe
+        return [Pipeline(*export.commands(), [
+            '/usr/bin/keytool', '-importkeystore',
+            '-deststorepass', self.storepass,
+            '-destkeypass', self.keypass,
+            '-destkeystore', self.keystore,
+            '-srckeystore', '/dev/stdin',
+            '-srcstoretype', 'PKCS12', '-srcstorepass',
+            self.p12_password, '-noprompt'
+        ], seekable=True)]
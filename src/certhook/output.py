@@ -0,0 +1,340 @@
+"""
+Module for streaming the output of external commands through ``logging``.
+
+Commands' standard output and errors are read as they're written and
+logged a line at a time, each line timestamped when it was read, so long
+running steps show their progress live. Only the last ``limit`` bytes of
+each stream are kept, for error reports, however much a command writes.
+
+Commands given a timeout run in a process group of their own. Once the
+timeout passes the group is sent SIGTERM, then SIGKILL if it hasn't exited
+within a grace period, so helpers a command started (e.g. the JVM behind
+a service script) are reaped with it.
+
+Lines are logged to the ``certhook.output`` logger with the command's
+context (certificate, manager, host, step and stream) as record attributes,
+which ``JSONFormatter`` writes as fields of one JSON object per line.
+"""
+
+import datetime
+import json
+import logging
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import time
+from typing import Optional
+
+logger = logging.getLogger('certhook.output')
+
+# Bytes of each stream kept for error reports
+DEFAULT_LIMIT = 64 * 1024
+# Bytes read from or written to a command at a time
+CHUNK_SIZE = 64 * 1024
+# Seconds a timed out command's process group has to exit after SIGTERM, before SIGKILL
+KILL_GRACE = 5.0
+# Record attributes describing the command a line came from
+CONTEXT_FIELDS = ('cert', 'manager', 'host', 'step', 'stream')
+
+
+class Tail:
+    """
+    The last ``limit`` bytes written to a stream.
+    """
+
+    def __init__(self, limit: int = DEFAULT_LIMIT):
+        """
+        Args:
+            limit: Number of bytes to keep
+        """
+        self.limit = limit
+        # Number of bytes written before the ones kept
+        self.dropped = 0
+        self._data = bytearray()
+
+    def write(self, data: bytes) -> None:
+        """Append data, dropping the oldest bytes beyond the limit"""
+        self._data += data
+        excess = len(self._data) - self.limit
+        if excess > 0:
+            del self._data[:excess]
+            self.dropped += excess
+
+    def getvalue(self) -> bytes:
+        """Bytes kept"""
+        return bytes(self._data)
+
+
+class CommandLog:
+    """
+    Destination of a command's output: each line is logged as it arrives,
+    and the tail of each stream kept.
+    """
+
+    def __init__(self, args: Optional[list] = None, level: int = logging.DEBUG,
+                 limit: int = DEFAULT_LIMIT, **context):
+        """
+        Args:
+            args: Arguments of the command, for reporting
+            level: Level to log the command's lines at
+            limit: Bytes of each stream to keep
+            context: Attributes added to every record, e.g. ``cert`` and ``step``
+        """
+        self.args = list(args or [])
+        self.level = level
+        self.context = context
+        self.stdout = Tail(limit)
+        self.stderr = Tail(limit)
+        # Incomplete last line of each stream, logged once complete
+        self._partial = {'stdout': b'', 'stderr': b''}
+
+    def start(self) -> None:
+        """Log that the command is starting"""
+        logger.log(self.level, 'command: %s', ' '.join(self.args), extra=self.context)
+
+    def feed(self, stream: str, data: bytes) -> None:
+        """
+        Take output read from a command.
+
+        Args:
+            stream: ``stdout`` or ``stderr``
+            data: Bytes read, not necessarily whole lines
+        """
+        getattr(self, stream).write(data)
+        if not logger.isEnabledFor(self.level):
+            return
+        *lines, partial = (self._partial[stream] + data).split(b'\n')
+        if len(partial) > getattr(self, stream).limit:
+            # A line without an end is logged in pieces rather than held on to
+            lines.append(partial)
+            partial = b''
+        self._partial[stream] = partial
+        for line in lines:
+            self._log(stream, line)
+
+    def close(self) -> None:
+        """Log the last line of each stream, if it didn't end with a newline"""
+        for stream, partial in self._partial.items():
+            if partial:
+                self._log(stream, partial)
+        self._partial = {'stdout': b'', 'stderr': b''}
+
+    def feed_result(self, result) -> None:
+        """
+        Take the whole output of a command run without streaming, e.g. a
+        ``CompletedProcess`` or ``CalledProcessError``.
+        """
+        self.feed('stdout', result.stdout or b'')
+        self.feed('stderr', result.stderr or b'')
+        self.close()
+
+    def _log(self, stream: str, line: bytes) -> None:
+        logger.log(self.level, '%s', line.decode('UTF-8', errors='replace').rstrip('\r'),
+                   extra=dict(self.context, stream=stream))
+
+
+def terminate(*processes: subprocess.Popen, grace: Optional[float] = None) -> None:
+    """
+    Stop commands started in process groups of their own, and everything they started.
+
+    Each group is sent SIGTERM, then SIGKILL once its command has exited or
+    the grace period has passed, so nothing a command started is left running.
+
+    Args:
+        processes: Commands to stop, started with ``start_new_session=True``
+        grace: Seconds to wait for the commands to exit after SIGTERM, ``KILL_GRACE`` if None
+    """
+    grace = KILL_GRACE if grace is None else grace
+    for process in processes:
+        signal_group(process, signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    for process in processes:
+        try:
+            process.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            pass
+    # Whatever is left of the groups, commands included if they ignored SIGTERM
+    for process in processes:
+        signal_group(process, signal.SIGKILL)
+        process.wait()
+
+
+def signal_group(process, sig: int) -> None:
+    """Send a signal to a command's process group, if any of it is still running"""
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def run(cmd: list, log: Optional[CommandLog] = None, input: Optional[bytes] = None,
+        env: Optional[dict] = None, cwd: Optional[str] = None, check: bool = True,
+        timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+    """
+    Run a command, streaming its output to a log, like ``subprocess.run``
+    with ``capture_output=True``.
+
+    Args:
+        cmd: Command to execute
+        log: Log taking the command's output, a quiet one if None
+        input: Data to send to the command's standard input
+        env: Environment of the command, None for this process's
+        cwd: Working directory of the command, None for this process's
+        check: Whether to raise if the command exits with a non-zero status
+        timeout: Seconds the command may run before its process group is
+                 terminated, None for no limit
+
+    Returns:
+        CompletedProcess instance with the tails of the command's output
+
+    Raises:
+        subprocess.CalledProcessError: If check is set and the command exits with a non-zero status
+        subprocess.TimeoutExpired: If the command ran for longer than the timeout
+    """
+    log = log or CommandLog(cmd)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    process = subprocess.Popen(cmd, stdin=None if input is None else subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=cwd,
+                               start_new_session=timeout is not None)
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ, 'stdout')
+            selector.register(process.stderr, selectors.EVENT_READ, 'stderr')
+            if input is not None:
+                os.set_blocking(process.stdin.fileno(), False)
+                selector.register(process.stdin, selectors.EVENT_WRITE)
+                pending = memoryview(input)
+            while selector.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise subprocess.TimeoutExpired(cmd, timeout)
+                for key, _ in selector.select(remaining):
+                    if key.fileobj is process.stdin:
+                        try:
+                            pending = pending[os.write(key.fd, pending[:CHUNK_SIZE]):]
+                        except BlockingIOError:
+                            continue
+                        except BrokenPipeError:
+                            # The command exited without reading all of its input
+                            pending = pending[:0]
+                        if not pending:
+                            selector.unregister(key.fileobj)
+                            key.fileobj.close()
+                        continue
+                    data = os.read(key.fd, CHUNK_SIZE)
+                    if data:
+                        log.feed(key.data, data)
+                    else:
+                        selector.unregister(key.fileobj)
+        # Output can close before the command exits, e.g. when it daemonizes
+        returncode = process.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+    except subprocess.TimeoutExpired:
+        terminate(process)
+        log.close()
+        raise subprocess.TimeoutExpired(cmd, timeout, log.stdout.getvalue(), log.stderr.getvalue()) from None
+    except BaseException:
+        if timeout is None:
+            process.kill()
+            process.wait()
+        else:
+            terminate(process, grace=0)
+        raise
+    finally:
+        for pipe in (process.stdin, process.stdout, process.stderr):
+            if pipe is not None:
+                pipe.close()
+    log.close()
+    stdout, stderr = log.stdout.getvalue(), log.stderr.getvalue()
+    if check and returncode:
+        raise subprocess.CalledProcessError(returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+
+
+def last_line(data: Optional[bytes]) -> str:
+    """Last non-blank line of a command's output, for one line error reports"""
+    for line in reversed((data or b'').decode('UTF-8', errors='replace').splitlines()):
+        if line.strip():
+            return line.strip()
+    return ''
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Formats records as timestamped text, prefixed with the context of the
+    command they came from, if any.
+    """
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        context = [str(getattr(record, field)) for field in CONTEXT_FIELDS if hasattr(record, field)]
+        if not context:
+            return line
+        prefix = f'{record.asctime} {record.levelname} '
+        return f'{prefix}[{" ".join(context)}] {line[len(prefix):]}'
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, with the context of the
+    command they came from as fields.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                    .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((field, getattr(record, field)) for field in CONTEXT_FIELDS if hasattr(record, field))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class StderrHandler(logging.StreamHandler):
+    """
+    Handler writing to the current standard error, even if it's replaced after the handler is set up.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+
+FORMATTERS = {
+    'text': TextFormatter,
+    'json': JSONFormatter,
+}
+
+
+def configure(fmt: str = 'text', level: int = logging.INFO, stream=None) -> logging.Handler:
+    """
+    Send certhook's log records to a stream, replacing any handler set up before.
+
+    Args:
+        fmt: Name of the format, a key of ``FORMATTERS``
+        level: Lowest level of the records written
+        stream: Stream to write to, standard error if None
+
+    Returns:
+        The handler installed
+    """
+    root = logging.getLogger('certhook')
+    for handler in [h for h in root.handlers if getattr(h, 'certhook', False)]:
+        root.removeHandler(handler)
+    handler = StderrHandler() if stream is None else logging.StreamHandler(stream)
+    handler.setFormatter(FORMATTERS[fmt]())
+    handler.certhook = True
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
@@ -0,0 +1,223 @@
+"""
+Module for running external commands as a pipeline, each one's output
+streamed to the next one's input instead of through a file.
+
+Some programs read their input by path and need it to be a regular file
+(``keytool`` refuses a pipe as a keystore, as it checks the file's size).
+Their pipelines are made seekable: each command's output is collected in
+an in-memory file (a memfd) and given to the next command, read through
+``/dev/stdin``, once the previous command has finished. Either way nothing
+is written to disk, so no secret bearing intermediate files are left behind.
+
+Commands' errors are collected in in-memory files too, and sent to the
+pipeline's ``CommandLog``, if any, once it has finished.
+"""
+
+import os
+import shlex
+import subprocess
+import tempfile
+import time
+from typing import List, Optional
+
+from .output import CommandLog, terminate
+
+
+class Pipeline:
+    """
+    External commands run as one step, each one's standard output
+    connected to the next one's standard input.
+    """
+
+    def __init__(self, *commands: list, seekable: bool = False):
+        """
+        Args:
+            commands: Commands, in pipeline order
+            seekable: Whether commands read their input as a regular file
+                      (e.g. ``/dev/stdin``), so each must be given the whole
+                      output of the previous one in an in-memory file
+        """
+        if not commands:
+            raise ValueError('A pipeline needs at least one command')
+        self.commands = [list(cmd) for cmd in commands]
+        self.seekable = seekable
+
+    @property
+    def args(self) -> List[str]:
+        """Arguments of every command, separated by ``|``, for reporting"""
+        args: List[str] = []
+        for cmd in self.commands:
+            args.extend((['|'] if args else []) + cmd)
+        return args
+
+    def script(self) -> str:
+        """
+        Equivalent POSIX shell script, for running on other hosts.
+
+        The script works in a private temporary directory, in /dev/shm where
+        available, removed once done: seekable pipelines pass output through
+        files there, and streaming ones record each command's exit status
+        there, as not every shell has ``set -o pipefail``.
+        """
+        quoted = [' '.join(shlex.quote(arg) for arg in cmd) for cmd in self.commands]
+        script = 'd=$(mktemp -d -p /dev/shm 2>/dev/null || mktemp -d) || exit 1; trap \'rm -rf "$d"\' EXIT; '
+        if self.seekable:
+            steps = []
+            for i, cmd in enumerate(quoted):
+                redirects = (f' < "$d/{i - 1}"' if i else '') + (f' > "$d/{i}"' if i < len(quoted) - 1 else '')
+                steps.append(cmd + redirects)
+            return script + ' && '.join(steps)
+        # Statuses are named so they sort in pipeline order, the last failure is the exit status
+        stages = [f'{{ {cmd} || echo $? > "$d/status{i:03d}"; }}' for i, cmd in enumerate(quoted)]
+        return (script + ' | '.join(stages) + '; '
+                'status=0; for s in "$d"/status*; do [ -e "$s" ] && status=$(cat "$s"); done; exit "$status"')
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __repr__(self) -> str:
+        seekable = ', seekable=True' if self.seekable else ''
+        return f"Pipeline({', '.join(repr(cmd) for cmd in self.commands)}{seekable})"
+
+
+def memory_file(name: str):
+    """
+    Anonymous in-memory file, falling back to an unlinked temporary file
+    where memfds aren't available.
+    """
+    if hasattr(os, 'memfd_create'):
+        return os.fdopen(os.memfd_create(name, os.MFD_CLOEXEC), 'w+b')
+    return tempfile.TemporaryFile()
+
+
+def run(pipeline: Pipeline, env: Optional[dict] = None, cwd: Optional[str] = None,
+        log: Optional[CommandLog] = None, timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+    """
+    Run a pipeline, capturing the last command's output and every command's
+    errors, like ``subprocess.run`` with ``capture_output=True, check=True``.
+
+    A pipeline fails if any of its commands fails, with the status of the
+    last one to fail, as with ``set -o pipefail``: earlier commands may only
+    have failed writing to a command that had already exited.
+
+    Args:
+        pipeline: Pipeline to run
+        env: Environment of the commands, None for this process's
+        cwd: Working directory of the commands, None for this process's
+        log: Log to send the output and errors to once the pipeline has finished
+        timeout: Seconds the whole pipeline may run before its commands'
+                 process groups are terminated, None for no limit
+
+    Returns:
+        CompletedProcess instance with the pipeline's arguments, the last
+        command's output and all the commands' errors
+
+    Raises:
+        subprocess.CalledProcessError: For the last command that exits with a non-zero status
+        subprocess.TimeoutExpired: If the pipeline ran for longer than the timeout
+    """
+    # Errors go to files rather than pipes, so no command blocks on a full pipe nobody reads
+    errors = [memory_file('certhook-stderr') for _ in pipeline.commands]
+    deadline = None if timeout is None else time.monotonic() + timeout
+    timed_out = False
+    try:
+        try:
+            if pipeline.seekable:
+                stdout, codes = _run_seekable(pipeline, errors, env, cwd, deadline)
+            else:
+                stdout, codes = _run_streaming(pipeline, errors, env, cwd, deadline)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            stdout, codes = b'', []
+        stderrs = []
+        for error in errors:
+            error.seek(0)
+            stderrs.append(error.read())
+    finally:
+        for error in errors:
+            error.close()
+    if log is not None:
+        log.feed_result(subprocess.CompletedProcess(pipeline.args, 0, stdout, b''.join(stderrs)))
+    if timed_out:
+        raise subprocess.TimeoutExpired(pipeline.args, timeout, stdout, b''.join(stderrs))
+    for cmd, code, stderr in reversed(list(zip(pipeline.commands, codes, stderrs))):
+        if code:
+            raise subprocess.CalledProcessError(code, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(pipeline.args, 0, stdout, b''.join(stderrs))
+
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    """Seconds left until a deadline, None if there isn't one"""
+    return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+
+def _run_streaming(pipeline: Pipeline, errors: list, env: Optional[dict], cwd: Optional[str],
+                   deadline: Optional[float]):
+    """Run every command at once, connected by pipes"""
+    processes: List[subprocess.Popen] = []
+    stdin = None
+    try:
+        for cmd, error in zip(pipeline.commands, errors):
+            process = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=error, env=env, cwd=cwd,
+                                       start_new_session=deadline is not None)
+            if stdin is not None:
+                # Only the next command keeps the read end, so it sees the previous one exit
+                stdin.close()
+            stdin = process.stdout
+            processes.append(process)
+        stdout, _ = processes[-1].communicate(timeout=remaining(deadline))
+        return stdout, [process.wait(remaining(deadline)) for process in processes]
+    except BaseException:
+        if stdin is not None:
+            stdin.close()
+        if deadline is None:
+            for process in processes:
+                process.kill()
+                process.wait()
+        else:
+            terminate(*processes)
+        raise
+
+
+def _run_seekable(pipeline: Pipeline, errors: list, env: Optional[dict], cwd: Optional[str],
+                  deadline: Optional[float]):
+    """Run each command once the previous one has finished, its output in an in-memory file"""
+    codes = []
+    stdin = None
+    stdout = b''
+    try:
+        for i, (cmd, error) in enumerate(zip(pipeline.commands, errors)):
+            last = i == len(pipeline.commands) - 1
+            output = subprocess.PIPE if last else memory_file('certhook-pipe')
+            try:
+                process = subprocess.Popen(cmd, stdin=stdin, stdout=output, stderr=error, env=env, cwd=cwd,
+                                           start_new_session=deadline is not None)
+                try:
+                    result, _ = process.communicate(timeout=remaining(deadline))
+                except BaseException:
+                    if deadline is None:
+                        process.kill()
+                        process.wait()
+                    else:
+                        terminate(process)
+                    raise
+            except BaseException:
+                if not last:
+                    output.close()
+                raise
+            codes.append(process.returncode)
+            if stdin is not None:
+                stdin.close()
+            stdin = None
+            if last:
+                stdout = result
+            elif process.returncode:
+                output.close()
+                break
+            else:
+                output.seek(0)
+                stdin = output
+    finally:
+        if stdin is not None:
+            stdin.close()
+    return stdout, codes
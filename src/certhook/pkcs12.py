@@ -0,0 +1,673 @@
+"""
+Module for building and reading PKCS#12 (.p12) files without shelling out to openssl.
+
+Keys are protected with PBES2 (PBKDF2-HMAC-SHA256 and AES-CBC) and the file
+is authenticated with an HMAC, matching what ``openssl pkcs12 -export``
+produces on OpenSSL 3. Certificates are stored unencrypted, as with
+``-certpbe NONE``, since they are public anyway.
+"""
+
+import hashlib
+import hmac
+import os
+from typing import Dict, List, Optional, Tuple
+
+from . import asn1
+
+# Matches openssl's PKCS12_DEFAULT_ITER
+DEFAULT_ITERATIONS = 2048
+
+OID_DATA = '1.2.840.113549.1.7.1'
+OID_KEY_BAG = '1.2.840.113549.1.12.10.1.1'
+OID_SHROUDED_KEY_BAG = '1.2.840.113549.1.12.10.1.2'
+OID_CERT_BAG = '1.2.840.113549.1.12.10.1.3'
+OID_X509_CERTIFICATE = '1.2.840.113549.1.9.22.1'
+OID_FRIENDLY_NAME = '1.2.840.113549.1.9.20'
+OID_LOCAL_KEY_ID = '1.2.840.113549.1.9.21'
+OID_PBES2 = '1.2.840.113549.1.5.13'
+OID_PBKDF2 = '1.2.840.113549.1.5.12'
+OID_HMAC_SHA256 = '1.2.840.113549.2.9'
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+OID_EC_PUBLIC_KEY = '1.2.840.10045.2.1'
+OID_ENCRYPTED_DATA = '1.2.840.113549.1.7.6'
+
+CIPHERS = {
+    'aes-128-cbc': ('2.16.840.1.101.3.4.1.2', 16),
+    'aes-192-cbc': ('2.16.840.1.101.3.4.1.22', 24),
+    'aes-256-cbc': ('2.16.840.1.101.3.4.1.42', 32),
+}
+
+MAC_DIGESTS = {
+    'sha1': '1.3.14.3.2.26',
+    'sha256': '2.16.840.1.101.3.4.2.1',
+    'sha512': '2.16.840.1.101.3.4.2.3',
+}
+
+PRFS = {
+    '1.2.840.113549.2.7': 'sha1',
+    OID_HMAC_SHA256: 'sha256',
+    '1.2.840.113549.2.11': 'sha512',
+}
+
+
+class PKCS12Error(ValueError):
+    """
+    Raised when a PKCS#12 file can't be read, either because it is damaged,
+    the password is wrong, or it uses algorithms this module doesn't implement.
+    """
+
+
+def _build_sboxes() -> Tuple[List[int], List[int]]:
+    """Generate the AES S-box and its inverse"""
+    sbox = [0] * 256
+    p = q = 1
+    while True:
+        # Multiply p by 3 and divide q by 3 in GF(2^8), so q is p's inverse
+        p = (p ^ (p << 1) ^ (0x1B if p & 0x80 else 0)) & 0xFF
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        x = q
+        for shift in range(1, 5):
+            x ^= ((q << shift) | (q >> (8 - shift))) & 0xFF
+        sbox[p] = x ^ 0x63
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    inverse = [0] * 256
+    for i, value in enumerate(sbox):
+        inverse[value] = i
+    return sbox, inverse
+
+
+def _gf_mul(a: int, b: int) -> int:
+    """Multiply two bytes in GF(2^8)"""
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        a = ((a << 1) ^ (0x1B if a & 0x80 else 0)) & 0xFF
+        b >>= 1
+    return result
+
+
+_SBOX, _INV_SBOX = _build_sboxes()
+_MUL = {n: [_gf_mul(i, n) for i in range(256)] for n in (2, 3, 9, 11, 13, 14)}
+_SHIFT_ROWS = [(i + 4 * (i % 4)) % 16 for i in range(16)]
+_INV_SHIFT_ROWS = [(i - 4 * (i % 4)) % 16 for i in range(16)]
+
+
+class AES:
+    """
+    Straightforward AES block cipher. Only ever used on a few kilobytes of
+    key material per deployment, so clarity wins over table-driven speed.
+    """
+
+    def __init__(self, key: bytes):
+        """
+        Args:
+            key: 16, 24 or 32 byte key
+        """
+        if len(key) not in (16, 24, 32):
+            raise ValueError('AES keys must be 16, 24 or 32 bytes')
+        self.rounds = len(key) // 4 + 6
+        self.round_keys = self._expand_key(key)
+
+    def _expand_key(self, key: bytes) -> List[List[int]]:
+        """Expand the key into one 16 byte key per round"""
+        nk = len(key) // 4
+        words = [list(key[i:i + 4]) for i in range(0, len(key), 4)]
+        rcon = 1
+        for i in range(nk, 4 * (self.rounds + 1)):
+            word = list(words[i - 1])
+            if i % nk == 0:
+                word = [_SBOX[b] for b in word[1:] + word[:1]]
+                word[0] ^= rcon
+                rcon = _MUL[2][rcon]
+            elif nk > 6 and i % nk == 4:
+                word = [_SBOX[b] for b in word]
+            words.append([a ^ b for a, b in zip(words[i - nk], word)])
+        return [sum(words[i:i + 4], []) for i in range(0, len(words), 4)]
+
+    def encrypt_block(self, block: bytes) -> bytes:
+        """Encrypt a single 16 byte block"""
+        state = [a ^ b for a, b in zip(block, self.round_keys[0])]
+        m2, m3 = _MUL[2], _MUL[3]
+        for rnd in range(1, self.rounds + 1):
+            state = [_SBOX[state[i]] for i in _SHIFT_ROWS]
+            if rnd != self.rounds:
+                mixed = []
+                for c in range(0, 16, 4):
+                    a0, a1, a2, a3 = state[c:c + 4]
+                    mixed += [m2[a0] ^ m3[a1] ^ a2 ^ a3,
+                              a0 ^ m2[a1] ^ m3[a2] ^ a3,
+                              a0 ^ a1 ^ m2[a2] ^ m3[a3],
+                              m3[a0] ^ a1 ^ a2 ^ m2[a3]]
+                state = mixed
+            state = [a ^ b for a, b in zip(state, self.round_keys[rnd])]
+        return bytes(state)
+
+    def decrypt_block(self, block: bytes) -> bytes:
+        """Decrypt a single 16 byte block"""
+        state = [a ^ b for a, b in zip(block, self.round_keys[self.rounds])]
+        m9, m11, m13, m14 = _MUL[9], _MUL[11], _MUL[13], _MUL[14]
+        for rnd in range(self.rounds - 1, -1, -1):
+            state = [_INV_SBOX[state[i]] for i in _INV_SHIFT_ROWS]
+            state = [a ^ b for a, b in zip(state, self.round_keys[rnd])]
+            if rnd:
+                mixed = []
+                for c in range(0, 16, 4):
+                    a0, a1, a2, a3 = state[c:c + 4]
+                    mixed += [m14[a0] ^ m11[a1] ^ m13[a2] ^ m9[a3],
+                              m9[a0] ^ m14[a1] ^ m11[a2] ^ m13[a3],
+                              m13[a0] ^ m9[a1] ^ m14[a2] ^ m11[a3],
+                              m11[a0] ^ m13[a1] ^ m9[a2] ^ m14[a3]]
+                state = mixed
+        return bytes(state)
+
+
+def cbc_encrypt(key: bytes, iv: bytes, data: bytes) -> bytes:
+    """AES-CBC encrypt with PKCS#7 padding"""
+    cipher = AES(key)
+    pad = 16 - len(data) % 16
+    data += bytes([pad]) * pad
+    out = bytearray()
+    previous = iv
+    for i in range(0, len(data), 16):
+        previous = cipher.encrypt_block(bytes(a ^ b for a, b in zip(data[i:i + 16], previous)))
+        out += previous
+    return bytes(out)
+
+
+def cbc_decrypt(key: bytes, iv: bytes, data: bytes) -> bytes:
+    """
+    AES-CBC decrypt and strip PKCS#7 padding.
+
+    Raises:
+        ValueError: If the padding is invalid, which usually means a wrong password
+    """
+    if not data or len(data) % 16:
+        raise ValueError('Encrypted data is not a whole number of blocks')
+    cipher = AES(key)
+    out = bytearray()
+    previous = iv
+    for i in range(0, len(data), 16):
+        block = data[i:i + 16]
+        out += bytes(a ^ b for a, b in zip(cipher.decrypt_block(block), previous))
+        previous = block
+    pad = out[-1]
+    if not 1 <= pad <= 16 or out[-pad:] != bytes([pad]) * pad:
+        raise ValueError('Bad decrypt, wrong password?')
+    return bytes(out[:-pad])
+
+
+def bmp_password(password: str) -> bytes:
+    """Password as a NUL terminated BMPString, as used by the PKCS#12 KDF"""
+    return (password + '\0').encode('utf-16-be')
+
+
+def pkcs12_kdf(password: str, salt: bytes, iterations: int, purpose: int,
+               length: int, digest: str = 'sha256') -> bytes:
+    """
+    PKCS#12 key derivation function (RFC 7292 appendix B.2).
+
+    Args:
+        password: Password
+        salt: Salt
+        iterations: Iteration count
+        purpose: 1 for keys, 2 for IVs, 3 for MAC keys
+        length: Number of bytes to derive
+        digest: Hash algorithm name
+
+    Returns:
+        Derived bytes
+    """
+    v = hashlib.new(digest).block_size
+
+    def fill(data: bytes) -> bytes:
+        if not data:
+            return b''
+        size = v * ((len(data) + v - 1) // v)
+        return (data * (size // len(data) + 1))[:size]
+
+    d = bytes([purpose]) * v
+    i = bytearray(fill(salt) + fill(bmp_password(password)))
+    out = b''
+    while len(out) < length:
+        a = d + bytes(i)
+        for _ in range(iterations):
+            a = hashlib.new(digest, a).digest()
+        out += a
+        b = int.from_bytes(fill(a)[:v], 'big') + 1
+        for j in range(0, len(i), v):
+            block = (int.from_bytes(i[j:j + v], 'big') + b) % (1 << (8 * v))
+            i[j:j + v] = block.to_bytes(v, 'big')
+    return out[:length]
+
+
+def to_pkcs8(label: str, der: bytes) -> bytes:
+    """
+    Convert a private key to an unencrypted PKCS#8 PrivateKeyInfo.
+
+    Args:
+        label: PEM label of the key
+        der: DER contents of the PEM block
+
+    Returns:
+        PKCS#8 DER bytes
+
+    Raises:
+        ValueError: If the key format isn't supported
+    """
+    if label == 'PRIVATE KEY':
+        return der
+    if label == 'RSA PRIVATE KEY':
+        return asn1.sequence(asn1.integer(0), asn1.algorithm(OID_RSA_ENCRYPTION),
+                             asn1.octet_string(der))
+    if label == 'EC PRIVATE KEY':
+        _, content, _ = asn1.decode(der)
+        for tag, value in asn1.decode_all(content):
+            if tag == 0xA0:
+                # [0] parameters holds the curve's OID
+                return asn1.sequence(asn1.integer(0),
+                                     asn1.sequence(asn1.oid(OID_EC_PUBLIC_KEY), value),
+                                     asn1.octet_string(der))
+        raise ValueError('EC private key does not name its curve')
+    raise ValueError(f"Unsupported private key type '{label}'")
+
+
+def load_key_and_chain(key_pem: bytes, chain_pem: bytes) -> Tuple[bytes, List[bytes]]:
+    """
+    Parse a PEM private key and certificate chain.
+
+    Args:
+        key_pem: Contents of the private key file (e.g. privkey.pem)
+        chain_pem: Contents of the certificate chain file, leaf first (e.g. fullchain.pem)
+
+    Returns:
+        Tuple of (PKCS#8 key DER, list of certificate DERs)
+
+    Raises:
+        ValueError: If either file holds no usable data
+    """
+    keys = [(label, der) for label, der in asn1.pem_blocks(key_pem) if label.endswith('PRIVATE KEY')]
+    if not keys:
+        raise ValueError('No private key found')
+    certs = [der for label, der in asn1.pem_blocks(chain_pem) if label == 'CERTIFICATE']
+    if not certs:
+        raise ValueError('No certificates found')
+    return to_pkcs8(*keys[0]), certs
+
+
+def attributes(friendly_name: Optional[str], local_key_id: Optional[bytes]) -> bytes:
+    """
+    Encode the bag attributes linking a key to its certificate.
+
+    Args:
+        friendly_name: Alias of the entry
+        local_key_id: Identifier shared by the key and its certificate
+
+    Returns:
+        Encoded SET OF Attribute
+    """
+    encoded = []
+    if local_key_id is not None:
+        encoded.append(asn1.sequence(asn1.oid(OID_LOCAL_KEY_ID),
+                                     asn1.set_of(asn1.octet_string(local_key_id))))
+    if friendly_name is not None:
+        encoded.append(asn1.sequence(asn1.oid(OID_FRIENDLY_NAME),
+                                     asn1.set_of(asn1.bmp_string(friendly_name))))
+    return asn1.set_of(*encoded)
+
+
+def encrypt_private_key(key_der: bytes, password: str, iterations: int = DEFAULT_ITERATIONS,
+                        cipher: str = 'aes-256-cbc') -> bytes:
+    """
+    Protect a PKCS#8 key with PBES2.
+
+    Args:
+        key_der: PKCS#8 PrivateKeyInfo DER
+        password: Password
+        iterations: PBKDF2 iteration count
+        cipher: One of ``CIPHERS``
+
+    Returns:
+        EncryptedPrivateKeyInfo DER
+    """
+    cipher_oid, key_length = CIPHERS[cipher]
+    salt = os.urandom(8)
+    iv = os.urandom(16)
+    key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations, key_length)
+    kdf = asn1.sequence(asn1.oid(OID_PBKDF2),
+                        asn1.sequence(asn1.octet_string(salt), asn1.integer(iterations),
+                                      asn1.algorithm(OID_HMAC_SHA256)))
+    scheme = asn1.sequence(asn1.oid(cipher_oid), asn1.octet_string(iv))
+    return asn1.sequence(asn1.sequence(asn1.oid(OID_PBES2), asn1.sequence(kdf, scheme)),
+                         asn1.octet_string(cbc_encrypt(key, iv, key_der)))
+
+
+def pbes2_decrypt(parameters: bytes, data: bytes, password: str) -> bytes:
+    """
+    Decrypt data protected with PBES2 (PBKDF2 and AES-CBC).
+
+    Args:
+        parameters: Content of the PBES2-params SEQUENCE
+        data: Encrypted bytes
+        password: Password
+
+    Returns:
+        Decrypted bytes
+
+    Raises:
+        PKCS12Error: If the scheme isn't supported or the password is wrong
+    """
+    (_, kdf), (_, scheme) = asn1.decode_all(parameters)
+    kdf_oid, kdf_params = asn1.decode_all(kdf)
+    scheme_oid, (_, iv) = asn1.decode_all(scheme)
+    if asn1.decode_oid(kdf_oid[1]) != OID_PBKDF2:
+        raise PKCS12Error('Unsupported PBES2 key derivation function')
+    ciphers = {oid: length for oid, length in CIPHERS.values()}
+    cipher_oid = asn1.decode_oid(scheme_oid[1])
+    if cipher_oid not in ciphers:
+        raise PKCS12Error(f'Unsupported PBES2 cipher {cipher_oid}')
+    fields = asn1.decode_all(kdf_params[1])
+    salt = fields[0][1]
+    iterations = asn1.decode_integer(fields[1][1])
+    prf = 'sha1'
+    for tag, value in fields[2:]:
+        if tag == asn1.SEQUENCE:
+            prf_oid = asn1.decode_oid(asn1.decode_all(value)[0][1])
+            if prf_oid not in PRFS:
+                raise PKCS12Error(f'Unsupported PBKDF2 PRF {prf_oid}')
+            prf = PRFS[prf_oid]
+    key = hashlib.pbkdf2_hmac(prf, password.encode('utf-8'), salt, iterations, ciphers[cipher_oid])
+    try:
+        return cbc_decrypt(key, iv, data)
+    except ValueError as e:
+        raise PKCS12Error(str(e)) from None
+
+
+def _decrypt(algorithm_der: bytes, data: bytes, password: str) -> bytes:
+    """Decrypt data given its encoded AlgorithmIdentifier"""
+    items = asn1.decode_all(asn1.decode(algorithm_der)[1])
+    algorithm_oid = asn1.decode_oid(items[0][1])
+    if algorithm_oid != OID_PBES2:
+        raise PKCS12Error(f'Unsupported encryption algorithm {algorithm_oid}')
+    return pbes2_decrypt(items[1][1], data, password)
+
+
+def decrypt_private_key(encrypted_der: bytes, password: str) -> bytes:
+    """
+    Recover the PKCS#8 key from an EncryptedPrivateKeyInfo.
+
+    Args:
+        encrypted_der: EncryptedPrivateKeyInfo DER
+        password: Password
+
+    Returns:
+        PKCS#8 PrivateKeyInfo DER
+    """
+    _, content, _ = asn1.decode(encrypted_der)
+    _, _, offset = asn1.decode(content)
+    _, data, _ = asn1.decode(content, offset)
+    return _decrypt(content[:offset], data, password)
+
+
+class SafeBag:
+    """
+    A single bag from a PKCS#12 file, kept in its encoded form so bags
+    that aren't modified are written back untouched.
+    """
+
+    def __init__(self, der: bytes):
+        """
+        Args:
+            der: Encoded SafeBag
+        """
+        self.der = der
+        items = asn1.decode_all(asn1.decode(der)[1])
+        self.bag_id = asn1.decode_oid(items[0][1])
+        self.value = items[1][1]
+        self.attributes: Dict[str, List[Tuple[int, bytes]]] = {}
+        if len(items) > 2:
+            for _, attribute in asn1.decode_all(items[2][1]):
+                (_, attr_oid), (_, values) = asn1.decode_all(attribute)
+                self.attributes[asn1.decode_oid(attr_oid)] = asn1.decode_all(values)
+
+    @property
+    def friendly_name(self) -> Optional[str]:
+        """Alias stored in the bag, if any"""
+        values = self.attributes.get(OID_FRIENDLY_NAME)
+        return values[0][1].decode('utf-16-be') if values else None
+
+    @property
+    def local_key_id(self) -> Optional[bytes]:
+        """Identifier linking a key to its certificate, if any"""
+        values = self.attributes.get(OID_LOCAL_KEY_ID)
+        return values[0][1] if values else None
+
+    @property
+    def certificate(self) -> Optional[bytes]:
+        """DER of the X.509 certificate held by a certificate bag"""
+        if self.bag_id != OID_CERT_BAG:
+            return None
+        (_, cert_type), (_, wrapped) = asn1.decode_all(asn1.decode(self.value)[1])
+        if asn1.decode_oid(cert_type) != OID_X509_CERTIFICATE:
+            return None
+        return asn1.decode(wrapped)[1]
+
+
+def cert_bag(cert_der: bytes, friendly_name: Optional[str] = None,
+             local_key_id: Optional[bytes] = None) -> bytes:
+    """
+    Encode a certificate bag.
+
+    Args:
+        cert_der: Certificate DER
+        friendly_name: Alias of the entry
+        local_key_id: Identifier linking the certificate to its key
+
+    Returns:
+        Encoded SafeBag
+    """
+    bag_value = asn1.sequence(asn1.oid(OID_X509_CERTIFICATE),
+                              asn1.explicit(0, asn1.octet_string(cert_der)))
+    bag = [asn1.oid(OID_CERT_BAG), asn1.explicit(0, bag_value)]
+    if friendly_name is not None or local_key_id is not None:
+        bag.append(attributes(friendly_name, local_key_id))
+    return asn1.sequence(*bag)
+
+
+def key_bag(key_der: bytes, password: str, friendly_name: Optional[str] = None,
+            local_key_id: Optional[bytes] = None, iterations: int = DEFAULT_ITERATIONS,
+            cipher: str = 'aes-256-cbc') -> bytes:
+    """
+    Encode a shrouded (encrypted) key bag.
+
+    Args:
+        key_der: PKCS#8 PrivateKeyInfo DER
+        password: Password protecting the key
+        friendly_name: Alias of the entry
+        local_key_id: Identifier linking the key to its certificate
+        iterations: Key derivation iteration count
+        cipher: One of ``CIPHERS``
+
+    Returns:
+        Encoded SafeBag
+    """
+    return asn1.sequence(asn1.oid(OID_SHROUDED_KEY_BAG),
+                         asn1.explicit(0, encrypt_private_key(key_der, password, iterations, cipher)),
+                         attributes(friendly_name, local_key_id))
+
+
+def _mac(auth_safe: bytes, password: str, salt: bytes, iterations: int, digest: str) -> bytes:
+    """HMAC over the authenticated safe using the PKCS#12 KDF for the key"""
+    mac_key = pkcs12_kdf(password, salt, iterations, 3, hashlib.new(digest).digest_size, digest)
+    return hmac.new(mac_key, auth_safe, digest).digest()
+
+
+def assemble_pfx(cert_bags: List[bytes], key_bags: List[bytes], password: str,
+                 iterations: int = DEFAULT_ITERATIONS, mac_digest: str = 'sha256') -> bytes:
+    """
+    Assemble encoded bags into a MAC protected PKCS#12 file.
+
+    Args:
+        cert_bags: Encoded certificate bags, stored unencrypted
+        key_bags: Encoded key bags, already protected individually
+        password: Password for the MAC
+        iterations: MAC key derivation iteration count
+        mac_digest: One of ``MAC_DIGESTS``
+
+    Returns:
+        DER encoded PFX
+    """
+    safes = []
+    for bags in (cert_bags, key_bags):
+        if bags:
+            safes.append(asn1.sequence(asn1.oid(OID_DATA),
+                                       asn1.explicit(0, asn1.octet_string(asn1.sequence(*bags)))))
+    auth_safe = asn1.sequence(*safes)
+
+    mac_salt = os.urandom(8)
+    mac = _mac(auth_safe, password, mac_salt, iterations, mac_digest)
+    mac_data = asn1.sequence(asn1.sequence(asn1.algorithm(MAC_DIGESTS[mac_digest]), asn1.octet_string(mac)),
+                             asn1.octet_string(mac_salt), asn1.integer(iterations))
+
+    return asn1.sequence(asn1.integer(3),
+                         asn1.sequence(asn1.oid(OID_DATA), asn1.explicit(0, asn1.octet_string(auth_safe))),
+                         mac_data)
+
+
+def parse_pfx(data: bytes, password: str) -> List[SafeBag]:
+    """
+    Verify a PKCS#12 file's MAC and return its bags.
+
+    Certificates in encrypted containers are decrypted; shrouded keys are
+    returned still encrypted.
+
+    Args:
+        data: DER encoded PFX
+        password: Password for the MAC and any encrypted containers
+
+    Returns:
+        List of bags in file order
+
+    Raises:
+        PKCS12Error: If the file is damaged, the password is wrong, or the
+                     file uses unsupported algorithms
+    """
+    try:
+        return _parse_pfx(data, password)
+    except PKCS12Error:
+        raise
+    except (ValueError, IndexError) as e:
+        raise PKCS12Error(f'Invalid PKCS#12 file: {e}') from None
+
+
+def _parse_pfx(data: bytes, password: str) -> List[SafeBag]:
+    """
+    Decode a PKCS#12 file like ``parse_pfx``, letting malformed structures
+    raise ValueError or IndexError.
+    """
+    items = asn1.decode_all(asn1.decode(data)[1])
+    (_, content_type), (_, wrapped) = asn1.decode_all(items[1][1])
+    if asn1.decode_oid(content_type) != OID_DATA:
+        raise PKCS12Error('PKCS#12 files signed with public keys are not supported')
+    auth_safe = asn1.decode(wrapped)[1]
+
+    if len(items) > 2:
+        mac_info, (_, mac_salt), *rest = asn1.decode_all(items[2][1])
+        (_, algorithm), (_, expected) = asn1.decode_all(mac_info[1])
+        digest_oid = asn1.decode_oid(asn1.decode_all(algorithm)[0][1])
+        digests = {oid: name for name, oid in MAC_DIGESTS.items()}
+        if digest_oid not in digests:
+            raise PKCS12Error(f'Unsupported MAC digest {digest_oid}')
+        iterations = asn1.decode_integer(rest[0][1]) if rest else 1
+        if not hmac.compare_digest(_mac(auth_safe, password, mac_salt, iterations, digests[digest_oid]), expected):
+            raise PKCS12Error('MAC verification failed, wrong password?')
+
+    bags = []
+    for _, content_info in asn1.decode_all(asn1.decode(auth_safe)[1]):
+        (_, content_type), (_, wrapped) = asn1.decode_all(content_info)
+        content_type = asn1.decode_oid(content_type)
+        if content_type == OID_DATA:
+            safe_contents = asn1.decode(wrapped)[1]
+        elif content_type == OID_ENCRYPTED_DATA:
+            _, encrypted_content_info = asn1.decode_all(asn1.decode(wrapped)[1])
+            _, algorithm, encrypted = asn1.decode_all(encrypted_content_info[1])
+            if encrypted[0] == 0xA0:
+                # Constructed form, a run of OCTET STRING chunks
+                encrypted = (0x80, b''.join(chunk for _, chunk in asn1.decode_all(encrypted[1])))
+            safe_contents = _decrypt(asn1.tlv(*algorithm), encrypted[1], password)
+        else:
+            raise PKCS12Error(f'Unsupported PKCS#12 content type {content_type}')
+        offset = 0
+        contents = asn1.decode(safe_contents)[1]
+        while offset < len(contents):
+            _, _, end = asn1.decode(contents, offset)
+            bags.append(SafeBag(contents[offset:end]))
+            offset = end
+    return bags
+
+
+def build_pkcs12(key_der: bytes, cert_ders: List[bytes], password: str,
+                 friendly_name: Optional[str] = None, iterations: int = DEFAULT_ITERATIONS,
+                 cipher: str = 'aes-256-cbc', mac_digest: str = 'sha256') -> bytes:
+    """
+    Build a PKCS#12 file holding a private key and its certificate chain.
+
+    Args:
+        key_der: PKCS#8 PrivateKeyInfo DER
+        cert_ders: Certificate DERs, leaf first
+        password: Password protecting the key and the MAC
+        friendly_name: Alias for the key and leaf certificate (e.g. ``unifi``)
+        iterations: Iteration count for both the key encryption and the MAC
+        cipher: One of ``CIPHERS``
+        mac_digest: One of ``MAC_DIGESTS``
+
+    Returns:
+        DER encoded PFX
+    """
+    local_key_id = hashlib.sha1(cert_ders[0]).digest()
+    cert_bags = [cert_bag(cert_ders[0], friendly_name, local_key_id)]
+    cert_bags.extend(cert_bag(cert) for cert in cert_ders[1:])
+    key_bags = [key_bag(key_der, password, friendly_name, local_key_id, iterations, cipher)]
+    return assemble_pfx(cert_bags, key_bags, password, iterations, mac_digest)
+
+
+def export_pkcs12(key_file: str, chain_file: str, password: str, **kwargs) -> bytes:
+    """
+    Build a PKCS#12 file from PEM key and chain files, like ``openssl pkcs12 -export``.
+
+    Args:
+        key_file: Path to the PEM private key
+        chain_file: Path to the PEM certificate chain, leaf first
+        password: Password for the PKCS#12 file
+        **kwargs: Passed on to ``build_pkcs12``
+
+    Returns:
+        DER encoded PFX
+    """
+    key_der, cert_ders = read_key_and_chain(key_file, chain_file)
+    return build_pkcs12(key_der, cert_ders, password, **kwargs)
+
+
+def read_key_and_chain(key_file: str, chain_file: str) -> Tuple[bytes, List[bytes]]:
+    """
+    Read a PEM private key and certificate chain from disk.
+
+    Args:
+        key_file: Path to the PEM private key
+        chain_file: Path to the PEM certificate chain, leaf first
+
+    Returns:
+        Tuple of (PKCS#8 key DER, list of certificate DERs)
+    """
+    with open(key_file, 'rb') as f:
+        key_pem = f.read()
+    with open(chain_file, 'rb') as f:
+        chain_pem = f.read()
+    return load_key_and_chain(key_pem, chain_pem)
@@ -0,0 +1,166 @@
+"""
+Module for checking that a restarted service is serving again.
+
+A probe makes one attempt to reach the service. ``Probe.wait`` retries it
+with a short backoff until it succeeds or a deadline passes.
+"""
+
+import os
+import socket
+import ssl
+import struct
+import time
+
+
+class ProbeTimeout(TimeoutError):
+    """
+    Raised when a service isn't ready before the deadline.
+    """
+
+
+class Probe:
+    """
+    Base class for readiness probes.
+    """
+    # Seconds before the first retry, doubled after each failure up to max_interval
+    interval = 0.01
+    max_interval = 0.25
+
+    def __init__(self, host: str = 'localhost', port: int = 443, timeout: float = 1.0):
+        """
+        Args:
+            host: Host the service listens on
+            port: Port the service listens on
+            timeout: Seconds a single attempt may take
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def check(self, timeout: float) -> None:
+        """
+        Make one attempt to reach the service, overridden by child classes.
+
+        Args:
+            timeout: Seconds the attempt may take
+
+        Raises:
+            OSError: If the service isn't ready
+        """
+        raise NotImplementedError
+
+    def wait(self, deadline: float) -> float:
+        """
+        Retry the probe until it succeeds.
+
+        Args:
+            deadline: Seconds to keep trying
+
+        Returns:
+            Seconds it took for the probe to succeed
+
+        Raises:
+            ProbeTimeout: If the probe didn't succeed within the deadline
+        """
+        start = time.monotonic()
+        end = start + deadline
+        interval = self.interval
+        while True:
+            remaining = end - time.monotonic()
+            try:
+                self.check(max(0.001, min(self.timeout, remaining)))
+                return time.monotonic() - start
+            except OSError as e:
+                error = e
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise ProbeTimeout(f'{self!r} not ready after {deadline:.1f}s: {error}') from error
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.max_interval)
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.host!r}, {self.port!r})'
+
+
+class TCPProbe(Probe):
+    """
+    Ready once the service accepts TCP connections.
+    """
+
+    def check(self, timeout: float) -> None:
+        socket.create_connection((self.host, self.port), timeout=timeout).close()
+
+
+class TLSProbe(Probe):
+    """
+    Ready once the service completes a TLS handshake.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 443, timeout: float = 1.0,
+                 server_name: str = None):
+        """
+        Args:
+            host: Host the service listens on
+            port: Port the service listens on
+            timeout: Seconds a single attempt may take
+            server_name: Name to send with SNI, the host if None
+        """
+        super().__init__(host, port, timeout)
+        self.server_name = server_name
+
+    def check(self, timeout: float) -> None:
+        # Only the handshake matters here, the certificate is checked separately
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        with socket.create_connection((self.host, self.port), timeout=timeout) as sock:
+            with context.wrap_socket(sock, server_hostname=self.server_name or self.host):
+                pass
+
+
+class DNSProbe(Probe):
+    """
+    Ready once the service answers a DNS query over UDP.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 53, timeout: float = 1.0,
+                 name: str = 'localhost'):
+        """
+        Args:
+            host: Address the DNS server listens on
+            port: Port the DNS server listens on
+            timeout: Seconds a single attempt may take
+            name: Name to query an A record for
+        """
+        super().__init__(host, port, timeout)
+        self.name = name
+
+    def query(self, query_id: int) -> bytes:
+        """DNS query packet for the A record of the name"""
+        header = struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+        labels = b''.join(bytes([len(label)]) + label.encode('ascii')
+                          for label in self.name.rstrip('.').split('.'))
+        return header + labels + b'\0' + struct.pack('>HH', 1, 1)
+
+    def check(self, timeout: float) -> None:
+        query_id = struct.unpack('>H', os.urandom(2))[0]
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.sendto(self.query(query_id), (self.host, self.port))
+            deadline = time.monotonic() + timeout
+            while True:
+                sock.settimeout(max(0.001, deadline - time.monotonic()))
+                response = sock.recv(512)
+                if len(response) < 12:
+                    continue
+                response_id, flags = struct.unpack('>HH', response[:4])
+                if response_id != query_id or not flags & 0x8000:
+                    continue
+                # NOERROR and NXDOMAIN both mean the server is answering
+                if flags & 0x000F not in (0, 3):
+                    raise ConnectionError(f'DNS server answered with rcode {flags & 0x000F}')
+                return
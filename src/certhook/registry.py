@@ -0,0 +1,134 @@
+"""
+Module for finding the manager class of each app.
+
+The built in apps are always available. Other packages add apps by declaring
+an entry point in the ``certhook.managers`` group, e.g. in their pyproject.toml:
+
+    [project.entry-points."certhook.managers"]
+    nginx = "certhook_nginx:NginxCertManager"
+
+A manager's module is only imported once its app is used, and installed
+packages are only searched for apps that aren't built in, since importing
+``importlib.metadata`` alone takes longer than the rest of certhook's startup.
+"""
+
+import functools
+import importlib
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, Type, Union
+
+ENTRY_POINT_GROUP = 'certhook.managers'
+
+# Built in apps, as entry point values
+BUILTIN = {
+    'unifi': 'certhook.unifi:UnifiCertManager',
+    'pihole': 'certhook.pihole:PiHoleCertManager',
+    'emby': 'certhook.emby:EmbyCertManager',
+    'freepbx': 'certhook.freepbx:FreePBXCertManager',
+}
+
+
+@functools.lru_cache(maxsize=None)
+def entry_points() -> Dict[str, str]:
+    """Manager entry points of the installed packages, by app name"""
+    try:
+        from importlib import metadata
+    except ImportError:  # Python < 3.8
+        return {}
+    try:
+        found = metadata.entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:  # Python < 3.10
+        found = metadata.entry_points().get(ENTRY_POINT_GROUP, [])
+    return {entry_point.name: entry_point.value for entry_point in found}
+
+
+def load(spec: str) -> type:
+    """
+    Import the object an entry point value (``module:attribute``) refers to.
+
+    Raises:
+        ImportError: If the module can't be imported
+        AttributeError: If the module has no such attribute
+        TypeError: If the object isn't a manager class
+    """
+    from .base import BaseCertManager
+
+    module_name, _, attribute = spec.partition(':')
+    obj = importlib.import_module(module_name)
+    for part in attribute.split('.') if attribute else []:
+        obj = getattr(obj, part)
+    if not (isinstance(obj, type) and issubclass(obj, BaseCertManager)):
+        raise TypeError(f'{spec} is not a certificate manager class')
+    return obj
+
+
+class Registry(MutableMapping):
+    """
+    Manager classes by app name, imported on first use.
+
+    Behaves as a dict of app names to classes. Apps can be added or replaced
+    with classes, or with entry point values to import when first used.
+    """
+
+    def __init__(self, entries: Dict[str, Union[str, type]] = None, discover: bool = True):
+        """
+        Args:
+            entries: Classes or entry point values by app name, the built in apps if None
+            discover: Whether to add the apps of installed packages' entry points
+        """
+        self._entries: Dict[str, Union[str, type]] = dict(BUILTIN if entries is None else entries)
+        self._discover = discover
+
+    def discover(self) -> None:
+        """Add the apps of installed packages, without replacing any known app"""
+        if self._discover:
+            for name, spec in entry_points().items():
+                self._entries.setdefault(name, spec)
+            self._discover = False
+
+    def __getitem__(self, name: str) -> Type:
+        if name not in self._entries:
+            self.discover()
+        entry = self._entries[name]
+        if isinstance(entry, str):
+            entry = self._entries[name] = load(entry)
+        return entry
+
+    def __setitem__(self, name: str, entry: Union[str, type]) -> None:
+        self._entries[name] = entry
+
+    def __delitem__(self, name: str) -> None:
+        if name not in self._entries:
+            self.discover()
+        del self._entries[name]
+
+    def __contains__(self, name: object) -> bool:
+        if name not in self._entries:
+            self.discover()
+        return name in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        self.discover()
+        return iter(list(self._entries))
+
+    def __len__(self) -> int:
+        self.discover()
+        return len(self._entries)
+
+    def copy(self) -> 'Registry':
+        """Shallow copy, without importing any manager"""
+        return Registry(self._entries, self._discover)
+
+    def update(self, other=(), **kwargs) -> None:
+        """Add or replace apps, copying another registry without importing its managers"""
+        if isinstance(other, Registry):
+            self._entries.update(other._entries)
+            self._discover = other._discover
+            other = ()
+        super().update(other, **kwargs)
+
+    def __repr__(self) -> str:
+        return f'Registry({self._entries!r})'
+
+
+managers = Registry()
@@ -0,0 +1,231 @@
+"""
+Module for coalescing service restarts across managers.
+
+Managers queue ``Restart`` entries rather than running restart commands
+themselves. Restarts are collected by a ``RestartCoordinator``, which
+drops duplicates and restarts made redundant by another one, orders them
+so services come back after what they depend on, and reloads instead of
+restarting where that's enough to pick up a new certificate.
+
+A restart with a readiness probe isn't done until the service is serving
+again; the time from issuing the restart until then is recorded as the
+service's outage.
+
+Restarts are coalesced across processes too: a certhook process asking
+for a restart while another process's restart of the same service on the
+same host is still pending waits for it and shares its outcome.
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from .locks import Coalescer
+from .probes import Probe
+
+# Services whose restart also cycles other services
+COVERS: Dict[str, Set[str]] = {
+    'unifi-core': {'unifi'},
+}
+
+# Services that must be restarted after the services they depend on
+DEPENDS_ON: Dict[str, Set[str]] = {
+    'unifi': {'unifi-core'},
+}
+
+# Services that load new certificates on a reload, without dropping connections
+RELOADABLE: Set[str] = {'apache2', 'nginx'}
+
+
+class Restart:
+    """
+    Request to restart a service once a deployment's files are in place.
+    """
+
+    def __init__(self, service: str, via: str = 'service', probe: Optional[Probe] = None,
+                 deadline: float = 60.0):
+        """
+        Args:
+            service: Name of the service
+            via: Tool used to control the service, ``service`` or ``systemctl``
+            probe: Probe to wait on after restarting, None to not wait
+            deadline: Seconds from issuing the restart for the probe to succeed
+        """
+        if via not in ('service', 'systemctl'):
+            raise ValueError(f"Unknown service tool '{via}'")
+        self.service = service
+        self.via = via
+        self.probe = probe
+        self.deadline = deadline
+
+    def command(self, action: str = 'restart') -> list:
+        """
+        Command performing an action on the service.
+
+        Args:
+            action: ``restart`` or ``reload``
+
+        Returns:
+            Command to execute
+        """
+        if self.via == 'systemctl':
+            return ['systemctl', action, self.service]
+        return ['/usr/sbin/service', self.service, action]
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __repr__(self) -> str:
+        if self.probe is None:
+            return f'Restart({self.service!r}, via={self.via!r})'
+        return f'Restart({self.service!r}, via={self.via!r}, probe={self.probe!r})'
+
+
+class RestartCoordinator:
+    """
+    Collects restart requests from any number of managers and performs
+    each distinct restart once.
+    """
+
+    def __init__(self, prefer_reload: bool = True, host: str = 'localhost'):
+        """
+        Args:
+            prefer_reload: Reload services that support it instead of restarting them
+            host: Host the services run on, naming the restarts shared with other processes
+        """
+        self.prefer_reload = prefer_reload
+        self.host = host
+        # service -> (restart, run function, requesters)
+        self._requests: Dict[str, Tuple[Restart, Callable, list]] = {}
+        # service -> seconds from issuing its restart until its probe succeeded
+        self.outages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def request(self, restart: Restart, run: Callable, requester=None) -> None:
+        """
+        Queue a restart.
+
+        Args:
+            restart: Restart to perform
+            run: Called with the command to execute it; the first requester's is used
+            requester: Who asked, reported back if the restart fails
+        """
+        with self._lock:
+            if restart.service not in self._requests:
+                self._requests[restart.service] = (restart, run, [])
+            elif restart.probe is not None and self._requests[restart.service][0].probe is None:
+                # Wait for the service if any requester asked to
+                _, first_run, requesters = self._requests[restart.service]
+                self._requests[restart.service] = (restart, first_run, requesters)
+            self._requests[restart.service][2].append(requester)
+
+    def plan(self) -> List[Tuple[Restart, str]]:
+        """
+        Work out the restarts to perform.
+
+        Returns:
+            List of (restart, action) tuples in the order to run them
+        """
+        with self._lock:
+            wanted = list(self._requests)
+        covered = set()
+        for service in wanted:
+            covered |= COVERS.get(service, set())
+        remaining = [service for service in wanted if service not in covered]
+
+        ordered: List[str] = []
+        while remaining:
+            # Earliest requested service whose dependencies have all been handled
+            for service in remaining:
+                if not DEPENDS_ON.get(service, set()) & set(remaining) - {service}:
+                    break
+            remaining.remove(service)
+            ordered.append(service)
+
+        plan = []
+        for service in ordered:
+            action = 'reload' if self.prefer_reload and service in RELOADABLE else 'restart'
+            plan.append((self._requests[service][0], action))
+        return plan
+
+    def _record(self, outcomes: Dict[str, Optional[BaseException]], service: str,
+                error: Optional[BaseException]) -> None:
+        """Record a restart's outcome, for the requested services it covers too"""
+        outcomes[service] = error
+        for covered in COVERS.get(service, set()):
+            if covered in self._requests:
+                outcomes[covered] = error
+
+    def _wait_ready(self, restart: Restart, start: float) -> None:
+        """
+        Wait for the probes of a restarted service, and of the requested
+        services its restart covers, recording how long each was out.
+
+        Args:
+            restart: Restart that was performed
+            start: ``time.monotonic()`` when the restart was issued
+
+        Raises:
+            ProbeTimeout: If a service isn't ready within its deadline
+        """
+        waiting = [restart] + [self._requests[covered][0]
+                               for covered in sorted(COVERS.get(restart.service, set()))
+                               if covered in self._requests]
+        for waited in waiting:
+            if waited.probe is None:
+                continue
+            waited.probe.wait(max(0.0, waited.deadline - (time.monotonic() - start)))
+            with self._lock:
+                self.outages[waited.service] = time.monotonic() - start
+
+    def coalescer(self, restart: Restart) -> Coalescer:
+        """Coalescer merging a restart with other processes' restarts of the service"""
+        return Coalescer(f'restart:{restart.service}@{self.host}')
+
+    def flush(self) -> Dict[str, Optional[BaseException]]:
+        """
+        Perform every queued restart, continuing past failures.
+
+        A restart that covers another service's restart reports its outcome
+        to that service's requesters too. A restart with a probe fails if
+        the service isn't ready within its deadline. A restart another
+        process performs in the meantime is shared rather than repeated.
+
+        Returns:
+            Mapping of service name to the error restarting it, or None
+        """
+        outcomes: Dict[str, Optional[BaseException]] = {}
+        for restart, action in self.plan():
+            _, run, _ = self._requests[restart.service]
+            coalescer = self.coalescer(restart)
+            try:
+                if coalescer.join():
+                    try:
+                        start = time.monotonic()
+                        run(restart.command(action))
+                        self._wait_ready(restart, start)
+                    except Exception as e:
+                        coalescer.done(e)
+                        raise
+                    coalescer.done()
+            except Exception as e:
+                self._record(outcomes, restart.service, e)
+            else:
+                self._record(outcomes, restart.service, None)
+        return outcomes
+
+    def failures(self, outcomes: Dict[str, Optional[BaseException]]) -> List[Tuple[object, BaseException]]:
+        """
+        Requesters affected by failed restarts.
+
+        Args:
+            outcomes: Result of ``flush``
+
+        Returns:
+            List of (requester, error) tuples
+        """
+        failed = []
+        for service, error in outcomes.items():
+            if error is not None:
+                failed.extend((requester, error) for requester in self._requests[service][2])
+        return failed
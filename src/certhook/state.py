@@ -0,0 +1,200 @@
+"""
+Module for tracking what has been deployed so unchanged certificates can be skipped.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .base import BaseCertManager
+from .locks import FileLock, LockSet, deployment_locks
+from .transport import file_digest
+
+DEFAULT_STATE_FILE = '/var/lib/certhook/state.json'
+
+
+def digest_files(paths: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Digest every file in a list.
+
+    Args:
+        paths: Paths to the files
+
+    Returns:
+        Mapping of path to hex digest (None for missing files)
+    """
+    return {path: file_digest(path) for path in paths}
+
+
+def digest_artifacts(manager: BaseCertManager) -> Dict[str, Optional[str]]:
+    """
+    Digest the files a deployment produced, on the host they were deployed to.
+    """
+    if manager.transport.local:
+        return digest_files(manager.artifacts)
+    return manager.transport.digest(manager.artifacts)
+
+
+class StateStore:
+    """
+    Persistent record of the inputs and artifacts of each (app, certificate)
+    deployment, kept as a JSON file.
+
+    A deployment is current when its input files hash the same as when it was
+    last deployed and every artifact it produced is still on disk unmodified.
+
+    Several processes can share a state file: entries are re-read when the
+    file changes, and changes are merged into the file under a lock.
+    """
+
+    def __init__(self, path: str = DEFAULT_STATE_FILE):
+        """
+        Args:
+            path: Path to the JSON state file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp: Optional[tuple] = None
+        self._entries: Dict[str, dict] = self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        """Read the state file, treating a missing or corrupt file as empty"""
+        try:
+            with open(self.path, 'r') as f:
+                st = os.fstat(f.fileno())
+                self._stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _refresh(self) -> None:
+        """Re-read the state file if another process has replaced it"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if (st.st_ino, st.st_mtime_ns, st.st_size) != self._stamp:
+                self._entries = self._load()
+
+    def _file_lock(self) -> FileLock:
+        """Lock held by any process changing the state file"""
+        return FileLock(f'state:{os.path.abspath(self.path)}')
+
+    def _save(self) -> None:
+        """Write the state file atomically"""
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.state-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._entries, f, indent=2, sort_keys=True)
+                f.flush()
+                st = os.fstat(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def key(app: str, cert_name: str) -> str:
+        """State entry key for an (app, certificate) pair"""
+        return f'{app}:{cert_name}'
+
+    def is_current(self, app: str, manager: BaseCertManager) -> bool:
+        """
+        Check whether a deployment can be skipped.
+
+        Args:
+            app: Application the manager deploys to
+            manager: Certificate manager for the deployment
+
+        Returns:
+            True if neither the inputs nor the artifacts changed since the last deployment
+        """
+        self._refresh()
+        with self._lock:
+            entry = self._entries.get(self.key(app, manager.cert_name))
+        if entry is None:
+            return False
+        inputs = digest_files(manager.inputs)
+        if None in inputs.values() or inputs != entry.get('inputs'):
+            return False
+        artifacts = digest_artifacts(manager)
+        return None not in artifacts.values() and artifacts == entry.get('artifacts')
+
+    def record(self, app: str, manager: BaseCertManager,
+               inputs: Optional[Dict[str, Optional[str]]] = None) -> None:
+        """
+        Record a completed deployment.
+
+        Args:
+            app: Application the manager deploys to
+            manager: Certificate manager that was run
+            inputs: Digests of the inputs taken before the manager ran,
+                    None to take them now
+        """
+        entry = {
+            'inputs': digest_files(manager.inputs) if inputs is None else inputs,
+            'artifacts': digest_artifacts(manager),
+            'deployed': time.time(),
+        }
+        with self._file_lock(), self._lock:
+            self._entries = self._load()
+            self._entries[self.key(app, manager.cert_name)] = entry
+            self._save()
+
+    def forget(self, app: str, cert_name: str) -> None:
+        """
+        Drop the record of a deployment, so the next run deploys it again.
+
+        Args:
+            app: Application the certificate was deployed to
+            cert_name: Name of the certificate
+        """
+        with self._file_lock(), self._lock:
+            self._entries = self._load()
+            if self._entries.pop(self.key(app, cert_name), None) is not None:
+                self._save()
+
+    def _wanted(self, app: str, manager: BaseCertManager, force: bool, held: LockSet) -> bool:
+        """
+        Whether a deployment holding its locks has to run, reporting it if it's skipped.
+
+        A forced deployment runs unless it waited for another process deploying the same certificate.
+        """
+        if (not force or held.contended) and self.is_current(app, manager):
+            manager.log_verbose('Certificate %s unchanged for %s, skipping', manager.cert_name, app)
+            return False
+        return True
+
+    def deploy(self, app: str, manager: BaseCertManager, force: bool = False) -> bool:
+        """
+        Run a manager unless its deployment is already current.
+
+        The deployment and the files it produces are locked against other
+        processes while it runs. If another process was deploying the same
+        certificate, this one waits for it and is skipped if it succeeded,
+        even when forced.
+
+        Args:
+            app: Application the manager deploys to
+            manager: Certificate manager to run
+            force: Deploy even if nothing changed
+
+        Returns:
+            True if the manager ran, False if it was skipped
+        """
+        with deployment_locks(app, manager) as held:
+            if not self._wanted(app, manager, force, held):
+                return False
+            # Taken first, so a renewal while running isn't recorded as deployed
+            inputs = digest_files(manager.inputs)
+            manager()
+            self.record(app, manager, inputs)
+        return True
@@ -0,0 +1,142 @@
+"""
+Module for running a manager's commands as a dependency graph.
+
+Plain commands and operations in a manager's command list run one after
+the other, as they always have. Wrapping an entry in a ``Step`` lets it
+declare what it actually depends on, so independent entries overlap.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, List, Optional, Set
+
+
+class Step:
+    """
+    A command or operation with explicit ordering constraints.
+    """
+
+    def __init__(self, action, after: Optional[Iterable['Step']] = None,
+                 resources: Iterable[str] = (), barrier: bool = False,
+                 timeout: Optional[float] = None, idempotent: bool = False):
+        """
+        Args:
+            action: Command (list) or operation to run
+            after: Entries of the command list that must finish first. None
+                   means the previous entry, an empty list means none.
+            resources: Names of shared resources (e.g. ``service:apache2``);
+                       steps sharing a resource never run at the same time
+            barrier: Run only once every non-barrier step has finished, as
+                     service restarts must
+            timeout: Seconds each of the step's commands may run, None for
+                     the manager's ``step_timeout``
+            idempotent: Whether running the step again after it failed or
+                        timed out is safe, so it may be retried
+        """
+        self.action = action
+        self.after = None if after is None else list(after)
+        self.resources = frozenset(resources)
+        self.barrier = barrier
+        self.timeout = timeout
+        self.idempotent = idempotent
+
+    def __repr__(self) -> str:
+        return f'Step({self.action!r})'
+
+
+def resolve(cmds: list) -> List[Set[int]]:
+    """
+    Work out which entries each entry of a command list waits for.
+
+    Entries without explicit dependencies wait for the previous non-barrier
+    entry. Barrier entries wait for every non-barrier entry and for the
+    previous barrier entry, so barriers run last and in order.
+
+    Args:
+        cmds: Command list of plain entries and Steps
+
+    Returns:
+        For each entry, the set of indexes it waits for
+
+    Raises:
+        ValueError: If a step depends on a step that isn't in the list
+    """
+    index = {id(cmd): i for i, cmd in enumerate(cmds)}
+    normal = [i for i, cmd in enumerate(cmds) if not getattr(cmd, 'barrier', False)]
+    deps: List[Set[int]] = []
+    previous = previous_barrier = None
+    for i, cmd in enumerate(cmds):
+        after = getattr(cmd, 'after', None)
+        if getattr(cmd, 'barrier', False):
+            wanted = set(normal)
+            if previous_barrier is not None:
+                wanted.add(previous_barrier)
+            previous_barrier = i
+        elif after is None:
+            wanted = set() if previous is None else {previous}
+            previous = i
+        else:
+            wanted = set()
+            previous = i
+        for step in after or ():
+            if id(step) not in index:
+                raise ValueError(f'{cmd!r} depends on {step!r}, which is not in the command list')
+            wanted.add(index[id(step)])
+        deps.append(wanted)
+    return deps
+
+
+def execute(cmds: list, run: Callable, max_workers: int = 4) -> None:
+    """
+    Run a command list with as much overlap as its dependencies allow.
+
+    A purely sequential list runs in the calling thread. On the first
+    failure no further entries are started, entries already running are
+    allowed to finish, and the error is raised.
+
+    Args:
+        cmds: Command list of plain entries and Steps
+        run: Called with each entry to execute it
+        max_workers: Maximum number of entries running at once
+
+    Raises:
+        ValueError: If the dependencies contain a cycle
+    """
+    deps = resolve(cmds)
+    # Each entry waiting for the one before it leaves nothing to overlap
+    if all(i - 1 in wanted and max(wanted) < i if i else not wanted for i, wanted in enumerate(deps)):
+        for cmd in cmds:
+            run(cmd)
+        return
+
+    done: Set[int] = set()
+    pending = set(range(len(cmds)))
+    running = {}
+    held: Set[str] = set()
+    error: Optional[BaseException] = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            if error is None:
+                for i in sorted(pending):
+                    resources = getattr(cmds[i], 'resources', frozenset())
+                    if deps[i] <= done and not resources & held and len(running) < max_workers:
+                        pending.discard(i)
+                        held |= resources
+                        running[pool.submit(run, cmds[i])] = i
+            if not running:
+                if error is None and pending:
+                    raise ValueError('Command list dependencies contain a cycle')
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                held -= getattr(cmds[i], 'resources', frozenset())
+                try:
+                    future.result()
+                except BaseException as e:
+                    if error is None:
+                        error = e
+                else:
+                    done.add(i)
+    if error is not None:
+        raise error
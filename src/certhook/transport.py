@@ -0,0 +1,428 @@
+"""
+Module for running a manager's commands and writing its files on the host
+a certificate is deployed to.
+
+``LocalTransport`` is this machine. ``SSHTransport`` keeps one multiplexed
+OpenSSH master connection per host (ControlMaster), so each command opens
+a channel on an established connection instead of a new SSH handshake.
+``RootTransport`` stands in for a host whose filesystem is a local
+directory, for testing without real hosts.
+
+Transports are pooled by host with ``connect``, so every manager deploying
+to a host shares its connection.
+"""
+
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+from . import output, pipeline
+from .ops import resolve_owner, write_atomic
+
+# Names that mean the host a transport reaches, e.g. in probes and endpoints
+LOOPBACK = {'localhost', '127.0.0.1', '::1'}
+
+# Writes stdin to $1 atomically with mode $2 and owner $3, either may be empty
+WRITE_SCRIPT = '''set -e
+dir=$(dirname "$1")
+mkdir -p "$dir"
+tmp=$(mktemp "$dir/.certhook.XXXXXX")
+trap 'rm -f "$tmp"' EXIT
+cat > "$tmp"
+[ -z "$2" ] || chmod "$2" "$tmp"
+[ -z "$3" ] || chown "$3" "$tmp"
+mv -f "$tmp" "$1"
+trap - EXIT
+'''
+
+# Prints the SHA-256 digest of each argument, or - for missing files
+DIGEST_SCRIPT = '''for f; do
+    if [ -f "$f" ]; then sha256sum < "$f"; else echo -; fi
+done
+'''
+
+
+class TransportError(OSError):
+    """
+    Raised when a host can't be reached.
+    """
+
+
+class Transport:
+    """
+    Base class for transports.
+    """
+    # Whether commands run and files are written on this machine
+    local = False
+
+    def __init__(self, host: str):
+        """
+        Args:
+            host: Name of the host, as used in job specifications
+        """
+        self.host = host
+        # Error that made the host unreachable, raised again by every later
+        # use so the host's remaining jobs fail without waiting on it, until
+        # the batch ends and ``reset`` is called
+        self.error: Optional[TransportError] = None
+
+    @property
+    def address(self) -> str:
+        """Network address of the host, for probes and endpoint checks"""
+        return self.host.rpartition('@')[2]
+
+    def resolve(self, host: str) -> str:
+        """
+        Address to reach a service at, given the host it listens on as seen from the deployed host.
+        """
+        return self.address if host in LOOPBACK else host
+
+    def run(self, cmd: list, input: Optional[bytes] = None, log: Optional[output.CommandLog] = None,
+            timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        """
+        Run a command on the host, capturing its output, overridden by child classes.
+
+        Args:
+            cmd: Command to execute
+            input: Data to send to the command's standard input
+            log: Log to stream the command's output to, keeping only its
+                 tail, None to capture all of it
+            timeout: Seconds the command may run before it's terminated, None for no limit
+
+        Returns:
+            CompletedProcess instance with execution results
+
+        Raises:
+            subprocess.CalledProcessError: If the command exits with a non-zero status
+            subprocess.TimeoutExpired: If the command ran for longer than the timeout
+            TransportError: If the host can't be reached
+        """
+        raise NotImplementedError
+
+    def run_pipeline(self, commands: pipeline.Pipeline, log: Optional[output.CommandLog] = None,
+                     timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        """
+        Run a pipeline on the host, as a shell script unless overridden.
+
+        Args:
+            commands: Pipeline to execute
+            log: Log to send the pipeline's output to, None to only capture it
+            timeout: Seconds the pipeline may run before it's terminated, None for no limit
+
+        Returns:
+            CompletedProcess instance with execution results
+
+        Raises:
+            subprocess.CalledProcessError: If any of the commands exits with a non-zero status
+            subprocess.TimeoutExpired: If the pipeline ran for longer than the timeout
+            TransportError: If the host can't be reached
+        """
+        try:
+            result = self.run(['sh', '-c', commands.script()], log=log, timeout=timeout)
+        except subprocess.CalledProcessError as e:
+            raise subprocess.CalledProcessError(e.returncode, commands.args, e.output, e.stderr) from None
+        except subprocess.TimeoutExpired as e:
+            raise subprocess.TimeoutExpired(commands.args, e.timeout, e.output, e.stderr) from None
+        return subprocess.CompletedProcess(commands.args, 0, result.stdout, result.stderr)
+
+    def write(self, path: str, data: bytes, mode: Optional[int] = None, owner: Optional[str] = None) -> None:
+        """
+        Replace a file on the host atomically, overridden by child classes.
+
+        Args:
+            path: Path of the file on the host
+            data: File contents
+            mode: Permissions of the file, None for private to its owner
+            owner: Owner of the file as ``user[:group]``, None for the transport's user
+        """
+        raise NotImplementedError
+
+    def put(self, local_path: str, path: Optional[str] = None) -> None:
+        """
+        Copy a local file to the host with the same permissions.
+
+        Args:
+            local_path: Path of the file on this machine
+            path: Path of the file on the host, the same path if None
+        """
+        with open(local_path, 'rb') as f:
+            data = f.read()
+            mode = os.stat(f.fileno()).st_mode & 0o7777
+        self.write(path or local_path, data, mode)
+
+    def digest(self, paths: List[str]) -> Dict[str, Optional[str]]:
+        """
+        SHA-256 digests of files on the host, overridden by child classes.
+
+        Returns:
+            Mapping of path to hex digest (None for missing files)
+        """
+        raise NotImplementedError
+
+    def reset(self) -> None:
+        """
+        Forget the error that made the host unreachable, so the next batch tries it again.
+        """
+        self.error = None
+
+    def close(self) -> None:
+        """
+        Release the connection to the host, if any.
+        """
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.host!r})'
+
+
+class LocalTransport(Transport):
+    """
+    Runs commands and writes files on this machine.
+    """
+    local = True
+
+    def __init__(self):
+        super().__init__('localhost')
+
+    def run(self, cmd: list, input: Optional[bytes] = None, log: Optional[output.CommandLog] = None,
+            timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        if log is not None:
+            return output.run(cmd, log, input, timeout=timeout)
+        if input is None and timeout is None:
+            return subprocess.run(cmd, capture_output=True, check=True)
+        return subprocess.run(cmd, input=input, capture_output=True, check=True, timeout=timeout)
+
+    def run_pipeline(self, commands: pipeline.Pipeline, log: Optional[output.CommandLog] = None,
+                     timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        return pipeline.run(commands, log=log, timeout=timeout)
+
+    def write(self, path: str, data: bytes, mode: Optional[int] = None, owner: Optional[str] = None) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        uid, gid = resolve_owner(owner) if owner else (-1, -1)
+        write_atomic(path, data, 0o600 if mode is None else mode, uid, gid)
+
+    def digest(self, paths: List[str]) -> Dict[str, Optional[str]]:
+        return {path: file_digest(path) for path in paths}
+
+
+class SSHTransport(Transport):
+    """
+    Runs commands and writes files on another host over SSH, sharing one
+    master connection between all of them.
+
+    The master is started by the first command and stays open for
+    ``persist`` seconds after the last one. Hosts are reached with OpenSSH's
+    ``ssh`` and its configuration, non-interactively, so keys must be set up.
+    An ``ssh`` exit status of 255 is taken as the host being unreachable.
+    """
+    # Seconds an idle master connection stays open
+    persist = 60
+    # Seconds to wait for a connection to be established
+    connect_timeout = 10
+
+    def __init__(self, host: str, control_dir: Optional[str] = None, options: Optional[List[str]] = None):
+        """
+        Args:
+            host: SSH destination, e.g. ``root@pihole.lan``
+            control_dir: Directory for the master connection's socket, a private temporary one if None
+            options: Extra ``ssh`` arguments, e.g. ``['-p', '2222']``
+        """
+        super().__init__(host)
+        self._own_control_dir = control_dir is None
+        self.control_dir = control_dir or tempfile.mkdtemp(prefix='certhook-ssh-')
+        self.options = list(options or [])
+
+    def ssh(self, *args: str) -> list:
+        """``ssh`` command line using the shared master connection"""
+        return ['ssh', '-o', 'ControlMaster=auto',
+                '-o', f'ControlPath={self.control_dir}/%C',
+                '-o', f'ControlPersist={self.persist}',
+                '-o', 'BatchMode=yes',
+                '-o', f'ConnectTimeout={self.connect_timeout}'] + self.options + list(args)
+
+    def run(self, cmd: list, input: Optional[bytes] = None, log: Optional[output.CommandLog] = None,
+            timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        if self.error is not None:
+            raise self.error
+        remote = ' '.join(shlex.quote(arg) for arg in cmd)
+        try:
+            if log is None:
+                result = subprocess.run(self.ssh(self.host, '--', remote), input=input, capture_output=True,
+                                        timeout=timeout)
+            else:
+                result = output.run(self.ssh(self.host, '--', remote), log, input, check=False, timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            # Only the connection is closed; the command may run on until the host notices
+            raise subprocess.TimeoutExpired(cmd, timeout, e.output, e.stderr) from None
+        if result.returncode == 255:
+            self.error = TransportError(f'{self.host}: {result.stderr.decode(errors="replace").strip()}')
+            raise self.error
+        if result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+        return subprocess.CompletedProcess(cmd, 0, result.stdout, result.stderr)
+
+    def write(self, path: str, data: bytes, mode: Optional[int] = None, owner: Optional[str] = None) -> None:
+        self.run(['sh', '-c', WRITE_SCRIPT, 'sh', path, '' if mode is None else '%04o' % mode, owner or ''],
+                 input=data)
+
+    def digest(self, paths: List[str]) -> Dict[str, Optional[str]]:
+        if not paths:
+            return {}
+        lines = self.run(['sh', '-c', DIGEST_SCRIPT, 'sh'] + paths).stdout.decode().splitlines()
+        return {path: None if line.startswith('-') else line.split()[0] for path, line in zip(paths, lines)}
+
+    def close(self) -> None:
+        subprocess.run(self.ssh('-O', 'exit', self.host), capture_output=True)
+        if self._own_control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+class RootTransport(Transport):
+    """
+    Stands in for another host, with a local directory as its root filesystem.
+
+    Absolute paths in commands are moved under the root, and programs are
+    run from the root's ``bin`` directories when present there.
+    """
+
+    def __init__(self, root: str, host: str = 'stand-in'):
+        """
+        Args:
+            root: Directory acting as the host's root filesystem
+            host: Name of the host, as used in job specifications
+        """
+        super().__init__(host)
+        self.root = root
+        self.commands: List[list] = []
+        self._lock = threading.Lock()
+
+    @property
+    def address(self) -> str:
+        return '127.0.0.1'
+
+    def path(self, path: str) -> str:
+        """Local path of a path on the host"""
+        return os.path.join(self.root, path.lstrip('/'))
+
+    @property
+    def bin_path(self) -> str:
+        """Search path of the host's programs"""
+        return os.pathsep.join(self.path(d) for d in ('/usr/local/bin', '/usr/bin', '/usr/sbin', '/bin'))
+
+    def local_command(self, cmd: list) -> list:
+        """Command with its program and absolute paths, other than devices, moved under the root"""
+        program = self.path(cmd[0]) if os.path.isabs(cmd[0]) else cmd[0]
+        if not os.path.exists(program):
+            program = shutil.which(os.path.basename(cmd[0]), path=self.bin_path) or cmd[0]
+        return [program] + [self.path(arg) if arg.startswith('/') and not arg.startswith('/dev/') else arg
+                            for arg in cmd[1:]]
+
+    def run(self, cmd: list, input: Optional[bytes] = None, log: Optional[output.CommandLog] = None,
+            timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        if self.error is not None:
+            raise self.error
+        with self._lock:
+            self.commands.append(cmd)
+        env = dict(os.environ, PATH=self.bin_path + os.pathsep + os.environ.get('PATH', ''))
+        try:
+            if log is None:
+                result = subprocess.run(self.local_command(cmd), input=input, capture_output=True,
+                                        env=env, cwd=self.root, timeout=timeout)
+            else:
+                result = output.run(self.local_command(cmd), log, input, env=env, cwd=self.root,
+                                    check=False, timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            raise subprocess.TimeoutExpired(cmd, timeout, e.output, e.stderr) from None
+        if result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+        return subprocess.CompletedProcess(cmd, 0, result.stdout, result.stderr)
+
+    def run_pipeline(self, commands: pipeline.Pipeline, log: Optional[output.CommandLog] = None,
+                     timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        if self.error is not None:
+            raise self.error
+        with self._lock:
+            self.commands.extend(commands.commands)
+        local = pipeline.Pipeline(*[self.local_command(cmd) for cmd in commands.commands],
+                                  seekable=commands.seekable)
+        env = dict(os.environ, PATH=self.bin_path + os.pathsep + os.environ.get('PATH', ''))
+        try:
+            result = pipeline.run(local, env=env, cwd=self.root, log=log, timeout=timeout)
+        except subprocess.CalledProcessError as e:
+            cmd = commands.commands[local.commands.index(e.cmd)]
+            raise subprocess.CalledProcessError(e.returncode, cmd, e.output, e.stderr) from None
+        except subprocess.TimeoutExpired as e:
+            raise subprocess.TimeoutExpired(commands.args, timeout, e.output, e.stderr) from None
+        return subprocess.CompletedProcess(commands.args, 0, result.stdout, result.stderr)
+
+    def write(self, path: str, data: bytes, mode: Optional[int] = None, owner: Optional[str] = None) -> None:
+        if self.error is not None:
+            raise self.error
+        os.makedirs(os.path.dirname(self.path(path)), exist_ok=True)
+        write_atomic(self.path(path), data, 0o600 if mode is None else mode)
+        if owner:
+            # Names are looked up on the host, as they would be over SSH
+            self.run(['chown', owner, path])
+
+    def digest(self, paths: List[str]) -> Dict[str, Optional[str]]:
+        return {path: file_digest(self.path(path)) for path in paths}
+
+
+def file_digest(path: str) -> Optional[str]:
+    """SHA-256 hex digest of a file, None if it doesn't exist"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+# Transport for this machine, used by managers unless told otherwise
+LOCAL = LocalTransport()
+
+_pool: Dict[str, Transport] = {}
+_pool_lock = threading.Lock()
+
+
+def connect(host: str) -> Transport:
+    """
+    Shared transport to a host, created on first use.
+
+    Args:
+        host: ``localhost`` for this machine, otherwise an SSH destination
+
+    Returns:
+        The host's transport
+    """
+    if host in LOOPBACK:
+        return LOCAL
+    with _pool_lock:
+        if host not in _pool:
+            _pool[host] = SSHTransport(host)
+        return _pool[host]
+
+
+def register(transport: Transport) -> None:
+    """
+    Make ``connect`` return a transport for its host, e.g. a stand-in.
+    """
+    with _pool_lock:
+        _pool[transport.host] = transport
+
+
+def close_all() -> None:
+    """
+    Close and forget every pooled transport.
+    """
+    with _pool_lock:
+        transports = list(_pool.values())
+        _pool.clear()
+    for transport in transports:
+        transport.close()
@@ -4,6 +4,9 @@ Module for converting a Let's Encrypt certificates for use with Unifi OS.
 
 from typing import List
 from .base import BaseCertManager
+from .ops import ImportKeystore
+from .probes import TLSProbe
+from .services import Restart
 
 
 class UnifiCertManager(BaseCertManager):
@@ -11,28 +14,30 @@ class UnifiCertManager(BaseCertManager):
     Creates and executes the commands required to install SSL certificates
     on Unifi OS, at least for the Unifi Network and Unifi Protect apps.
     """
+    # Java keystore used by Unifi Network
+    keystore = '/data/unifi/data/keystore'
+    # Unifi OS and Unifi Network serve HTTPS again once restarted
+    probes = {'unifi-core': TLSProbe('localhost', 443), 'unifi': TLSProbe('localhost', 8443)}
+    endpoints = [('localhost', 443), ('localhost', 8443)]
+
+    @property
+    def artifacts(self) -> List[str]:
+        """Paths of the files produced for Unifi"""
+        return [self.keystore]
 
     def cert_cmds(self) -> None:
         """
         Creates the commands required to install the certificate
         within Unifi OS/Network/Protect.
         """
-        # Convert certificate to .p12
-        self.cmds.append(['/usr/bin/openssl', 'pkcs12', '-export',
-                         '-inkey', f'/etc/letsencrypt/live/{self.cert_name}/privkey.pem',
-                         '-in', f'/etc/letsencrypt/live/{self.cert_name}/fullchain.pem',
-                         '-out', f'/etc/letsencrypt/live/{self.cert_name}/fullchain.p12',
-                         '-name', 'unifi', '-password', 'pass:unifi'])
-
-        # Import certificate into Unifi Network
-        self.cmds.append(['/usr/bin/keytool', '-importkeystore',
-                          '-deststorepass', 'aircontrolenterprise',
-                          '-destkeypass', 'aircontrolenterprise',
-                          '-destkeystore', '/data/unifi/data/keystore',
-                          '-srckeystore',
-                          f'/etc/letsencrypt/live/{self.cert_name}/fullchain.p12',
-                          '-srcstoretype', 'PKCS12', '-srcstorepass',
-                          'unifi', '-noprompt'])
+        # Import certificate into Unifi Network; falling back to openssl
+        # and keytool streams the .p12 between them in memory
+        self.cmds.append(ImportKeystore(key_file=f'{self.cert_dir}/privkey.pem',
+                                        chain_file=f'{self.cert_dir}/fullchain.pem',
+                                        keystore=self.keystore, alias='unifi',
+                                        storepass='aircontrolenterprise',
+                                        keypass='aircontrolenterprise',
+                                        p12_password='unifi'))
         # Restart Unifi Core/Network
-        self.cmds.append(['/usr/sbin/service', 'unifi-core', 'restart'])
-        self.cmds.append(['/usr/sbin/service', 'unifi', 'restart'])
\ No newline at end of file
+        self.cmds.append(Restart('unifi-core'))
+        self.cmds.append(Restart('unifi'))
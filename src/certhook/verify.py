@@ -0,0 +1,210 @@
+"""
+Module for checking services serve the certificates deployed to them.
+
+Every TLS endpoint a manager declares is connected to concurrently on an
+asyncio event loop, and the fingerprint of the leaf certificate it serves
+is compared with the lineage's ``cert.pem``. Connections are bounded in
+number and each is given a timeout, so hundreds of endpoints are checked
+in about the time of the slowest one.
+
+Services restarted by the deployment may refuse connections, or still serve
+the previous certificate, for a moment, so an endpoint is tried again with
+an exponential backoff until it serves the deployed certificate or its
+timeout runs out.
+"""
+
+import asyncio
+import ssl
+import time
+from typing import List, Optional, Tuple
+
+from . import x509
+from .base import BaseCertManager
+from .deadlines import Deadline
+from .x509 import fingerprint
+
+# Wait before trying an endpoint again in seconds, doubled after every attempt up to the maximum
+RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 1.0
+
+
+def leaf_fingerprint(path: str) -> str:
+    """
+    Fingerprint of the first certificate in a PEM file.
+
+    Args:
+        path: PEM file, e.g. a lineage's cert.pem or fullchain.pem
+
+    Returns:
+        SHA-256 fingerprint of the certificate
+
+    Raises:
+        ValueError: If the file holds no certificate
+    """
+    return x509.load(path)[0].fingerprint
+
+
+class Verification:
+    """
+    Result of checking the certificate served on one endpoint.
+    """
+
+    def __init__(self, app: str, cert_name: str, host: str, port: int, expected: Optional[str],
+                 served: Optional[str] = None, duration: float = 0.0,
+                 error: Optional[BaseException] = None):
+        """
+        Args:
+            app: Name of the app deployed to
+            cert_name: Name of the certificate deployed
+            host: Host connected to
+            port: Port connected to
+            expected: Fingerprint of the deployed certificate
+            served: Fingerprint of the certificate served, None if it couldn't be fetched
+            duration: Seconds the check took
+            error: Error fetching either certificate, if any
+        """
+        self.app = app
+        self.cert_name = cert_name
+        self.host = host
+        self.port = port
+        self.expected = expected
+        self.served = served
+        self.duration = duration
+        self.error = error
+
+    @property
+    def success(self) -> bool:
+        """Whether the endpoint serves the deployed certificate"""
+        return self.error is None and self.served == self.expected
+
+    def __str__(self) -> str:
+        status = 'ok' if self.success else 'FAILED'
+        line = f'{status} {self.app}:{self.cert_name} {self.host}:{self.port} ({self.duration:.2f}s)'
+        if self.error is not None:
+            line += f': {self.error}'
+        elif not self.success:
+            line += f': serving {self.served}, expected {self.expected}'
+        return line
+
+
+class VerificationReport:
+    """
+    Collected results of checking many endpoints.
+    """
+
+    def __init__(self, results: List[Verification], wall_time: float):
+        """
+        Args:
+            results: Per-endpoint results, in job order
+            wall_time: Total wall time of the checks in seconds
+        """
+        self.results = results
+        self.wall_time = wall_time
+
+    @property
+    def failed(self) -> List[Verification]:
+        """Results of the endpoints not serving the deployed certificate"""
+        return [result for result in self.results if not result.success]
+
+    def summary(self) -> str:
+        """
+        Human readable report with one line per endpoint and a totals line.
+        """
+        lines = [str(result) for result in self.results]
+        lines.append(f'{len(self.results)} endpoints: {len(self.results) - len(self.failed)} verified, '
+                     f'{len(self.failed)} failed in {self.wall_time:.2f}s')
+        return '\n'.join(lines)
+
+
+async def served_fingerprint(host: str, port: int, server_name: str, timeout: float) -> str:
+    """
+    Fingerprint of the leaf certificate an endpoint serves.
+
+    Args:
+        host: Host to connect to
+        port: Port to connect to
+        server_name: Name to send with SNI
+        timeout: Seconds to connect and complete the handshake
+
+    Returns:
+        SHA-256 fingerprint of the certificate
+    """
+    # The served certificate is compared byte for byte, trusting it isn't needed
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    _, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port, ssl=context, server_hostname=server_name), timeout)
+    try:
+        return fingerprint(writer.get_extra_info('ssl_object').getpeercert(binary_form=True))
+    finally:
+        writer.close()
+
+
+async def verify_endpoint(app: str, manager: BaseCertManager, host: str, port: int,
+                          slots: asyncio.Semaphore, timeout: float) -> Verification:
+    """
+    Check one endpoint of a manager, capturing any failure in the result.
+
+    The endpoint is tried until it serves the deployed certificate or
+    ``timeout`` seconds have passed, the result being the certificate last
+    served, or the last error if none was.
+    """
+    start = time.monotonic()
+    result = Verification(app, manager.cert_name, host, port, None)
+    try:
+        result.expected = leaf_fingerprint(manager.served_cert)
+    except (OSError, ValueError) as e:
+        result.error = e
+        return result
+    deadline = Deadline(timeout)
+    delay = RETRY_DELAY
+    while True:
+        error = None
+        try:
+            # The slot is given back between attempts, for other endpoints to use
+            async with slots:
+                result.served = await served_fingerprint(host, port, manager.cert_name,
+                                                         max(deadline.remaining(), 0))
+        except asyncio.TimeoutError:
+            error = TimeoutError(f'no handshake within {timeout:.1f}s')
+        except (OSError, ValueError) as e:
+            error = e
+        # The certificate an earlier attempt was served says more than a later one failing
+        if error is None or result.served is None:
+            result.error = error
+        if result.success or deadline.remaining() <= delay:
+            break
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RETRY_DELAY)
+    result.duration = time.monotonic() - start
+    return result
+
+
+async def verify_async(jobs: List[Tuple[str, BaseCertManager]], max_connections: int = 32,
+                       timeout: float = 5.0) -> VerificationReport:
+    """
+    Check every endpoint of the given jobs concurrently.
+
+    Args:
+        jobs: List of (app, manager) tuples, typically the jobs just deployed
+        max_connections: Maximum number of connections open at once
+        timeout: Seconds each endpoint has to serve the deployed certificate
+
+    Returns:
+        VerificationReport with a result for every endpoint
+    """
+    start = time.monotonic()
+    slots = asyncio.Semaphore(max_connections)
+    results = await asyncio.gather(*(verify_endpoint(app, manager, manager.transport.resolve(host), port,
+                                                     slots, timeout)
+                                     for app, manager in jobs for host, port in manager.endpoints))
+    return VerificationReport(list(results), time.monotonic() - start)
+
+
+def verify(jobs: List[Tuple[str, BaseCertManager]], max_connections: int = 32,
+           timeout: float = 5.0) -> VerificationReport:
+    """
+    Check every endpoint of the given jobs like ``verify_async``, on a new event loop.
+    """
+    return asyncio.run(verify_async(jobs, max_connections, timeout))
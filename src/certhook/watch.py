@@ -0,0 +1,209 @@
+"""
+Module for watching the Let's Encrypt directories for renewed certificates.
+
+Uses Linux inotify through ctypes, so a renewal is noticed as soon as
+certbot writes it, without polling.
+"""
+
+import ctypes
+import errno
+import os
+import re
+import select
+import struct
+import time
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+# inotify_init1 flags
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# inotify event masks
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Events showing a lineage's files have changed
+LINEAGE_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ATTRIB
+# Events showing lineages have been added or removed
+ROOT_EVENTS = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+# Files certbot writes in a lineage: the live symlinks and the numbered archive files they
+# point to. Anything else, such as files deployments convert next to them, isn't a renewal.
+CERTBOT_FILE = re.compile(r'(cert|chain|fullchain|privkey)\d*\.pem')
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    Minimal wrapper around a Linux inotify instance.
+    """
+
+    def __init__(self):
+        """
+        Raises:
+            OSError: If inotify isn't available on this system
+        """
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available on this system')
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """
+        Watch a path for events.
+
+        Args:
+            path: Path to watch
+            mask: Events to report
+
+        Returns:
+            Watch descriptor
+
+        Raises:
+            OSError: If the path can't be watched
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read(self) -> Iterator[Tuple[int, int, str]]:
+        """
+        Read the events that are ready, without blocking.
+
+        Yields:
+            Tuples of (watch descriptor, mask, name)
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield wd, mask, name
+
+    def close(self) -> None:
+        """Release the inotify instance"""
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Reports which certificate lineages change, one burst of writes at a time.
+
+    Each lineage's ``live/`` directory is watched for its symlinks being
+    replaced and its ``archive/`` directory for new certificate files. A
+    renewal touches several files; changes are collected until no event
+    has arrived for the debounce period, then reported together.
+
+    Only certbot's own files count, so the files deployments write into a
+    lineage (e.g. Emby's ``fullchain.p12``) don't look like another renewal.
+    """
+
+    def __init__(self, live_root: str = '/etc/letsencrypt/live', debounce: float = 2.0):
+        """
+        Args:
+            live_root: Directory holding the certificate lineages
+            debounce: Seconds without events that end a burst
+        """
+        self.live_root = live_root
+        self.archive_root = os.path.join(os.path.dirname(live_root.rstrip('/')), 'archive')
+        self.debounce = debounce
+        self.inotify = Inotify()
+        # Watch descriptor -> lineage name, None for the live root itself
+        self._watches: Dict[int, Optional[str]] = {}
+        self._root = self.inotify.add_watch(live_root, ROOT_EVENTS)
+        self._watches[self._root] = None
+        for name in sorted(os.listdir(live_root)):
+            if os.path.isdir(os.path.join(live_root, name)):
+                self._watch_lineage(name)
+
+    def _watch_lineage(self, name: str) -> None:
+        """Watch a lineage's live and archive directories, if they exist"""
+        for root in (self.live_root, self.archive_root):
+            try:
+                self._watches[self.inotify.add_watch(os.path.join(root, name), LINEAGE_EVENTS)] = name
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+
+    @property
+    def lineages(self) -> Set[str]:
+        """Names of the lineages being watched"""
+        return {name for name in self._watches.values() if name is not None}
+
+    def _changes(self) -> Set[str]:
+        """Lineages changed by the events ready to read"""
+        changed = set()
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so anything may have changed
+                changed |= self.lineages
+            elif mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+            elif wd == self._root:
+                if mask & IN_DELETE_SELF:
+                    raise FileNotFoundError(errno.ENOENT, 'Watched directory removed', self.live_root)
+                if mask & (IN_CREATE | IN_MOVED_TO) and mask & IN_ISDIR:
+                    self._watch_lineage(name)
+                    changed.add(name)
+            elif wd in self._watches and CERTBOT_FILE.fullmatch(name):
+                changed.add(self._watches[wd])
+        return changed
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Wait for a burst of changes to finish.
+
+        Args:
+            timeout: Seconds to wait for a burst to start, None to wait forever
+
+        Returns:
+            Names of the changed lineages, empty if the timeout expired first
+        """
+        changed: Set[str] = set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if changed:
+                wait_for = self.debounce
+            elif deadline is not None:
+                wait_for = max(0.0, deadline - time.monotonic())
+            else:
+                wait_for = None
+            ready, _, _ = select.select([self.inotify.fd], [], [], wait_for)
+            if ready:
+                changed |= self._changes()
+            elif changed or deadline is not None:
+                return changed
+
+    def changes(self) -> Iterator[Set[str]]:
+        """
+        Wait for bursts of changes forever.
+
+        Yields:
+            Names of the lineages changed by each burst
+        """
+        while True:
+            yield self.wait()
+
+    def close(self) -> None:
+        """Stop watching"""
+        self.inotify.close()
@@ -0,0 +1,191 @@
+"""
+Minimal X.509 certificate parsing, for reporting on certificates without openssl.
+
+Only the fields certhook reports are decoded: subject, issuer, subject
+alternative names, validity, public key type and the SHA-256 fingerprint.
+"""
+
+import datetime
+import hashlib
+import ipaddress
+from typing import Dict, List, Optional
+
+from . import asn1
+
+OID_SUBJECT_ALT_NAME = '2.5.29.17'
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+OID_EC_PUBLIC_KEY = '1.2.840.10045.2.1'
+
+# Short names of the attributes commonly found in certificate names
+NAME_ATTRIBUTES = {
+    '2.5.4.3': 'CN',
+    '2.5.4.6': 'C',
+    '2.5.4.7': 'L',
+    '2.5.4.8': 'ST',
+    '2.5.4.10': 'O',
+    '2.5.4.11': 'OU',
+    '1.2.840.113549.1.9.1': 'emailAddress',
+}
+
+KEY_TYPES = {
+    '1.3.101.112': 'Ed25519',
+    '1.3.101.113': 'Ed448',
+}
+
+CURVES = {
+    '1.2.840.10045.3.1.7': 'P-256',
+    '1.3.132.0.34': 'P-384',
+    '1.3.132.0.35': 'P-521',
+}
+
+T61_STRING = 0x14
+UNIVERSAL_STRING = 0x1C
+BOOLEAN = 0x01
+
+
+def fingerprint(der: bytes) -> str:
+    """SHA-256 fingerprint of a DER encoded certificate, as colon separated hex"""
+    return ':'.join(f'{byte:02X}' for byte in hashlib.sha256(der).digest())
+
+
+def decode_string(tag: int, content: bytes) -> str:
+    """Value of one of the ASN.1 string types"""
+    if tag == asn1.BMP_STRING:
+        return content.decode('utf-16-be')
+    if tag == UNIVERSAL_STRING:
+        return content.decode('utf-32-be')
+    if tag == T61_STRING:
+        return content.decode('latin-1')
+    return content.decode('utf-8', errors='replace')
+
+
+def decode_time(tag: int, content: bytes) -> datetime.datetime:
+    """
+    Value of a UTCTime or GeneralizedTime, as an aware UTC datetime.
+    """
+    text = content.decode('ascii')
+    if tag == asn1.UTC_TIME:
+        # Two digit years are 1950-2049
+        year = int(text[:2])
+        text = str(1900 + year if year >= 50 else 2000 + year) + text[2:]
+    elif tag != asn1.GENERALIZED_TIME:
+        raise ValueError(f'Unexpected time tag {tag:#x}')
+    return datetime.datetime.strptime(text[:14], '%Y%m%d%H%M%S').replace(tzinfo=datetime.timezone.utc)
+
+
+def decode_name(content: bytes) -> str:
+    """
+    A Name as a comma separated string, most significant attribute first,
+    e.g. ``C=US, O=Let's Encrypt, CN=R3``.
+    """
+    parts = []
+    for _, rdn in asn1.decode_all(content):
+        for _, attribute in asn1.decode_all(rdn):
+            (_, oid), (tag, value) = asn1.decode_all(attribute)[:2]
+            dotted = asn1.decode_oid(oid)
+            parts.append(f'{NAME_ATTRIBUTES.get(dotted, dotted)}={decode_string(tag, value)}')
+    return ', '.join(parts)
+
+
+def decode_alt_names(content: bytes) -> List[str]:
+    """DNS names and IP addresses in a SubjectAltName extension's value"""
+    names = []
+    for tag, value in asn1.decode_all(asn1.decode(content)[1]):
+        if tag == 0x82:
+            names.append(value.decode('ascii'))
+        elif tag == 0x87:
+            names.append(str(ipaddress.ip_address(value)))
+    return names
+
+
+def decode_key_type(content: bytes) -> str:
+    """
+    Short description of a SubjectPublicKeyInfo's key, e.g. ``RSA-2048`` or ``EC-P-256``.
+    """
+    (_, algorithm), (_, key) = asn1.decode_all(content)[:2]
+    algorithm = asn1.decode_all(algorithm)
+    dotted = asn1.decode_oid(algorithm[0][1])
+    if dotted == OID_RSA_ENCRYPTION:
+        # Skip the BIT STRING's unused bits octet
+        modulus = asn1.decode_all(asn1.decode(key[1:])[1])[0][1]
+        return f'RSA-{int.from_bytes(modulus, "big").bit_length()}'
+    if dotted == OID_EC_PUBLIC_KEY:
+        curve = asn1.decode_oid(algorithm[1][1]) if len(algorithm) > 1 else ''
+        return f'EC-{CURVES.get(curve, curve or "unknown")}'
+    return KEY_TYPES.get(dotted, dotted)
+
+
+class Certificate:
+    """
+    Fields of a parsed certificate.
+    """
+
+    def __init__(self, der: bytes):
+        """
+        Args:
+            der: DER encoded certificate
+
+        Raises:
+            ValueError: If the certificate can't be parsed
+        """
+        try:
+            tbs = asn1.decode_all(asn1.decode_all(asn1.decode(der)[1])[0][1])
+            # Skip the explicitly tagged version, present in v2 and v3 certificates
+            if tbs[0][0] == 0xA0:
+                tbs = tbs[1:]
+            self.serial = asn1.decode_integer(tbs[0][1])
+            self.issuer = decode_name(tbs[2][1])
+            not_before, not_after = asn1.decode_all(tbs[3][1])
+            self.not_before = decode_time(*not_before)
+            self.not_after = decode_time(*not_after)
+            self.subject = decode_name(tbs[4][1])
+            self.key_type = decode_key_type(tbs[5][1])
+            self.sans: List[str] = []
+            for tag, content in tbs[6:]:
+                if tag != 0xA3:
+                    continue
+                for _, extension in asn1.decode_all(asn1.decode(content)[1]):
+                    fields = asn1.decode_all(extension)
+                    if asn1.decode_oid(fields[0][1]) == OID_SUBJECT_ALT_NAME:
+                        self.sans = decode_alt_names(fields[-1][1])
+        except (IndexError, UnicodeDecodeError) as e:
+            raise ValueError(f'Malformed certificate: {e}') from e
+        self.fingerprint = fingerprint(der)
+
+    @property
+    def common_name(self) -> Optional[str]:
+        """The subject's common name, if it has one"""
+        for part in self.subject.split(', '):
+            if part.startswith('CN='):
+                return part[3:]
+        return None
+
+    def as_dict(self) -> Dict[str, object]:
+        """Fields as a JSON serialisable dict, times in ISO 8601"""
+        return {
+            'subject': self.subject,
+            'issuer': self.issuer,
+            'serial': f'{self.serial:X}',
+            'sans': self.sans,
+            'not_before': self.not_before.isoformat(),
+            'not_after': self.not_after.isoformat(),
+            'key_type': self.key_type,
+            'fingerprint': self.fingerprint,
+        }
+
+    def __repr__(self) -> str:
+        return f'Certificate(subject={self.subject!r}, not_after={self.not_after.isoformat()!r})'
+
+
+def load(path: str) -> List[Certificate]:
+    """
+    Parse every certificate in a PEM file, in file order.
+
+    Raises:
+        ValueError: If the file holds no certificate
+    """
+    with open(path, 'rb') as f:
+        ders = [der for label, der in asn1.pem_blocks(f.read()) if label == 'CERTIFICATE']
+    if not ders:
+        raise ValueError(f'No certificate in {path}')
+    return [Certificate(der) for der in ders]
@@ -0,0 +1,247 @@
+"""
+End-to-end benchmarks for the certificate managers.
+
+Runs every manager against a generated certificate under a temporary
+Let's Encrypt root, with the external programs (openssl, keytool, service,
+systemctl, fwconsole, cp, chown, chmod) replaced by stubs that log each
+call and sleep for a configurable latency. Measures per-manager latency,
+programs started per deployment, and batch throughput at increasing sizes,
+and prints the results as JSON for comparing runs across versions.
+
+Usage:
+    python tests/benchmark.py [--sizes 1 10 100 1000] [--latency 0.005]
+                              [--stub-latency keytool=0.5] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from conftest import make_test_certs
+
+import certhook
+import certhook.artifacts
+import certhook.locks
+from certhook import EmbyCertManager, FreePBXCertManager, PiHoleCertManager, UnifiCertManager
+from certhook.base import BaseCertManager
+from certhook.batch import BatchRunner
+
+# Programs the managers may run, replaced by stubs
+STUB_PROGRAMS = ('openssl', 'keytool', 'service', 'systemctl', 'fwconsole', 'cp', 'chown', 'chmod')
+
+
+def install_stubs(bin_dir: Path, log: Path, latency: float,
+                  overrides: Optional[Dict[str, float]] = None) -> Dict[str, str]:
+    """
+    Write stub programs that log their invocation and sleep.
+
+    Args:
+        bin_dir: Directory to write the stubs to
+        log: File each stub appends its command line to
+        latency: Seconds each stub sleeps
+        overrides: Latency for particular programs
+
+    Returns:
+        Mapping of program name to stub path, for ``BaseCertManager.programs``
+    """
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    programs = {}
+    for name in STUB_PROGRAMS:
+        delay = (overrides or {}).get(name, latency)
+        stub = bin_dir / name
+        script = f'#!/bin/sh\necho "{name} $*" >> "{log}"\n'
+        if delay:
+            script += f'sleep {delay}\n'
+        stub.write_text(script)
+        stub.chmod(0o755)
+        programs[name] = str(stub)
+    return programs
+
+
+class Environment:
+    """
+    Temporary Let's Encrypt root, stubs and manager classes writing inside it.
+    """
+
+    def __init__(self, root: Path, latency: float, overrides: Optional[Dict[str, float]] = None,
+                 native: bool = True):
+        """
+        Args:
+            root: Empty directory to build the environment in
+            latency: Seconds each stub program sleeps
+            overrides: Latency for particular programs
+            native: Whether managers run operations in-process
+        """
+        self.root = root
+        self.native = native
+        self.live_root = root / 'live'
+        self.log = root / 'stub.log'
+        self.log.touch()
+        self.template = make_test_certs(root / 'template', 'template.example.com')
+        programs = install_stubs(root / 'bin', self.log, latency, overrides)
+        owner = {'user': str(os.getuid()), 'group': str(os.getgid())}
+        attrs = {'live_root': str(self.live_root), 'programs': programs}
+        (root / 'keys').mkdir()
+
+        self.managers = {
+            'emby': type('BenchEmbyCertManager', (EmbyCertManager,), dict(attrs)),
+            'freepbx': type('BenchFreePBXCertManager', (FreePBXCertManager,),
+                            dict(attrs, keys_dir=str(root / 'keys'))),
+            'pihole': type('BenchPiHoleCertManager', (PiHoleCertManager,), dict(attrs)),
+            'unifi': type('BenchUnifiCertManager', (UnifiCertManager,),
+                          dict(attrs, keystore=str(root / 'keystore'))),
+        }
+        self._owner = owner
+
+    def lineage(self, cert_name: str) -> None:
+        """Create a lineage by copying the generated certificate"""
+        if not (self.live_root / cert_name).exists():
+            shutil.copytree(self.template, self.live_root / cert_name)
+
+    def manager(self, app: str, cert_name: str) -> BaseCertManager:
+        """Build a manager for an app, writing inside the environment"""
+        options = dict(self._owner) if app == 'pihole' else {}
+        return self.managers[app](cert_name, native=self.native, **options)
+
+    def forks(self) -> int:
+        """Number of stub programs started so far"""
+        with open(self.log) as f:
+            return sum(1 for _ in f)
+
+
+def bench_managers(env: Environment, repeats: int) -> Dict[str, dict]:
+    """
+    Deploy one certificate with each manager, several times.
+
+    Returns:
+        Mapping of app to its latency statistics and programs started per deployment
+    """
+    env.lineage('single.example.com')
+    results = {}
+    for app in sorted(env.managers):
+        timings = []
+        forks = env.forks()
+        for _ in range(repeats):
+            manager = env.manager(app, 'single.example.com')
+            start = time.perf_counter()
+            manager()
+            timings.append(time.perf_counter() - start)
+        results[app] = {
+            'repeats': repeats,
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'max': max(timings),
+            'forks_per_deployment': (env.forks() - forks) / repeats,
+        }
+    return results
+
+
+def bench_batch(env: Environment, size: int, workers: int) -> dict:
+    """
+    Deploy a batch of certificates spread across every app.
+
+    Returns:
+        Wall time, throughput and programs started for the batch
+    """
+    apps = sorted(env.managers)
+    jobs = []
+    for i in range(size):
+        cert_name = f'cert{i}.example.com'
+        env.lineage(cert_name)
+        app = apps[i % len(apps)]
+        jobs.append((app, env.manager(app, cert_name)))
+    forks = env.forks()
+    report = BatchRunner(max_workers=workers, per_app_limit=workers).run(jobs)
+    forks = env.forks() - forks
+    return {
+        'size': size,
+        'workers': workers,
+        'wall': report.wall_time,
+        'throughput': size / report.wall_time,
+        'forks': forks,
+        'forks_per_deployment': forks / size,
+        'failed': len(report.failed),
+    }
+
+
+def run(sizes: List[int], latency: float, overrides: Optional[Dict[str, float]] = None,
+        repeats: int = 5, workers: int = 4, native: bool = True) -> dict:
+    """
+    Run every benchmark in a fresh temporary environment.
+
+    Returns:
+        Machine readable results
+    """
+    defaults = certhook.locks.DEFAULT_LOCK_DIR, certhook.artifacts.DEFAULT_CACHE_DIR
+    with tempfile.TemporaryDirectory(prefix='certhook-bench-') as tmp:
+        # Keep locks and converted files (which hold private keys) out of /run and /var
+        certhook.locks.DEFAULT_LOCK_DIR = os.path.join(tmp, 'locks')
+        certhook.artifacts.DEFAULT_CACHE_DIR = os.path.join(tmp, 'artifacts')
+        try:
+            return bench(Path(tmp), sizes, latency, overrides, repeats, workers, native)
+        finally:
+            certhook.locks.DEFAULT_LOCK_DIR, certhook.artifacts.DEFAULT_CACHE_DIR = defaults
+
+
+def bench(tmp: Path, sizes: List[int], latency: float, overrides: Optional[Dict[str, float]],
+          repeats: int, workers: int, native: bool) -> dict:
+    """Run every benchmark in an environment under tmp"""
+    env = Environment(tmp, latency, overrides, native)
+    return {
+        'certhook': certhook.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'latency': latency,
+        'stub_latency': overrides or {},
+        'native': native,
+        'managers': bench_managers(env, repeats),
+        'batch': [bench_batch(env, size, workers) for size in sizes],
+    }
+
+
+def parse_latency(spec: str) -> tuple:
+    """Parse a program=seconds latency override"""
+    name, _, seconds = spec.partition('=')
+    if name not in STUB_PROGRAMS:
+        raise argparse.ArgumentTypeError(f'unknown program {name!r}')
+    return name, float(seconds)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark certhook deployments against stub programs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='Batch sizes to measure (default: 1 10 100 1000)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds each stub program takes (default: 0.005)')
+    parser.add_argument('--stub-latency', type=parse_latency, action='append', default=[],
+                        metavar='PROGRAM=SECONDS', help='Latency for a particular program')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='Deployments per manager for the latency figures (default: 5)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Batch worker threads (default: 4)')
+    parser.add_argument('--no-native', dest='native', action='store_false',
+                        help='Run the external programs instead of the in-process operations')
+    parser.add_argument('--output', help='File to write the results to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.latency, dict(args.stub_latency), args.repeats,
+                  args.workers, args.native)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
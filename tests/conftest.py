@@ -2,20 +2,44 @@
 Pytest configuration and fixtures
 """
 
+import subprocess
 import pytest
 from pathlib import Path
 
 
+@pytest.fixture(autouse=True)
+def state_file(tmp_path: Path, monkeypatch) -> Path:
+    """Keep the deployment state store out of /var/lib during tests"""
+    path = tmp_path / "state.json"
+    monkeypatch.setattr('certhook.state.DEFAULT_STATE_FILE', str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def lock_dir(tmp_path: Path, monkeypatch) -> Path:
+    """Keep the locks shared between processes out of /run/lock during tests"""
+    path = tmp_path / "locks"
+    monkeypatch.setattr('certhook.locks.DEFAULT_LOCK_DIR', str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def artifact_dir(tmp_path: Path, monkeypatch) -> Path:
+    """Keep the cache of converted files out of /var/cache during tests"""
+    path = tmp_path / "artifacts"
+    monkeypatch.setattr('certhook.artifacts.DEFAULT_CACHE_DIR', str(path))
+    return path
+
+
 @pytest.fixture
 def cert_name() -> str:
     """Set the certificate name for testing"""
     return "example.com"
 
 
-@pytest.fixture
-def test_certs(cert_name: str, tmp_path: Path) -> Path:
-    """Create temporary certificate paths with real self-signed certificates for testing"""
-    live_dir = tmp_path / "etc" / "letsencrypt" / "live" / cert_name
+def make_test_certs(live_root: Path, cert_name: str) -> Path:
+    """Create a certificate lineage with real CA-signed certificates under live_root"""
+    live_dir = live_root / cert_name
     live_dir.mkdir(parents=True)
     
     # Generate CA key and certificate
@@ -29,20 +53,19 @@ def test_certs(cert_name: str, tmp_path: Path) -> Path:
     fullchain = live_dir / "fullchain.pem"
     
     # Generate CA key and self-signed certificate
-    import subprocess
     subprocess.run([
         'openssl', 'req', '-x509', '-new', '-nodes',
         '-keyout', str(ca_key), '-out', str(ca_cert),
         '-subj', '/CN=Test CA',
         '-days', '365'
-    ], check=True)
+    ], check=True, capture_output=True)
     
     # Generate server key and CSR
     subprocess.run([
         'openssl', 'req', '-new', '-nodes',
         '-keyout', str(server_key), '-out', str(server_csr),
         '-subj', f'/CN={cert_name}',
-    ], check=True)
+    ], check=True, capture_output=True)
     
     # Sign the server certificate with CA
     subprocess.run([
@@ -51,7 +74,7 @@ def test_certs(cert_name: str, tmp_path: Path) -> Path:
         '-CAkey', str(ca_key), '-CAcreateserial',
         '-out', str(server_cert),
         '-days', '365'
-    ], check=True)
+    ], check=True, capture_output=True)
     
     # Create fullchain by concatenating server cert and CA cert
     with open(fullchain, 'wb') as f:
@@ -59,3 +82,9 @@ def test_certs(cert_name: str, tmp_path: Path) -> Path:
         f.write(ca_cert.read_bytes())
     
     return live_dir
+
+
+@pytest.fixture
+def test_certs(cert_name: str, tmp_path: Path) -> Path:
+    """Create temporary certificate paths with real self-signed certificates for testing"""
+    return make_test_certs(tmp_path / "etc" / "letsencrypt" / "live", cert_name)
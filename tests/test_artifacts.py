@@ -0,0 +1,100 @@
+"""
+Tests for the cache of converted files.
+"""
+
+import os
+import stat
+from pathlib import Path
+import pytest
+from certhook import EmbyCertManager
+from certhook.artifacts import ArtifactCache
+from certhook.base import BaseCertManager
+from certhook.ops import Artifact
+from certhook.transport import RootTransport
+
+
+def counted(data: bytes) -> Artifact:
+    """Artifact without inputs, counting its conversions"""
+    def render():
+        artifact.renders += 1
+        return data
+    artifact = Artifact('test', [], {}, '/unused', render)
+    artifact.renders = 0
+    return artifact
+
+
+def test_converted_once(tmp_path: Path):
+    """Test a file is converted once for the same inputs, format and parameters"""
+    source = tmp_path / 'cert.pem'
+    source.write_bytes(b'certificate')
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    artifact = counted(b'converted')
+    artifact.inputs = [str(source)]
+
+    assert cache.fetch(artifact) == b'converted'
+    assert cache.fetch(artifact) == b'converted'
+    assert artifact.renders == 1 and (cache.misses, cache.hits) == (1, 1)
+
+    # Other parameters or inputs make another file
+    artifact.params = {'password': 'secret'}
+    cache.fetch(artifact)
+    source.write_bytes(b'renewed certificate')
+    cache.fetch(artifact)
+    assert artifact.renders == 3
+
+    entries = list((tmp_path / 'cache').iterdir())
+    assert len(entries) == 3
+    assert stat.S_IMODE((tmp_path / 'cache').stat().st_mode) == 0o700
+    assert all(stat.S_IMODE(entry.stat().st_mode) == 0o600 for entry in entries)
+
+    artifact.inputs.append(str(tmp_path / 'missing.pem'))
+    with pytest.raises(FileNotFoundError):
+        cache.fetch(artifact)
+
+
+def test_least_recently_used_evicted(tmp_path: Path):
+    """Test the entries used longest ago are removed once the cache is over its limits"""
+    cache = ArtifactCache(str(tmp_path / 'cache'), max_entries=2, max_bytes=10)
+    artifacts = [counted(b'xxxx') for _ in range(3)]
+    for i, artifact in enumerate(artifacts):
+        artifact.params = {'n': i}
+
+    cache.fetch(artifacts[0])
+    cache.fetch(artifacts[1])
+    # File times can be coarser than these calls, so order the entries explicitly
+    os.utime(cache.entry(cache.key(artifacts[0])), ns=(2, 2))
+    os.utime(cache.entry(cache.key(artifacts[1])), ns=(1, 1))
+    # Using an entry makes it the most recently used
+    cache.fetch(artifacts[1])
+    cache.fetch(artifacts[2])
+    assert sorted(os.listdir(cache.path)) == sorted(cache.key(a) for a in artifacts[1:])
+    assert [artifact.renders for artifact in artifacts] == [1, 1, 1]
+
+    # Over the size limit, even within the number of entries
+    big = counted(b'y' * 8)
+    cache.fetch(big)
+    assert os.listdir(cache.path) == [cache.key(big)]
+
+
+def test_shared_between_deployments(tmp_path: Path, test_certs: Path, monkeypatch):
+    """Test deployments of the same certificate to other hosts share one conversion"""
+    monkeypatch.setattr(BaseCertManager, 'live_root', str(test_certs.parent))
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    host = RootTransport(str(tmp_path / 'host'), 'host')
+    local = EmbyCertManager('example.com')
+    remote = EmbyCertManager('example.com')
+    remote.transport = host
+    for manager in (local, remote):
+        manager.artifact_cache = cache
+        manager.run(manager.cmds[0])
+
+    p12 = test_certs / 'fullchain.p12'
+    assert Path(host.path(str(p12))).read_bytes() == p12.read_bytes()
+    assert (cache.misses, cache.hits) == (1, 1)
+    # The other host was written to, rather than converting there
+    assert host.commands == []
+
+    # A renewed certificate is converted again
+    (test_certs / 'fullchain.pem').write_bytes((test_certs / 'cert.pem').read_bytes())
+    local.run(local.cmds[0])
+    assert cache.misses == 2
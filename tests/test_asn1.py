@@ -0,0 +1,58 @@
+"""
+Tests for the DER/PEM helpers.
+"""
+
+import pytest
+from certhook import asn1
+
+
+@pytest.mark.parametrize('value,content', [
+    (0, '00'), (127, '7f'), (128, '0080'), (256, '0100'), (65537, '010001'),
+    (-1, 'ff'), (-128, '80'), (-129, 'ff7f'),
+])
+def test_integer_round_trip(value, content):
+    """Test INTEGER encoding is minimal and decodes back"""
+    tag, encoded, end = asn1.decode(asn1.integer(value))
+    assert tag == asn1.INTEGER
+    assert encoded.hex() == content
+    assert asn1.decode_integer(encoded) == value
+
+
+@pytest.mark.parametrize('dotted', ['1.2.840.113549.1.12.10.1.2', '2.16.840.1.101.3.4.1.42', '2.5.29.17'])
+def test_oid_round_trip(dotted):
+    """Test OBJECT IDENTIFIER encoding decodes back"""
+    _, content, _ = asn1.decode(asn1.oid(dotted))
+    assert asn1.decode_oid(content) == dotted
+
+
+def test_long_length():
+    """Test elements longer than 127 bytes use long form lengths"""
+    encoded = asn1.octet_string(b'x' * 300)
+    assert encoded[:4] == b'\x04\x82\x01\x2c'
+    tag, content, end = asn1.decode(encoded)
+    assert content == b'x' * 300
+    assert end == len(encoded)
+
+
+def test_decode_all():
+    """Test decoding concatenated elements"""
+    data = asn1.integer(1) + asn1.null() + asn1.octet_string(b'ab')
+    assert asn1.decode_all(data) == [(asn1.INTEGER, b'\x01'), (asn1.NULL, b''), (asn1.OCTET_STRING, b'ab')]
+
+
+def test_decode_truncated():
+    """Test truncated data is rejected"""
+    with pytest.raises(ValueError):
+        asn1.decode(asn1.octet_string(b'abcd')[:-1])
+
+
+def test_set_of_is_sorted():
+    """Test SET OF elements are in DER order"""
+    assert asn1.set_of(asn1.integer(2), asn1.integer(1)) == asn1.tlv(asn1.SET, asn1.integer(1) + asn1.integer(2))
+
+
+def test_pem_round_trip():
+    """Test PEM blocks encode and decode back"""
+    der = bytes(range(200))
+    pem = asn1.pem_encode('CERTIFICATE', der) + asn1.pem_encode('PRIVATE KEY', b'key')
+    assert asn1.pem_blocks(pem) == [('CERTIFICATE', der), ('PRIVATE KEY', b'key')]
@@ -2,10 +2,18 @@
 Tests for the base certificate manager module.
 """
 
+import logging
 import pytest
 import subprocess
-from unittest.mock import patch, MagicMock
+import time
+from unittest.mock import ANY, patch, MagicMock
 from certhook.base import BaseCertManager
+from certhook.deadlines import Deadline, DeadlineExceeded
+from certhook.ops import Operation, UnsupportedOperation
+from certhook.pipeline import Pipeline
+from certhook.probes import Probe, ProbeTimeout
+from certhook.services import Restart
+from certhook.steps import Step
 
 def test_base_cert_manager_init():
     """Test initialization of BaseCertManager."""
@@ -27,7 +35,7 @@ def test_cert_cmds_default_behavior():
     manager.cert_cmds()
     assert manager.cmds == []
 
-@patch('subprocess.run')
+@patch('certhook.output.run')
 def test_run_command(mock_run):
     """Test running a command."""
     mock_result = MagicMock()
@@ -39,30 +47,26 @@ def test_run_command(mock_run):
     cmd = ["echo", "test"]
     result = manager.run(cmd)
     
-    mock_run.assert_called_once_with(cmd, capture_output=True, check=True)
+    mock_run.assert_called_once_with(cmd, ANY, None, timeout=None)
     assert result == mock_result
 
-@patch('subprocess.run')
-def test_run_command_verbose(mock_run):
-    """Test running a command with verbose output."""
-    mock_result = MagicMock()
-    mock_result.stdout = b"test output\n"
-    mock_result.stderr = b"test error\n"
-    mock_result.args = ["echo", "test"]
-    mock_run.return_value = mock_result
-    
-    manager = BaseCertManager("test-cert", verbose=True)
-    cmd = ["echo", "test"]
-    
-    with patch('builtins.print') as mock_print:
-        result = manager.run(cmd)
-        
-        # Verify all print calls were made
-        mock_print.assert_any_call('command: echo test')
-        mock_print.assert_any_call('stdout: test output\n')
-        mock_print.assert_any_call('stderr: test error\n')
-
-@patch('subprocess.run')
+def test_run_command_verbose(caplog):
+    """Test command output is logged a line at a time, at INFO level with verbose output."""
+    cmd = ["sh", "-c", "echo test output; echo test error >&2"]
+    with caplog.at_level(logging.DEBUG, logger="certhook"):
+        BaseCertManager("test-cert", verbose=True).run(cmd)
+        BaseCertManager("test-cert").run(cmd)
+
+    records = [(record.levelno, getattr(record, "stream", None), record.message) for record in caplog.records]
+    for level, first in [(logging.INFO, 0), (logging.DEBUG, 3)]:
+        assert records[first] == (level, None, "command: sh -c echo test output; echo test error >&2")
+        assert set(records[first + 1:first + 3]) == {
+            (level, "stdout", "test output"), (level, "stderr", "test error")}
+    record = caplog.records[1]
+    assert (record.cert, record.manager, record.host, record.step) == (
+        "test-cert", "BaseCertManager", "localhost", "sh -c")
+
+@patch('certhook.output.run')
 def test_call_executes_commands(mock_run):
     """Test that __call__ executes all commands in the queue."""
     class TestCertManager(BaseCertManager):
@@ -81,8 +85,8 @@ def test_call_executes_commands(mock_run):
     manager()
     
     assert mock_run.call_count == 2
-    mock_run.assert_any_call(["cmd1", "arg1"], capture_output=True, check=True)
-    mock_run.assert_any_call(["cmd2", "arg2"], capture_output=True, check=True)
+    mock_run.assert_any_call(["cmd1", "arg1"], ANY, None, timeout=None)
+    mock_run.assert_any_call(["cmd2", "arg2"], ANY, None, timeout=None)
 
 def test_subprocess_error_handling():
     """Test that subprocess errors are propagated."""
@@ -90,3 +94,165 @@ def test_subprocess_error_handling():
     with pytest.raises((subprocess.CalledProcessError, FileNotFoundError)):
         # Running a command that should fail
         manager.run(["nonexistent_command"])
+
+@patch('certhook.output.run')
+def test_run_operation(mock_run):
+    """Test operations run in-process by default."""
+    operation = MagicMock(spec=Operation)
+    manager = BaseCertManager("test-cert")
+    assert manager.run(operation) is None
+    operation.assert_called_once_with()
+    mock_run.assert_not_called()
+
+@patch('certhook.output.run')
+def test_run_operation_without_native(mock_run):
+    """Test operations run their equivalent commands when native execution is disabled."""
+    operation = MagicMock(spec=Operation)
+    operation.native_only = False
+    operation.commands.return_value = [["cmd1"], ["cmd2"]]
+    manager = BaseCertManager("test-cert", native=False)
+    manager.run(operation)
+    operation.assert_not_called()
+    assert mock_run.call_count == 2
+    mock_run.assert_any_call(["cmd2"], ANY, None, timeout=None)
+
+@patch('certhook.output.run')
+def test_run_unsupported_operation_falls_back(mock_run):
+    """Test operations that can't handle their input fall back to their commands."""
+    operation = MagicMock(spec=Operation)
+    operation.native_only = False
+    operation.side_effect = UnsupportedOperation('legacy keystore')
+    operation.commands.return_value = [["keytool"]]
+    manager = BaseCertManager("test-cert")
+    manager.run(operation)
+    mock_run.assert_called_once_with(["keytool"], ANY, None, timeout=None)
+
+@patch('certhook.output.run')
+def test_call_restarts_last(mock_run):
+    """Test restarts run after every command, and a failed restart doesn't stop the others."""
+    class TestCertManager(BaseCertManager):
+        def cert_cmds(self):
+            self.cmds = [Restart("emby-server"), ["cmd1"], Restart("apache2")]
+
+    mock_run.side_effect = [MagicMock(), subprocess.CalledProcessError(1, "service"), MagicMock()]
+    manager = TestCertManager("test-cert")
+    with pytest.raises(subprocess.CalledProcessError):
+        manager()
+    assert [call.args[0] for call in mock_run.call_args_list] == [
+        ["cmd1"],
+        ["/usr/sbin/service", "emby-server", "restart"],
+        ["/usr/sbin/service", "apache2", "reload"],
+    ]
+
+@patch('certhook.output.run')
+def test_run_native_only_operation(mock_run):
+    """Test operations without external commands run in-process even when native execution is disabled."""
+    operation = MagicMock(spec=Operation)
+    operation.native_only = True
+    manager = BaseCertManager("test-cert", native=False)
+    manager.run(operation)
+    operation.assert_called_once_with()
+    operation.commands.assert_not_called()
+    mock_run.assert_not_called()
+
+@patch('certhook.output.run')
+def test_run_program_override(mock_run):
+    """Test programs can be run from configured paths."""
+    class TestCertManager(BaseCertManager):
+        programs = {"keytool": "/opt/java/bin/keytool"}
+
+    manager = TestCertManager("test-cert")
+    manager.run(["/usr/bin/keytool", "-list"])
+    manager.run(["/usr/bin/openssl", "version"])
+    assert [call.args[0] for call in mock_run.call_args_list] == [
+        ["/opt/java/bin/keytool", "-list"], ["/usr/bin/openssl", "version"]]
+
+def test_run_pipeline(caplog):
+    """Test pipelines stream between their commands, run from configured paths."""
+    class TestCertManager(BaseCertManager):
+        programs = {"rev": "/usr/bin/tac"}
+
+    manager = TestCertManager("test-cert", verbose=True)
+    with caplog.at_level(logging.INFO, logger="certhook"):
+        result = manager.run(Pipeline(["printf", "a\\nb\\n"], ["/opt/rev"]))
+    assert result.stdout == b"b\na\n"
+    assert caplog.messages == ["command: printf a\\nb\\n | /usr/bin/tac", "b", "a"]
+
+@patch('certhook.output.run')
+def test_restart_waits_ready(mock_run, caplog):
+    """Test restarted services are only probed when waiting for them is enabled."""
+    caplog.set_level(logging.INFO, logger="certhook")
+    probe = MagicMock(spec=Probe)
+    probe.wait.return_value = 0.5
+
+    class TestCertManager(BaseCertManager):
+        probes = {"emby-server": probe}
+        readiness_deadline = 10.0
+
+        def cert_cmds(self):
+            self.cmds = [Restart("emby-server")]
+
+    TestCertManager("test-cert")()
+    probe.wait.assert_not_called()
+
+    TestCertManager("test-cert", verbose=True, wait_ready=True)()
+    probe.wait.assert_called_once()
+    assert probe.wait.call_args.args[0] <= 10.0
+    assert "emby-server ready after" in caplog.text
+
+    probe.wait.side_effect = ProbeTimeout("not ready")
+    with pytest.raises(ProbeTimeout):
+        TestCertManager("test-cert", wait_ready=True)()
+
+
+def test_idempotent_steps_retried(tmp_path, caplog):
+    """Test failed steps are retried only when marked idempotent, with a backoff."""
+    attempts = tmp_path / "attempts"
+    # Fails on its first two attempts
+    flaky = ["sh", "-c", f'echo x >> {attempts}; [ $(wc -l < {attempts}) -gt 2 ]']
+
+    class TestCertManager(BaseCertManager):
+        retry_delay = 0.01
+
+    manager = TestCertManager("test-cert")
+    with pytest.raises(subprocess.CalledProcessError):
+        manager.run(Step(flaky))
+    assert len(attempts.read_text().split()) == 1
+
+    attempts.unlink()
+    manager.run(Step(flaky, idempotent=True))
+    assert len(attempts.read_text().split()) == 3
+    assert [record.levelname for record in caplog.records] == ["WARNING", "WARNING"]
+    assert caplog.messages[0].startswith("sh -c failed, retrying in ")
+
+    attempts.unlink()
+    manager.retries = 1
+    with pytest.raises(subprocess.CalledProcessError):
+        manager.run(Step(flaky, idempotent=True))
+    assert len(attempts.read_text().split()) == 2
+
+
+def test_step_timeouts():
+    """Test commands are bounded by their step's timeout, the manager's and the run's deadline."""
+    class TestCertManager(BaseCertManager):
+        step_timeout = 0.2
+
+    manager = TestCertManager("test-cert")
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        manager.run(["sleep", "30"])
+    assert e.value.timeout == 0.2
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        manager.run(Step(["sleep", "30"], timeout=0.1))
+    assert e.value.timeout == 0.1
+    assert time.monotonic() - start < 5
+
+    # The run's deadline shortens steps, and stops new ones once it has passed
+    manager.deadline = Deadline(0.1)
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        manager.run(["sleep", "30"])
+    assert e.value.timeout <= 0.1
+    operation = MagicMock(spec=Operation)
+    with pytest.raises(DeadlineExceeded):
+        manager.run(operation)
+    operation.assert_not_called()
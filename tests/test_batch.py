@@ -0,0 +1,192 @@
+"""
+Tests for the batch runner module.
+"""
+
+import subprocess
+import threading
+import time
+import pytest
+from unittest.mock import MagicMock
+from certhook.base import BaseCertManager
+from certhook.batch import BatchRunner, JobResult, load_manifest, parse_job, split_app
+from certhook.probes import Probe
+from certhook.services import Restart
+
+
+class SleepyCertManager(BaseCertManager):
+    """Manager that sleeps instead of running commands"""
+    delay = 0.05
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def __call__(self):
+        cls = type(self)
+        with cls.lock:
+            cls.running += 1
+            cls.peak = max(cls.peak, cls.running)
+        time.sleep(self.delay)
+        with cls.lock:
+            cls.running -= 1
+        if self.cert_name.startswith('bad'):
+            raise RuntimeError('deployment failed')
+
+
+@pytest.fixture
+def sleepy():
+    """Fresh manager class so concurrency counters don't leak between tests"""
+    return type('Sleepy', (SleepyCertManager,), {'running': 0, 'peak': 0, 'lock': threading.Lock()})
+
+
+def test_parse_job():
+    """Test splitting app:cert specifications"""
+    assert parse_job('unifi:example.com') == ('unifi', 'example.com')
+    assert parse_job(' emby:media.example.com\n') == ('emby', 'media.example.com')
+    assert parse_job('pihole@root@dns.lan:example.com') == ('pihole@root@dns.lan', 'example.com')
+    assert split_app('pihole@root@dns.lan') == ('pihole', 'root@dns.lan')
+    assert split_app('pihole') == ('pihole', 'localhost')
+
+
+@pytest.mark.parametrize('spec', ['unifi', 'unifi:', ':example.com', '', 'unifi@:example.com'])
+def test_parse_job_invalid(spec):
+    """Test malformed job specifications are rejected"""
+    with pytest.raises(ValueError):
+        parse_job(spec)
+
+
+def test_load_manifest(tmp_path):
+    """Test reading jobs from a manifest, skipping comments and blanks"""
+    manifest = tmp_path / 'manifest'
+    manifest.write_text('# renewal wave\nunifi:example.com\n\nemby:media.example.com\n')
+    assert load_manifest(str(manifest)) == [('unifi', 'example.com'),
+                                            ('emby', 'media.example.com')]
+
+    # Kept until the file changes, and not changed by callers
+    load_manifest(str(manifest)).clear()
+    assert len(load_manifest(str(manifest))) == 2
+    manifest.write_text('pihole:example.com\n')
+    assert load_manifest(str(manifest)) == [('pihole', 'example.com')]
+
+
+def test_run_collects_results(sleepy):
+    """Test every job gets a result and failures don't stop the batch"""
+    jobs = [('a', sleepy('one.example.com')),
+            ('b', sleepy('bad.example.com')),
+            ('c', sleepy('two.example.com'))]
+    report = BatchRunner(max_workers=3).run(jobs)
+
+    assert [r.cert_name for r in report.results] == ['one.example.com', 'bad.example.com', 'two.example.com']
+    assert [r.success for r in report.results] == [True, False, True]
+    assert len(report.failed) == 1
+    assert isinstance(report.failed[0].error, RuntimeError)
+    assert report.wall_time > 0
+    assert '3 jobs: 2 deployed, 0 skipped, 1 failed' in report.summary()
+
+
+def test_run_in_parallel(sleepy):
+    """Test jobs for different apps overlap"""
+    jobs = [(f'app{i}', sleepy(f'cert{i}')) for i in range(4)]
+    report = BatchRunner(max_workers=4).run(jobs)
+
+    assert sleepy.peak == 4
+    assert report.wall_time < sleepy.delay * 4
+
+
+def test_per_app_limit(sleepy):
+    """Test jobs for the same app are limited"""
+    jobs = [('unifi', sleepy(f'cert{i}')) for i in range(4)]
+    BatchRunner(max_workers=4, per_app_limit=2).run(jobs)
+
+    assert sleepy.peak == 2
+
+
+def test_run_skips_unchanged(sleepy, state_file):
+    """Test jobs the state store considers current are reported as skipped"""
+    state = MagicMock()
+    state.deploy.side_effect = [True, False]
+    jobs = [('a', sleepy('one.example.com')), ('b', sleepy('two.example.com'))]
+    report = BatchRunner(max_workers=1, state=state).run(jobs)
+
+    assert [r.skipped for r in report.results] == [False, True]
+    assert len(report.deployed) == 1
+    assert len(report.skipped) == 1
+    assert state.deploy.call_count == 2
+
+
+def test_restarts_coalesced(sleepy):
+    """Test a service shared by every job in a batch is restarted once, after all jobs"""
+    class RestartingCertManager(sleepy):
+        def __call__(self):
+            super().__call__()
+            self.restart(Restart('apache2'))
+
+    run = MagicMock()
+    jobs = [('freepbx', RestartingCertManager(f'cert{i}.example.com')) for i in range(5)]
+    for _, manager in jobs:
+        manager.run = run
+    report = BatchRunner(max_workers=5).run(jobs)
+
+    assert len(report.deployed) == 5
+    run.assert_called_once_with(['/usr/sbin/service', 'apache2', 'reload'])
+
+
+def test_restart_outages_reported(sleepy):
+    """Test how long probed services took to come back is in the report"""
+    probe = MagicMock(spec=Probe)
+    probe.wait.return_value = 0.0
+
+    class RestartingCertManager(sleepy):
+        def __call__(self):
+            super().__call__()
+            self.restart(Restart('apache2', probe=probe))
+
+    manager = RestartingCertManager('one.example.com')
+    manager.run = MagicMock()
+    report = BatchRunner().run([('freepbx', manager)])
+
+    assert list(report.outages) == ['apache2']
+    assert 'apache2 ready after' in report.summary()
+
+
+def test_failed_restart_fails_jobs(sleepy):
+    """Test jobs whose restart failed are reported as failed and forgotten by the state store"""
+    class RestartingCertManager(sleepy):
+        def __call__(self):
+            super().__call__()
+            self.restart(Restart('emby-server'))
+
+    state = MagicMock()
+    state.deploy.side_effect = lambda app, manager, force: manager() or True
+    jobs = [('emby', RestartingCertManager('one.example.com')), ('a', sleepy('two.example.com'))]
+    jobs[0][1].run = MagicMock(side_effect=RuntimeError('restart failed'))
+    report = BatchRunner(max_workers=2, state=state).run(jobs)
+
+    assert [r.success for r in report.results] == [False, True]
+    assert str(report.results[0].error) == 'restart failed'
+    state.forget.assert_called_once_with('emby', 'one.example.com')
+
+
+def test_failed_command_reported():
+    """Test a failed command's result ends with the last line of its errors"""
+    error = subprocess.CalledProcessError(1, ['keytool'], b'', b'Importing keystore...\nkeystore password was incorrect\n\n')
+    assert str(JobResult('unifi', 'example.com', False, 1.5, error)).endswith(
+        "returned non-zero exit status 1. (keystore password was incorrect)")
+
+
+def test_timeouts_reported():
+    """Test jobs that took too long are reported apart from ones that failed"""
+    error = subprocess.TimeoutExpired(['fwconsole', 'reload'], 30)
+    assert str(JobResult('freepbx', 'pbx.example.com', False, 30.0, error)).startswith(
+        'TIMEOUT freepbx:pbx.example.com (30.00s): ')
+
+    class HangingCertManager(BaseCertManager):
+        step_timeout = 0.05
+
+        def __call__(self):
+            self.run(['sleep', '5'] if self.cert_name == 'hung' else ['false'])
+
+    jobs = [('a', HangingCertManager('hung')), ('b', HangingCertManager('broken'))]
+    report = BatchRunner(max_workers=2).run(jobs)
+    assert [result.cert_name for result in report.timed_out] == ['hung']
+    assert len(report.failed) == 2
+    assert ' 2 failed (1 timed out) in ' in report.summary()
@@ -0,0 +1,36 @@
+"""
+Tests for the benchmark harness, at a size small enough for the test suite.
+"""
+
+import json
+import subprocess
+import benchmark
+import certhook.artifacts
+import certhook.locks
+
+
+def test_benchmark(tmp_path, lock_dir, artifact_dir):
+    """Test every manager and batch size is measured without failures"""
+    output = tmp_path / 'results.json'
+    assert benchmark.main(['--sizes', '1', '8', '--repeats', '1', '--latency', '0',
+                           '--stub-latency', 'keytool=0.01', '--output', str(output)]) == 0
+    results = json.loads(output.read_text())
+
+    assert sorted(results['managers']) == ['emby', 'freepbx', 'pihole', 'unifi']
+    # Pi-hole and UniFi only start their service restarts
+    assert results['managers']['pihole']['forks_per_deployment'] == 1
+    assert results['managers']['unifi']['forks_per_deployment'] == 1
+    assert [batch['size'] for batch in results['batch']] == [1, 8]
+    assert all(batch['failed'] == 0 for batch in results['batch'])
+    assert results['stub_latency'] == {'keytool': 0.01}
+    # Locks and converted files were kept in the benchmark's own directory
+    assert certhook.locks.DEFAULT_LOCK_DIR == str(lock_dir) and not lock_dir.exists()
+    assert certhook.artifacts.DEFAULT_CACHE_DIR == str(artifact_dir) and not artifact_dir.exists()
+
+
+def test_stubs_log_calls(tmp_path):
+    """Test stub programs record every call"""
+    programs = benchmark.install_stubs(tmp_path / 'bin', tmp_path / 'log', 0)
+    assert sorted(programs) == sorted(benchmark.STUB_PROGRAMS)
+    subprocess.run([programs['keytool'], '-importkeystore'], check=True)
+    assert (tmp_path / 'log').read_text() == 'keytool -importkeystore\n'
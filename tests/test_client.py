@@ -0,0 +1,52 @@
+"""
+Tests for the certhook command's client of certhook serve.
+"""
+
+import socket
+import threading
+from pathlib import Path
+from unittest.mock import patch
+from certhook import client
+
+
+def test_in_process_without_daemon(tmp_path: Path, monkeypatch):
+    """Test commands run in-process when no daemon is listening, or the socket is disabled"""
+    monkeypatch.setenv(client.SOCKET_ENV, str(tmp_path / 'missing.sock'))
+    assert client.request(['unifi', 'example.com']) is None
+    with patch('certhook.main.main', return_value=0) as run:
+        assert client.main(['unifi', 'example.com']) == 0
+        monkeypatch.setenv(client.SOCKET_ENV, '')
+        assert client.main(['batch', 'unifi:example.com']) == 0
+    assert [c.args[0] for c in run.call_args_list] == [['unifi', 'example.com'], ['batch', 'unifi:example.com']]
+
+
+def test_local_commands_not_sent(tmp_path: Path, monkeypatch):
+    """Test commands a daemon can't run for a client are never sent to it"""
+    monkeypatch.setenv(client.SOCKET_ENV, str(tmp_path / 'certhook.sock'))
+    with patch('certhook.client.request') as request, patch('certhook.main.main', return_value=0):
+        for command in client.LOCAL_COMMANDS:
+            client.main([command])
+    request.assert_not_called()
+
+
+def test_lost_connection(tmp_path: Path, capsys):
+    """Test a daemon going away part way through a command fails it, rather than running it again"""
+    path = str(tmp_path / 'certhook.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+
+    def serve():
+        sock, _ = listener.accept()
+        with sock:
+            sock.makefile('rb').readline()
+            sock.sendall(b'{"stdout": "OK unifi:example.com (1.00s)\\n"}\n')
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    assert client.request(['unifi', 'example.com'], path) == 1
+    thread.join()
+    listener.close()
+    captured = capsys.readouterr()
+    assert captured.out == 'OK unifi:example.com (1.00s)\n'
+    assert 'lost connection' in captured.err
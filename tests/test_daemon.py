@@ -0,0 +1,126 @@
+"""
+Tests for running deployments in a certhook serve daemon.
+"""
+
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+import pytest
+from certhook import client
+from certhook.base import BaseCertManager
+from certhook.daemon import Server
+from certhook.main import APP_MANAGERS
+from certhook.transport import LOCAL
+
+
+class EchoCertManager(BaseCertManager):
+    """Manager running a single quick command"""
+
+    def cert_cmds(self):
+        self.cmds = [['sh', '-c', 'echo "deploying $0"; [ "$0" != bad.example.com ]', self.cert_name]]
+
+
+@pytest.fixture
+def server(tmp_path: Path, monkeypatch):
+    """Daemon listening on a socket of its own, which the client uses"""
+    path = str(tmp_path / 'run' / 'certhook.sock')
+    monkeypatch.setenv(client.SOCKET_ENV, path)
+    server = Server(path, window=0.3)
+    server.bind()
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    yield server
+    server.close()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def mock_manager_class() -> MagicMock:
+    """Manager class whose managers deploy nothing"""
+    manager_class = MagicMock()
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+    return manager_class
+
+
+def test_requests_batched(server, capsys):
+    """Test requests arriving together are deployed as one batch, each client getting its own results"""
+    manager_class = mock_manager_class()
+    managers = {}
+    manager_class.side_effect = lambda cert_name, **options: managers.setdefault(cert_name, MagicMock(
+        cert_name=cert_name, inputs=[], artifacts=[], transport=LOCAL))
+
+    with patch.dict(APP_MANAGERS, {'emby': manager_class}), ThreadPoolExecutor(3) as pool:
+        statuses = list(pool.map(client.request, [['batch', f'emby:{i}.example.com'] for i in range(3)]))
+
+    assert statuses == [0, 0, 0]
+    # Batched managers share their host's restarts
+    coordinators = {id(manager.restart_coordinator) for manager in managers.values()}
+    assert len(managers) == 3 and len(coordinators) == 1
+    out = capsys.readouterr().out
+    assert out.count('1 jobs: 1 deployed, 0 skipped, 0 failed in ') == 3
+
+
+def test_single_deployment(server, capsys, caplog):
+    """Test a failed deployment is reported to its client, with the output of its commands"""
+    caplog.set_level(logging.INFO, logger='certhook')
+    with patch.dict(APP_MANAGERS, {'emby': EchoCertManager}):
+        assert client.request(['emby', 'example.com', '--verbose']) == 0
+        assert client.request(['emby', 'bad.example.com']) == 1
+
+    captured = capsys.readouterr()
+    assert captured.err.count('[example.com EchoCertManager localhost sh -c stdout] deploying example.com') == 1
+    # As are the messages --verbose turns on, which used to stay in the daemon
+    assert '[example.com EchoCertManager localhost] Processing certificate example.com' in captured.err
+    assert '[example.com EchoCertManager localhost] OK emby:example.com' in captured.err
+    assert 'FAILED emby:bad.example.com' in captured.err
+    # Without --verbose, command output is only kept for the report
+    assert 'deploying bad.example.com' not in captured.err
+
+
+def test_invalid_commands(server, capsys, tmp_path, monkeypatch):
+    """Test usage errors and help are written by the client, and files are found from its directory"""
+    assert client.request(['batch', 'invalid:example.com']) == 2
+    assert "unknown app 'invalid'" in capsys.readouterr().err
+    assert client.request(['hook', '--help']) == 0
+    assert 'usage: certhook hook' in capsys.readouterr().out
+
+    monkeypatch.chdir(tmp_path)
+    Path('manifest').write_text('unifi:example.com\n')
+    monkeypatch.setenv('RENEWED_LINEAGE', '/etc/letsencrypt/live/other.example.com')
+    assert client.request(['hook', '--manifest', 'manifest']) == 0
+    monkeypatch.delenv('RENEWED_LINEAGE')
+    assert client.request(['hook', '--manifest', 'manifest']) == 2
+
+
+def test_queued_requests(server):
+    """Test a queued request returns before its jobs are deployed"""
+    manager_class = mock_manager_class()
+    deployed = threading.Event()
+    manager_class.return_value.side_effect = lambda: deployed.set()
+
+    with patch.dict(APP_MANAGERS, {'pihole': manager_class}):
+        start = time.monotonic()
+        assert client.request(['pihole', 'example.com', '--queue']) == 0
+        assert not deployed.is_set() and time.monotonic() - start < server.window
+        assert deployed.wait(5)
+
+
+def test_bind(server, tmp_path):
+    """Test a second daemon can't take over the socket, but a stale socket is replaced"""
+    with pytest.raises(OSError, match='already running'):
+        Server(server.path).bind()
+
+    path = str(tmp_path / 'stale.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    other = Server(path)
+    other.bind()
+    assert (Path(path).stat().st_mode & 0o777) == 0o600
+    other.close()
+    assert not Path(path).exists()
@@ -0,0 +1,36 @@
+"""
+Tests for run deadlines and retry backoff.
+"""
+
+import subprocess
+import time
+import pytest
+from certhook.deadlines import Deadline, DeadlineExceeded, retry_delay, timed_out
+
+
+def test_deadline_bounds_timeouts():
+    """Test steps get the smaller of their own timeout and the time left"""
+    deadline = Deadline(10)
+    assert deadline.bound(2) == 2
+    assert 9 < deadline.bound(None) <= 10
+    assert 9 < deadline.bound(60) <= 10
+
+    deadline = Deadline(0.01)
+    time.sleep(0.02)
+    with pytest.raises(DeadlineExceeded, match='Run deadline of 0.01s exceeded'):
+        deadline.bound(5)
+    assert timed_out(DeadlineExceeded()) and not timed_out(RuntimeError())
+
+
+def test_retry_delay():
+    """Test retries back off exponentially with jitter, within the deadline and the retries allowed"""
+    error = subprocess.CalledProcessError(1, ['fwconsole', 'reload'])
+    for attempt in range(3):
+        delays = [retry_delay(error, attempt, 3, 0.5) for _ in range(200)]
+        assert all(0 <= delay <= 0.5 * 2 ** attempt for delay in delays)
+        assert len(set(delays)) > 1
+    assert retry_delay(error, 3, 3, 0.5) is None
+    assert retry_delay(RuntimeError(), 0, 3, 0.5) is None
+    # Waits that would outlast the run aren't made
+    assert retry_delay(error, 0, 3, 0.5, Deadline(10)) is not None
+    assert retry_delay(error, 0, 3, 0.5, Deadline(0)) is None
@@ -2,8 +2,12 @@
 Tests for the EmbyCertManager class
 """
 
-from unittest.mock import patch, MagicMock
+import logging
+from unittest.mock import ANY, patch, MagicMock
 from certhook import EmbyCertManager
+from certhook.ops import Chmod, Chown, ExportPKCS12
+from certhook.services import Restart
+from certhook.steps import resolve
 
 
 def test_init():
@@ -24,21 +28,33 @@ def test_cert_cmds():
     """Test command generation"""
     manager = EmbyCertManager(cert_name="example.com")
     expected_cmds = [
-        [
-            '/usr/bin/openssl', 'pkcs12', '-export',
-            '-inkey', '/etc/letsencrypt/live/example.com/privkey.pem',
-            '-in', '/etc/letsencrypt/live/example.com/fullchain.pem',
-            '-out', '/etc/letsencrypt/live/example.com/fullchain.p12',
-            '-password', 'pass:'
-        ],
-        ['/usr/bin/chown', 'root:ssl-certs', '/etc/letsencrypt/live/example.com/fullchain.p12'],
-        ['/usr/bin/chmod', '0770', '/etc/letsencrypt/live/example.com/fullchain.p12'],
-        ['/usr/sbin/service', 'emby-server', 'restart']
+        ExportPKCS12(
+            key_file='/etc/letsencrypt/live/example.com/privkey.pem',
+            chain_file='/etc/letsencrypt/live/example.com/fullchain.pem',
+            out_file='/etc/letsencrypt/live/example.com/fullchain.p12',
+            password=''
+        ),
+        Chown('/etc/letsencrypt/live/example.com/fullchain.p12', 'root:ssl-certs'),
+        Chmod('/etc/letsencrypt/live/example.com/fullchain.p12', 0o770),
+        Restart('emby-server')
     ]
-    assert manager.cmds == expected_cmds
+    assert [getattr(cmd, 'action', cmd) for cmd in manager.cmds] == expected_cmds
+    # chown and chmod overlap after the conversion, the restart is deferred
+    assert resolve(manager.cmds[:-1]) == [set(), {0}, {0}]
+    assert manager.cmds[0].commands() == [[
+        '/usr/bin/openssl', 'pkcs12', '-export',
+        '-inkey', '/etc/letsencrypt/live/example.com/privkey.pem',
+        '-in', '/etc/letsencrypt/live/example.com/fullchain.pem',
+        '-out', '/etc/letsencrypt/live/example.com/fullchain.p12',
+        '-password', 'pass:'
+    ]]
+    assert manager.cmds[1].action.commands() == [
+        ['chown', 'root:ssl-certs', '/etc/letsencrypt/live/example.com/fullchain.p12']]
+    assert manager.cmds[2].action.commands() == [
+        ['chmod', '0770', '/etc/letsencrypt/live/example.com/fullchain.p12']]
 
 
-@patch('subprocess.run')
+@patch('certhook.output.run')
 def test_run_command(mock_run):
     """Test command execution"""
     manager = EmbyCertManager(cert_name="example.com")
@@ -50,29 +66,20 @@ def test_run_command(mock_run):
     test_cmd = ['test', 'command']
     result = manager.run(test_cmd)
     
-    mock_run.assert_called_once_with(test_cmd, capture_output=True, check=True)
+    mock_run.assert_called_once_with(test_cmd, ANY, None, timeout=None)
     assert result == mock_process
 
 
-@patch('subprocess.run')
-def test_run_command_verbose(mock_run):
-    """Test command execution with verbose output"""
+def test_run_command_verbose(caplog):
+    """Test command output is logged a line at a time with verbose output"""
     manager = EmbyCertManager(cert_name="example.com", verbose=True)
-    mock_process = MagicMock()
-    mock_process.stdout = b"test output"
-    mock_process.stderr = b"test error"
-    mock_process.args = ['test', 'command']
-    mock_run.return_value = mock_process
-    
-    test_cmd = ['test', 'command']
-    with patch('builtins.print') as mock_print:
-        result = manager.run(test_cmd)
-    
-    mock_run.assert_called_once_with(test_cmd, capture_output=True, check=True)
-    assert result == mock_process
-    mock_print.assert_any_call('command: test command')
-    mock_print.assert_any_call('stdout: test output')
-    mock_print.assert_any_call('stderr: test error')
+    with caplog.at_level(logging.INFO, logger='certhook'):
+        result = manager.run(['sh', '-c', 'echo test output; echo test error >&2'])
+
+    assert result.stdout == b'test output\n'
+    assert caplog.messages[0] == 'command: sh -c echo test output; echo test error >&2'
+    assert {(record.stream, record.message) for record in caplog.records[1:]} == {
+        ('stdout', 'test output'), ('stderr', 'test error')}
 
 
 @patch('certhook.emby.EmbyCertManager.run')
@@ -82,6 +89,17 @@ def test_call_executes_all_commands(mock_run):
     manager()
     
     assert mock_run.call_count == len(manager.cmds)
-    for cmd in manager.cmds:
+    for cmd in manager.cmds[:-1]:
         mock_run.assert_any_call(cmd)
+    assert mock_run.call_args_list[-1].args[0] == ['/usr/sbin/service', 'emby-server', 'restart']
+
+
 
+@patch('certhook.output.run')
+def test_call_without_native(mock_run):
+    """Test openssl is used for the conversion when native operations are disabled"""
+    manager = EmbyCertManager(cert_name="example.com", native=False)
+    manager()
+
+    mock_run.assert_any_call(manager.cmds[0].commands()[0], ANY, None, timeout=None)
+    assert mock_run.call_count == len(manager.cmds)
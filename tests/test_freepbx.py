@@ -2,8 +2,12 @@
 Tests for the FreePBXCertManager class
 """
 
-from unittest.mock import patch, MagicMock
+import logging
+from unittest.mock import ANY, patch, MagicMock
 from certhook import FreePBXCertManager
+from certhook.ops import AuditTree, Chmod, Chown, Copy
+from certhook.services import Restart
+from certhook.steps import resolve
 
 
 def test_init():
@@ -24,22 +28,46 @@ def test_cert_cmds():
     """Test command generation"""
     manager = FreePBXCertManager(cert_name="example.com")
     expected_cmds = [
-        ['cp', '/etc/letsencrypt/live/example.com/cert.pem',
-         '/etc/asterisk/keys/example.com.crt'],
-        ['cp', '/etc/letsencrypt/live/example.com/privkey.pem',
-         '/etc/asterisk/keys/example.com.key'],
-        ['chmod', '-R', '0700', '/etc/asterisk/keys/'],
-        ['chown', '-R', 'asterisk:asterisk', '/etc/asterisk/keys/'],
+        Copy('/etc/letsencrypt/live/example.com/cert.pem',
+             '/etc/asterisk/keys/example.com.crt'),
+        Copy('/etc/letsencrypt/live/example.com/privkey.pem',
+             '/etc/asterisk/keys/example.com.key'),
+        Chmod('/etc/asterisk/keys/example.com.crt', 0o700),
+        Chown('/etc/asterisk/keys/example.com.crt', 'asterisk:asterisk'),
+        Chmod('/etc/asterisk/keys/example.com.key', 0o700),
+        Chown('/etc/asterisk/keys/example.com.key', 'asterisk:asterisk'),
         ['/usr/sbin/fwconsole', 'certificate', '--import'],
         ['/usr/sbin/fwconsole', 'certificate', '--default=0'],
         ['/usr/sbin/fwconsole', 'sysadmin', 'installHttpsCert', 'default'],
         ['/usr/sbin/fwconsole', 'sysadmin', 'updatecert'],
-        ['/usr/sbin/service', 'apache2', 'restart']
+        Restart('apache2')
     ]
-    assert manager.cmds == expected_cmds
+    assert [getattr(cmd, 'action', cmd) for cmd in manager.cmds] == expected_cmds
+    # Copies overlap, then each file's chmod/chown, then fwconsole runs in order
+    assert resolve(manager.cmds[:-1]) == [set(), set(), {0}, {0}, {1}, {1}, {2, 3, 4, 5},
+                                          {6}, {7}, {8}]
+    assert [manager.cmds[i].action.commands()[0] for i in range(4)] == [
+        ['cp', '/etc/letsencrypt/live/example.com/cert.pem', '/etc/asterisk/keys/example.com.crt'],
+        ['cp', '/etc/letsencrypt/live/example.com/privkey.pem', '/etc/asterisk/keys/example.com.key'],
+        ['chmod', '0700', '/etc/asterisk/keys/example.com.crt'],
+        ['chown', 'asterisk:asterisk', '/etc/asterisk/keys/example.com.crt'],
+    ]
+
+
+def test_cert_cmds_audit():
+    """Test the keys directory audit runs after the files are fixed and before fwconsole"""
+    class AuditingFreePBXCertManager(FreePBXCertManager):
+        audit_interval = 86400
 
+    manager = AuditingFreePBXCertManager(cert_name="example.com")
+    assert manager.cmds[6].action == AuditTree('/etc/asterisk/keys', 0o700, 'asterisk:asterisk',
+                                               '/var/lib/certhook/freepbx-keys.audit', 86400)
+    deps = resolve(manager.cmds[:-1])
+    assert deps[6] == {2, 3, 4, 5}
+    assert deps[7] == {6}
 
-@patch('subprocess.run')
+
+@patch('certhook.output.run')
 def test_run_command(mock_run):
     """Test command execution"""
     manager = FreePBXCertManager(cert_name="example.com")
@@ -51,29 +79,20 @@ def test_run_command(mock_run):
     test_cmd = ['test', 'command']
     result = manager.run(test_cmd)
     
-    mock_run.assert_called_once_with(test_cmd, capture_output=True, check=True)
+    mock_run.assert_called_once_with(test_cmd, ANY, None, timeout=None)
     assert result == mock_process
 
 
-@patch('subprocess.run')
-def test_run_command_verbose(mock_run):
-    """Test command execution with verbose output"""
+def test_run_command_verbose(caplog):
+    """Test command output is logged a line at a time with verbose output"""
     manager = FreePBXCertManager(cert_name="example.com", verbose=True)
-    mock_process = MagicMock()
-    mock_process.stdout = b"test output"
-    mock_process.stderr = b"test error"
-    mock_process.args = ['test', 'command']
-    mock_run.return_value = mock_process
-    
-    test_cmd = ['test', 'command']
-    with patch('builtins.print') as mock_print:
-        result = manager.run(test_cmd)
-    
-    mock_run.assert_called_once_with(test_cmd, capture_output=True, check=True)
-    assert result == mock_process
-    mock_print.assert_any_call('command: test command')
-    mock_print.assert_any_call('stdout: test output')
-    mock_print.assert_any_call('stderr: test error')
+    with caplog.at_level(logging.INFO, logger='certhook'):
+        result = manager.run(['sh', '-c', 'echo test output; echo test error >&2'])
+
+    assert result.stdout == b'test output\n'
+    assert caplog.messages[0] == 'command: sh -c echo test output; echo test error >&2'
+    assert {(record.stream, record.message) for record in caplog.records[1:]} == {
+        ('stdout', 'test output'), ('stderr', 'test error')}
 
 
 @patch('certhook.freepbx.FreePBXCertManager.run')
@@ -83,5 +102,7 @@ def test_call_executes_all_commands(mock_run):
     manager()
     
     assert mock_run.call_count == len(manager.cmds)
-    for cmd in manager.cmds:
+    for cmd in manager.cmds[:-1]:
         mock_run.assert_any_call(cmd)
+    # Apache picks up the new certificate on a reload
+    assert mock_run.call_args_list[-1].args[0] == ['/usr/sbin/service', 'apache2', 'reload']
@@ -0,0 +1,71 @@
+"""
+Tests for the lineage inventory and its index.
+"""
+
+import os
+from pathlib import Path
+from conftest import make_test_certs
+from certhook.inventory import Index, by_expiry, scan
+
+
+def make_lineages(live_root: Path, names: list) -> None:
+    """Create a lineage of test certificates for each name"""
+    for name in names:
+        make_test_certs(live_root, name)
+
+
+def test_scan(tmp_path: Path):
+    """Test every lineage is read, and broken ones are reported rather than raised"""
+    live_root = tmp_path / 'live'
+    make_lineages(live_root, ['b.example.com', 'a.example.com'])
+    (live_root / 'broken.example.com').mkdir()
+    (live_root / 'broken.example.com' / 'cert.pem').write_text('not a certificate')
+    (live_root / 'README').write_text('')
+
+    results = scan(str(live_root))
+    assert [result.name for result in results] == ['a.example.com', 'b.example.com', 'broken.example.com']
+    assert results[0].cert['subject'] == 'CN=a.example.com'
+    assert 364 < results[0].days_left() <= 365
+    assert isinstance(results[2].error, ValueError)
+    assert results[2].as_dict()['days_left'] is None
+    assert by_expiry(results)[0].name == 'broken.example.com'
+
+
+def test_index_reparses_changed_files(tmp_path: Path):
+    """Test repeat scans only parse certificates that changed"""
+    live_root = tmp_path / 'live'
+    make_lineages(live_root, [f'cert{i}.example.com' for i in range(5)])
+    path = str(tmp_path / 'index.json')
+
+    index = Index(path)
+    scan(str(live_root), index)
+    index.save()
+    assert index.parsed == 5
+
+    index = Index(path)
+    first = scan(str(live_root), index)
+    assert index.parsed == 0
+
+    # A renewal replaces the certificate, as certbot does with a new archive file
+    cert = live_root / 'cert2.example.com' / 'cert.pem'
+    renewed = live_root / 'cert2.example.com' / 'renewed.pem'
+    renewed.write_bytes((live_root / 'cert3.example.com' / 'cert.pem').read_bytes())
+    os.replace(renewed, cert)
+    index = Index(path)
+    second = scan(str(live_root), index)
+    assert index.parsed == 1
+    assert second[2].cert['subject'] == 'CN=cert3.example.com'
+    assert [result.cert for result in first if result.name != 'cert2.example.com'] == \
+        [result.cert for result in second if result.name != 'cert2.example.com']
+
+
+def test_index_pruned(tmp_path: Path):
+    """Test entries of lineages that are gone are dropped from the index"""
+    live_root = tmp_path / 'live'
+    make_lineages(live_root, ['a.example.com', 'b.example.com'])
+    index = Index(str(tmp_path / 'index.json'))
+    scan(str(live_root), index)
+    (live_root / 'b.example.com' / 'cert.pem').unlink()
+    scan(str(live_root), index)
+    index.save()
+    assert list(Index(str(tmp_path / 'index.json'))._entries) == [str(live_root / 'a.example.com' / 'cert.pem')]
@@ -0,0 +1,109 @@
+"""
+Tests for the Java keystore module.
+"""
+
+import subprocess
+import pytest
+from certhook import asn1, keystore, pkcs12
+
+
+@pytest.fixture
+def key_and_chain(test_certs):
+    """PKCS#8 key and certificate chain of the test certificate"""
+    return pkcs12.read_key_and_chain(str(test_certs / 'privkey.pem'), str(test_certs / 'fullchain.pem'))
+
+
+def test_jks_key_protector_round_trip(key_and_chain):
+    """Test JKS key protection recovers the key and rejects wrong passwords"""
+    key_der, _ = key_and_chain
+    protected = keystore.jks_protect_key(key_der, 'secret')
+    assert keystore.jks_recover_key(protected, 'secret') == key_der
+    with pytest.raises(keystore.KeystoreError):
+        keystore.jks_recover_key(protected, 'wrong')
+
+
+def test_jks_round_trip(key_and_chain):
+    """Test a JKS keystore survives being written and read back"""
+    key_der, chain = key_and_chain
+    store = keystore.JKSKeyStore()
+    store.set_key_entry('UniFi', key_der, chain, 'keypass')
+    data = store.dumps('storepass')
+
+    assert data[:8] == b'\xfe\xed\xfe\xed\x00\x00\x00\x02'
+    loaded = keystore.loads(data, 'storepass')
+    assert isinstance(loaded, keystore.JKSKeyStore)
+    assert loaded.aliases() == ['unifi']
+    assert loaded.get_key('unifi', 'keypass') == (key_der, chain)
+
+
+def test_jks_wrong_storepass(key_and_chain):
+    """Test the JKS integrity check catches wrong passwords and damage"""
+    store = keystore.JKSKeyStore()
+    store.set_key_entry('unifi', *key_and_chain, 'keypass')
+    data = store.dumps('storepass')
+    with pytest.raises(keystore.KeystoreError):
+        keystore.loads(data, 'wrong')
+    with pytest.raises(keystore.KeystoreError):
+        keystore.loads(data[:40] + b'x' + data[41:], 'storepass')
+
+
+def test_jks_replace_keeps_other_entries(key_and_chain):
+    """Test replacing an alias leaves other entries untouched"""
+    key_der, chain = key_and_chain
+    store = keystore.JKSKeyStore()
+    store.set_key_entry('other', key_der, chain[1:], 'otherpass')
+    store.set_key_entry('unifi', b'old key', chain, 'keypass')
+    other = store.entries['other']
+
+    loaded = keystore.loads(store.dumps('storepass'), 'storepass')
+    loaded.set_key_entry('unifi', key_der, chain, 'keypass')
+    reloaded = keystore.loads(loaded.dumps('storepass'), 'storepass')
+
+    assert reloaded.aliases() == ['other', 'unifi']
+    assert reloaded.entries['other'] == other
+    assert reloaded.get_key('unifi', 'keypass') == (key_der, chain)
+
+
+def test_pkcs12_keystore_replace(key_and_chain, test_certs, tmp_path):
+    """Test replacing an entry in a PKCS#12 keystore made by openssl"""
+    key_der, chain = key_and_chain
+    original = tmp_path / 'keystore'
+    subprocess.run(['openssl', 'pkcs12', '-export', '-inkey', str(test_certs / 'privkey.pem'),
+                    '-in', str(test_certs / 'cert.pem'), '-name', 'unifi', '-out', str(original),
+                    '-passout', 'pass:storepass'], check=True)
+
+    store = keystore.load(str(original), 'storepass')
+    assert isinstance(store, keystore.PKCS12KeyStore)
+    store.set_key_entry('unifi', key_der, chain, 'storepass')
+    store.set_key_entry('unifi', key_der, chain, 'storepass')
+    updated = tmp_path / 'updated'
+    updated.write_bytes(store.dumps('storepass'))
+
+    reloaded = keystore.load(str(updated), 'storepass')
+    assert reloaded.aliases() == ['unifi']
+    assert reloaded.get_key('unifi', 'storepass') == (key_der, chain[:1])
+    # Issuer copies don't pile up on repeated imports
+    assert len(reloaded.cert_bags) == len(chain)
+
+    # openssl accepts the result
+    result = subprocess.run(['openssl', 'pkcs12', '-in', str(updated), '-nodes', '-passin', 'pass:storepass'],
+                            capture_output=True, check=True)
+    assert len([label for label, _ in asn1.pem_blocks(result.stdout) if label == 'CERTIFICATE']) == len(chain)
+
+
+def test_pkcs12_legacy_unsupported(test_certs, tmp_path):
+    """Test keystores using legacy encryption are reported, not mangled"""
+    legacy = tmp_path / 'keystore'
+    result = subprocess.run(['openssl', 'pkcs12', '-export', '-legacy', '-inkey', str(test_certs / 'privkey.pem'),
+                             '-in', str(test_certs / 'cert.pem'), '-out', str(legacy),
+                             '-passout', 'pass:storepass'], capture_output=True)
+    if result.returncode:
+        pytest.skip('openssl legacy provider not available')
+    with pytest.raises(keystore.KeystoreError):
+        keystore.load(str(legacy), 'storepass')
+
+
+def test_jceks_unsupported():
+    """Test JCEKS keystores are rejected"""
+    with pytest.raises(keystore.KeystoreError):
+        keystore.loads(b'\xce\xce\xce\xce' + bytes(40), 'storepass')
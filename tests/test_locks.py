@@ -0,0 +1,153 @@
+"""
+Tests for the locks shared between certhook processes.
+"""
+
+import multiprocessing
+import threading
+import time
+from pathlib import Path
+import pytest
+from certhook.locks import Coalescer, CoalescedError, FileLock, LockSet, lock_path
+
+
+def test_file_lock(lock_dir: Path):
+    """Test a lock excludes every other holder until released, in this process too"""
+    first = FileLock('deploy:unifi:example.com')
+    second = FileLock('deploy:unifi:example.com')
+    with first:
+        assert first.locked
+        assert not second.acquire(blocking=False)
+        assert FileLock('deploy:emby:example.com').acquire(blocking=False)
+
+        threading.Timer(0.1, first.release).start()
+        second.acquire()
+        assert second.contended and second.waited > 0
+    second.release()
+    assert sorted(path.name for path in lock_dir.iterdir()) == [
+        'deploy:emby:example.com.lock', 'deploy:unifi:example.com.lock']
+
+
+def test_long_names(lock_dir: Path):
+    """Test names too long for a filename are shortened, keeping them distinct"""
+    names = [f'file:/{"d" * 300}/{i}@localhost' for i in range(2)]
+    paths = [lock_path(name) for name in names]
+    assert paths[0] != paths[1]
+    assert all(len(Path(path).name) < 255 for path in paths)
+
+
+def test_lock_set_order():
+    """Test locks are taken in name order, whatever order they're given in"""
+    locks = LockSet(['file:/b', 'deploy:a', 'file:/b'])
+    assert [lock.name for lock in locks.locks] == ['deploy:a', 'file:/b']
+    with locks:
+        assert not FileLock('file:/b').acquire(blocking=False)
+        assert not locks.contended
+    assert FileLock('file:/b').acquire(blocking=False)
+
+
+def request_restart(lock_dir: str, started, log: str) -> None:
+    """Process asking for a restart that takes a while, logging whether it ran it"""
+    import certhook.locks
+    certhook.locks.DEFAULT_LOCK_DIR = lock_dir
+    coalescer = Coalescer('restart:apache2@localhost')
+    started.set()
+    ran = coalescer.join()
+    if ran:
+        time.sleep(0.5)
+        coalescer.done()
+    with open(log, 'a') as f:
+        f.write('ran\n' if ran else 'merged\n')
+
+
+def test_coalesced_across_processes(lock_dir: Path, tmp_path: Path):
+    """Test requests made while a restart is pending merge into a single later restart"""
+    context = multiprocessing.get_context('fork')
+    log = tmp_path / 'log'
+    first_started = context.Event()
+    first = context.Process(target=request_restart, args=(str(lock_dir), first_started, str(log)))
+    first.start()
+    first_started.wait()
+    time.sleep(0.1)
+
+    # Requested while the first restart runs, after its files were in place
+    processes = []
+    for _ in range(4):
+        started = context.Event()
+        process = context.Process(target=request_restart, args=(str(lock_dir), started, str(log)))
+        process.start()
+        started.wait()
+        processes.append(process)
+    for process in [first] + processes:
+        process.join(10)
+        assert process.exitcode == 0
+
+    assert sorted(log.read_text().split()) == ['merged'] * 3 + ['ran'] * 2
+
+
+def test_coalesced_failure():
+    """Test requests covered by a failed run share its failure"""
+    running = Coalescer('restart:emby-server@localhost')
+    assert running.join()
+    outcomes = []
+
+    def request():
+        coalescer = Coalescer('restart:emby-server@localhost')
+        try:
+            if coalescer.join():
+                coalescer.done(RuntimeError('restart failed'))
+                outcomes.append('ran')
+        except CoalescedError as e:
+            outcomes.append(str(e))
+
+    threads = [threading.Thread(target=request) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while running._update(lambda counters: None)['requested'] < 3:
+        time.sleep(0.01)
+    running.done()
+    for thread in threads:
+        thread.join(5)
+
+    assert sorted(outcomes) == ['ran', 'restart:emby-server@localhost failed in another process: restart failed']
+    # Later requests aren't covered by the failed run
+    late = Coalescer('restart:emby-server@localhost')
+    assert late.join()
+    late.done()
+
+
+def test_coalesced_outcome_of_covering_run():
+    """Test a request reports the run that covered it, not a later one finishing first"""
+    name = 'restart:emby-server@localhost'
+    waiter = Coalescer(name)
+    acquire = waiter._lock.acquire
+    other_runs_done = threading.Event()
+
+    def slow_acquire():
+        # Other processes get the lock first
+        other_runs_done.wait(5)
+        acquire()
+
+    waiter._lock.acquire = slow_acquire
+    outcomes = []
+
+    def request():
+        try:
+            outcomes.append(waiter.join())
+        except CoalescedError as e:
+            outcomes.append(str(e))
+
+    thread = threading.Thread(target=request)
+    thread.start()
+    while waiter._update(lambda counters: None)['requested'] < 1:
+        time.sleep(0.01)
+    # A failed run covering the waiting request, then a successful one that doesn't
+    failed = Coalescer(name)
+    assert failed.join()
+    failed.done(RuntimeError('restart failed'))
+    later = Coalescer(name)
+    assert later.join()
+    later.done()
+    other_runs_done.set()
+    thread.join(5)
+
+    assert outcomes == [f'{name} failed in another process: restart failed']
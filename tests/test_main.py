@@ -1,9 +1,13 @@
 """
 Tests for the main CLI interface.
 """
+import json
+import logging
 import pytest
 from unittest.mock import patch, MagicMock
+from certhook.artifacts import ArtifactCache
 from certhook.main import main, APP_MANAGERS
+from conftest import make_test_certs
 
 
 def test_cli_required_args():
@@ -106,3 +110,241 @@ def test_cli_freepbx(mock_run):
     
     mock_manager_class.assert_called_once_with(cert_name='example.com', verbose=False)
     mock_instance.assert_called_once_with()
+
+
+def test_cli_batch(tmp_path):
+    """Test batch mode builds every manager and runs them all"""
+    manifest = tmp_path / 'manifest'
+    manifest.write_text('unifi:example.com\n')
+    unifi_class = MagicMock()
+    emby_class = MagicMock()
+
+    with patch.dict(APP_MANAGERS, {'unifi': unifi_class, 'emby': emby_class}):
+        result = main(['batch', '--manifest', str(manifest), 'emby:media.example.com'])
+
+    assert result == 0
+    unifi_class.assert_called_once_with(cert_name='example.com', verbose=False)
+    emby_class.assert_called_once_with(cert_name='media.example.com', verbose=False)
+    unifi_class.return_value.assert_called_once_with()
+    emby_class.return_value.assert_called_once_with()
+
+
+def test_cli_batch_failure():
+    """Test batch mode reports failures in its exit code"""
+    manager_class = MagicMock()
+    manager_class.return_value.side_effect = RuntimeError('boom')
+    manager_class.return_value.cert_name = 'example.com'
+
+    with patch.dict(APP_MANAGERS, {'unifi': manager_class}):
+        assert main(['batch', 'unifi:example.com']) == 1
+
+
+def test_cli_batch_invalid_app():
+    """Test batch mode rejects unknown apps before running anything"""
+    with pytest.raises(SystemExit):
+        main(['batch', 'invalid:example.com'])
+
+
+def test_cli_skips_unchanged(state_file):
+    """Test a second run of an unchanged certificate doesn't redeploy"""
+    manager_class = MagicMock()
+    manager_class.return_value.cert_name = 'example.com'
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+
+    with patch.dict(APP_MANAGERS, {'unifi': manager_class}):
+        main(['unifi', 'example.com', '--state-file', str(state_file)])
+        main(['unifi', 'example.com', '--state-file', str(state_file)])
+        assert manager_class.return_value.call_count == 1
+        main(['unifi', 'example.com', '--state-file', str(state_file), '--force'])
+        assert manager_class.return_value.call_count == 2
+
+
+def test_cli_no_native():
+    """Test --no-native is passed on to the manager"""
+    manager_class = MagicMock()
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+
+    with patch.dict(APP_MANAGERS, {'emby': manager_class}):
+        main(['emby', 'example.com', '--no-native'])
+
+    manager_class.assert_called_once_with(cert_name='example.com', verbose=False, native=False)
+
+
+def test_cli_wait_ready():
+    """Test --wait-ready is passed on to the manager"""
+    manager_class = MagicMock()
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+
+    with patch.dict(APP_MANAGERS, {'pihole': manager_class}):
+        main(['pihole', 'example.com', '--wait-ready'])
+
+    manager_class.assert_called_once_with(cert_name='example.com', verbose=False, wait_ready=True)
+
+
+def test_cli_verify(tmp_path):
+    """Test --verify checks the deployed jobs and fails the run on a mismatch"""
+    manager_class = MagicMock()
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+    report = MagicMock()
+    report.failed = [MagicMock()]
+
+    with patch.dict(APP_MANAGERS, {'emby': manager_class}), \
+            patch('certhook.verify.verify', return_value=report) as mock_verify:
+        assert main(['emby', 'example.com', '--state-file', str(tmp_path / 'state.json')]) == 0
+        mock_verify.assert_not_called()
+        assert main(['emby', 'example.com', '--verify', '--force',
+                     '--state-file', str(tmp_path / 'state.json')]) == 1
+
+    mock_verify.assert_called_once_with([('emby', manager_class.return_value)], timeout=5.0)
+
+
+def test_cli_host(tmp_path):
+    """Test --host and app@host jobs deploy through the host's shared transport"""
+    manager_class = MagicMock()
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+    remote = MagicMock(local=False)
+    remote.digest.return_value = {}
+
+    with patch.dict(APP_MANAGERS, {'pihole': manager_class}), \
+            patch('certhook.transport.connect', return_value=remote) as connect, \
+            patch('certhook.transport.close_all') as close_all:
+        main(['pihole', 'example.com', '--host', 'root@dns.lan', '--state-file', str(tmp_path / 'state.json')])
+        main(['batch', 'pihole@root@dns.lan:example.com', '--state-file', str(tmp_path / 'state.json')])
+
+    assert connect.call_count == 2
+    connect.assert_called_with('root@dns.lan')
+    assert manager_class.return_value.transport is remote
+    assert close_all.call_count == 2
+
+def test_cli_watch(tmp_path, caplog):
+    """Test watch mode deploys the manifest jobs for each changed lineage"""
+    caplog.set_level(logging.INFO, logger='certhook')
+    manifest = tmp_path / 'manifest'
+    manifest.write_text('unifi:example.com\nemby:example.com\nemby:media.example.com\n')
+    manager_class = MagicMock()
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+
+    with patch('certhook.watch.Watcher') as watcher_class, \
+            patch.dict(APP_MANAGERS, {'unifi': manager_class, 'emby': manager_class}):
+        watcher_class.return_value.changes.return_value = iter([{'example.com'}, {'unknown.com'}])
+        assert main(['watch', '--manifest', str(manifest), '--debounce', '0.5', '--verbose']) == 0
+
+    watcher_class.assert_called_once_with('/etc/letsencrypt/live', 0.5)
+    assert [c.kwargs['cert_name'] for c in manager_class.call_args_list] == ['example.com', 'example.com']
+    watcher_class.return_value.close.assert_called_once_with()
+    changed = [(record.cert, record.getMessage()) for record in caplog.records if record.name == 'certhook.main']
+    assert changed == [('example.com', 'Changed: 2 jobs'), ('unknown.com', 'Changed: 0 jobs')]
+
+
+def test_cli_watch_invalid_manifest(tmp_path):
+    """Test watch mode rejects manifests naming unknown apps"""
+    manifest = tmp_path / 'manifest'
+    manifest.write_text('invalid:example.com\n')
+    with pytest.raises(SystemExit):
+        main(['watch', '--manifest', str(manifest)])
+
+
+def test_cli_watch_force_rejected(tmp_path):
+    """Test watch mode refuses --force, as it would redeploy every deployment's own changes"""
+    manifest = tmp_path / 'manifest'
+    manifest.write_text('unifi:example.com\n')
+    with patch('certhook.watch.Watcher') as watcher_class, pytest.raises(SystemExit):
+        main(['watch', '--manifest', str(manifest), '--force'])
+    watcher_class.assert_not_called()
+
+
+def test_cli_hook(tmp_path, monkeypatch, caplog):
+    """Test the deploy hook runs only the jobs for the renewed lineage"""
+    caplog.set_level(logging.INFO, logger='certhook')
+    manifest = tmp_path / 'manifest'
+    manifest.write_text('unifi:example.com\nemby:example.com\nemby:media.example.com\n')
+    monkeypatch.setenv('RENEWED_LINEAGE', '/etc/letsencrypt/live/example.com')
+    monkeypatch.setenv('RENEWED_DOMAINS', 'example.com www.example.com')
+    manager_class = MagicMock()
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+
+    with patch.dict(APP_MANAGERS, {'unifi': manager_class, 'emby': manager_class}):
+        assert main(['hook', '--manifest', str(manifest), '--verbose']) == 0
+
+    assert [c.kwargs['cert_name'] for c in manager_class.call_args_list] == ['example.com', 'example.com']
+    assert manager_class.return_value.call_count == 2
+    renewed = [(record.cert, record.getMessage()) for record in caplog.records if record.name == 'certhook.main']
+    assert renewed == [('example.com', 'Renewed example.com (example.com www.example.com): 2 jobs')]
+
+
+def test_cli_hook_unused_lineage(tmp_path, monkeypatch):
+    """Test the deploy hook does nothing for lineages no app uses"""
+    manifest = tmp_path / 'manifest'
+    manifest.write_text('unifi:example.com\n')
+    monkeypatch.setenv('RENEWED_LINEAGE', '/etc/letsencrypt/live/other.example.com')
+    manager_class = MagicMock()
+
+    with patch.dict(APP_MANAGERS, {'unifi': manager_class}):
+        assert main(['hook', '--manifest', str(manifest)]) == 0
+    manager_class.assert_not_called()
+
+
+def test_cli_hook_outside_certbot(tmp_path, monkeypatch):
+    """Test the deploy hook refuses to run without certbot's environment"""
+    monkeypatch.delenv('RENEWED_LINEAGE', raising=False)
+    with pytest.raises(SystemExit):
+        main(['hook', '--manifest', str(tmp_path / 'manifest')])
+
+
+def test_cli_metrics(tmp_path):
+    """Test metrics outputs are written after a deployment"""
+    manager_class = MagicMock()
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+    prom = tmp_path / 'certhook.prom'
+
+    with patch.dict(APP_MANAGERS, {'emby': manager_class}):
+        main(['emby', 'example.com', '--metrics-file', str(prom), '--trace-file', str(tmp_path / 'trace.json')])
+
+    assert manager_class.return_value.metrics is not None
+    assert 'certhook_run_steps 0' in prom.read_text()
+    assert (tmp_path / 'trace.json').exists()
+
+
+def test_cli_status(tmp_path, capsys):
+    """Test lineages are reported as JSON, and an unreadable one fails the command"""
+    live_root = tmp_path / 'live'
+    make_test_certs(live_root, 'example.com')
+    index = tmp_path / 'index.json'
+
+    assert main(['status', '--live-root', str(live_root), '--index', str(index), '--json']) == 0
+    status = json.loads(capsys.readouterr().out)
+    assert [lineage['name'] for lineage in status] == ['example.com']
+    assert status[0]['subject'] == 'CN=example.com'
+    assert index.exists()
+
+    assert main(['status', '--live-root', str(live_root), '--within', '30']) == 0
+    assert capsys.readouterr().out == ''
+
+    (live_root / 'broken.com').mkdir()
+    assert main(['status', '--live-root', str(live_root), '--no-index']) == 1
+    assert 'broken.com  ERROR' in capsys.readouterr().out
+
+
+def test_cli_artifact_cache(artifact_dir):
+    """Test managers only share an artifact cache when one is asked for"""
+    manager_class = MagicMock()
+    manager_class.return_value.inputs = []
+    manager_class.return_value.artifacts = []
+
+    with patch.dict(APP_MANAGERS, {'emby': manager_class}):
+        manager_class.return_value.artifact_cache = None
+        main(['emby', 'example.com', '--force'])
+        assert manager_class.return_value.artifact_cache is None
+
+        main(['batch', 'emby:example.com', 'emby:media.example.com', '--force',
+              '--artifact-cache', str(artifact_dir)])
+        cache = manager_class.return_value.artifact_cache
+        assert isinstance(cache, ArtifactCache) and cache.path == str(artifact_dir)
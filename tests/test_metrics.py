@@ -0,0 +1,125 @@
+"""
+Tests for the deployment metrics module.
+"""
+
+import json
+import resource
+import subprocess
+from types import SimpleNamespace
+import pytest
+from certhook.base import BaseCertManager
+from certhook.metrics import Recorder, step_name
+from certhook.ops import Write
+from certhook.pipeline import Pipeline
+from certhook.transport import RootTransport
+
+
+class ScriptCertManager(BaseCertManager):
+    """Manager running a couple of shell commands and an operation"""
+
+    def __init__(self, cert_name, out_file):
+        self.out_file = out_file
+        super().__init__(cert_name)
+
+    def cert_cmds(self):
+        self.cmds = [
+            ['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done'],
+            Write(self.out_file, b'x' * 1000),
+            ['sh', '-c', 'exit 0'],
+        ]
+
+
+@pytest.fixture
+def recorder(tmp_path):
+    recorder = Recorder()
+    manager = ScriptCertManager('example.com', str(tmp_path / 'out'))
+    manager.metrics = recorder
+    manager()
+    return recorder
+
+
+def test_step_name():
+    """Test steps get short, stable names"""
+    assert step_name(['/usr/sbin/fwconsole', 'certificate', '--import']) == 'fwconsole certificate'
+    assert step_name(['/usr/bin/keytool', '-importkeystore', '-noprompt']) == 'keytool -importkeystore'
+    assert step_name(Write('/tmp/x', b'')) == 'Write'
+    assert step_name(Pipeline(['/usr/bin/openssl', 'pkcs12', '-export'], ['/usr/bin/keytool', '-importkeystore'])) \
+        == 'openssl pkcs12 | keytool -importkeystore'
+
+
+def test_steps_recorded(recorder):
+    """Test every step is measured"""
+    assert [step.step for step in recorder.steps] == ['sh -c', 'Write', 'sh -c']
+    busy, write, _ = recorder.steps
+    assert busy.wall > 0
+    assert busy.user + busy.sys > 0
+    assert busy.max_rss >= 0
+    assert write.bytes_written == 1000
+    assert all(step.exit_code == 0 for step in recorder.steps)
+    assert all(step.manager == 'ScriptCertManager' and step.cert_name == 'example.com'
+               for step in recorder.steps)
+
+
+def test_peak_memory_only_when_raised(tmp_path, monkeypatch):
+    """Test the lifetime peak memory is only reported by steps that raised it"""
+    peaks = iter([100, 150, 150, 150])
+    monkeypatch.setattr(resource, 'getrusage', lambda who: SimpleNamespace(
+        ru_utime=0.0, ru_stime=0.0, ru_maxrss=next(peaks), ru_oublock=0))
+    recorder = Recorder()
+    manager = ScriptCertManager('example.com', str(tmp_path / 'out'))
+    for _ in range(2):
+        with recorder.measure(manager, ['true']):
+            pass
+    assert [step.max_rss for step in recorder.steps] == [150 * 1024, 0]
+
+
+def test_remote_bytes_not_counted(tmp_path):
+    """Test bytes written are only counted for files on this host"""
+    recorder = Recorder()
+    manager = ScriptCertManager('example.com', str(tmp_path / 'out'))
+    manager.transport = RootTransport(str(tmp_path / 'host'), 'host')
+    (tmp_path / 'out').write_bytes(b'x' * 1000)
+    with recorder.measure(manager, Write(str(tmp_path / 'out'), b'x' * 1000)):
+        pass
+    assert recorder.steps[0].bytes_written == 0
+
+
+def test_failed_step_recorded():
+    """Test a failing command records its exit status"""
+    recorder = Recorder()
+    manager = BaseCertManager('example.com')
+    manager.metrics = recorder
+    with pytest.raises(subprocess.CalledProcessError):
+        manager.run(['sh', '-c', 'exit 3'])
+    with pytest.raises(FileNotFoundError):
+        manager.run(['/nonexistent/command'])
+    assert [step.exit_code for step in recorder.steps] == [3, 127]
+
+
+def test_prometheus(recorder):
+    """Test the textfile has one series per step name, per deployment and per run"""
+    text = recorder.prometheus()
+    assert '# TYPE certhook_step_seconds gauge' in text
+    assert 'certhook_step_seconds{manager="ScriptCertManager",cert="example.com",step="Write"}' in text
+    assert 'certhook_step_written_bytes{manager="ScriptCertManager",cert="example.com",step="Write"} 1000' in text
+    # Steps of the same name are added together
+    assert text.count('certhook_step_exit_code{manager="ScriptCertManager",cert="example.com",step="sh -c"} 0') == 1
+    assert 'certhook_deployment_seconds{manager="ScriptCertManager",cert="example.com"}' in text
+    assert 'certhook_run_steps 3\n' in text
+    assert 'certhook_run_failed_steps 0\n' in text
+
+
+def test_write(recorder, tmp_path):
+    """Test every output format is written"""
+    prom, lines, trace = tmp_path / 'certhook.prom', tmp_path / 'steps.jsonl', tmp_path / 'trace.json'
+    recorder.write(str(prom), str(lines), str(trace))
+    recorder.write(json_lines=str(lines))
+
+    assert prom.read_text().startswith('# HELP certhook_step_seconds')
+    records = [json.loads(line) for line in lines.read_text().splitlines()]
+    assert len(records) == 6
+    assert records[1]['step'] == 'Write' and records[1]['bytes_written'] == 1000
+    events = json.loads(trace.read_text())['traceEvents']
+    assert [event['name'] for event in events] == ['sh -c', 'Write', 'sh -c']
+    assert all(event['ph'] == 'X' and event['dur'] > 0 for event in events)
+    assert events[0]['ts'] <= events[1]['ts'] <= events[2]['ts']
@@ -0,0 +1,211 @@
+"""
+Tests for the in-process operations module.
+"""
+
+import grp
+import os
+import pwd
+import stat
+import pytest
+from certhook import keystore
+from certhook.ops import (AtomicReplace, AuditTree, Chmod, Chown, Concat, Copy, ExportPKCS12, ImportKeystore,
+                          UnsupportedOperation, Write, copy_fd, resolve_owner, write_atomic)
+
+
+def test_write_atomic(tmp_path):
+    """Test files are replaced in one step with the requested mode"""
+    path = tmp_path / 'file'
+    path.write_text('old')
+    write_atomic(str(path), b'new', 0o640)
+    assert path.read_bytes() == b'new'
+    assert stat.S_IMODE(path.stat().st_mode) == 0o640
+    assert os.listdir(tmp_path) == ['file']
+
+
+def test_export_pkcs12(test_certs):
+    """Test the PKCS#12 file is written privately"""
+    out = test_certs / 'fullchain.p12'
+    ExportPKCS12(str(test_certs / 'privkey.pem'), str(test_certs / 'fullchain.pem'), str(out), 'pw')()
+    assert out.read_bytes()[:1] == b'\x30'
+    assert stat.S_IMODE(out.stat().st_mode) == 0o600
+
+
+def test_export_pkcs12_commands():
+    """Test the openssl fallback command"""
+    op = ExportPKCS12('key.pem', 'chain.pem', 'out.p12', 'pw', name='alias', iterations=1000)
+    assert op.commands() == [['/usr/bin/openssl', 'pkcs12', '-export', '-inkey', 'key.pem', '-in', 'chain.pem',
+                              '-out', 'out.p12', '-name', 'alias', '-iter', '1000', '-password', 'pass:pw']]
+
+
+def test_operation_equality():
+    """Test operations compare by type and arguments"""
+    assert ExportPKCS12('k', 'c', 'o', 'pw') == ExportPKCS12('k', 'c', 'o', 'pw')
+    assert ExportPKCS12('k', 'c', 'o', 'pw') != ExportPKCS12('k', 'c', 'o', 'other')
+    assert 'ExportPKCS12(' in repr(ExportPKCS12('k', 'c', 'o', 'pw'))
+
+
+def test_import_keystore_new(test_certs, tmp_path):
+    """Test a missing keystore is created as JKS"""
+    path = tmp_path / 'keystore'
+    ImportKeystore(str(test_certs / 'privkey.pem'), str(test_certs / 'fullchain.pem'), str(path),
+                   'unifi', 'storepass', 'keypass', 'unifi')()
+    store = keystore.load(str(path), 'storepass')
+    assert isinstance(store, keystore.JKSKeyStore)
+    assert store.aliases() == ['unifi']
+
+
+def test_import_keystore_preserves_mode(test_certs, tmp_path):
+    """Test the keystore keeps its permissions when rewritten"""
+    path = tmp_path / 'keystore'
+    op = ImportKeystore(str(test_certs / 'privkey.pem'), str(test_certs / 'fullchain.pem'), str(path),
+                        'unifi', 'storepass', 'keypass', 'unifi')
+    op()
+    path.chmod(0o604)
+    op()
+    assert stat.S_IMODE(path.stat().st_mode) == 0o604
+
+
+def test_import_keystore_unreadable(test_certs, tmp_path):
+    """Test keystores that can't be read natively ask for the keytool fallback"""
+    path = tmp_path / 'keystore'
+    path.write_bytes(b'\xce\xce\xce\xce' + bytes(40))
+    op = ImportKeystore(str(test_certs / 'privkey.pem'), str(test_certs / 'fullchain.pem'), str(path),
+                        'unifi', 'storepass', 'keypass', 'unifi')
+    with pytest.raises(UnsupportedOperation):
+        op()
+
+
+def test_copy(tmp_path):
+    """Test files are copied with their permissions"""
+    src = tmp_path / 'src'
+    src.write_bytes(b'cert')
+    src.chmod(0o640)
+    Copy(str(src), str(tmp_path / 'dst'))()
+    assert (tmp_path / 'dst').read_bytes() == b'cert'
+    assert stat.S_IMODE((tmp_path / 'dst').stat().st_mode) == 0o640
+    assert Copy('a', 'b').commands() == [['cp', 'a', 'b']]
+
+
+def test_resolve_owner():
+    """Test user and group names and ids are resolved"""
+    user = pwd.getpwuid(os.getuid()).pw_name
+    group = grp.getgrgid(os.getgid()).gr_name
+    assert resolve_owner(f'{user}:{group}') == (os.getuid(), os.getgid())
+    assert resolve_owner(f':{group}') == (-1, os.getgid())
+    assert resolve_owner('1234') == (1234, -1)
+    with pytest.raises(UnsupportedOperation):
+        resolve_owner('no-such-user-certhook')
+
+
+def test_chown_recursive(tmp_path):
+    """Test ownership changes cover the whole tree"""
+    (tmp_path / 'keys').mkdir()
+    (tmp_path / 'keys' / 'cert.key').write_bytes(b'key')
+    owner = f'{os.getuid()}:{os.getgid()}'
+    Chown(str(tmp_path / 'keys'), owner, recursive=True)()
+    assert (tmp_path / 'keys' / 'cert.key').stat().st_uid == os.getuid()
+    assert Chown('/keys/', 'asterisk:asterisk', recursive=True).commands() == [
+        ['chown', '-R', 'asterisk:asterisk', '/keys/']]
+
+
+def test_chmod_recursive(tmp_path):
+    """Test permission changes cover the tree but not files behind symbolic links"""
+    outside = tmp_path / 'outside'
+    outside.write_bytes(b'')
+    outside.chmod(0o644)
+    keys = tmp_path / 'keys'
+    keys.mkdir()
+    (keys / 'cert.key').write_bytes(b'key')
+    (keys / 'link').symlink_to(outside)
+    Chmod(str(keys), 0o700, recursive=True)()
+    assert stat.S_IMODE((keys / 'cert.key').stat().st_mode) == 0o700
+    assert stat.S_IMODE(keys.stat().st_mode) == 0o700
+    assert stat.S_IMODE(outside.stat().st_mode) == 0o644
+    assert Chmod('/p12', 0o770).commands() == [['chmod', '0770', '/p12']]
+
+
+def test_write(tmp_path):
+    """Test data is written in place and hidden from the repr"""
+    path = tmp_path / 'file'
+    operation = Write(str(path), b'secret', mode=0o600)
+    operation()
+    assert path.read_bytes() == b'secret'
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    assert b'secret'.decode() not in repr(operation)
+    assert operation.native_only
+
+    # The owner is set, and handed to transports writing on other hosts
+    owner = f'{os.getuid()}:{os.getgid()}'
+    operation = Write(str(path), b'secret', owner=owner)
+    operation()
+    assert operation.payload() == (str(path), b'secret', None, owner)
+
+
+def test_atomic_replace(tmp_path):
+    """Test files are replaced with the requested owner and mode"""
+    path = tmp_path / 'file'
+    path.write_bytes(b'old')
+    AtomicReplace(str(path), b'new', mode=0o640, owner=str(os.getuid()))()
+    assert path.read_bytes() == b'new'
+    assert stat.S_IMODE(path.stat().st_mode) == 0o640
+    assert os.listdir(tmp_path) == ['file']
+
+
+def test_audit_tree(tmp_path, monkeypatch):
+    """Test only entries that differ are changed, and audits wait for the interval"""
+    keys = tmp_path / 'keys'
+    keys.mkdir(mode=0o700)
+    (keys / 'good.key').write_bytes(b'')
+    (keys / 'good.key').chmod(0o700)
+    (keys / 'bad.key').write_bytes(b'')
+    (keys / 'bad.key').chmod(0o644)
+    marker = tmp_path / 'state' / 'audit'
+    audit = AuditTree(str(keys), 0o700, f'{os.getuid()}:{os.getgid()}', str(marker), interval=60)
+
+    changed = []
+    monkeypatch.setattr(os, 'chmod', lambda path, mode, _chmod=os.chmod: changed.append(path) or _chmod(path, mode))
+    audit()
+    assert changed == [str(keys / 'bad.key')]
+    assert stat.S_IMODE((keys / 'bad.key').stat().st_mode) == 0o700
+    assert marker.exists() and not audit.due()
+    assert audit.commands() == []
+
+    os.utime(marker, (0, 0))
+    assert audit.due()
+    assert audit.commands()[-1] == ['touch', str(marker)]
+
+
+@pytest.mark.parametrize('missing', [[], ['copy_file_range'], ['copy_file_range', 'sendfile']])
+def test_copy_fd(tmp_path, monkeypatch, missing):
+    """Test files are appended whichever copy mechanisms are available"""
+    for name in missing:
+        monkeypatch.delattr(os, name, raising=False)
+    data = os.urandom(200000)
+    (tmp_path / 'src').write_bytes(data)
+    with open(tmp_path / 'src', 'rb') as src, open(tmp_path / 'dst', 'wb') as dst:
+        dst.write(b'head')
+        dst.flush()
+        copy_fd(src.fileno(), dst.fileno())
+    assert (tmp_path / 'dst').read_bytes() == b'head' + data
+
+
+def test_concat(tmp_path):
+    """Test files are joined into an atomically replaced file"""
+    (tmp_path / 'chain.pem').write_bytes(b'chain\n')
+    (tmp_path / 'key.pem').write_bytes(b'key\n')
+    (tmp_path / 'bundle.pem').write_bytes(b'old')
+    operation = Concat([str(tmp_path / 'chain.pem'), str(tmp_path / 'key.pem')], str(tmp_path / 'bundle.pem'),
+                       mode=0o640, owner=f'{os.getuid()}:{os.getgid()}', separator=b'\n')
+    operation()
+    assert (tmp_path / 'bundle.pem').read_bytes() == b'chain\n\nkey\n'
+    assert stat.S_IMODE((tmp_path / 'bundle.pem').stat().st_mode) == 0o640
+    assert sorted(os.listdir(tmp_path)) == ['bundle.pem', 'chain.pem', 'key.pem']
+
+
+def test_concat_missing_source(tmp_path):
+    """Test a failed concatenation leaves the existing file in place"""
+    (tmp_path / 'bundle.pem').write_bytes(b'old')
+    with pytest.raises(FileNotFoundError):
+        Concat([str(tmp_path / 'missing.pem')], str(tmp_path / 'bundle.pem'))()
+    assert os.listdir(tmp_path) == ['bundle.pem']
+    assert (tmp_path / 'bundle.pem').read_bytes() == b'old'
@@ -0,0 +1,124 @@
+"""
+Tests for streaming command output through logging.
+"""
+
+import io
+import json
+import logging
+import subprocess
+import sys
+import time
+import pytest
+from certhook import output
+from certhook.output import CommandLog, Tail
+
+
+@pytest.fixture
+def records(caplog):
+    """Records logged by certhook, at every level"""
+    caplog.set_level(logging.DEBUG, logger='certhook')
+    return caplog
+
+
+def test_tail():
+    """Test only the last bytes written are kept"""
+    tail = Tail(4)
+    for data in (b'ab', b'cdef', b'g'):
+        tail.write(data)
+    assert tail.getvalue() == b'defg'
+    assert tail.dropped == 3
+
+
+def test_lines_logged_as_written(records):
+    """Test each line is logged when it's written, not when the command exits"""
+    script = 'import sys, time; print("first", flush=True); time.sleep(0.3); print("second")'
+    result = output.run([sys.executable, '-c', script], CommandLog(step='python', cert='example.com'))
+
+    assert result.stdout == b'first\nsecond\n'
+    assert [(record.message, record.stream, record.cert) for record in records.records] == [
+        ('first', 'stdout', 'example.com'), ('second', 'stdout', 'example.com')]
+    assert records.records[1].created - records.records[0].created >= 0.25
+
+
+def test_output_bounded(records):
+    """Test a chatty command only leaves the tail of its output in memory"""
+    size = 1 << 20
+    script = f'import sys; sys.stdout.write("o" * {size} + "\\nend"); sys.stderr.write("e\\n" * {size // 2})'
+    result = output.run([sys.executable, '-c', script], CommandLog(limit=4096, level=logging.DEBUG - 1))
+
+    assert result.stdout == b'o' * (4096 - 4) + b'\nend'
+    assert len(result.stderr) == 4096
+    # Below the logger's level, lines aren't split or logged
+    assert not records.records
+
+
+def test_long_line_logged_in_pieces(records):
+    """Test a line without an end isn't held on to beyond the limit"""
+    script = 'import sys; sys.stdout.write("x" * 10000)'
+    output.run([sys.executable, '-c', script], CommandLog(limit=4096))
+    assert ''.join(records.messages) == 'x' * 10000
+
+
+def test_input_and_failure():
+    """Test input larger than a pipe holds is written while output is read, and failures raise"""
+    data = b'line\n' * (1 << 18)
+    assert output.run(['cat'], input=data).stdout == data[-output.DEFAULT_LIMIT:]
+    # Commands that don't read their input don't block on it
+    assert output.run(['true'], input=data).returncode == 0
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        output.run(['sh', '-c', 'echo progress; echo "keystore was tampered with" >&2; exit 1'])
+    assert e.value.returncode == 1
+    assert e.value.stdout == b'progress\n'
+    assert output.last_line(e.value.stderr) == 'keystore was tampered with'
+    assert output.run(['false'], check=False).returncode == 1
+
+
+def test_formatters():
+    """Test records are written as timestamped text or JSON objects, with the command's context"""
+    stream = io.StringIO()
+    output.configure('json', stream=stream)
+    log = CommandLog(['keytool', '-list'], logging.INFO, cert='example.com', step='keytool -list')
+    log.start()
+    log.feed('stderr', b'warning: "old"\nnext')
+    log.close()
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(entry['message'], entry.get('stream')) for entry in entries] == [
+        ('command: keytool -list', None), ('warning: "old"', 'stderr'), ('next', 'stderr')]
+    assert entries[1]['cert'] == 'example.com' and entries[1]['level'] == 'INFO'
+    assert entries[1]['time'].endswith('+00:00')
+
+    # Configuring again replaces the handler rather than adding another
+    stream = io.StringIO()
+    output.configure('text', stream=stream)
+    log.feed('stdout', b'done\n')
+    line, = stream.getvalue().splitlines()
+    assert line.endswith(' INFO [example.com keytool -list stdout] done')
+    logging.getLogger('certhook').handlers.clear()
+
+
+def pid_running(pid: int) -> bool:
+    """Whether a process is alive, not counting zombies nobody has reaped"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def test_timeout_reaps_process_group(monkeypatch):
+    """Test a command running too long is terminated, then killed, with everything it started"""
+    monkeypatch.setattr(output, 'KILL_GRACE', 0.2)
+    # Ignores SIGTERM, and leaves a helper running in the background
+    script = "trap '' TERM; sleep 30 & echo $!; echo stuck >&2; wait"
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        output.run(['sh', '-c', script], timeout=0.3)
+    assert time.monotonic() - start < 2
+    assert e.value.stderr == b'stuck\n'
+    helper = int(e.value.output)
+    for _ in range(100):
+        if not pid_running(helper):
+            break
+        time.sleep(0.01)
+    assert not pid_running(helper)
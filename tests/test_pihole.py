@@ -2,8 +2,11 @@
 Tests for the PiHoleCertManager class
 """
 
-from unittest.mock import patch, mock_open, MagicMock
+import os
+import pytest
+from unittest.mock import ANY, patch
 from certhook import PiHoleCertManager
+from certhook.ops import UnsupportedOperation
 
 
 def test_init():
@@ -28,22 +31,26 @@ def test_init_custom_user_group():
     assert manager.verbose is True
 
 
-@patch('shutil.copy2')
-@patch('builtins.open', new_callable=mock_open, read_data='private key content')
-def test_create_combined_cert(mock_file, mock_copy):
+@pytest.fixture
+def local_manager(test_certs):
+    """Manager reading the generated test certificate, owned by the current user"""
+    class LocalPiHoleCertManager(PiHoleCertManager):
+        live_root = str(test_certs.parent)
+
+    return LocalPiHoleCertManager(cert_name=test_certs.name, user=str(os.getuid()),
+                                  group=str(os.getgid()))
+
+
+def test_create_combined_cert(local_manager, test_certs):
     """Test certificate combination process"""
-    manager = PiHoleCertManager(cert_name="example.com")
-    manager.create_combined_cert()
-    
-    # Check if fullchain.pem was copied
-    mock_copy.assert_called_once_with(
-        '/etc/letsencrypt/live/example.com/fullchain.pem',
-        '/etc/letsencrypt/live/example.com/pihole.pem'
-    )
-    
-    # Check if privkey.pem was appended
-    mock_file.assert_any_call('/etc/letsencrypt/live/example.com/privkey.pem', 'r')
-    mock_file.assert_any_call('/etc/letsencrypt/live/example.com/pihole.pem', 'a')
+    (test_certs / 'pihole.pem').write_text('old')
+    local_manager.create_combined_cert()
+
+    fullchain = (test_certs / 'fullchain.pem').read_bytes()
+    privkey = (test_certs / 'privkey.pem').read_bytes()
+    assert (test_certs / 'pihole.pem').read_bytes() == fullchain + b'\n' + privkey
+    assert os.stat(local_manager.pihole_cert).st_mode & 0o777 == 0o640
+    assert not [name for name in os.listdir(test_certs) if name.startswith('.')]
 
 
 def test_pihole_cert_property():
@@ -53,45 +60,33 @@ def test_pihole_cert_property():
     assert manager.pihole_cert == expected_path
 
 
-@patch('os.chmod')
-@patch('subprocess.run')
-def test_set_permissions(mock_run, mock_chmod):
-    """Test permission setting"""
-    manager = PiHoleCertManager(cert_name="example.com")
-    manager.set_permissions()
-    
-    mock_run.assert_called_once_with(
-        ['chown', 'pihole:ssl-certs', '/etc/letsencrypt/live/example.com/pihole.pem'],
-        capture_output=True,
-        check=True
-    )
-    mock_chmod.assert_called_once_with(
-        '/etc/letsencrypt/live/example.com/pihole.pem',
-        0o640
-    )
+@patch('certhook.output.run')
+def test_create_combined_cert_unknown_owner(mock_run, test_certs):
+    """Test the existing file is left alone if its owner doesn't exist"""
+    class LocalPiHoleCertManager(PiHoleCertManager):
+        live_root = str(test_certs.parent)
+
+    (test_certs / 'pihole.pem').write_text('old')
+    manager = LocalPiHoleCertManager(cert_name=test_certs.name, user='no-such-user-certhook')
+    with pytest.raises(UnsupportedOperation):
+        manager.create_combined_cert()
+    assert (test_certs / 'pihole.pem').read_text() == 'old'
+    mock_run.assert_not_called()
 
 
-@patch('subprocess.run')
+@patch('certhook.output.run')
 def test_restart_service(mock_run):
     """Test service restart"""
     manager = PiHoleCertManager(cert_name="example.com")
     manager.restart_service()
     
-    mock_run.assert_called_once_with(
-        ['systemctl', 'restart', 'pihole-FTL'],
-        capture_output=True,
-        check=True
-    )
+    mock_run.assert_called_once_with(['systemctl', 'restart', 'pihole-FTL'], ANY, None, timeout=None)
 
 
-@patch('certhook.pihole.PiHoleCertManager.restart_service')
-@patch('certhook.pihole.PiHoleCertManager.set_permissions')
-@patch('certhook.pihole.PiHoleCertManager.create_combined_cert')
-def test_call_executes_all_steps(mock_create, mock_perms, mock_restart):
-    """Test that __call__ executes all required steps"""
-    manager = PiHoleCertManager(cert_name="example.com")
-    manager()
-    
-    mock_create.assert_called_once()
-    mock_perms.assert_called_once()
-    mock_restart.assert_called_once()
+@patch('certhook.output.run')
+def test_call_executes_all_steps(mock_run, local_manager, test_certs):
+    """Test that __call__ writes the combined certificate, then restarts FTL"""
+    local_manager()
+
+    assert (test_certs / 'pihole.pem').exists()
+    mock_run.assert_called_once_with(['systemctl', 'restart', 'pihole-FTL'], ANY, None, timeout=None)
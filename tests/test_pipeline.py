@@ -0,0 +1,79 @@
+"""
+Tests for running commands as pipelines.
+"""
+
+import subprocess
+import sys
+import time
+import pytest
+from certhook import pipeline
+from certhook.pipeline import Pipeline
+
+# Succeeds only if its input is a regular file, as keytool requires, and echoes it
+NEEDS_FILE = ['sh', '-c', 'test -f /dev/stdin || exit 3; cat /dev/stdin']
+
+
+def run_script(commands: Pipeline) -> subprocess.CompletedProcess:
+    """Run a pipeline's shell script, as it would be on another host"""
+    return subprocess.run(['sh', '-c', commands.script()], capture_output=True)
+
+
+def test_streaming():
+    """Test each command's output is streamed to the next one"""
+    commands = Pipeline(['printf', 'hello\\nworld\\n'], ['tr', 'a-z', 'A-Z'], ['sort', '-r'])
+    result = pipeline.run(commands)
+    assert result.stdout == b'WORLD\nHELLO\n'
+    assert result.args == ['printf', 'hello\\nworld\\n', '|', 'tr', 'a-z', 'A-Z', '|', 'sort', '-r']
+    assert run_script(commands).stdout == result.stdout
+
+
+def test_streaming_needs_seekable():
+    """Test commands reading their input as a file fail on a pipe, and work when seekable"""
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        pipeline.run(Pipeline(['echo', 'secret'], NEEDS_FILE))
+    assert e.value.returncode == 3
+    assert e.value.cmd == NEEDS_FILE
+
+    commands = Pipeline(['echo', 'secret'], NEEDS_FILE, ['tr', 'a-z', 'A-Z'], seekable=True)
+    assert pipeline.run(commands).stdout == b'SECRET\n'
+    result = run_script(commands)
+    assert result.returncode == 0
+    assert result.stdout == b'SECRET\n'
+
+
+@pytest.mark.parametrize('seekable', [False, True])
+def test_failure(seekable: bool):
+    """Test a failing command fails the pipeline, with its errors"""
+    failing = ['sh', '-c', 'echo broken >&2; exit 2']
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        pipeline.run(Pipeline(['echo', 'data'], failing, ['cat'], seekable=seekable))
+    assert e.value.cmd == failing
+    assert e.value.returncode == 2
+    assert e.value.stderr == b'broken\n'
+    assert run_script(Pipeline(['echo', 'data'], failing, ['cat'], seekable=seekable)).returncode == 2
+
+
+def test_large_output():
+    """Test commands writing more than a pipe holds, to output and errors, don't block"""
+    size = 1 << 20
+    noisy = [sys.executable, '-c', f'import sys; sys.stderr.write("e" * {size}); sys.stdout.write("o" * {size})']
+    result = pipeline.run(Pipeline(noisy, ['cat']))
+    assert len(result.stdout) == size
+    assert len(result.stderr) == size
+
+
+def test_missing_program():
+    """Test a missing program is raised, without leaving the other commands running"""
+    with pytest.raises(FileNotFoundError):
+        pipeline.run(Pipeline(['sleep', '10'], ['/nonexistent/program']))
+
+
+@pytest.mark.parametrize('seekable', [False, True])
+def test_timeout(seekable: bool):
+    """Test a pipeline running too long is terminated as a whole"""
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        pipeline.run(Pipeline(['sh', '-c', 'echo waiting >&2; sleep 30'], ['cat'], seekable=seekable), timeout=0.2)
+    assert time.monotonic() - start < 2
+    assert e.value.cmd == ['sh', '-c', 'echo waiting >&2; sleep 30', '|', 'cat']
+    assert e.value.stderr == b'waiting\n'
@@ -0,0 +1,116 @@
+"""
+Tests for the native PKCS#12 builder.
+"""
+
+import os
+import subprocess
+import pytest
+from certhook import asn1, pkcs12
+
+
+def openssl_read(p12_path, password):
+    """Read a PKCS#12 file with openssl, returning its info output and PEM contents"""
+    result = subprocess.run(['openssl', 'pkcs12', '-in', str(p12_path), '-info', '-nodes',
+                             '-passin', f'pass:{password}'], capture_output=True, check=True)
+    return result.stderr.decode(), result.stdout
+
+
+def test_aes_known_answers():
+    """Test AES against the FIPS-197 example vectors"""
+    plaintext = bytes.fromhex('00112233445566778899aabbccddeeff')
+    assert pkcs12.AES(bytes(range(16))).encrypt_block(plaintext).hex() == '69c4e0d86a7b0430d8cdb78070b4c55a'
+    assert pkcs12.AES(bytes(range(24))).encrypt_block(plaintext).hex() == 'dda97ca4864cdfe06eaf70a0ec0d7191'
+    assert pkcs12.AES(bytes(range(32))).encrypt_block(plaintext).hex() == '8ea2b7ca516745bfeafc49904b496089'
+
+
+@pytest.mark.parametrize('size', [0, 15, 16, 100])
+def test_cbc_round_trip(size):
+    """Test CBC encryption matches openssl and decrypts back"""
+    key, iv, data = os.urandom(32), os.urandom(16), os.urandom(size)
+    encrypted = pkcs12.cbc_encrypt(key, iv, data)
+    expected = subprocess.run(['openssl', 'enc', '-aes-256-cbc', '-K', key.hex(), '-iv', iv.hex(), '-nosalt'],
+                              input=data, capture_output=True, check=True).stdout
+    assert encrypted == expected
+    assert pkcs12.cbc_decrypt(key, iv, encrypted) == data
+
+
+def test_cbc_wrong_key():
+    """Test decrypting with the wrong key is detected"""
+    encrypted = pkcs12.cbc_encrypt(b'k' * 16, b'i' * 16, b'secret data')
+    with pytest.raises(ValueError):
+        pkcs12.cbc_decrypt(b'x' * 16, b'i' * 16, encrypted)
+
+
+def test_pkcs12_kdf():
+    """Test the PKCS#12 KDF against a published SHA-1 test vector"""
+    derived = pkcs12.pkcs12_kdf('smeg', bytes.fromhex('0a58cf64530d823f'), 1, 1, 24, 'sha1')
+    assert derived.hex() == '8aaae6297b6cb04642ab5b077851284eb7128f1a2a7fbca3'
+
+
+@pytest.mark.parametrize('password,name', [('unifi', 'unifi'), ('', None)])
+def test_export_readable_by_openssl(test_certs, tmp_path, password, name):
+    """Test openssl accepts the MAC, decrypts the key and sees the friendly name"""
+    out = tmp_path / 'fullchain.p12'
+    out.write_bytes(pkcs12.export_pkcs12(str(test_certs / 'privkey.pem'), str(test_certs / 'fullchain.pem'),
+                                         password, friendly_name=name))
+    info, pem = openssl_read(out, password)
+
+    assert 'MAC: sha256, Iteration 2048' in info
+    assert 'PBES2, PBKDF2, AES-256-CBC' in info
+    certs = [der for label, der in asn1.pem_blocks(pem) if label == 'CERTIFICATE']
+    expected = [der for _, der in asn1.pem_blocks((test_certs / 'fullchain.pem').read_bytes())]
+    assert certs == expected
+    keys = [der for label, der in asn1.pem_blocks(pem) if label == 'PRIVATE KEY']
+    assert keys == [der for _, der in asn1.pem_blocks((test_certs / 'privkey.pem').read_bytes())]
+    assert (f'friendlyName: {name}' in pem.decode()) == (name is not None)
+
+
+def test_export_iterations(test_certs, tmp_path):
+    """Test the iteration count is configurable"""
+    out = tmp_path / 'fullchain.p12'
+    out.write_bytes(pkcs12.export_pkcs12(str(test_certs / 'privkey.pem'), str(test_certs / 'fullchain.pem'),
+                                         'pw', iterations=1))
+    info, _ = openssl_read(out, 'pw')
+    assert 'Iteration 1' in info
+
+
+def test_traditional_rsa_key(test_certs, tmp_path):
+    """Test PKCS#1 keys are converted to PKCS#8"""
+    rsa_key = tmp_path / 'rsa.pem'
+    subprocess.run(['openssl', 'rsa', '-in', str(test_certs / 'privkey.pem'), '-traditional',
+                    '-out', str(rsa_key)], capture_output=True, check=True)
+    assert b'BEGIN RSA PRIVATE KEY' in rsa_key.read_bytes()
+
+    out = tmp_path / 'fullchain.p12'
+    out.write_bytes(pkcs12.export_pkcs12(str(rsa_key), str(test_certs / 'fullchain.pem'), 'pw'))
+    _, pem = openssl_read(out, 'pw')
+    keys = [der for label, der in asn1.pem_blocks(pem) if label == 'PRIVATE KEY']
+    assert keys == [der for _, der in asn1.pem_blocks((test_certs / 'privkey.pem').read_bytes())]
+
+
+def test_missing_key():
+    """Test files without a key or certificates are rejected"""
+    with pytest.raises(ValueError):
+        pkcs12.load_key_and_chain(b'', asn1.pem_encode('CERTIFICATE', b'x'))
+    with pytest.raises(ValueError):
+        pkcs12.load_key_and_chain(asn1.pem_encode('PRIVATE KEY', b'x'), b'')
+
+
+def test_malformed_bags():
+    """Test oddly structured contents are rejected as invalid files"""
+    # Encrypted contents missing their optional [0] ciphertext
+    encrypted_data = asn1.sequence(asn1.integer(0), asn1.sequence(
+        asn1.oid(pkcs12.OID_DATA), asn1.algorithm(pkcs12.OID_PBES2)))
+    auth_safe = asn1.sequence(asn1.sequence(asn1.oid(pkcs12.OID_ENCRYPTED_DATA), asn1.explicit(0, encrypted_data)))
+    pfx = asn1.sequence(asn1.integer(3), asn1.sequence(
+        asn1.oid(pkcs12.OID_DATA), asn1.explicit(0, asn1.octet_string(auth_safe))))
+    with pytest.raises(pkcs12.PKCS12Error, match='Invalid PKCS#12 file'):
+        pkcs12.parse_pfx(pfx, 'pw')
+
+    # Contents truncated partway through a bag
+    truncated = asn1.sequence(asn1.sequence(asn1.oid(pkcs12.OID_DATA), asn1.explicit(0, asn1.octet_string(
+        asn1.sequence(asn1.sequence(asn1.oid(pkcs12.OID_CERT_BAG)))[:-3]))))
+    pfx = asn1.sequence(asn1.integer(3), asn1.sequence(
+        asn1.oid(pkcs12.OID_DATA), asn1.explicit(0, asn1.octet_string(truncated))))
+    with pytest.raises(pkcs12.PKCS12Error, match='Invalid PKCS#12 file'):
+        pkcs12.parse_pfx(pfx, 'pw')
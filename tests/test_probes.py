@@ -0,0 +1,157 @@
+"""
+Tests for the readiness probes, against local stand-in listeners.
+"""
+
+import socket
+import ssl
+import struct
+import threading
+import time
+import pytest
+from pathlib import Path
+from certhook.probes import DNSProbe, ProbeTimeout, TCPProbe, TLSProbe
+
+
+def free_port(kind: int = socket.SOCK_STREAM) -> int:
+    """Port nothing is listening on"""
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TLSListener:
+    """TLS server completing handshakes with the test certificate, started after a delay"""
+
+    def __init__(self, cert_dir: Path, port: int, delay: float = 0.0):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(str(cert_dir / 'fullchain.pem'), str(cert_dir / 'privkey.pem'))
+        self.port = port
+        self.delay = delay
+        self.handshakes = 0
+        self.sock = None
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self) -> None:
+        time.sleep(self.delay)
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', self.port))
+        self.sock.listen()
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            try:
+                with self.context.wrap_socket(conn, server_side=True):
+                    self.handshakes += 1
+            except (OSError, ssl.SSLError):
+                pass
+
+    def close(self) -> None:
+        self.thread.join(self.delay + 1)
+        self.sock.close()
+
+
+class DNSListener:
+    """UDP DNS server answering every query with the given rcode"""
+
+    def __init__(self, rcode: int = 0):
+        self.rcode = rcode
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.queries = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self) -> None:
+        while True:
+            try:
+                query, address = self.sock.recvfrom(512)
+            except OSError:
+                return
+            self.queries.append(query)
+            query_id, = struct.unpack('>H', query[:2])
+            # Unrelated datagram first, which the probe has to ignore
+            self.sock.sendto(struct.pack('>HHHHHH', query_id ^ 1, 0x8180, 0, 0, 0, 0), address)
+            self.sock.sendto(struct.pack('>HHHHHH', query_id, 0x8180 | self.rcode, 1, 0, 0, 0)
+                             + query[12:], address)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def test_tcp_probe():
+    """Test a TCP probe succeeds against a listening socket"""
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        assert TCPProbe('127.0.0.1', server.getsockname()[1]).wait(1.0) < 1.0
+
+
+def test_tls_probe_waits_for_service(test_certs: Path):
+    """Test a TLS probe keeps retrying until the service comes back"""
+    listener = TLSListener(test_certs, free_port(), delay=0.3)
+    try:
+        outage = TLSProbe('127.0.0.1', listener.port).wait(5.0)
+    finally:
+        listener.close()
+    assert 0.3 <= outage < 5.0
+    assert listener.handshakes == 1
+
+
+def test_tls_probe_requires_handshake():
+    """Test a TLS probe doesn't pass a service accepting connections without TLS"""
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+
+        def accept():
+            # Accept and hang up without speaking TLS
+            for _ in range(100):
+                try:
+                    server.accept()[0].close()
+                except OSError:
+                    return
+
+        threading.Thread(target=accept, daemon=True).start()
+        with pytest.raises(ProbeTimeout):
+            TLSProbe('127.0.0.1', server.getsockname()[1], timeout=0.1).wait(0.3)
+
+
+def test_probe_timeout():
+    """Test a probe gives up at the deadline, with the last error attached"""
+    probe = TCPProbe('127.0.0.1', free_port())
+    start = time.monotonic()
+    with pytest.raises(ProbeTimeout) as excinfo:
+        probe.wait(0.2)
+    assert 0.2 <= time.monotonic() - start < 1.0
+    assert isinstance(excinfo.value.__cause__, OSError)
+
+
+def test_dns_probe():
+    """Test a DNS probe passes once the server answers, even with NXDOMAIN"""
+    for rcode in (0, 3):
+        listener = DNSListener(rcode)
+        try:
+            assert DNSProbe('127.0.0.1', listener.port, name='pi.hole').wait(1.0) < 1.0
+        finally:
+            listener.close()
+        assert b'\x02pi\x04hole\x00' in listener.queries[0]
+
+
+def test_dns_probe_server_failure():
+    """Test a DNS probe keeps failing while the server answers SERVFAIL"""
+    listener = DNSListener(rcode=2)
+    try:
+        with pytest.raises(ProbeTimeout):
+            DNSProbe('127.0.0.1', listener.port).wait(0.2)
+    finally:
+        listener.close()
+
+
+def test_dns_probe_no_server():
+    """Test a DNS probe fails with nothing listening"""
+    with pytest.raises(ProbeTimeout):
+        DNSProbe('127.0.0.1', free_port(socket.SOCK_DGRAM), timeout=0.05).wait(0.2)
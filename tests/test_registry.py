@@ -0,0 +1,102 @@
+"""
+Tests for the registry of app managers.
+"""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+from unittest.mock import patch
+import pytest
+from certhook import EmbyCertManager, registry
+from certhook.main import main
+
+# Budget for importing the CLI, far above its usual time so only a regression fails it
+STARTUP_BUDGET = 1.0
+
+
+@pytest.fixture
+def plugin(tmp_path: Path, monkeypatch) -> Path:
+    """Install a package providing an 'example' app through an entry point"""
+    dist_info = tmp_path / 'certhook_example-1.0.dist-info'
+    dist_info.mkdir()
+    (dist_info / 'METADATA').write_text('Metadata-Version: 2.1\nName: certhook-example\nVersion: 1.0\n')
+    (dist_info / 'entry_points.txt').write_text(
+        '[certhook.managers]\n'
+        'example = certhook_example:ExampleCertManager\n'
+        'broken = certhook_example:not_a_manager\n'
+    )
+    (tmp_path / 'certhook_example.py').write_text(
+        'from certhook.emby import EmbyCertManager\n'
+        '\n'
+        'class ExampleCertManager(EmbyCertManager):\n'
+        '    pass\n'
+        '\n'
+        'not_a_manager = object()\n'
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    registry.entry_points.cache_clear()
+    yield tmp_path
+    registry.entry_points.cache_clear()
+    sys.modules.pop('certhook_example', None)
+
+
+def test_builtin_apps():
+    """Test the built in apps are found without searching installed packages"""
+    managers = registry.Registry()
+    with patch.object(registry, 'entry_points', side_effect=AssertionError('searched packages')):
+        assert 'emby' in managers
+        assert managers['emby'] is EmbyCertManager
+    assert list(managers) == ['unifi', 'pihole', 'emby', 'freepbx']
+    with pytest.raises(KeyError):
+        managers['nginx']
+
+
+def test_entry_points(plugin: Path):
+    """Test apps of installed packages are found, without replacing the built in apps"""
+    managers = registry.Registry({'emby': 'certhook_example:ExampleCertManager', 'example': EmbyCertManager})
+    assert managers['emby'].__name__ == 'ExampleCertManager'
+    assert managers['example'] is EmbyCertManager
+
+    managers = registry.Registry()
+    assert 'example' in managers
+    assert managers['example'].__name__ == 'ExampleCertManager'
+    assert managers['emby'] is EmbyCertManager
+    with pytest.raises(TypeError):
+        managers['broken']
+
+
+def test_cli_plugin(plugin: Path, tmp_path: Path):
+    """Test the CLI accepts apps of installed packages"""
+    managers = registry.Registry()
+    with patch('certhook.main.APP_MANAGERS', managers), \
+            patch('certhook_example.ExampleCertManager.__call__') as call:
+        main(['example', 'example.com', '--state-file', str(tmp_path / 'state.json')])
+    call.assert_called_once()
+
+
+def test_startup_imports_only_selected_manager():
+    """Test the CLI only imports the manager of the app used, and within the startup budget"""
+    code = (
+        'import json, sys\n'
+        'from certhook.main import APP_MANAGERS\n'
+        'APP_MANAGERS["emby"]\n'
+        'print(json.dumps(sorted(sys.modules)))\n'
+    )
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True)
+    modules = set(json.loads(result.stdout))
+    assert 'certhook.emby' in modules
+    assert not {'certhook.unifi', 'certhook.pihole', 'certhook.freepbx', 'importlib.metadata'} & modules
+    # Nor the modules of other sub-commands, or conversions it hasn't run yet
+    assert not {'certhook.pkcs12', 'certhook.keystore', 'certhook.watch', 'certhook.inventory',
+                'certhook.verify', 'certhook.daemon'} & modules
+
+    # Lines are "import time: self [us] | cumulative | name", nested imports indented
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, total, name = line.split('|')
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total) / 1e6
+    assert cumulative['certhook.main'] < STARTUP_BUDGET
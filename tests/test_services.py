@@ -0,0 +1,115 @@
+"""
+Tests for the service restart coordinator.
+"""
+
+import time
+import pytest
+from unittest.mock import MagicMock
+from certhook.probes import ProbeTimeout
+from certhook.services import Restart, RestartCoordinator
+
+
+def test_restart_command():
+    """Test restart and reload commands for both service tools"""
+    assert Restart('emby-server').command() == ['/usr/sbin/service', 'emby-server', 'restart']
+    assert Restart('apache2').command('reload') == ['/usr/sbin/service', 'apache2', 'reload']
+    assert Restart('pihole-FTL', via='systemctl').command() == ['systemctl', 'restart', 'pihole-FTL']
+    with pytest.raises(ValueError):
+        Restart('emby-server', via='rc')
+
+
+def test_duplicates_coalesced():
+    """Test a service requested many times is restarted once"""
+    run = MagicMock()
+    coordinator = RestartCoordinator()
+    for i in range(40):
+        coordinator.request(Restart('emby-server'), run, f'cert{i}')
+    assert coordinator.flush() == {'emby-server': None}
+    run.assert_called_once_with(['/usr/sbin/service', 'emby-server', 'restart'])
+
+
+def test_reload_preferred():
+    """Test services that support it are reloaded unless restarts are forced"""
+    coordinator = RestartCoordinator()
+    coordinator.request(Restart('apache2'), MagicMock())
+    assert coordinator.plan() == [(Restart('apache2'), 'reload')]
+    coordinator.prefer_reload = False
+    assert coordinator.plan() == [(Restart('apache2'), 'restart')]
+
+
+def test_covered_restart_skipped():
+    """Test unifi isn't restarted when unifi-core cycles it, in either request order"""
+    run = MagicMock()
+    coordinator = RestartCoordinator()
+    coordinator.request(Restart('unifi'), run, 'network')
+    coordinator.request(Restart('emby-server'), run, 'media')
+    coordinator.request(Restart('unifi-core'), run, 'core')
+    assert coordinator.plan() == [(Restart('emby-server'), 'restart'), (Restart('unifi-core'), 'restart')]
+
+    outcomes = coordinator.flush()
+    assert outcomes == {'emby-server': None, 'unifi-core': None, 'unifi': None}
+    assert run.call_count == 2
+
+
+def test_dependency_order(monkeypatch):
+    """Test a service is restarted after the services it depends on"""
+    monkeypatch.setattr('certhook.services.COVERS', {})
+    coordinator = RestartCoordinator()
+    coordinator.request(Restart('unifi'), MagicMock())
+    coordinator.request(Restart('unifi-core'), MagicMock())
+    assert [restart.service for restart, _ in coordinator.plan()] == ['unifi-core', 'unifi']
+
+
+def test_failures_reported_to_requesters():
+    """Test a failed restart is reported to everyone who asked for it, and others still run"""
+    def run(cmd):
+        if cmd[1] == 'unifi-core':
+            raise RuntimeError('restart failed')
+
+    coordinator = RestartCoordinator()
+    coordinator.request(Restart('unifi-core'), run, 'core')
+    coordinator.request(Restart('unifi'), run, 'network')
+    coordinator.request(Restart('emby-server'), run, 'media')
+    outcomes = coordinator.flush()
+
+    assert outcomes['emby-server'] is None
+    assert sorted(requester for requester, _ in coordinator.failures(outcomes)) == ['core', 'network']
+
+
+class FakeProbe:
+    """Probe that passes after a number of seconds, or never"""
+
+    def __init__(self, ready_after: float = None):
+        self.ready_after = ready_after
+        self.deadlines = []
+
+    def wait(self, deadline: float) -> float:
+        self.deadlines.append(deadline)
+        if self.ready_after is None or self.ready_after > deadline:
+            raise ProbeTimeout('not ready')
+        time.sleep(self.ready_after)
+        return self.ready_after
+
+
+def test_restart_waits_for_probe():
+    """Test a restart with a probe records how long the service was out"""
+    coordinator = RestartCoordinator()
+    probe = FakeProbe(0.05)
+    coordinator.request(Restart('emby-server'), MagicMock(), 'first')
+    coordinator.request(Restart('emby-server', probe=probe, deadline=5.0), MagicMock(), 'second')
+    assert coordinator.flush() == {'emby-server': None}
+    assert len(probe.deadlines) == 1 and probe.deadlines[0] <= 5.0
+    assert 0.05 <= coordinator.outages['emby-server'] < 5.0
+
+
+def test_probe_timeout_fails_restart():
+    """Test a service that doesn't come back fails its requesters"""
+    coordinator = RestartCoordinator()
+    coordinator.request(Restart('unifi-core', probe=FakeProbe(0.0)), MagicMock(), 'core')
+    coordinator.request(Restart('unifi', probe=FakeProbe()), MagicMock(), 'network')
+    outcomes = coordinator.flush()
+
+    # unifi is covered by the unifi-core restart, but still waited for
+    assert isinstance(outcomes['unifi-core'], ProbeTimeout)
+    assert sorted(requester for requester, _ in coordinator.failures(outcomes)) == ['core', 'network']
+    assert list(coordinator.outages) == ['unifi-core']
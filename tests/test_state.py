@@ -0,0 +1,145 @@
+"""
+Tests for the deployment state store.
+"""
+
+import json
+import threading
+import pytest
+from pathlib import Path
+from unittest.mock import MagicMock
+from certhook.base import BaseCertManager
+from certhook.state import StateStore, file_digest
+
+
+class FileCertManager(BaseCertManager):
+    """Manager that writes a single artifact"""
+
+    def __init__(self, cert_name, live_root):
+        self.live_root = str(live_root)
+        self.calls = 0
+        super().__init__(cert_name)
+
+    @property
+    def artifacts(self):
+        return [f'{self.cert_dir}/artifact']
+
+    def __call__(self):
+        self.calls += 1
+        with open(self.artifacts[0], 'w') as f:
+            f.write('converted')
+
+@pytest.fixture
+def manager(test_certs, cert_name):
+    return FileCertManager(cert_name, test_certs.parent)
+
+
+def test_file_digest(tmp_path):
+    """Test digests of present and missing files"""
+    path = tmp_path / 'file'
+    path.write_bytes(b'abc')
+    assert file_digest(str(path)) == 'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad'
+    assert file_digest(str(tmp_path / 'missing')) is None
+
+
+def test_deploy_then_skip(manager, state_file):
+    """Test an unchanged certificate is only deployed once"""
+    store = StateStore(str(state_file))
+    assert store.deploy('test', manager) is True
+    assert store.deploy('test', manager) is False
+    assert manager.calls == 1
+
+    # State survives a fresh store
+    assert StateStore(str(state_file)).is_current('test', manager)
+    assert 'test:example.com' in json.loads(state_file.read_text())
+
+
+def test_force(manager, state_file):
+    """Test force deploys an unchanged certificate"""
+    store = StateStore(str(state_file))
+    store.deploy('test', manager)
+    assert store.deploy('test', manager, force=True) is True
+    assert manager.calls == 2
+
+
+def test_changed_input(manager, test_certs, state_file):
+    """Test a renewed certificate is deployed again"""
+    store = StateStore(str(state_file))
+    store.deploy('test', manager)
+    with open(test_certs / 'privkey.pem', 'a') as f:
+        f.write('\n')
+    assert store.deploy('test', manager) is True
+
+
+@pytest.mark.parametrize('tamper', [
+    lambda path: path.write_text('tampered'),
+    lambda path: path.unlink(),
+])
+def test_changed_artifact(manager, state_file, tamper):
+    """Test a modified or removed artifact is deployed again"""
+    store = StateStore(str(state_file))
+    store.deploy('test', manager)
+    tamper(Path(manager.artifacts[0]))
+    assert store.deploy('test', manager) is True
+
+
+def test_failed_deploy_not_recorded(state_file):
+    """Test a failing manager is retried on the next run"""
+    manager = MagicMock(cert_name='example.com', inputs=[], artifacts=[])
+    manager.side_effect = RuntimeError('boom')
+    store = StateStore(str(state_file))
+    with pytest.raises(RuntimeError):
+        store.deploy('test', manager)
+    assert not store.is_current('test', manager)
+
+
+def test_per_app_entries(manager, state_file):
+    """Test the same certificate is tracked separately per app"""
+    store = StateStore(str(state_file))
+    store.deploy('one', manager)
+    assert not store.is_current('two', manager)
+
+
+def test_corrupt_state_file(state_file):
+    """Test an unreadable state file is treated as empty"""
+    state_file.write_text('not json')
+    assert StateStore(str(state_file))._entries == {}
+
+
+def test_forget(manager, state_file):
+    """Test a forgotten deployment runs again"""
+    store = StateStore(str(state_file))
+    store.deploy('emby', manager)
+    store.forget('emby', manager.cert_name)
+    assert not StateStore(str(state_file)).is_current('emby', manager)
+
+
+def test_concurrent_deploy_coalesced(manager, test_certs, cert_name, state_file):
+    """Test a deployment waiting on another process's deployment of the same certificate is skipped"""
+    started, finish = threading.Event(), threading.Event()
+
+    class SlowCertManager(FileCertManager):
+        def __call__(self):
+            started.set()
+            finish.wait(5)
+            super().__call__()
+
+    slow = SlowCertManager(cert_name, test_certs.parent)
+    thread = threading.Thread(target=StateStore(str(state_file)).deploy, args=('emby', slow))
+    thread.start()
+    started.wait(5)
+
+    # Another process, with its own view of the state file, forcing a deployment
+    finish_later = threading.Timer(0.1, finish.set)
+    finish_later.start()
+    assert StateStore(str(state_file)).deploy('emby', manager, force=True) is False
+    thread.join(5)
+    assert slow.calls == 1 and manager.calls == 0
+
+
+def test_concurrent_records_merged(manager, test_certs, state_file):
+    """Test processes sharing a state file keep each other's records"""
+    first, second = StateStore(str(state_file)), StateStore(str(state_file))
+    first.deploy('emby', manager)
+    second.deploy('unifi', manager)
+    assert set(json.loads(state_file.read_text())) == {'emby:example.com', 'unifi:example.com'}
+    assert second.is_current('emby', manager)
@@ -0,0 +1,120 @@
+"""
+Tests for the dependency graph executor.
+"""
+
+import threading
+import time
+import pytest
+from certhook.steps import Step, execute, resolve
+
+
+class Recorder:
+    """Run function recording start/end order and peak concurrency"""
+
+    def __init__(self, delay=0.02, fail=None):
+        self.delay = delay
+        self.fail = fail
+        self.events = []
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, cmd):
+        name = getattr(cmd, 'action', cmd)
+        with self.lock:
+            self.events.append(('start', name))
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.events.append(('end', name))
+        if name == self.fail:
+            raise RuntimeError(name)
+
+    def order(self, kind):
+        return [name for event, name in self.events if event == kind]
+
+
+def test_plain_commands_chain():
+    """Test plain entries each wait for the previous one"""
+    assert resolve(['a', 'b', 'c']) == [set(), {0}, {1}]
+
+
+def test_plain_commands_run_in_order():
+    """Test a plain command list runs sequentially in the calling thread"""
+    recorder = Recorder(delay=0)
+    threads = []
+    execute(['a', 'b', 'c'], lambda cmd: (threads.append(threading.current_thread()), recorder(cmd)))
+    assert recorder.order('start') == ['a', 'b', 'c']
+    assert set(threads) == {threading.current_thread()}
+
+
+def test_independent_steps_overlap():
+    """Test steps without dependencies run at the same time"""
+    first = Step('a', after=[])
+    second = Step('b', after=[])
+    joined = Step('c', after=[first, second])
+    recorder = Recorder()
+    execute([first, second, joined], recorder)
+
+    assert recorder.peak == 2
+    assert recorder.order('start')[-1] == 'c'
+    assert recorder.events.index(('start', 'c')) > recorder.events.index(('end', 'a'))
+    assert recorder.events.index(('start', 'c')) > recorder.events.index(('end', 'b'))
+
+
+def test_max_workers():
+    """Test the number of entries running at once is bounded"""
+    recorder = Recorder()
+    execute([Step(str(i), after=[]) for i in range(6)], recorder, max_workers=2)
+    assert recorder.peak == 2
+    assert len(recorder.order('end')) == 6
+
+
+def test_shared_resources_serialize():
+    """Test steps sharing a resource never overlap"""
+    recorder = Recorder()
+    execute([Step('a', after=[], resources=['x']), Step('b', after=[], resources=['x']),
+             Step('c', after=[], resources=['y'])], recorder)
+    starts = recorder.events.index(('start', 'b')), recorder.events.index(('start', 'a'))
+    assert recorder.events.index(('end', 'a')) < max(starts) or recorder.events.index(('end', 'b')) < max(starts)
+    assert recorder.peak == 2
+
+
+def test_barriers_run_last_in_order():
+    """Test barrier steps wait for everything else, even entries after them"""
+    cmds = [Step('restart1', barrier=True), Step('a', after=[]), Step('restart2', barrier=True),
+            Step('b', after=[])]
+    assert resolve(cmds) == [{1, 3}, set(), {0, 1, 3}, set()]
+
+    recorder = Recorder()
+    execute(cmds, recorder)
+    assert recorder.order('start')[-2:] == ['restart1', 'restart2']
+
+
+def test_failure_stops_new_steps():
+    """Test a failure is raised and dependent steps never start"""
+    first = Step('a', after=[])
+    cmds = [first, Step('b', after=[first]), Step('slow', after=[])]
+    recorder = Recorder(fail='a')
+    with pytest.raises(RuntimeError):
+        execute(cmds, recorder)
+    assert 'b' not in recorder.order('start')
+    # Entries already running are allowed to finish
+    assert 'slow' in recorder.order('end')
+
+
+def test_unknown_dependency():
+    """Test depending on an entry outside the list is rejected"""
+    with pytest.raises(ValueError):
+        resolve([Step('a', after=[Step('elsewhere')])])
+
+
+def test_cycle():
+    """Test dependency cycles are detected instead of hanging"""
+    first = Step('a', after=[])
+    second = Step('b', after=[first])
+    first.after = [second]
+    with pytest.raises(ValueError):
+        execute([first, second], Recorder(delay=0))
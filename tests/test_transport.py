@@ -0,0 +1,200 @@
+"""
+Tests for deploying to other hosts through transports.
+"""
+
+import os
+import shlex
+import stat
+import subprocess
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+import pytest
+from certhook import EmbyCertManager, PiHoleCertManager
+from certhook import transport
+from certhook.batch import BatchRunner
+from certhook.pipeline import Pipeline
+from certhook.state import StateStore
+from certhook.transport import LOCAL, RootTransport, SSHTransport, TransportError
+
+
+def stand_in(root: Path, host: str) -> RootTransport:
+    """Stand-in host with stub service tools logging to /var/log/stub.log"""
+    log = root / 'var' / 'log' / 'stub.log'
+    log.parent.mkdir(parents=True)
+    log.touch()
+    for directory, name in (('usr/sbin', 'service'), ('usr/bin', 'systemctl'),
+                            ('usr/bin', 'chown'), ('usr/bin', 'chmod')):
+        stub = root / directory / name
+        stub.parent.mkdir(parents=True, exist_ok=True)
+        stub.write_text(f'#!/bin/sh\necho "{name} $*" >> "{log}"\n')
+        stub.chmod(0o755)
+    return RootTransport(str(root), host)
+
+
+def stub_log(transport: RootTransport) -> list:
+    """Commands the stubs on a stand-in host were run with"""
+    return Path(transport.path('/var/log/stub.log')).read_text().splitlines()
+
+
+def test_root_transport(tmp_path: Path):
+    """Test the stand-in moves paths under its root and runs its own programs"""
+    host = stand_in(tmp_path / 'host', 'host')
+    host.write('/etc/app/cert.pem', b'certificate', 0o640, 'app:app')
+    written = tmp_path / 'host' / 'etc' / 'app' / 'cert.pem'
+    assert written.read_bytes() == b'certificate'
+    assert stat.S_IMODE(written.stat().st_mode) == 0o640
+    assert stub_log(host) == [f'chown app:app {written}']
+
+    assert host.run(['cat', '/etc/app/cert.pem']).stdout == b'certificate'
+    with pytest.raises(subprocess.CalledProcessError):
+        host.run(['cat', '/etc/app/missing.pem'])
+    digests = host.digest(['/etc/app/cert.pem', '/etc/app/missing.pem'])
+    assert digests['/etc/app/missing.pem'] is None
+    assert len(digests['/etc/app/cert.pem']) == 64
+
+    result = host.run_pipeline(Pipeline(['cat', '/etc/app/cert.pem'], ['cat', '/dev/stdin'], seekable=True))
+    assert result.stdout == b'certificate'
+    assert result.args == ['cat', '/etc/app/cert.pem', '|', 'cat', '/dev/stdin']
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        host.run_pipeline(Pipeline(['cat', '/etc/app/missing.pem'], ['cat']))
+    assert e.value.cmd == ['cat', '/etc/app/missing.pem']
+
+
+@patch('subprocess.run')
+def test_ssh_transport(mock_run):
+    """Test commands share a master connection and are quoted for the remote shell"""
+    mock_run.return_value = subprocess.CompletedProcess([], 0, b'out', b'')
+    ssh = SSHTransport('root@pihole.lan', control_dir='/run/certhook', options=['-p', '2222'])
+    result = ssh.run(['chown', 'pihole:ssl certs', '/etc/pihole/tls.pem'])
+
+    argv = mock_run.call_args.args[0]
+    assert argv[0] == 'ssh'
+    assert 'ControlMaster=auto' in argv and 'ControlPath=/run/certhook/%C' in argv
+    assert argv[-5:-3] == ['-p', '2222']
+    assert argv[-3:] == ['root@pihole.lan', '--', "chown 'pihole:ssl certs' /etc/pihole/tls.pem"]
+    assert result.args == ['chown', 'pihole:ssl certs', '/etc/pihole/tls.pem'] and result.stdout == b'out'
+    assert ssh.address == 'pihole.lan'
+    assert ssh.resolve('localhost') == 'pihole.lan' and ssh.resolve('10.0.0.1') == '10.0.0.1'
+
+    ssh.write('/etc/pihole/tls.pem', b'pem', 0o640, 'pihole')
+    assert mock_run.call_args.kwargs['input'] == b'pem'
+    assert mock_run.call_args.args[0][-1].endswith(" sh /etc/pihole/tls.pem 0640 pihole")
+
+    mock_run.return_value = subprocess.CompletedProcess([], 0, b'abc123  -\n-\n', b'')
+    assert ssh.digest(['/a', '/b']) == {'/a': 'abc123', '/b': None}
+
+    # Pipelines run on the host as a single shell command
+    commands = Pipeline(['openssl', 'pkcs12', '-export'], ['keytool', '-srckeystore', '/dev/stdin'], seekable=True)
+    result = ssh.run_pipeline(commands)
+    assert mock_run.call_args.args[0][-1] == ' '.join(['sh', '-c', shlex.quote(commands.script())])
+    assert result.args == commands.args
+
+
+@patch('subprocess.run')
+def test_ssh_transport_failures(mock_run):
+    """Test command failures are raised as usual, and an unreachable host fails every later use"""
+    ssh = SSHTransport('pihole.lan', control_dir='/run/certhook')
+    mock_run.return_value = subprocess.CompletedProcess([], 1, b'', b'no such service')
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        ssh.run(['service', 'missing', 'restart'])
+    assert excinfo.value.cmd == ['service', 'missing', 'restart']
+
+    mock_run.return_value = subprocess.CompletedProcess([], 255, b'', b'Connection refused')
+    with pytest.raises(TransportError, match='Connection refused'):
+        ssh.run(['true'])
+    calls = mock_run.call_count
+    with pytest.raises(TransportError):
+        ssh.run(['true'])
+    assert mock_run.call_count == calls
+
+
+@patch('subprocess.run')
+def test_connection_pool(mock_run):
+    """Test managers deploying to the same host share its transport until closed"""
+    assert transport.connect('localhost') is LOCAL
+    first = transport.connect('root@emby.lan')
+    assert transport.connect('root@emby.lan') is first
+    assert transport.connect('root@unifi.lan') is not first
+
+    transport.close_all()
+    assert any(call.args[0][-3:] == ['-O', 'exit', 'root@emby.lan'] for call in mock_run.call_args_list)
+    assert not os.path.exists(first.control_dir)
+    assert transport.connect('root@emby.lan') is not first
+    transport.close_all()
+
+
+def test_fan_out(test_certs: Path, tmp_path: Path):
+    """Test a batch deploys to several hosts at once, isolating a host that can't be reached"""
+    hosts = {name: stand_in(tmp_path / name, name) for name in ('media', 'dns', 'down')}
+    hosts['down'].error = TransportError('down: Connection refused')
+
+    class TestEmbyCertManager(EmbyCertManager):
+        live_root = str(test_certs.parent)
+
+    class TestPiHoleCertManager(PiHoleCertManager):
+        live_root = str(test_certs.parent)
+
+    jobs = [('emby@media', TestEmbyCertManager('example.com')),
+            ('pihole@dns', TestPiHoleCertManager('example.com')),
+            ('emby@down', TestEmbyCertManager('example.com'))]
+    for app, manager in jobs:
+        manager.transport = hosts[app.partition('@')[2]]
+    report = BatchRunner(max_workers=3).run(jobs)
+
+    assert [result.success for result in report.results] == [True, True, False]
+    assert isinstance(report.results[2].error, TransportError)
+
+    # Certificate files are uploaded, and the .p12 built by openssl on the host
+    media = hosts['media']
+    cert_dir = str(test_certs)
+    assert Path(media.path(f'{cert_dir}/privkey.pem')).read_bytes() == (test_certs / 'privkey.pem').read_bytes()
+    assert os.path.getsize(media.path(f'{cert_dir}/fullchain.p12'))
+    assert any(os.path.basename(cmd[0]) == 'openssl' for cmd in media.commands)
+    assert stub_log(media)[-1] == 'service emby-server restart'
+
+    # Pi-hole's combined file is built here and written on the host
+    dns = hosts['dns']
+    combined = Path(dns.path(f'{cert_dir}/pihole.pem'))
+    assert combined.read_bytes() == ((test_certs / 'fullchain.pem').read_bytes() + b'\n'
+                                     + (test_certs / 'privkey.pem').read_bytes())
+    assert stub_log(dns)[-1] == 'systemctl restart pihole-FTL'
+    assert not (test_certs / 'pihole.pem').exists()
+
+
+def test_host_recovers(test_certs: Path, tmp_path: Path):
+    """Test a pooled host that couldn't be reached in one batch is tried again in the next"""
+    host = stand_in(tmp_path / 'media', 'media')
+    transport.register(host)
+
+    class TestEmbyCertManager(EmbyCertManager):
+        live_root = str(test_certs.parent)
+
+    runner = BatchRunner()
+    try:
+        host.error = TransportError('media: Connection refused')
+        manager = TestEmbyCertManager('example.com')
+        manager.transport = transport.connect('media')
+        report = runner.run([('emby@media', manager)])
+        assert isinstance(report.results[0].error, TransportError)
+        assert host.error is None
+
+        manager = TestEmbyCertManager('example.com')
+        manager.transport = transport.connect('media')
+        report = runner.run([('emby@media', manager)])
+        assert report.results[0].success
+        assert stub_log(host)[-1] == 'service emby-server restart'
+    finally:
+        transport.close_all()
+
+
+def test_remote_state(tmp_path: Path):
+    """Test deployments to another host are checked against the files on that host"""
+    host = RootTransport(str(tmp_path / 'host'), 'host')
+    host.write('/etc/app/out.pem', b'artifact')
+    manager = MagicMock(inputs=[], artifacts=['/etc/app/out.pem'], cert_name='example.com', transport=host)
+
+    store = StateStore(str(tmp_path / 'state.json'))
+    store.record('emby@host', manager)
+    assert store.is_current('emby@host', manager)
+    host.write('/etc/app/out.pem', b'changed')
+    assert not store.is_current('emby@host', manager)
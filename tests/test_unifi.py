@@ -2,9 +2,14 @@
 Tests for the UnifiCertManager class
 """
 
+import logging
+import subprocess
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock
 from certhook import UnifiCertManager
+from certhook import keystore
+from certhook.ops import ImportKeystore
+from certhook.services import Restart
 
 
 @pytest.fixture
@@ -31,34 +36,36 @@ def test_cert_cmds(cert_name):
     manager = UnifiCertManager(cert_name=cert_name)
     manager.cert_cmds()
     
-    # Test openssl command
+    # Test openssl command, writing the .p12 to its output
     expected_cmd1 = [
         '/usr/bin/openssl', 'pkcs12', '-export',
         '-inkey', f'/etc/letsencrypt/live/{cert_name}/privkey.pem',
         '-in', f'/etc/letsencrypt/live/{cert_name}/fullchain.pem',
-        '-out', f'/etc/letsencrypt/live/{cert_name}/fullchain.p12',
         '-name', 'unifi', '-password', 'pass:unifi'
     ]
-    assert manager.cmds[0] == expected_cmd1
+    assert isinstance(manager.cmds[0], ImportKeystore)
+    assert manager.cmds[0].alias == 'unifi'
+    pipeline, = manager.cmds[0].commands()
+    assert pipeline.seekable
+    assert pipeline.commands[0] == expected_cmd1
 
-    # Test keytool command
+    # Test keytool command, reading the .p12 from its input
     expected_cmd2 = [
         '/usr/bin/keytool', '-importkeystore',
         '-deststorepass', 'aircontrolenterprise',
         '-destkeypass', 'aircontrolenterprise',
         '-destkeystore', '/data/unifi/data/keystore',
-        '-srckeystore', f'/etc/letsencrypt/live/{cert_name}/fullchain.p12',
+        '-srckeystore', '/dev/stdin',
         '-srcstoretype', 'PKCS12',
         '-srcstorepass', 'unifi', '-noprompt'
     ]
-    assert manager.cmds[1] == expected_cmd2
+    assert pipeline.commands[1] == expected_cmd2
 
     # Test service restart commands
-    assert manager.cmds[2] == ['/usr/sbin/service', 'unifi-core', 'restart']
-    assert manager.cmds[3] == ['/usr/sbin/service', 'unifi', 'restart']
+    assert manager.cmds[1:3] == [Restart('unifi-core'), Restart('unifi')]
 
 
-@patch('subprocess.run')
+@patch('certhook.output.run')
 def test_run_command(mock_run, cert_name):
     """Test command execution"""
     manager = UnifiCertManager(cert_name=cert_name)
@@ -70,26 +77,67 @@ def test_run_command(mock_run, cert_name):
     test_cmd = ['test', 'command']
     result = manager.run(test_cmd)
     
-    mock_run.assert_called_once_with(test_cmd, capture_output=True, check=True)
+    mock_run.assert_called_once_with(test_cmd, ANY, None, timeout=None)
     assert result == mock_process
 
 
-@patch('subprocess.run')
-def test_run_command_verbose(mock_run, cert_name):
-    """Test command execution with verbose output"""
+def test_run_command_verbose(caplog, cert_name):
+    """Test command output is logged a line at a time with verbose output"""
     manager = UnifiCertManager(cert_name=cert_name, verbose=True)
-    mock_process = MagicMock()
-    mock_process.stdout = b"test output"
-    mock_process.stderr = b"test error"
-    mock_process.args = ['test', 'command']
-    mock_run.return_value = mock_process
-    
-    test_cmd = ['test', 'command']
-    with patch('builtins.print') as mock_print:
-        result = manager.run(test_cmd)
-    
-    mock_run.assert_called_once_with(test_cmd, capture_output=True, check=True)
-    assert result == mock_process
-    mock_print.assert_any_call('command: test command')
-    mock_print.assert_any_call('stdout: test output')
-    mock_print.assert_any_call('stderr: test error')
+    with caplog.at_level(logging.INFO, logger='certhook'):
+        result = manager.run(['sh', '-c', 'echo test output; echo test error >&2'])
+
+    assert result.stdout == b'test output\n'
+    assert caplog.messages[0] == 'command: sh -c echo test output; echo test error >&2'
+    assert {(record.stream, record.message) for record in caplog.records[1:]} == {
+        ('stdout', 'test output'), ('stderr', 'test error')}
+
+
+@patch('certhook.output.run')
+def test_call_native(mock_run, test_certs, tmp_path):
+    """Test the keystore is written in-process, without openssl or keytool"""
+    class LocalUnifiCertManager(UnifiCertManager):
+        live_root = str(test_certs.parent)
+        keystore = str(tmp_path / 'keystore')
+
+    manager = LocalUnifiCertManager(cert_name=test_certs.name)
+    manager()
+
+    store = keystore.load(manager.keystore, 'aircontrolenterprise')
+    assert store.aliases() == ['unifi']
+    assert not (test_certs / 'fullchain.p12').exists()
+    # Restarting unifi-core cycles unifi too
+    assert [call.args[0] for call in mock_run.call_args_list] == [['/usr/sbin/service', 'unifi-core', 'restart']]
+
+
+@patch('certhook.output.run')
+@patch('subprocess.Popen')
+def test_call_without_native(mock_popen, mock_output_run, cert_name):
+    """Test openssl and keytool are used when native operations are disabled"""
+    mock_popen.return_value.communicate.return_value = (b'', b'')
+    mock_popen.return_value.returncode = 0
+    manager = UnifiCertManager(cert_name=cert_name, native=False)
+    manager()
+
+    # The conversion pipeline's stages run one after the other, restarts stream their output
+    assert [call.args[0][0] for call in mock_popen.call_args_list] == ['/usr/bin/openssl', '/usr/bin/keytool']
+    assert [call.args[0][0] for call in mock_output_run.call_args_list] == ['/usr/sbin/service']
+
+
+def test_call_without_native_streams(test_certs, tmp_path):
+    """Test openssl's .p12 reaches keytool as a regular file, without writing one to disk"""
+    received = tmp_path / 'received.p12'
+    keytool = tmp_path / 'keytool'
+    # Like keytool, refuse a keystore that isn't a regular, non-empty file
+    keytool.write_text(f'#!/bin/sh\ntest -f /dev/stdin && test -s /dev/stdin || exit 1\ncat /dev/stdin > {received}\n')
+    keytool.chmod(0o755)
+
+    class LocalUnifiCertManager(UnifiCertManager):
+        live_root = str(test_certs.parent)
+        programs = {'keytool': str(keytool), 'service': '/bin/true'}
+
+    before = set(test_certs.iterdir())
+    LocalUnifiCertManager(cert_name=test_certs.name, native=False)()
+
+    assert set(test_certs.iterdir()) == before
+    subprocess.run(['openssl', 'pkcs12', '-in', str(received), '-passin', 'pass:unifi', '-noout'], check=True)
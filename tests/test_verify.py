@@ -0,0 +1,137 @@
+"""
+Tests for checking services serve the deployed certificates.
+"""
+
+import asyncio
+import socket
+import ssl
+import threading
+import time
+from pathlib import Path
+import pytest
+from conftest import make_test_certs
+from certhook.base import BaseCertManager
+from certhook.verify import leaf_fingerprint, verify, verify_async
+
+
+def tls_context(cert_dir: Path) -> ssl.SSLContext:
+    """Server context serving a lineage's certificate"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(str(cert_dir / 'fullchain.pem'), str(cert_dir / 'privkey.pem'))
+    return context
+
+
+async def serve(context: ssl.SSLContext = None):
+    """Local server, speaking TLS with a context or accepting and staying silent without"""
+    async def handle(reader, writer):
+        await reader.read()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0, ssl=context)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def manager_for(live_root: Path, cert_name: str, ports: list) -> BaseCertManager:
+    """Manager whose endpoints are the given local ports"""
+    class TestCertManager(BaseCertManager):
+        pass
+
+    TestCertManager.live_root = str(live_root)
+    TestCertManager.endpoints = [('127.0.0.1', port) for port in ports]
+    return TestCertManager(cert_name)
+
+
+def test_leaf_fingerprint(test_certs: Path):
+    """Test the leaf is the first certificate of a chain"""
+    fingerprint = leaf_fingerprint(str(test_certs / 'cert.pem'))
+    assert leaf_fingerprint(str(test_certs / 'fullchain.pem')) == fingerprint
+    assert leaf_fingerprint(str(test_certs / 'ca-cert.pem')) != fingerprint
+    assert len(fingerprint.split(':')) == 32
+    with pytest.raises(ValueError):
+        leaf_fingerprint(str(test_certs / 'privkey.pem'))
+
+
+def test_verify(test_certs: Path, tmp_path: Path):
+    """Test matching, mismatched, silent and closed endpoints are each reported"""
+    live_root = test_certs.parent
+    stale = make_test_certs(tmp_path / 'stale', 'example.com')
+
+    async def run():
+        good, good_port = await serve(tls_context(test_certs))
+        old, old_port = await serve(tls_context(stale))
+        silent, silent_port = await serve()
+        closed, closed_port = await serve()
+        closed.close()
+        await closed.wait_closed()
+        manager = manager_for(live_root, 'example.com', [good_port, old_port, silent_port, closed_port])
+        try:
+            return await verify_async([('emby', manager)], timeout=0.5)
+        finally:
+            for server in (good, old, silent):
+                server.close()
+
+    report = asyncio.run(run())
+    good, old, silent, closed = report.results
+    assert good.success and good.served == good.expected
+    assert not old.success and old.error is None and old.served != old.expected
+    assert 'expected' in str(old)
+    assert isinstance(silent.error, TimeoutError)
+    assert isinstance(closed.error, ConnectionError)
+    assert len(report.failed) == 3
+    assert '4 endpoints: 1 verified, 3 failed' in report.summary()
+
+
+def test_verify_retries_restarting_service(test_certs: Path):
+    """Test an endpoint refusing connections is tried again until its service is back"""
+    async def run():
+        closed, port = await serve()
+        closed.close()
+        await closed.wait_closed()
+        check = asyncio.ensure_future(
+            verify_async([('emby', manager_for(test_certs.parent, 'example.com', [port]))], timeout=5))
+        # Restarted after the first connection is refused
+        await asyncio.sleep(0.3)
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', port,
+                                            ssl=tls_context(test_certs))
+        try:
+            return await check
+        finally:
+            server.close()
+
+    report = asyncio.run(run())
+    assert not report.failed
+    assert 0.3 <= report.results[0].duration < 5
+
+
+def test_verify_concurrent(test_certs: Path):
+    """Test many slow endpoints are checked at once, not one after another"""
+    context = tls_context(test_certs)
+
+    def slow_server(sock: socket.socket) -> None:
+        # Hold each connection before starting the handshake
+        with sock:
+            conn, _ = sock.accept()
+            time.sleep(0.2)
+            with context.wrap_socket(conn, server_side=True) as tls:
+                tls.recv(1)
+
+    ports = []
+    for _ in range(20):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen()
+        ports.append(sock.getsockname()[1])
+        threading.Thread(target=slow_server, args=(sock,), daemon=True).start()
+
+    report = verify([('emby', manager_for(test_certs.parent, 'example.com', ports))],
+                    max_connections=20)
+    assert not report.failed
+    assert report.wall_time < 2.0
+    assert all(result.duration >= 0.2 for result in report.results)
+
+
+def test_verify_missing_certificate(tmp_path: Path):
+    """Test a lineage without a certificate fails without connecting"""
+    report = verify([('emby', manager_for(tmp_path, 'missing.example.com', [1]))])
+    assert isinstance(report.results[0].error, FileNotFoundError)
+
@@ -0,0 +1,88 @@
+"""
+Tests for the inotify watcher.
+"""
+
+import os
+import threading
+import pytest
+from certhook.watch import Watcher
+
+
+@pytest.fixture
+def letsencrypt(tmp_path):
+    """Let's Encrypt style tree with one lineage, its live files linking into archive"""
+    for name in ('example.com',):
+        (tmp_path / 'archive' / name).mkdir(parents=True)
+        (tmp_path / 'live' / name).mkdir(parents=True)
+        (tmp_path / 'archive' / name / 'fullchain1.pem').write_text('chain')
+        (tmp_path / 'live' / name / 'fullchain.pem').symlink_to(tmp_path / 'archive' / name / 'fullchain1.pem')
+    return tmp_path
+
+
+@pytest.fixture
+def watcher(letsencrypt):
+    watcher = Watcher(str(letsencrypt / 'live'), debounce=0.1)
+    yield watcher
+    watcher.close()
+
+
+def renew(root, name, version):
+    """Write a new certificate version and repoint the live symlink, like certbot"""
+    archive = root / 'archive' / name / f'fullchain{version}.pem'
+    archive.write_text(f'chain {version}')
+    link = root / 'live' / name / 'fullchain.pem'
+    tmp_link = root / 'live' / name / 'fullchain.pem.new'
+    tmp_link.symlink_to(archive)
+    os.replace(tmp_link, link)
+
+
+def test_lineages_watched(watcher):
+    """Test existing lineages are watched"""
+    assert watcher.lineages == {'example.com'}
+
+
+def test_timeout_without_changes(watcher):
+    """Test waiting returns nothing once the timeout expires"""
+    assert watcher.wait(timeout=0.05) == set()
+
+
+def test_renewal_reported_once(watcher, letsencrypt):
+    """Test a renewal's writes are collected into a single change"""
+    renew(letsencrypt, 'example.com', 2)
+    assert watcher.wait(timeout=1) == {'example.com'}
+    assert watcher.wait(timeout=0.2) == set()
+
+
+def test_burst_debounced(watcher, letsencrypt):
+    """Test writes arriving within the debounce period are reported together"""
+    def writes():
+        for version in range(2, 5):
+            renew(letsencrypt, 'example.com', version)
+            threading.Event().wait(0.03)
+
+    thread = threading.Thread(target=writes)
+    thread.start()
+    assert watcher.wait(timeout=1) == {'example.com'}
+    thread.join()
+    assert watcher.wait(timeout=0.2) == set()
+
+
+def test_new_lineage(watcher, letsencrypt):
+    """Test lineages created after the watcher started are picked up"""
+    (letsencrypt / 'archive' / 'new.example.com').mkdir()
+    (letsencrypt / 'live' / 'new.example.com').mkdir()
+    assert watcher.wait(timeout=1) == {'new.example.com'}
+    assert watcher.lineages == {'example.com', 'new.example.com'}
+
+    renew(letsencrypt, 'new.example.com', 1)
+    assert watcher.wait(timeout=1) == {'new.example.com'}
+
+
+def test_deployed_files_ignored(watcher, letsencrypt):
+    """Test files written next to certbot's, as deployments do, aren't reported as renewals"""
+    live = letsencrypt / 'live' / 'example.com'
+    (live / '.pihole.pem.tmp').write_text('combined')
+    os.replace(live / '.pihole.pem.tmp', live / 'pihole.pem')
+    (live / 'fullchain.p12').write_text('p12')
+    os.chmod(live / 'fullchain.p12', 0o640)
+    assert watcher.wait(timeout=0.2) == set()
@@ -0,0 +1,68 @@
+"""
+Tests for the X.509 certificate parser, checked against openssl.
+"""
+
+import datetime
+import subprocess
+from pathlib import Path
+import pytest
+from certhook import asn1, x509
+
+
+def openssl_field(path: Path, *options: str) -> str:
+    """Value printed by ``openssl x509`` for a certificate"""
+    result = subprocess.run(['openssl', 'x509', '-in', str(path), '-noout', *options],
+                            check=True, capture_output=True, text=True)
+    return result.stdout.strip().partition('=')[2]
+
+
+def test_parse_rsa(test_certs: Path):
+    """Test the fields of an RSA certificate match openssl's"""
+    chain = x509.load(str(test_certs / 'fullchain.pem'))
+    assert len(chain) == 2
+    cert = chain[0]
+    assert cert.subject == 'CN=example.com'
+    assert cert.common_name == 'example.com'
+    assert cert.issuer == 'CN=Test CA'
+    assert cert.key_type == 'RSA-2048'
+    assert cert.sans == []
+    assert cert.fingerprint == openssl_field(test_certs / 'cert.pem', '-fingerprint', '-sha256')
+    assert cert.serial == int(openssl_field(test_certs / 'cert.pem', '-serial'), 16)
+    not_after = datetime.datetime.strptime(openssl_field(test_certs / 'cert.pem', '-enddate'),
+                                           '%b %d %H:%M:%S %Y %Z')
+    assert cert.not_after == not_after.replace(tzinfo=datetime.timezone.utc)
+    assert cert.not_before < cert.not_after
+
+
+def test_parse_ec_with_alt_names(tmp_path: Path):
+    """Test an EC certificate's curve and DNS and IP alternative names"""
+    subprocess.run([
+        'openssl', 'req', '-x509', '-nodes', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:P-384',
+        '-keyout', str(tmp_path / 'key.pem'), '-out', str(tmp_path / 'cert.pem'),
+        '-subj', '/C=CA/O=Example Org/CN=www.example.com', '-days', '10000',
+        '-addext', 'subjectAltName=DNS:www.example.com,DNS:example.com,IP:192.0.2.1,IP:2001:db8::1',
+    ], check=True, capture_output=True)
+    cert = x509.load(str(tmp_path / 'cert.pem'))[0]
+    assert cert.subject == 'C=CA, O=Example Org, CN=www.example.com'
+    assert cert.key_type == 'EC-P-384'
+    assert cert.sans == ['www.example.com', 'example.com', '192.0.2.1', '2001:db8::1']
+    # Dates from 2050 are encoded as GeneralizedTime
+    assert cert.not_after.year >= 2050
+    assert cert.as_dict()['not_after'] == cert.not_after.isoformat()
+
+
+def test_decode_time():
+    """Test two digit years fall within 1950-2049"""
+    assert x509.decode_time(asn1.UTC_TIME, b'491231235959Z').year == 2049
+    assert x509.decode_time(asn1.UTC_TIME, b'500101000000Z').year == 1950
+    assert x509.decode_time(asn1.GENERALIZED_TIME, b'20610101000000Z').year == 2061
+
+
+def test_invalid(tmp_path: Path):
+    """Test files without a valid certificate are rejected"""
+    empty = tmp_path / 'empty.pem'
+    empty.write_text('')
+    with pytest.raises(ValueError):
+        x509.load(str(empty))
+    with pytest.raises(ValueError):
+        x509.Certificate(asn1.sequence(asn1.integer(1)))